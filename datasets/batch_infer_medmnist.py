@@ -0,0 +1,258 @@
+"""
+MedMNIST离线批量推理
+直接从npz数组读取图像（不写PNG），组成多请求批次调用模型，结果逐批写入JSONL
+
+特性:
+- 按行读取npz数组，内存占用与数据集大小无关
+- 支持断点续跑：从输出文件中最后一条完成记录的下一个索引继续
+- 实时报告吞吐量（图片/秒）
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import zipfile
+import argparse
+
+import numpy as np
+
+from extract_sample_images import array_to_image, label_to_str
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "web_interface", "backend")
+
+DEFAULT_PROMPT = "请判断这张医学图像属于哪一类，并简要说明依据。"
+
+
+class NpzArrayReader:
+    """
+    按行读取npz中的单个数组，不把整个数组载入内存
+    
+    未压缩成员（np.savez）直接内存映射，支持随机访问；
+    压缩成员（np.savez_compressed）按顺序流式解压，跳过的行只解压不保留。
+    """
+    
+    def __init__(self, npz_path, key):
+        """
+        Args:
+            npz_path: npz文件路径
+            key: 数组名，例如 'train_images'
+        """
+        self.npz_path = npz_path
+        self._zip = zipfile.ZipFile(npz_path)
+        self._info = self._zip.getinfo(f"{key}.npy")
+        
+        # 读取npy头部：形状、数据类型、头部长度
+        with self._zip.open(self._info) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self._header_len = f.tell()
+        
+        if fortran_order:
+            raise ValueError(f"不支持Fortran顺序的数组: {key}")
+        
+        self.shape = shape
+        self.dtype = dtype
+        self.row_shape = shape[1:]
+        self.row_bytes = int(np.prod(self.row_shape)) * dtype.itemsize
+        
+        self._memmap = None
+        if self._info.compress_type == zipfile.ZIP_STORED:
+            self._memmap = np.memmap(
+                npz_path, dtype=dtype, mode='r',
+                offset=self._member_data_offset() + self._header_len, shape=shape
+            )
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def _member_data_offset(self):
+        """计算zip成员数据在文件中的起始偏移（需要读取本地文件头）"""
+        with open(self.npz_path, 'rb') as f:
+            f.seek(self._info.header_offset)
+            local_header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        return self._info.header_offset + 30 + name_len + extra_len
+    
+    def iter_rows(self, start=0):
+        """
+        从start开始逐行读取
+        
+        Yields:
+            (索引, 单行数组)
+        """
+        if self._memmap is not None:
+            for idx in range(start, len(self)):
+                yield idx, np.array(self._memmap[idx])
+            return
+        
+        with self._zip.open(self._info) as f:
+            f.read(self._header_len)
+            # 跳过已完成的行（分块读取，内存占用固定）
+            to_skip = start * self.row_bytes
+            while to_skip > 0:
+                skipped = len(f.read(min(to_skip, 64 * 1024 * 1024)))
+                if skipped == 0:
+                    return
+                to_skip -= skipped
+            for idx in range(start, len(self)):
+                data = f.read(self.row_bytes)
+                if len(data) < self.row_bytes:
+                    return
+                yield idx, np.frombuffer(data, dtype=self.dtype).reshape(self.row_shape)
+    
+    def close(self):
+        """关闭文件"""
+        self._memmap = None
+        self._zip.close()
+
+
+def find_resume_index(output_path):
+    """
+    读取已有输出，返回下一个待处理的索引
+    
+    崩溃时可能留下写了一半的最后一行，会被截断丢弃。
+    """
+    if not os.path.exists(output_path):
+        return 0
+    
+    next_index = 0
+    valid_bytes = 0
+    with open(output_path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            next_index = max(next_index, record["index"] + 1)
+            valid_bytes += len(line)
+    
+    if valid_bytes < os.path.getsize(output_path):
+        print(f"  注意: 截断输出文件末尾不完整的记录")
+        with open(output_path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return next_index
+
+
+def iter_batches(reader, labels, start, limit, batch_size):
+    """按批次产出 (索引列表, 图像列表, 标签列表)"""
+    indices, images, batch_labels = [], [], []
+    for idx, img_array in reader.iter_rows(start):
+        if limit is not None and idx >= limit:
+            break
+        img = array_to_image(img_array)
+        if img is None:
+            print(f"  警告: 图像 {idx} 的形状 {img_array.shape} 无法处理，跳过")
+            continue
+        indices.append(idx)
+        images.append(img)
+        batch_labels.append(label_to_str(labels[idx]) if labels is not None else None)
+        if len(indices) == batch_size:
+            yield indices, images, batch_labels
+            indices, images, batch_labels = [], [], []
+    if indices:
+        yield indices, images, batch_labels
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='MedMNIST离线批量推理')
+    parser.add_argument('--npz', type=str,
+                       default='datasets/medmnist_data/chestmnist.npz',
+                       help='npz文件路径 (默认: datasets/medmnist_data/chestmnist.npz)')
+    parser.add_argument('--split', type=str, default='test',
+                       choices=['train', 'val', 'test'],
+                       help='数据集分割类型 (默认: test)')
+    parser.add_argument('--output', type=str, default=None,
+                       help='输出JSONL文件 (默认: <数据集名>_<分割>_results.jsonl)')
+    parser.add_argument('--model', type=str,
+                       default=os.path.join(PROJECT_ROOT, 'models', 'Lingshu-7B'),
+                       help='模型路径')
+    parser.add_argument('--quantization', type=str, default='4bit',
+                       choices=['4bit', '8bit', 'standard', 'cpu'],
+                       help='量化模式 (默认: 4bit)')
+    parser.add_argument('--prompt', type=str, default=DEFAULT_PROMPT, help='每张图片的问题')
+    parser.add_argument('--batch-size', type=int, default=8, help='每批图片数 (默认: 8)')
+    parser.add_argument('--max-new-tokens', type=int, default=64, help='最大生成token数 (默认: 64)')
+    parser.add_argument('--limit', type=int, default=None, help='只处理索引小于该值的图片')
+    
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.npz):
+        print(f"错误: 文件不存在: {args.npz}")
+        return
+    
+    output_path = args.output or f"{os.path.splitext(os.path.basename(args.npz))[0]}_{args.split}_results.jsonl"
+    
+    reader = NpzArrayReader(args.npz, f'{args.split}_images')
+    labels_key = f'{args.split}_labels'
+    with np.load(args.npz) as data:
+        labels = data[labels_key] if labels_key in data.files else None
+    
+    start = find_resume_index(output_path)
+    total = min(len(reader), args.limit) if args.limit is not None else len(reader)
+    print(f"数据集: {args.npz} ({args.split}), 图像形状: {reader.shape}, 存储方式: {'内存映射' if reader._memmap is not None else '流式解压'}")
+    if start >= total:
+        print(f"✓ 已全部完成 ({total} 张)，输出: {output_path}")
+        return
+    if start > 0:
+        print(f"从索引 {start} 继续 (已完成 {start}/{total})")
+    print("-" * 50)
+    
+    sys.path.insert(0, BACKEND_DIR)
+    from model_manager import ModelManager
+    
+    manager = ModelManager(model_path=args.model, quantization=args.quantization)
+    if not manager.load_model():
+        print("✗ 模型加载失败")
+        return
+    
+    generation_config = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": False,
+        "repetition_penalty": 1.0
+    }
+    
+    processed = 0
+    start_time = time.perf_counter()
+    with open(output_path, 'a', encoding='utf-8') as out:
+        for indices, images, batch_labels in iter_batches(reader, labels, start, args.limit, args.batch_size):
+            result = manager.generate_batch(
+                [{"prompt": args.prompt, "images": [img]} for img in images],
+                generation_config
+            )
+            if not result["success"]:
+                print(f"✗ 批次 {indices[0]}-{indices[-1]} 失败: {result['error']}")
+                break
+            
+            for idx, label, response in zip(indices, batch_labels, result["responses"]):
+                out.write(json.dumps({
+                    "index": idx,
+                    "label": label,
+                    "prompt": args.prompt,
+                    "response": response
+                }, ensure_ascii=False) + "\n")
+            out.flush()
+            
+            processed += len(indices)
+            elapsed = time.perf_counter() - start_time
+            print(f"  ✓ [{indices[-1] + 1}/{total}] {processed / elapsed:.2f} 图片/秒")
+    
+    reader.close()
+    elapsed = time.perf_counter() - start_time
+    print("-" * 50)
+    print(f"✓ 本次处理 {processed} 张图片，用时 {elapsed:.1f} 秒，平均 {processed / elapsed if elapsed else 0:.2f} 图片/秒")
+    print(f"  输出文件: {output_path}")
+    print("=" * 50)
+    manager.unload_model()
+
+
+if __name__ == "__main__":
+    main()
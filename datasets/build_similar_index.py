@@ -0,0 +1,126 @@
+"""
+构建相似病例检索的参考集
+从MedMNIST的npz数组读取图像（不写PNG），用 Lingshu 视觉编码器计算图片向量，写入 Web 服务的相似检索索引
+
+特性:
+- 与 Web 服务共用索引目录（默认 config.SIMILAR_INDEX_DIR），/api/similar 可用 source=reference 只检索参考集
+- 条目键为 "<数据集名>/<分割>/<索引>"，已写入的条目直接跳过，中断后重新运行即可继续
+- 实时报告吞吐量（图片/秒）
+
+注意: 服务运行时会在退出前保存索引，请在服务停止时构建参考集，避免互相覆盖
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from batch_infer_medmnist import NpzArrayReader, iter_batches
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "web_interface", "backend")
+
+
+def main():
+    """主函数"""
+    sys.path.insert(0, BACKEND_DIR)
+    import config
+    from similar_index import SimilarIndex, INDEX_BACKENDS
+
+    parser = argparse.ArgumentParser(description='构建相似病例检索的参考集')
+    parser.add_argument('--npz', type=str,
+                       default='datasets/medmnist_data/chestmnist.npz',
+                       help='npz文件路径 (默认: datasets/medmnist_data/chestmnist.npz)')
+    parser.add_argument('--split', type=str, default='train',
+                       choices=['train', 'val', 'test'],
+                       help='数据集分割类型 (默认: train)')
+    parser.add_argument('--index-dir', type=str, default=config.SIMILAR_INDEX_DIR,
+                       help='索引目录 (默认: config.SIMILAR_INDEX_DIR)')
+    parser.add_argument('--backend', type=str, default=config.SIMILAR_INDEX_BACKEND,
+                       choices=list(INDEX_BACKENDS),
+                       help='近邻结构 (默认: config.SIMILAR_INDEX_BACKEND)')
+    parser.add_argument('--model', type=str,
+                       default=os.path.join(PROJECT_ROOT, 'models', 'Lingshu-7B'),
+                       help='模型路径')
+    parser.add_argument('--quantization', type=str, default='4bit',
+                       choices=['4bit', '8bit', 'standard', 'cpu'],
+                       help='量化模式 (默认: 4bit)')
+    parser.add_argument('--batch-size', type=int, default=32, help='每批读取的图片数 (默认: 32)')
+    parser.add_argument('--limit', type=int, default=None, help='只处理索引小于该值的图片')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.npz):
+        print(f"错误: 文件不存在: {args.npz}")
+        return
+
+    dataset = os.path.splitext(os.path.basename(args.npz))[0]
+    reader = NpzArrayReader(args.npz, f'{args.split}_images')
+    labels_key = f'{args.split}_labels'
+    with np.load(args.npz) as data:
+        labels = data[labels_key] if labels_key in data.files else None
+
+    index = SimilarIndex(
+        args.index_dir,
+        backend=args.backend,
+        m=config.SIMILAR_HNSW_M,
+        ef_construction=config.SIMILAR_HNSW_EF_CONSTRUCTION,
+        ef_search=config.SIMILAR_HNSW_EF_SEARCH,
+        save_every=config.SIMILAR_SAVE_EVERY
+    )
+    total = min(len(reader), args.limit) if args.limit is not None else len(reader)
+    done = sum(1 for idx in range(total) if index.contains(f"{dataset}/{args.split}/{idx}"))
+    print(f"数据集: {args.npz} ({args.split}), 图像形状: {reader.shape}, 索引: {args.index_dir} ({index.backend}, 已有 {len(index)} 条)")
+    if done >= total:
+        print(f"✓ 已全部写入 ({total} 张)")
+        return
+    if done > 0:
+        print(f"跳过已写入的 {done}/{total} 张")
+    print("-" * 50)
+
+    from model_manager import ModelManager
+
+    manager = ModelManager(model_path=args.model, quantization=args.quantization)
+    if not manager.load_model():
+        print("✗ 模型加载失败")
+        return
+
+    processed = 0
+    start_time = time.perf_counter()
+    try:
+        for indices, images, batch_labels in iter_batches(reader, labels, 0, args.limit, args.batch_size):
+            pending = [
+                (idx, img, label) for idx, img, label in zip(indices, images, batch_labels)
+                if not index.contains(f"{dataset}/{args.split}/{idx}")
+            ]
+            if not pending:
+                continue
+            vectors = manager.embed_images([img for _, img, _ in pending])
+            for (idx, _, label), vector in zip(pending, vectors):
+                index.add(f"{dataset}/{args.split}/{idx}", vector, {
+                    "source": "reference",
+                    "dataset": dataset,
+                    "split": args.split,
+                    "index": idx,
+                    "label": label
+                })
+
+            processed += len(pending)
+            elapsed = time.perf_counter() - start_time
+            print(f"  ✓ [{indices[-1] + 1}/{total}] {processed / elapsed:.2f} 图片/秒")
+    finally:
+        index.save()
+        reader.close()
+
+    elapsed = time.perf_counter() - start_time
+    print("-" * 50)
+    print(f"✓ 本次写入 {processed} 张图片，用时 {elapsed:.1f} 秒，平均 {processed / elapsed if elapsed else 0:.2f} 图片/秒")
+    print(f"  索引: {args.index_dir} (共 {len(index)} 条)")
+    print("=" * 50)
+    manager.unload_model()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,57 @@ import os
 import numpy as np
 from PIL import Image
 
+def array_to_image(img_array):
+    """
+    将MedMNIST的单张图像数组转换为PIL图像
+    
+    Args:
+        img_array: 图像数组，(H, W)、(H, W, C) 或 (C, H, W)
+        
+    Returns:
+        PIL图像；形状无法处理时返回None
+    """
+    # 处理不同的图像格式
+    # 如果是3D数组 (height, width, channels) 或 (channels, height, width)
+    if len(img_array.shape) == 3:
+        if img_array.shape[0] == 1 or img_array.shape[0] == 3:
+            # 通道在第一个维度 (C, H, W)
+            img_array = np.transpose(img_array, (1, 2, 0))
+        # 现在应该是 (H, W, C) 格式
+        if img_array.shape[2] == 1:
+            # 灰度图，去掉最后一个维度
+            img_array = img_array[:, :, 0]
+    
+    # 归一化到0-255范围（如果图像是float类型且在0-1范围）
+    if img_array.dtype == np.float32 or img_array.dtype == np.float64:
+        if img_array.max() <= 1.0:
+            img_array = (img_array * 255).astype(np.uint8)
+        else:
+            img_array = img_array.astype(np.uint8)
+    elif img_array.dtype != np.uint8:
+        # 确保是uint8类型
+        if img_array.max() > 255:
+            img_array = (img_array / img_array.max() * 255).astype(np.uint8)
+        else:
+            img_array = img_array.astype(np.uint8)
+    
+    # 转换为PIL Image
+    if len(img_array.shape) == 2:
+        # 灰度图
+        return Image.fromarray(img_array)
+    elif len(img_array.shape) == 3 and img_array.shape[2] == 3:
+        # RGB图
+        return Image.fromarray(img_array)
+    return None
+
+
+def label_to_str(label):
+    """将标签转换为字符串（多维标签用下划线连接）"""
+    if isinstance(label, np.ndarray):
+        return "_".join(map(str, label.flatten()))
+    return str(label)
+
+
 def extract_samples_from_npz(npz_path, output_dir, num_samples=10, split='train'):
     """
     从npz文件中提取示例图片
@@ -85,51 +136,16 @@ def extract_samples_from_npz(npz_path, output_dir, num_samples=10, split='train'
             # 获取图像
             img_array = images[idx]
             
-            # 处理不同的图像格式
-            # 如果是3D数组 (height, width, channels) 或 (channels, height, width)
-            if len(img_array.shape) == 3:
-                if img_array.shape[0] == 1 or img_array.shape[0] == 3:
-                    # 通道在第一个维度 (C, H, W)
-                    img_array = np.transpose(img_array, (1, 2, 0))
-                # 现在应该是 (H, W, C) 格式
-                if img_array.shape[2] == 1:
-                    # 灰度图，去掉最后一个维度
-                    img_array = img_array[:, :, 0]
-            
-            # 归一化到0-255范围（如果图像是float类型且在0-1范围）
-            if img_array.dtype == np.float32 or img_array.dtype == np.float64:
-                if img_array.max() <= 1.0:
-                    img_array = (img_array * 255).astype(np.uint8)
-                else:
-                    img_array = img_array.astype(np.uint8)
-            elif img_array.dtype != np.uint8:
-                # 确保是uint8类型
-                if img_array.max() > 255:
-                    img_array = (img_array / img_array.max() * 255).astype(np.uint8)
-                else:
-                    img_array = img_array.astype(np.uint8)
-            
             # 转换为PIL Image
-            if len(img_array.shape) == 2:
-                # 灰度图
-                img = Image.fromarray(img_array)
-            elif len(img_array.shape) == 3 and img_array.shape[2] == 3:
-                # RGB图
-                img = Image.fromarray(img_array)
-            else:
+            img = array_to_image(img_array)
+            if img is None:
                 print(f"  警告: 图像 {idx} 的形状 {img_array.shape} 无法处理，跳过")
                 continue
             
             # 保存图片
             label_info = ""
             if labels is not None:
-                label = labels[idx]
-                # 如果是多维标签，转换为字符串
-                if isinstance(label, np.ndarray):
-                    label_str = "_".join(map(str, label.flatten()))
-                else:
-                    label_str = str(label)
-                label_info = f"_label_{label_str}"
+                label_info = f"_label_{label_to_str(labels[idx])}"
             
             filename = f"sample_{idx:05d}{label_info}.png"
             filepath = os.path.join(output_dir, filename)
@@ -2,7 +2,7 @@
 Lingshu-7B Web 服务 - Flask应用主文件
 """
 
-from flask import Flask, request, jsonify, send_from_directory, session, Response, stream_with_context
+from flask import Flask, request, jsonify, send_from_directory, session, Response, stream_with_context, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import os
@@ -12,10 +12,33 @@ from pathlib import Path
 import uuid
 from datetime import datetime
 import json
-from threading import Semaphore
+import time
+import base64
+import atexit
+import hmac
+import socket
+from threading import Semaphore, Thread, Lock
 from functools import wraps
 
 from model_manager import ModelManager
+from stub_backend import StubModelManager
+from traffic_recorder import TrafficRecorder
+from tracing import Tracer
+from profiling import ProfilerCapture
+from dicom_loader import DicomLoader
+from series_loader import SeriesLoader
+from slide_loader import SlideLoader
+from upload_store import UploadStore, FileTooLargeError
+from stream_replay import StreamRegistry
+from similar_index import SimilarIndex, SimilarIndexer
+import dicom_loader
+import series_loader
+import slide_loader
+import upload_store
+import stream_replay
+import similar_index
+import tracing
+import profiling
 import config
 
 # 配置日志
@@ -36,7 +59,7 @@ app = Flask(
     static_url_path='/static',
     template_folder=FRONTEND_DIR
 )
-app.config['MAX_CONTENT_LENGTH'] = config.MAX_FILE_SIZE
+app.config['MAX_CONTENT_LENGTH'] = max(config.MAX_FILE_SIZE, config.SLIDE_MAX_FILE_SIZE)  # 单个文件的上限在保存时检查
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
 app.config['SECRET_KEY'] = 'lingshu-7b-secret-key-' + str(uuid.uuid4())  # 用于session加密
 
@@ -50,8 +73,217 @@ model_manager = None
 # 格式: {session_id: [{"role": "user/assistant", "content": [...], "timestamp": ...}, ...]}
 conversation_sessions = {}
 
-# 并发控制信号量
+# 并发控制信号量（Flask 和 ASGI 服务共用，通过 acquire_request_slot / release_request_slot 获取和释放）
 request_semaphore = Semaphore(config.MAX_CONCURRENT_REQUESTS)
+# 正在处理的请求数（/api/status 的 active_requests，路由器按此均衡新会话）
+inflight_lock = Lock()
+inflight_requests = 0
+
+# 流量录制器（可选，用于离线回放）
+traffic_recorder = TrafficRecorder(
+    record_dir=config.TRAFFIC_RECORD_DIR,
+    record_prompts=config.TRAFFIC_RECORD_PROMPTS,
+    store_images=config.TRAFFIC_RECORD_IMAGES,
+    max_bytes=config.TRAFFIC_RECORD_MAX_BYTES,
+    max_files=config.TRAFFIC_RECORD_MAX_FILES,
+    session_salt=config.TRAFFIC_SESSION_SALT
+) if config.TRAFFIC_RECORDING else None
+
+# 录制流量的接口
+RECORDED_ENDPOINTS = ('chat', 'chat_stream')
+
+# 请求追踪（按采样率）
+tracer = Tracer(
+    sample_rate=config.TRACE_SAMPLE_RATE,
+    trace_dir=config.TRACE_DIR,
+    max_in_memory=config.TRACE_MAX_IN_MEMORY
+)
+
+
+# 按需性能剖析（管理员接口触发，未抓取时无额外开销）
+profiling.capture = ProfilerCapture(config.PROFILE_DIR, max_seconds=config.PROFILE_MAX_SECONDS)
+
+# DICOM 加载器（渲染结果和头信息缓存，模型管理器、假后端和流量录制共用）
+dicom_loader.loader = DicomLoader(
+    max_size=config.IMAGE_COMPRESSION_MAX_SIZE,
+    max_pixels=config.MAX_PIXELS,
+    header_cache_size=config.DICOM_HEADER_CACHE_SIZE,
+    image_cache_size=config.DICOM_IMAGE_CACHE_SIZE
+)
+
+# CT/MR序列加载器（采样结果按上传文件缓存，清除会话时释放）
+series_loader.loader = SeriesLoader(
+    sampling=config.SERIES_SAMPLING,
+    token_budget=config.SERIES_TOKEN_BUDGET,
+    frame_max_size=config.SERIES_FRAME_MAX_SIZE,
+    max_pixels=config.MAX_PIXELS,
+    min_frames=config.SERIES_MIN_FRAMES,
+    max_frames=config.SERIES_MAX_FRAMES,
+    max_slices=config.SERIES_MAX_SLICES,
+    cache_size=config.SERIES_CACHE_SIZE
+)
+
+# 内容寻址上传存储（按内容哈希去重，按会话引用计数，上传时记录一次尺寸和视觉token数清单）
+upload_store.store = UploadStore(
+    config.UPLOAD_FOLDER,
+    instance_id=config.UPLOAD_INSTANCE_ID or f"{socket.gethostname()}-{config.FLASK_PORT}",
+    max_size=config.IMAGE_COMPRESSION_MAX_SIZE,
+    max_pixels=config.MAX_PIXELS
+)
+
+# 全切片/超大图片加载器（按块读取金字塔层，可附带高倍视野）
+slide_loader.loader = SlideLoader(
+    max_size=config.IMAGE_COMPRESSION_MAX_SIZE,
+    max_pixels=config.MAX_PIXELS,
+    min_pixels=config.SLIDE_MIN_PIXELS,
+    max_decode_pixels=config.SLIDE_MAX_DECODE_PIXELS,
+    read_tile=config.SLIDE_READ_TILE,
+    tile_count=config.SLIDE_TILE_COUNT,
+    tile_size=config.SLIDE_TILE_SIZE,
+    tile_downsample=config.SLIDE_TILE_DOWNSAMPLE,
+    cache_size=config.SLIDE_CACHE_SIZE
+)
+
+# 可续传流式回复的重放缓冲区（断线后按 Last-Event-ID 续传）
+stream_replay.registry = StreamRegistry(
+    max_events=config.STREAM_REPLAY_MAX_EVENTS,
+    grace_seconds=config.STREAM_REPLAY_GRACE_SECONDS
+)
+
+# 相似病例检索索引（参考集由 datasets/build_similar_index.py 写入；开启 SIMILAR_INDEX_UPLOADS 时
+# 上传图片由后台线程计算向量写入，文件的最后一个引用释放时删除）
+if config.SIMILAR_INDEX_ENABLED:
+    similar_index.index = SimilarIndex(
+        config.SIMILAR_INDEX_DIR,
+        backend=config.SIMILAR_INDEX_BACKEND,
+        m=config.SIMILAR_HNSW_M,
+        ef_construction=config.SIMILAR_HNSW_EF_CONSTRUCTION,
+        ef_search=config.SIMILAR_HNSW_EF_SEARCH,
+        save_every=config.SIMILAR_SAVE_EVERY,
+        duplicate_threshold=config.SIMILAR_DUPLICATE_THRESHOLD
+    )
+    # 会话只在内存中，上次运行留下的上传条目已没有引用方
+    similar_index.index.purge("upload")
+    if config.SIMILAR_INDEX_UPLOADS:
+        similar_index.indexer = SimilarIndexer(similar_index.index, embed=lambda paths: embed_for_index(paths))
+        upload_store.store.on_delete = similar_index.indexer.forget
+    atexit.register(similar_index.index.save)  # 退出前保存未满 SIMILAR_SAVE_EVERY 条的插入
+
+# 内存记账与泄漏检测（空闲时清理并采集内存基线）
+memory_accountant = None
+if config.MEMORY_ACCOUNTING:
+    from memory_monitor import MemoryAccountant
+
+    memory_accountant = MemoryAccountant(
+        sessions_provider=lambda: conversation_sessions,
+        cleanup=lambda: model_manager.clear_cuda_cache() if model_manager else None,
+        upload_bytes=upload_store.store.owner_bytes,
+        idle_seconds=config.MEMORY_IDLE_SECONDS,
+        check_interval_s=config.MEMORY_CHECK_INTERVAL,
+        baseline_window=config.MEMORY_BASELINE_WINDOW,
+        min_samples=config.MEMORY_LEAK_MIN_SAMPLES,
+        rss_threshold_mb_per_hour=config.MEMORY_LEAK_RSS_MB_PER_HOUR,
+        device_threshold_mb_per_hour=config.MEMORY_LEAK_DEVICE_MB_PER_HOUR,
+        thread_tolerance=config.MEMORY_LEAK_THREAD_TOLERANCE,
+        thread_alert_samples=config.MEMORY_LEAK_THREAD_SAMPLES
+    )
+
+
+def admin_required(f):
+    """装饰器：校验 X-Admin-Token 请求头；未配置 ADMIN_TOKEN 时管理员接口一律拒绝"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not config.ADMIN_TOKEN:
+            return jsonify({
+                "success": False,
+                "error": "管理员接口未启用（未配置 ADMIN_TOKEN）"
+            }), 403
+        token = request.headers.get('X-Admin-Token') or ''
+        if not hmac.compare_digest(token.encode('utf-8'), config.ADMIN_TOKEN.encode('utf-8')):
+            return jsonify({
+                "success": False,
+                "error": "无权访问管理员接口"
+            }), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def traced(endpoint):
+    """装饰器：为请求分配request_id，并按采样率（或 X-Trace: 1 请求头）开启追踪"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.request_id = uuid.uuid4().hex
+            g.trace = tracer.start(endpoint, g.request_id, force=request.headers.get('X-Trace') == '1')
+            g.trace_deferred = False
+            # 会话ID确定后由接口写入 g.memory_record["session"]
+            g.memory_record = memory_accountant.begin(endpoint, request.form.get('session_id')) if memory_accountant else None
+            with tracing.activate(g.trace):
+                response = f(*args, **kwargs)
+            # 流式响应的追踪和内存记账在生成器结束时完成
+            if not g.trace_deferred:
+                tracer.finish(g.trace)
+                profiling.capture.request_finished()
+                if memory_accountant:
+                    memory_accountant.end(g.memory_record)
+            return response
+        return decorated_function
+    return decorator
+
+
+def stream_in_background(buffer, events, trace, memory_record=None):
+    """
+    后台生成线程：迭代期间激活追踪，把SSE事件写入续传缓冲区。客户端断开不影响生成，
+    用户停止生成（buffer.cancelled）时关闭事件生成器；结束时保存追踪并完成内存记账
+    """
+    def run():
+        try:
+            with tracing.activate(trace):
+                for payload in events:
+                    if buffer.cancelled.is_set():
+                        buffer.append(stream_replay.cancelled_payload(buffer.request_id))
+                        break
+                    buffer.append(payload)
+        finally:
+            events.close()
+            buffer.finish()
+            tracer.finish(trace)
+            profiling.capture.request_finished()
+            if memory_accountant:
+                memory_accountant.end(memory_record)
+    
+    Thread(target=run, name=f"stream-{buffer.request_id[:8]}", daemon=True).start()
+
+
+def traced_stream(buffer, last_event_id=0, trace=None):
+    """
+    读取续传缓冲区中断点之后的事件并发送（带事件ID），记录每个事件的发送耗时；
+    客户端断开只结束读取，生成在后台继续
+    """
+    for index, (event_id, payload) in enumerate(buffer.follow(last_event_id)):
+        event = stream_replay.format_event(event_id, payload)
+        start = time.perf_counter()
+        yield event
+        if trace is not None:
+            trace.add_span("send_event", start, time.perf_counter(), index=index, bytes=len(event))
+
+
+def acquire_request_slot(blocking=False):
+    """获取并发名额并计入正在处理的请求数"""
+    global inflight_requests
+    if not request_semaphore.acquire(blocking=blocking):
+        return False
+    with inflight_lock:
+        inflight_requests += 1
+    return True
+
+
+def release_request_slot():
+    """释放并发名额"""
+    global inflight_requests
+    with inflight_lock:
+        inflight_requests -= 1
+    request_semaphore.release()
 
 
 def with_concurrency_limit(f):
@@ -59,8 +291,10 @@ def with_concurrency_limit(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # 尝试获取信号量（非阻塞）
-        if not request_semaphore.acquire(blocking=False):
+        if not acquire_request_slot():
             logger.warning("服务器繁忙，拒绝新请求")
+            if request.endpoint in RECORDED_ENDPOINTS:
+                record_traffic(request.endpoint, request.form.get('session_id'), request.form.get('prompt', ''), 'busy')
             return jsonify({
                 "success": False,
                 "error": "服务器繁忙，请稍后重试"
@@ -69,17 +303,122 @@ def with_concurrency_limit(f):
         try:
             return f(*args, **kwargs)
         finally:
-            request_semaphore.release()
+            release_request_slot()
     
     return decorated_function
 
 
+def record_traffic(endpoint, session_id, prompt, outcome, image_paths=None, **fields):
+    """写入一条流量记录（未开启录制时不做任何事）"""
+    if traffic_recorder is None:
+        return
+    traffic_recorder.record(
+        endpoint=endpoint,
+        session_id=session_id,
+        prompt=prompt,
+        outcome=outcome,
+        images=traffic_recorder.describe_images(image_paths or []),
+        **fields
+    )
+
+
+def token_counts(stats):
+    """从生成统计（prefill、kv_cache）中提取预填充和生成token数"""
+    prefill, kv_cache = stats.get('prefill'), stats.get('kv_cache')
+    if not prefill or not kv_cache:
+        return None
+    return {"prompt": prefill["tokens"], "generated": kv_cache["tokens"] - prefill["tokens"]}
+
+
 def allowed_file(filename):
     """检查文件扩展名是否允许"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
 
 
+def save_uploaded_images(owner, files=None):
+    """
+    保存请求中上传的图片（表单字段 images）到内容寻址存储，重复上传的文件共用一份
+    
+    Args:
+        owner: 引用方（会话ID；打分等不保存会话的请求使用请求ID，用完后 release_owner）
+        files: 上传文件列表（默认取当前Flask请求的 images 字段；ASGI服务传入 Starlette 的 UploadFile）
+    
+    Returns:
+        保存后的图片路径列表；存在不支持的文件格式或文件过大时释放已保存的图片并返回None
+    """
+    image_paths = []
+    if files is None:
+        files = request.files.getlist('images') if 'images' in request.files else []
+    if files:
+        for file in files:
+            if file and file.filename:
+                if not allowed_file(file.filename):
+                    # 释放已保存的图片
+                    upload_store.store.release(image_paths, owner)
+                    return None
+                filename = secure_filename(file.filename)
+                # 切片文件放宽大小限制，其他文件仍受 MAX_FILE_SIZE 限制（写入时检查，超出立即中止）
+                max_size = config.SLIDE_MAX_FILE_SIZE if SlideLoader.is_slide_name(filename) else config.MAX_FILE_SIZE
+                stream = file.stream if hasattr(file, 'stream') else file.file
+                try:
+                    image_path = upload_store.store.put(stream, filename, owner, max_bytes=max_size)
+                except FileTooLargeError:
+                    logger.warning(f"文件过大: {filename}")
+                    upload_store.store.release(image_paths, owner)
+                    return None
+                image_paths.append(image_path)
+                logger.info(f"保存图片: {filename} -> {image_path}")
+    return image_paths
+
+
+def embed_images(paths):
+    """计算相似检索向量（假模型后端不支持）"""
+    if not model_manager or not model_manager.is_loaded() or not hasattr(model_manager, 'embed_images'):
+        raise RuntimeError("模型未加载或当前后端不支持图片向量")
+    return model_manager.embed_images(paths)
+
+
+def embed_for_index(paths):
+    """后台索引计算向量（与生成请求共用并发名额，等待空闲名额）"""
+    acquire_request_slot(blocking=True)
+    try:
+        return embed_images(paths)
+    finally:
+        release_request_slot()
+
+
+def index_uploads(image_paths):
+    """把上传的图片交给后台索引线程（已索引的内容直接跳过）"""
+    if similar_index.indexer is None or not image_paths:
+        return
+    if not model_manager or not model_manager.is_loaded():
+        return
+    items = []
+    for path in image_paths:
+        manifest = upload_store.manifest(path)
+        if manifest is not None:
+            items.append({
+                "key": manifest["sha256"],
+                "path": path,
+                "source": "upload",
+                "filename": manifest["filename"],
+                "kind": manifest["kind"]
+            })
+    similar_index.indexer.submit(items)
+
+
+def remove_files(paths):
+    """删除临时文件（压缩文件等），忽略不存在的文件"""
+    for temp_path in paths:
+        if os.path.exists(temp_path):
+            try:
+                os.remove(temp_path)
+                logger.info(f"删除临时文件: {temp_path}")
+            except Exception as e:
+                logger.warning(f"删除临时文件失败: {e}")
+
+
 @app.route('/')
 def index():
     """主页 - 返回前端页面"""
@@ -99,7 +438,13 @@ def get_status():
         status = {
             "service": "running",
             "model_loaded": model_manager is not None and model_manager.is_loaded(),
-            "quantization": config.DEFAULT_QUANTIZATION if model_manager else None
+            "backend": config.INFERENCE_BACKEND,
+            "quantization": model_manager.quantization if model_manager else None,
+            "engine_mode": model_manager.engine_mode if model_manager else None,
+            "kv_cache_quantization": model_manager.kv_cache_quantization if model_manager else None,
+            # 正在处理的请求数（路由器按此均衡新会话）
+            "active_requests": inflight_requests,
+            "sessions": len(conversation_sessions)
         }
         
         # 如果模型已加载，添加GPU信息
@@ -112,6 +457,35 @@ def get_status():
                 status["gpu_memory_reserved"] = f"{torch.cuda.memory_reserved(0) / 1024**3:.2f} GB"
             else:
                 status["gpu_available"] = False
+            
+            # chunked模式下的调度队列和视觉编码合批统计
+            if model_manager.scheduler is not None:
+                status["scheduler_pending"] = model_manager.scheduler.pending_count()
+                status["vision_encoder"] = dict(model_manager.scheduler.vision_stage.stats)
+            
+            # 多LoRA适配器的加载和淘汰统计
+            if getattr(model_manager, 'lora', None) is not None:
+                status["lora"] = model_manager.lora.status()
+            
+            # 增量聊天模板缓存命中统计
+            if getattr(model_manager, 'prompt_cache', None) is not None:
+                status["prompt_cache"] = model_manager.prompt_cache.status()
+        
+        # DICOM 解码和缓存命中统计
+        status["dicom"] = dicom_loader.loader.status()
+        status["series"] = series_loader.loader.status()
+        status["slides"] = slide_loader.loader.status()
+        status["uploads"] = upload_store.store.status()
+        status["streams"] = stream_replay.registry.status()
+        if similar_index.index is not None:
+            status["similar"] = {
+                **similar_index.index.status(),
+                "indexer": similar_index.indexer.status() if similar_index.indexer is not None else None
+            }
+        
+        # 请求内存记账、会话归因和空闲基线趋势
+        if memory_accountant:
+            status["memory"] = memory_accountant.status()
         
         return jsonify(status)
     except Exception as e:
@@ -119,6 +493,14 @@ def get_status():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文本格式的指标"""
+    if not memory_accountant:
+        return Response("", mimetype='text/plain; version=0.0.4')
+    return Response(memory_accountant.metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/load_model', methods=['POST'])
 def load_model():
     """加载模型"""
@@ -130,6 +512,17 @@ def load_model():
             logger.info("模型已加载，先卸载...")
             model_manager.unload_model()
         
+        # 假模型后端：不需要模型文件
+        if config.INFERENCE_BACKEND == "stub":
+            logger.info(f"使用假模型后端: {config.STUB_BACKEND_CONFIG}")
+            model_manager = StubModelManager(max_pixels=config.MAX_PIXELS, **config.STUB_BACKEND_CONFIG)
+            model_manager.load_model()
+            return jsonify({
+                "success": True,
+                "message": "假模型加载成功",
+                "quantization": "stub"
+            })
+        
         # 检查模型路径是否存在
         if not os.path.exists(config.MODEL_PATH):
             return jsonify({
@@ -143,7 +536,20 @@ def load_model():
         model_manager = ModelManager(
             model_path=config.MODEL_PATH,
             quantization=config.DEFAULT_QUANTIZATION,
-            max_pixels=config.MAX_PIXELS
+            max_pixels=config.MAX_PIXELS,
+            engine_mode=config.ENGINE_MODE,
+            static_cache_buckets=config.STATIC_CACHE_BUCKETS,
+            compile_cache_dir=config.COMPILE_CACHE_DIR,
+            kv_cache_quantization=config.KV_CACHE_QUANTIZATION,
+            kv_cache_residual_length=config.KV_CACHE_RESIDUAL_LENGTH,
+            prefill_chunk_size=config.PREFILL_CHUNK_SIZE,
+            vision_batch_max_patches=config.VISION_BATCH_MAX_PATCHES,
+            vision_batch_wait_ms=config.VISION_BATCH_WAIT_MS,
+            visual_token_pruning=config.VISUAL_TOKEN_PRUNING,
+            visual_token_keep_ratio=config.VISUAL_TOKEN_KEEP_RATIO,
+            lora_adapters=config.LORA_ADAPTERS,
+            lora_max_memory_mb=config.LORA_MAX_MEMORY_MB,
+            prompt_cache_sessions=config.PROMPT_CACHE_MAX_SESSIONS
         )
         
         # 加载模型
@@ -171,6 +577,7 @@ def load_model():
 
 
 @app.route('/api/chat', methods=['POST'])
+@traced('chat')
 @with_concurrency_limit
 def chat():
     """处理聊天请求（支持上下文记忆）"""
@@ -181,6 +588,8 @@ def chat():
         }), 400
     
     try:
+        request_start = time.perf_counter()
+        
         # 获取或创建会话ID
         session_id = request.form.get('session_id')
         if not session_id:
@@ -191,6 +600,8 @@ def chat():
         if session_id not in conversation_sessions:
             conversation_sessions[session_id] = []
             logger.info(f"初始化会话历史: {session_id}")
+        if g.memory_record is not None:
+            g.memory_record["session"] = session_id
         
         # 获取请求数据
         prompt = request.form.get('prompt', '').strip()
@@ -202,35 +613,19 @@ def chat():
             }), 400
         
         # 处理多张图片（如果有）
-        image_paths = []
-        if 'images' in request.files:
-            files = request.files.getlist('images')
-            for file in files:
-                if file and file.filename:
-                    if allowed_file(file.filename):
-                        # 保存文件
-                        filename = secure_filename(file.filename)
-                        # 添加时间戳避免文件名冲突
-                        import time
-                        timestamp = str(int(time.time() * 1000))
-                        base, ext = os.path.splitext(filename)
-                        filename = f"{base}_{timestamp}{ext}"
-                        image_path = os.path.join(config.UPLOAD_FOLDER, filename)
-                        file.save(image_path)
-                        image_paths.append(image_path)
-                        logger.info(f"保存图片: {image_path}")
-                    else:
-                        # 清理已保存的图片
-                        for path in image_paths:
-                            if os.path.exists(path):
-                                os.remove(path)
-                        return jsonify({
-                            "success": False,
-                            "error": "不支持的文件格式"
-                        }), 400
+        with tracing.span("upload_save"):
+            image_paths = save_uploaded_images(session_id)
+        if image_paths is None:
+            return jsonify({
+                "success": False,
+                "error": "不支持的文件格式或文件过大"
+            }), 400
+        upload_ms = (time.perf_counter() - request_start) * 1000
+        index_uploads(image_paths)  # 后台写入相似检索索引
         
         # 获取会话历史
         history = conversation_sessions[session_id]
+        history_len = len(history)
         
         # 生成回复（带历史记录）
         logger.info(f"处理请求 [会话:{session_id[:8]}]: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
@@ -238,7 +633,24 @@ def chat():
             prompt=prompt,
             image_paths=image_paths,  # 传递图片路径列表
             history=history,
-            generation_config=config.GENERATION_CONFIG
+            generation_config=config.GENERATION_CONFIG,
+            adapter=request.form.get('adapter') or None,  # LoRA适配器（可选）
+            session_id=session_id  # 增量聊天模板缓存按会话复用历史token
+        )
+        
+        record_traffic(
+            'chat', session_id, prompt,
+            'ok' if result.get('success') else 'error',
+            image_paths=image_paths,
+            history_len=history_len,
+            generation_config=result.get('generation_config'),
+            timings={
+                "upload_ms": upload_ms,
+                **result.get('timings', {}),
+                "total_ms": (time.perf_counter() - request_start) * 1000
+            },
+            tokens=token_counts(result),
+            error=result.get('error')
         )
         
         # 获取压缩文件路径
@@ -270,14 +682,19 @@ def chat():
             
             logger.info(f"对话已保存到历史 [会话:{session_id[:8]}], 当前消息数: {len(conversation_sessions[session_id])}")
         
+        # 请求ID可用于查询追踪 /api/trace/<request_id>
+        result['request_id'] = g.request_id
+        result['traced'] = g.trace is not None
+        
         # 清理上传的临时文件（只删除压缩文件，保留原始图片用于后续对话）
-        for temp_path in compressed_paths:
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                    logger.info(f"删除临时压缩文件: {temp_path}")
-                except Exception as e:
-                    logger.warning(f"删除临时文件失败: {e}")
+        with tracing.span("cleanup"):
+            for temp_path in compressed_paths:
+                if os.path.exists(temp_path):
+                    try:
+                        os.remove(temp_path)
+                        logger.info(f"删除临时压缩文件: {temp_path}")
+                    except Exception as e:
+                        logger.warning(f"删除临时文件失败: {e}")
         
         # 原始图片保留在会话中，等清理历史时一并删除
         if result.get('success'):
@@ -295,22 +712,26 @@ def chat():
 
 
 @app.route('/api/chat_stream', methods=['POST'])
+@traced('chat_stream')
 def chat_stream():
     """处理流式聊天请求（支持上下文记忆）"""
     # 尝试获取并发信号量
-    if not request_semaphore.acquire(blocking=False):
+    if not acquire_request_slot():
         logger.warning("服务器繁忙，拒绝流式请求")
+        record_traffic('chat_stream', request.form.get('session_id'), request.form.get('prompt', ''), 'busy')
         def error_gen():
             yield f"data: {json.dumps({'error': '服务器繁忙，请稍后重试'})}\n\n"
         return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
     
     if not model_manager or not model_manager.is_loaded():
-        request_semaphore.release()  # 释放信号量
+        release_request_slot()  # 释放信号量
         def error_gen():
             yield f"data: {json.dumps({'error': '模型未加载，请先加载模型'})}\n\n"
         return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
     
     try:
+        request_start = time.perf_counter()
+        
         # 获取或创建会话ID
         session_id = request.form.get('session_id')
         if not session_id:
@@ -321,48 +742,38 @@ def chat_stream():
         if session_id not in conversation_sessions:
             conversation_sessions[session_id] = []
             logger.info(f"初始化会话历史: {session_id}")
+        if g.memory_record is not None:
+            g.memory_record["session"] = session_id
         
         # 获取请求数据
         prompt = request.form.get('prompt', '').strip()
         
         if not prompt:
+            release_request_slot()
             def error_gen():
                 yield f"data: {json.dumps({'error': '请输入问题'})}\n\n"
             return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
         
         # 处理多张图片（如果有）
-        image_paths = []
-        if 'images' in request.files:
-            files = request.files.getlist('images')
-            for file in files:
-                if file and file.filename:
-                    if allowed_file(file.filename):
-                        # 保存文件
-                        filename = secure_filename(file.filename)
-                        # 添加时间戳避免文件名冲突
-                        import time
-                        timestamp = str(int(time.time() * 1000))
-                        base, ext = os.path.splitext(filename)
-                        filename = f"{base}_{timestamp}{ext}"
-                        image_path = os.path.join(config.UPLOAD_FOLDER, filename)
-                        file.save(image_path)
-                        image_paths.append(image_path)
-                        logger.info(f"保存图片: {image_path}")
-                    else:
-                        # 清理已保存的图片
-                        for path in image_paths:
-                            if os.path.exists(path):
-                                os.remove(path)
-                        def error_gen():
-                            yield f"data: {json.dumps({'error': '不支持的文件格式'})}\n\n"
-                        return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
+        with tracing.span("upload_save"):
+            image_paths = save_uploaded_images(session_id)
+        if image_paths is None:
+            release_request_slot()
+            def error_gen():
+                yield f"data: {json.dumps({'error': '不支持的文件格式或文件过大'})}\n\n"
+            return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
+        
+        upload_ms = (time.perf_counter() - request_start) * 1000
+        index_uploads(image_paths)  # 后台写入相似检索索引
         
         # 获取会话历史
         history = conversation_sessions[session_id]
+        history_len = len(history)
         
         # 获取生成配置
         config_str = request.form.get('config')
         generation_config = json.loads(config_str) if config_str else config.GENERATION_CONFIG
+        adapter = request.form.get('adapter') or None  # LoRA适配器（可选）
         
         # 保存用户消息（包含图片路径以便后续对话使用）
         user_message = {
@@ -378,30 +789,48 @@ def chat_stream():
         logger.info(f"处理流式请求 [会话:{session_id[:8]}]: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
         
         def generate():
-            """生成器函数，用于流式输出"""
+            """生成器函数，产出SSE事件内容（由后台线程写入续传缓冲区）"""
             # 用于接收压缩文件路径的容器
             compressed_paths = []
+            # 用于接收本次请求统计信息（KV缓存显存等）的容器
+            stats = {}
+            # 流量录制：用户停止生成时生成器被关闭，结果保持 aborted（客户端断开不影响生成）
+            outcome = 'aborted'
+            error = None
+            chunk_count = 0
+            ttft_ms = None
+            chunks = None
             
             try:
-                # 发送会话ID
-                yield f"data: {json.dumps({'session_id': session_id})}\n\n"
+                # 发送会话ID和请求ID（请求ID可用于查询追踪 /api/trace/<request_id>）
+                # 请求ID同时用于断线续传 /api/chat_stream/<request_id>
+                yield {'session_id': session_id, 'request_id': request_id, 'traced': trace is not None}
                 
                 full_response = ""
                 
-                # 流式生成回复（传递压缩路径容器）
-                for chunk in model_manager.generate_response_stream(
+                # 流式生成回复（传递压缩路径容器）；用户停止生成时在下一个token处停止
+                chunks = model_manager.generate_response_stream(
                     prompt=prompt,
                     image_paths=image_paths,  # 传递图片路径列表
                     history=history,
                     generation_config=generation_config,
-                    compressed_paths_container=compressed_paths  # 传递容器以接收压缩文件路径
-                ):
+                    compressed_paths_container=compressed_paths,  # 传递容器以接收压缩文件路径
+                    stats_container=stats,
+                    adapter=adapter,
+                    session_id=session_id,
+                    cancel_event=buffer.cancelled
+                )
+                for chunk in chunks:
                     full_response += chunk
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - request_start) * 1000
+                    chunk_count += 1
                     # 发送文本块
-                    yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+                    yield {'chunk': chunk}
                 
-                # 发送完成信号
-                yield f"data: {json.dumps({'done': True})}\n\n"
+                # 发送完成信号（附带KV缓存显存和预填充token统计）
+                yield {'done': True, **stats}
+                outcome = 'error' if full_response.startswith('[错误]') else 'ok'
                 
                 # 保存助手回复到历史
                 assistant_message = {
@@ -416,36 +845,308 @@ def chat_stream():
             except Exception as e:
                 logger.error(f"流式生成出错: {e}")
                 traceback.print_exc()
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                outcome = 'error'
+                error = str(e)
+                yield {'error': str(e)}
             finally:
+                # 先关闭模型的流式生成器（等待生成线程退出），再清理文件和释放并发名额
+                if chunks is not None:
+                    chunks.close()
+                record_traffic(
+                    'chat_stream', session_id, prompt, outcome,
+                    image_paths=image_paths,
+                    history_len=history_len,
+                    generation_config=stats.get('generation_config'),
+                    timings={
+                        "upload_ms": upload_ms,
+                        **stats.get('timings', {}),
+                        **({"ttft_ms": ttft_ms} if ttft_ms is not None else {}),
+                        "total_ms": (time.perf_counter() - request_start) * 1000
+                    },
+                    tokens=token_counts(stats),
+                    chunks=chunk_count,
+                    error=error
+                )
+                
                 # 清理上传的临时文件（只删除压缩文件，保留原始图片用于后续对话）
                 logger.info(f"开始清理临时文件，共{len(compressed_paths)}个压缩文件（保留{len(image_paths)}张原始图片）")
-                for temp_path in compressed_paths:
-                    if os.path.exists(temp_path):
-                        try:
-                            os.remove(temp_path)
-                            logger.info(f"删除临时压缩文件: {temp_path}")
-                        except Exception as e:
-                            logger.warning(f"删除临时文件失败: {e}")
+                with tracing.span("cleanup"):
+                    for temp_path in compressed_paths:
+                        if os.path.exists(temp_path):
+                            try:
+                                os.remove(temp_path)
+                                logger.info(f"删除临时压缩文件: {temp_path}")
+                            except Exception as e:
+                                logger.warning(f"删除临时文件失败: {e}")
                 
                 # 原始图片保留在会话中，等清理历史时一并删除
                 logger.info(f"保留{len(image_paths)}张原始图片用于后续对话")
                 
                 # 释放并发信号量
-                request_semaphore.release()
+                release_request_slot()
                 logger.info("已释放并发信号量")
         
-        return Response(stream_with_context(generate()), mimetype='text/event-stream')
+        request_id = g.request_id
+        trace = g.trace
+        g.trace_deferred = True
+        # 生成在后台线程中进行，事件写入续传缓冲区；本连接和断线重连都从缓冲区读取
+        buffer = stream_replay.registry.create(request_id, session_id)
+        stream_in_background(buffer, generate(), trace, g.memory_record)
+        return Response(stream_with_context(traced_stream(buffer, 0, trace)), mimetype='text/event-stream')
         
     except Exception as e:
         logger.error(f"处理流式聊天请求时出错: {e}")
         traceback.print_exc()
-        request_semaphore.release()  # 确保异常时也释放信号量
+        release_request_slot()  # 确保异常时也释放信号量
         def error_gen():
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
         return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
 
 
+@app.route('/api/chat_stream/<request_id>', methods=['GET'])
+def resume_chat_stream(request_id):
+    """断线续传：从 Last-Event-ID 请求头（或 last_event_id 参数）之后继续接收流式回复"""
+    buffer = stream_replay.registry.resume(request_id, request.args.get('session_id'))
+    if buffer is None:
+        return jsonify({
+            "success": False,
+            "error": "流式回复不存在或已过期"
+        }), 404
+    last_event_id = stream_replay.parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    )
+    return Response(stream_with_context(traced_stream(buffer, last_event_id)), mimetype='text/event-stream')
+
+
+@app.route('/api/chat_stream/<request_id>/cancel', methods=['POST'])
+def cancel_chat_stream(request_id):
+    """停止生成（断开连接不再中止生成，前端停止按钮调用此接口）"""
+    if not stream_replay.registry.cancel(request_id, request.args.get('session_id')):
+        return jsonify({
+            "success": False,
+            "error": "流式回复不存在或已过期"
+        }), 404
+    return jsonify({"success": True})
+
+
+@app.route('/api/score', methods=['POST'])
+@with_concurrency_limit
+def score():
+    """候选答案打分：一次预填充计算每个候选答案的对数概率（适合分类类问题）"""
+    if not model_manager or not model_manager.is_loaded():
+        return jsonify({
+            "success": False,
+            "error": "模型未加载，请先加载模型"
+        }), 400
+    
+    # 打分请求不保存会话，上传的图片由本次请求持有引用
+    upload_owner = f"score:{uuid.uuid4().hex}"
+    try:
+        prompt = request.form.get('prompt', '').strip()
+        if not prompt:
+            return jsonify({
+                "success": False,
+                "error": "请输入问题"
+            }), 400
+        
+        # 候选答案：JSON数组字符串，或多个同名表单字段
+        options_str = request.form.get('options', '')
+        if options_str.lstrip().startswith('['):
+            try:
+                options = json.loads(options_str)
+            except json.JSONDecodeError:
+                options = None
+        else:
+            options = request.form.getlist('options')
+        if not options or not all(isinstance(option, str) and option.strip() for option in options):
+            return jsonify({
+                "success": False,
+                "error": "请提供候选答案列表 options"
+            }), 400
+        if len(options) > config.MAX_SCORE_OPTIONS:
+            return jsonify({
+                "success": False,
+                "error": f"候选答案过多，最多 {config.MAX_SCORE_OPTIONS} 个"
+            }), 400
+        
+        image_paths = save_uploaded_images(upload_owner)
+        if image_paths is None:
+            return jsonify({
+                "success": False,
+                "error": "不支持的文件格式或文件过大"
+            }), 400
+        
+        logger.info(f"处理打分请求: {prompt[:50]}... (候选数: {len(options)}, 图片数: {len(image_paths)})")
+        result = model_manager.score_options(
+            prompt=prompt,
+            options=options,
+            image_paths=image_paths,
+            adapter=request.form.get('adapter') or None
+        )
+        remove_files(result.pop('compressed_paths', []))
+        
+        return jsonify(result), (200 if result.get('success') else 500)
+        
+    except Exception as e:
+        logger.error(f"处理打分请求时出错: {e}")
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+    finally:
+        # 打分请求不保存会话，释放上传图片的引用（其他会话仍在使用的文件保留）
+        upload_store.store.release_owner(upload_owner)
+
+
+@app.route('/api/similar', methods=['POST'])
+@with_concurrency_limit
+def similar():
+    """
+    相似病例检索：返回与上传图片（或本会话已上传图片的内容哈希）最相似的已索引图片；
+    上传来源的结果只包含本会话（session_id）上传的图片，查询图片本身不写入索引
+    """
+    if similar_index.index is None:
+        return jsonify({
+            "success": False,
+            "error": "相似检索未开启"
+        }), 400
+
+    # 查询图片不保存会话，上传的图片由本次请求持有引用
+    upload_owner = f"similar:{uuid.uuid4().hex}"
+    try:
+        try:
+            k = int(request.form.get('k', config.SIMILAR_TOP_K))
+        except ValueError:
+            k = config.SIMILAR_TOP_K
+        k = max(1, min(k, config.SIMILAR_MAX_K))
+        source = request.form.get('source') or None
+        if source not in (None, "upload", "reference"):
+            return jsonify({
+                "success": False,
+                "error": "source 只能是 upload 或 reference"
+            }), 400
+
+        # 本会话上传过的图片可以只传内容哈希，直接复用保存的向量
+        owned = upload_store.store.owned(request.form.get('session_id'))
+        key = request.form.get('sha256', '').strip().lower()
+        path = None
+        if key and key not in owned:
+            return jsonify({
+                "success": False,
+                "error": "索引中没有该图片，请上传图片"
+            }), 404
+        if not key:
+            image_paths = save_uploaded_images(upload_owner)
+            if image_paths is None:
+                return jsonify({
+                    "success": False,
+                    "error": "不支持的文件格式或文件过大"
+                }), 400
+            if len(image_paths) != 1:
+                return jsonify({
+                    "success": False,
+                    "error": "请上传一张图片（images）或提供已索引图片的 sha256"
+                }), 400
+            path = image_paths[0]
+            key = upload_store.store.sha_of(path)
+
+        embed_ms = 0.0
+        # 只复用本会话已有的向量（其他会话的图片不暴露是否已索引）
+        vector = similar_index.index.vector(key) if key in owned else None
+        if vector is None:
+            if path is None:
+                return jsonify({
+                    "success": False,
+                    "error": "索引中没有该图片，请上传图片"
+                }), 404
+            if not model_manager or not model_manager.is_loaded():
+                return jsonify({
+                    "success": False,
+                    "error": "模型未加载，请先加载模型"
+                }), 400
+            embed_start = time.perf_counter()
+            vector = embed_images([path])[0]
+            embed_ms = (time.perf_counter() - embed_start) * 1000
+
+        query_start = time.perf_counter()
+        neighbors = similar_index.index.query(
+            vector, k=k, source=source, exclude=[key],
+            allow=lambda item: item.get("source") != "upload" or item["key"] in owned
+        )
+        query_ms = (time.perf_counter() - query_start) * 1000
+        logger.info(f"🔎 相似检索: {key[:12]} -> {len(neighbors)} 条 (向量 {embed_ms:.0f}ms, 检索 {query_ms:.1f}ms)")
+
+        return jsonify({
+            "success": True,
+            "sha256": key,
+            "neighbors": neighbors,
+            "embed_ms": round(embed_ms, 1),
+            "query_ms": round(query_ms, 2),
+            "backend": similar_index.index.backend,
+            "indexed": len(similar_index.index)
+        })
+
+    except Exception as e:
+        logger.error(f"处理相似检索请求时出错: {e}")
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+    finally:
+        upload_store.store.release_owner(upload_owner)
+
+
+@app.route('/api/trace/<request_id>', methods=['GET'])
+def get_trace(request_id):
+    """获取单个请求的时间线追踪（Chrome Trace JSON，可在 chrome://tracing 或 Perfetto 中打开）"""
+    trace = tracer.get(request_id)
+    if trace is None:
+        return jsonify({
+            "success": False,
+            "error": "追踪不存在（请求未被采样或已过期）"
+        }), 404
+    response = jsonify(trace)
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename=trace_{request_id}.json'
+    return response
+
+
+@app.route('/api/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """开始性能抓取：接下来 requests 个请求或 seconds 秒（torch.profiler + Python采样剖析）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        capture = profiling.capture.arm(
+            model=getattr(model_manager, "model", None),
+            requests=data.get('requests'),
+            seconds=data.get('seconds'),
+            sampling_interval_ms=float(data.get('sampling_interval_ms', 5.0)),
+            record_shapes=bool(data.get('record_shapes', True))
+        )
+        return jsonify({"success": True, "capture": capture})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+
+
+@app.route('/api/admin/profile', methods=['GET'])
+@admin_required
+def profile_status():
+    """性能抓取状态和最近的抓取记录"""
+    return jsonify({"success": True, **profiling.capture.status()})
+
+
+@app.route('/api/admin/profile/<capture_id>/<filename>', methods=['GET'])
+@admin_required
+def download_profile(capture_id, filename):
+    """下载抓取产物（torch_trace.json, operators.txt, python_stacks.collapsed, summary.json）"""
+    return send_from_directory(profiling.capture.artifact_dir(capture_id), filename, as_attachment=True)
+
+
 @app.route('/api/clear_history', methods=['POST'])
 def clear_history():
     """清除对话历史"""
@@ -456,20 +1157,19 @@ def clear_history():
         if session_id:
             # 清除特定会话的历史
             if session_id in conversation_sessions:
-                # 清理会话相关的图片文件
-                image_count = 0
-                for msg in conversation_sessions[session_id]:
-                    if msg.get('role') == 'user' and msg.get('image_paths'):
-                        for img_path in msg['image_paths']:
-                            if os.path.exists(img_path):
-                                try:
-                                    os.remove(img_path)
-                                    image_count += 1
-                                    logger.info(f"清理会话图片: {img_path}")
-                                except Exception as e:
-                                    logger.warning(f"清理图片失败: {e}")
+                # 释放会话对图片的引用（其他会话仍在使用的文件保留）
+                image_count = upload_store.store.release_owner(session_id)
                 
+                session_paths = [
+                    img_path for msg in conversation_sessions[session_id] for img_path in msg.get('image_paths', [])
+                ]
+                series_loader.loader.forget(session_paths)
+                slide_loader.loader.forget(session_paths)
+                if getattr(model_manager, 'prompt_cache', None) is not None:
+                    model_manager.prompt_cache.forget(session_id)
                 del conversation_sessions[session_id]
+                if memory_accountant:
+                    memory_accountant.forget_session(session_id)
                 logger.info(f"已清除会话历史: {session_id[:8]}, 删除了{image_count}张图片")
                 return jsonify({
                     "success": True,
@@ -482,20 +1182,15 @@ def clear_history():
                 })
         else:
             # 清除所有会话历史
-            image_count = 0
-            for sid, messages in conversation_sessions.items():
-                for msg in messages:
-                    if msg.get('role') == 'user' and msg.get('image_paths'):
-                        for img_path in msg['image_paths']:
-                            if os.path.exists(img_path):
-                                try:
-                                    os.remove(img_path)
-                                    image_count += 1
-                                    logger.info(f"清理会话图片: {img_path}")
-                                except Exception as e:
-                                    logger.warning(f"清理图片失败: {e}")
+            image_count = sum(upload_store.store.release_owner(sid) for sid in list(conversation_sessions))
             
             conversation_sessions.clear()
+            series_loader.loader.forget()
+            slide_loader.loader.forget()
+            if getattr(model_manager, 'prompt_cache', None) is not None:
+                model_manager.prompt_cache.forget()
+            if memory_accountant:
+                memory_accountant.forget_session()
             logger.info(f"已清除所有会话历史，删除了{image_count}张图片")
             return jsonify({
                 "success": True,
@@ -510,6 +1205,94 @@ def clear_history():
         }), 500
 
 
+@app.route('/api/sessions', methods=['GET'])
+@admin_required
+def list_sessions():
+    """列出本实例上的会话（路由器迁移会话时使用）"""
+    return jsonify({
+        "success": True,
+        "sessions": [
+            {"session_id": sid, "messages": len(messages)}
+            for sid, messages in list(conversation_sessions.items())
+        ]
+    })
+
+
+@app.route('/api/session/<session_id>/export', methods=['GET'])
+@admin_required
+def export_session(session_id):
+    """导出会话历史和会话图片（图片以base64内嵌），用于迁移到其他实例"""
+    if session_id not in conversation_sessions:
+        return jsonify({
+            "success": False,
+            "error": "会话不存在"
+        }), 404
+    
+    messages = []
+    images = {}
+    for msg in conversation_sessions[session_id]:
+        msg = dict(msg)
+        names = []
+        for img_path in msg.pop('image_paths', []):
+            name = os.path.basename(img_path)
+            if name not in images and os.path.exists(img_path):
+                with open(img_path, 'rb') as f:
+                    images[name] = base64.b64encode(f.read()).decode('ascii')
+            names.append(name)
+        if names:
+            msg['image_files'] = names
+        messages.append(msg)
+    
+    return jsonify({
+        "success": True,
+        "session_id": session_id,
+        "messages": messages,
+        "images": images
+    })
+
+
+@app.route('/api/session/import', methods=['POST'])
+@admin_required
+def import_session():
+    """导入 export_session 导出的会话（已存在的同名会话会被替换）"""
+    try:
+        data = request.get_json()
+        session_id = data['session_id']
+        
+        # 替换同名会话时先释放旧会话的图片引用
+        if session_id in conversation_sessions:
+            upload_store.store.release_owner(session_id)
+        
+        # 图片写入本实例的内容寻址存储（本实例已有的相同图片直接复用）
+        decoded = {name: base64.b64decode(encoded) for name, encoded in data.get('images', {}).items()}
+        
+        messages = []
+        for msg in data.get('messages', []):
+            msg = dict(msg)
+            names = msg.pop('image_files', [])
+            if msg.get('role') == 'user':
+                # 每次出现都增加一次引用，与会话中的图片路径一一对应
+                msg['image_paths'] = [
+                    upload_store.store.put_bytes(decoded[name], secure_filename(name), session_id)
+                    for name in names if name in decoded
+                ]
+            messages.append(msg)
+        
+        conversation_sessions[session_id] = messages
+        logger.info(f"已导入会话: {session_id[:8]}, 消息数: {len(messages)}, 图片数: {len(decoded)}")
+        return jsonify({
+            "success": True,
+            "session_id": session_id,
+            "messages": len(messages)
+        })
+    except Exception as e:
+        logger.error(f"导入会话失败: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+
 @app.route('/api/unload_model', methods=['POST'])
 def unload_model():
     """卸载模型"""
@@ -548,7 +1331,7 @@ def request_entity_too_large(error):
     """处理文件过大错误"""
     return jsonify({
         "success": False,
-        "error": f"文件过大，最大允许 {config.MAX_FILE_SIZE / 1024 / 1024:.0f}MB"
+        "error": f"文件过大，最大允许 {config.MAX_FILE_SIZE / 1024 / 1024:.0f}MB（切片文件 {config.SLIDE_MAX_FILE_SIZE / 1024 / 1024:.0f}MB）"
     }), 413
 
 
@@ -556,14 +1339,24 @@ if __name__ == '__main__':
     logger.info("=" * 60)
     logger.info("Lingshu-7B Web 服务")
     logger.info("=" * 60)
+    logger.info(f"推理后端: {config.INFERENCE_BACKEND}")
     logger.info(f"模型路径: {config.MODEL_PATH}")
     logger.info(f"量化模式: {config.DEFAULT_QUANTIZATION}")
     logger.info(f"显存优化 - 最大像素: {config.MAX_PIXELS} (约{config.MAX_PIXELS/1e6:.1f}M)")
     logger.info(f"显存优化 - 图片压缩: {config.IMAGE_COMPRESSION_MAX_SIZE}px")
+    logger.info(f"推理引擎: {config.ENGINE_MODE}")
+    logger.info(f"KV缓存量化: {config.KV_CACHE_QUANTIZATION or '关闭'}")
     logger.info(f"上传文件夹: {config.UPLOAD_FOLDER}")
+    logger.info(f"内存泄漏检测: {'开启' if memory_accountant else '关闭'}")
+    if similar_index.index is not None:
+        logger.info(f"相似检索索引: {len(similar_index.index)} 条 ({similar_index.index.backend})")
     logger.info(f"服务地址: http://{config.FLASK_HOST}:{config.FLASK_PORT}")
     logger.info("=" * 60)
     
+    # 启动空闲内存基线检测线程
+    if memory_accountant:
+        memory_accountant.start()
+    
     # 启动Flask应用
     # 注意：禁用use_reloader，避免在加载大模型时自动重启服务
     app.run(
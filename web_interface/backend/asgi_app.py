@@ -0,0 +1,497 @@
+"""
+Lingshu-7B Web 服务 - 异步(ASGI)服务入口
+
+/api/chat 和 /api/chat_stream 在事件循环上处理：连接、上传解析和SSE发送都不占用线程，
+只有正在生成的请求占用生成线程池中的一个线程（最多 MAX_CONCURRENT_REQUESTS 个）。
+生成线程把文本块写入续传缓冲区（stream_replay），连接在事件循环上读取缓冲区；客户端断开后生成继续，
+重连 GET /api/chat_stream/<request_id>（带 Last-Event-ID）从断点续传，停止生成由 cancel 接口触发
+（chunked模式下会取消调度请求）。
+等待生成名额的请求在事件循环上排队，不占线程，超过 ASGI_MAX_PENDING_REQUESTS 时返回服务器繁忙。
+
+其余接口（静态文件、/api/status、模型加载等）由原 Flask 应用通过 WSGI 挂载提供，
+运行在独立的线程池中，不受长时间流式请求影响。会话历史、追踪、流量录制和内存记账与 Flask 服务共用。
+
+启动:
+    python asgi_app.py
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+依赖（可选，只有异步服务需要）: pip install starlette uvicorn python-multipart
+"""
+
+import json
+import time
+import uuid
+import asyncio
+import logging
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route, Mount
+except ImportError as e:
+    raise ImportError("异步服务需要 starlette: pip install starlette uvicorn python-multipart") from e
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import app as wsgi
+import config
+import tracing
+import profiling
+import stream_replay
+
+logger = logging.getLogger(__name__)
+
+# 生成线程池：与处理WSGI请求的线程池分开，长时间生成不会让静态文件和状态接口排队
+generation_executor = ThreadPoolExecutor(
+    max_workers=config.MAX_CONCURRENT_REQUESTS,
+    thread_name_prefix="asgi-generate"
+)
+
+# 生成名额（事件循环上等待，不占线程）
+generation_slots = asyncio.Semaphore(config.MAX_CONCURRENT_REQUESTS)
+pending_requests = 0
+active_generations = 0
+
+# 与客户端连接解耦的后台生成任务
+background_streams = set()
+
+# 等待与 Flask 接口共用的并发名额时的轮询间隔（秒）
+SHARED_SLOT_POLL_S = 0.02
+
+
+def sse(payload):
+    """格式化一条SSE事件（与 Flask 服务相同的格式）"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def error_stream(message):
+    async def events():
+        yield sse({'error': message})
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+class GenerationSlot:
+    """
+    等待生成名额：排队请求数超出上限时拒绝。排到后再获取与 Flask 接口（打分、相似检索等）共用的并发名额，
+    正在处理的请求数统一记在 app.inflight_requests（/api/status 的 active_requests）
+    """
+
+    def __init__(self):
+        self.acquired = False
+
+    async def __aenter__(self):
+        global pending_requests, active_generations
+        if pending_requests >= config.ASGI_MAX_PENDING_REQUESTS:
+            return self
+        pending_requests += 1
+        try:
+            await generation_slots.acquire()
+            try:
+                # 在事件循环上轮询，不占线程（获取名额本身不阻塞，取消等待不会泄漏名额）
+                while not wsgi.acquire_request_slot():
+                    await asyncio.sleep(SHARED_SLOT_POLL_S)
+            except BaseException:
+                generation_slots.release()
+                raise
+            self.acquired = True
+            active_generations += 1
+        finally:
+            pending_requests -= 1
+        return self
+
+    async def __aexit__(self, *exc):
+        global active_generations
+        if self.acquired:
+            active_generations -= 1
+            wsgi.release_request_slot()
+            generation_slots.release()
+        return False
+
+
+def produce_chunks(chunks, buffer, progress, trace, request_start):
+    """
+    生成线程：迭代模型的流式生成器，把文本块写入续传缓冲区
+
+    客户端断开不影响生成；用户停止生成（buffer.cancelled 被设置）时关闭生成器并退出
+    （chunked模式下会取消调度请求）。progress 记录已生成的回复、文本块数和首个文本块耗时。
+    """
+    with tracing.activate(trace):
+        try:
+            for chunk in chunks:
+                if buffer.cancelled.is_set():
+                    break
+                progress["response"] += chunk
+                if progress["ttft_ms"] is None:
+                    progress["ttft_ms"] = (time.perf_counter() - request_start) * 1000
+                progress["chunks"] += 1
+                buffer.append({'chunk': chunk})
+        finally:
+            chunks.close()
+
+
+async def replay_events(buffer, last_event_id=0):
+    """
+    读取续传缓冲区中断点之后的事件（带事件ID）；在事件循环上等待新事件，不占线程。
+    客户端断开只结束读取，生成在后台继续
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        loop.call_soon_threadsafe(wake.set)
+
+    buffer.add_listener(notify)
+    try:
+        while True:
+            wake.clear()
+            events, finished, lost = buffer.since(last_event_id)
+            if lost:
+                yield stream_replay.format_event(None, stream_replay.expired_payload(buffer.request_id))
+                return
+            for event_id, payload in events:
+                yield stream_replay.format_event(event_id, payload)
+                last_event_id = event_id
+            if finished:
+                return
+            if not events:
+                await wake.wait()
+    finally:
+        buffer.remove_listener(notify)
+
+
+async def parse_chat_form(request):
+    """
+    解析表单、获取或创建会话，并以会话为引用方保存上传图片（文件写入在线程池中进行）
+
+    Returns:
+        (表单, 会话ID, 图片路径列表或None)
+    """
+    form = await request.form()
+    session_id = open_session(form.get('session_id'))
+    image_paths = await asyncio.get_running_loop().run_in_executor(
+        None, wsgi.save_uploaded_images, session_id, form.getlist('images')
+    )
+    if image_paths:
+        wsgi.index_uploads(image_paths)  # 后台写入相似检索索引
+    return form, session_id, image_paths
+
+
+def open_session(session_id):
+    """获取或创建会话历史"""
+    if not session_id:
+        session_id = str(uuid.uuid4())
+        logger.info(f"创建新会话: {session_id}")
+    if session_id not in wsgi.conversation_sessions:
+        wsgi.conversation_sessions[session_id] = []
+        logger.info(f"初始化会话历史: {session_id}")
+    return session_id
+
+
+def finish_request(trace, memory_record):
+    """请求结束：保存追踪、统计性能抓取的请求数、完成内存记账"""
+    wsgi.tracer.finish(trace)
+    profiling.capture.request_finished()
+    if wsgi.memory_accountant:
+        wsgi.memory_accountant.end(memory_record)
+
+
+async def chat(request):
+    """处理聊天请求（与 Flask /api/chat 相同的请求和返回格式）"""
+    model_manager = wsgi.model_manager
+    if not model_manager or not model_manager.is_loaded():
+        return JSONResponse({"success": False, "error": "模型未加载，请先加载模型"}, status_code=400)
+
+    request_id = uuid.uuid4().hex
+    trace = wsgi.tracer.start('chat', request_id, force=request.headers.get('X-Trace') == '1')
+    memory_record = wsgi.memory_accountant.begin('chat') if wsgi.memory_accountant else None
+    request_start = time.perf_counter()
+    try:
+        # 先解析表单和保存上传（慢速上传不占生成名额），再等待名额
+        form, session_id, image_paths = await parse_chat_form(request)
+        if memory_record is not None:
+            memory_record["session"] = session_id
+        prompt = (form.get('prompt') or '').strip()
+        if not prompt:
+            wsgi.upload_store.store.release(image_paths or [], session_id)
+            return JSONResponse({"success": False, "error": "请输入问题"}, status_code=400)
+        if image_paths is None:
+            return JSONResponse({"success": False, "error": "不支持的文件格式或文件过大"}, status_code=400)
+        upload_ms = (time.perf_counter() - request_start) * 1000
+
+        async with GenerationSlot() as slot:
+            if not slot.acquired:
+                logger.warning("服务器繁忙，拒绝新请求")
+                wsgi.upload_store.store.release(image_paths, session_id)
+                return JSONResponse({"success": False, "error": "服务器繁忙，请稍后重试"}, status_code=429)
+            queue_wait_ms = (time.perf_counter() - request_start) * 1000 - upload_ms
+
+            history = wsgi.conversation_sessions[session_id]
+            history_len = len(history)
+            logger.info(f"处理请求 [会话:{session_id[:8]}]: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
+
+            def run():
+                with tracing.activate(trace):
+                    return model_manager.generate_response_with_history(
+                        prompt=prompt,
+                        image_paths=image_paths,
+                        history=history,
+                        generation_config=config.GENERATION_CONFIG,
+                        adapter=form.get('adapter') or None,
+                        session_id=session_id
+                    )
+
+            result = await asyncio.get_running_loop().run_in_executor(generation_executor, run)
+
+        wsgi.record_traffic(
+            'chat', session_id, prompt,
+            'ok' if result.get('success') else 'error',
+            image_paths=image_paths,
+            history_len=history_len,
+            generation_config=result.get('generation_config'),
+            timings={
+                "upload_ms": upload_ms,
+                "slot_wait_ms": queue_wait_ms,
+                **result.get('timings', {}),
+                "total_ms": (time.perf_counter() - request_start) * 1000
+            },
+            tokens=wsgi.token_counts(result),
+            error=result.get('error')
+        )
+
+        if result.get('success'):
+            wsgi.conversation_sessions[session_id].append({
+                "role": "user",
+                "content": prompt,
+                "has_images": len(image_paths) > 0,
+                "image_count": len(image_paths),
+                "image_paths": image_paths.copy(),
+                "timestamp": datetime.now().isoformat()
+            })
+            wsgi.conversation_sessions[session_id].append({
+                "role": "assistant",
+                "content": result['response'],
+                "timestamp": datetime.now().isoformat()
+            })
+            result['session_id'] = session_id
+            logger.info(f"对话已保存到历史 [会话:{session_id[:8]}], 当前消息数: {len(wsgi.conversation_sessions[session_id])}")
+
+        result['request_id'] = request_id
+        result['traced'] = trace is not None
+        with tracing.activate(trace), tracing.span("cleanup"):
+            wsgi.remove_files(result.get('compressed_paths', []) if result.get('success') else [])
+        return JSONResponse(result)
+
+    except Exception as e:
+        logger.error(f"处理聊天请求时出错: {e}")
+        traceback.print_exc()
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+    finally:
+        finish_request(trace, memory_record)
+
+
+async def chat_stream(request):
+    """处理流式聊天请求（与 Flask /api/chat_stream 相同的SSE事件格式）"""
+    model_manager = wsgi.model_manager
+    if not model_manager or not model_manager.is_loaded():
+        return error_stream('模型未加载，请先加载模型')
+    if pending_requests >= config.ASGI_MAX_PENDING_REQUESTS:
+        logger.warning("服务器繁忙，拒绝流式请求")
+        return error_stream('服务器繁忙，请稍后重试')
+
+    request_id = uuid.uuid4().hex
+    trace = wsgi.tracer.start('chat_stream', request_id, force=request.headers.get('X-Trace') == '1')
+    memory_record = wsgi.memory_accountant.begin('chat_stream') if wsgi.memory_accountant else None
+    request_start = time.perf_counter()
+
+    try:
+        form, session_id, image_paths = await parse_chat_form(request)
+    except Exception as e:
+        logger.error(f"处理流式聊天请求时出错: {e}")
+        finish_request(trace, memory_record)
+        return error_stream(str(e))
+
+    if memory_record is not None:
+        memory_record["session"] = session_id
+    prompt = (form.get('prompt') or '').strip()
+    if not prompt or image_paths is None:
+        wsgi.upload_store.store.release(image_paths or [], session_id)
+        finish_request(trace, memory_record)
+        return error_stream('请输入问题' if not prompt else '不支持的文件格式或文件过大')
+    upload_ms = (time.perf_counter() - request_start) * 1000
+
+    history = wsgi.conversation_sessions[session_id]
+    history_len = len(history)
+    config_str = form.get('config')
+    generation_config = json.loads(config_str) if config_str else config.GENERATION_CONFIG
+    adapter = form.get('adapter') or None
+
+    wsgi.conversation_sessions[session_id].append({
+        "role": "user",
+        "content": prompt,
+        "has_images": len(image_paths) > 0,
+        "image_count": len(image_paths),
+        "image_paths": image_paths.copy(),
+        "timestamp": datetime.now().isoformat()
+    })
+    logger.info(f"处理流式请求 [会话:{session_id[:8]}]: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
+
+    buffer = stream_replay.registry.create(request_id, session_id)
+
+    async def generate():
+        """后台生成任务：事件写入续传缓冲区，客户端断开后继续生成直到结束或被停止"""
+        compressed_paths = []
+        stats = {}
+        progress = {"response": "", "chunks": 0, "ttft_ms": None}
+        outcome = 'aborted'
+        error = None
+        slot_wait_ms = 0.0
+        producer = None
+        cancelled = False
+
+        try:
+            # 请求ID同时用于断线续传 /api/chat_stream/<request_id>
+            buffer.append({'session_id': session_id, 'request_id': request_id, 'traced': trace is not None})
+
+            async with GenerationSlot() as slot:
+                if not slot.acquired:
+                    outcome = 'busy'
+                    buffer.append({'error': '服务器繁忙，请稍后重试'})
+                    return
+                slot_wait_ms = (time.perf_counter() - request_start) * 1000 - upload_ms
+
+                chunks = model_manager.generate_response_stream(
+                    prompt=prompt,
+                    image_paths=image_paths,
+                    history=history,
+                    generation_config=generation_config,
+                    compressed_paths_container=compressed_paths,
+                    stats_container=stats,
+                    adapter=adapter,
+                    session_id=session_id,
+                    cancel_event=buffer.cancelled
+                )
+                producer = asyncio.get_running_loop().run_in_executor(
+                    generation_executor, produce_chunks, chunks, buffer, progress, trace, request_start
+                )
+                await producer
+
+            if buffer.cancelled.is_set():
+                cancelled = True
+                return
+            buffer.append({'done': True, **stats})
+            full_response = progress["response"]
+            outcome = 'error' if full_response.startswith('[错误]') else 'ok'
+            wsgi.conversation_sessions[session_id].append({
+                "role": "assistant",
+                "content": full_response,
+                "timestamp": datetime.now().isoformat()
+            })
+            logger.info(f"流式对话已保存 [会话:{session_id[:8]}], 当前消息数: {len(wsgi.conversation_sessions[session_id])}")
+
+        except Exception as e:
+            logger.error(f"流式生成出错: {e}")
+            traceback.print_exc()
+            outcome = 'error'
+            error = str(e)
+            buffer.append({'error': str(e)})
+        finally:
+            # 任务被取消（服务关闭）：通知生成线程停止，等待它关闭生成器后再清理文件
+            if producer is not None and not producer.done():
+                buffer.cancel()
+                cancelled = True
+                await asyncio.shield(producer)
+
+            wsgi.record_traffic(
+                'chat_stream', session_id, prompt, outcome,
+                image_paths=image_paths,
+                history_len=history_len,
+                generation_config=stats.get('generation_config'),
+                timings={
+                    "upload_ms": upload_ms,
+                    "slot_wait_ms": slot_wait_ms,
+                    **stats.get('timings', {}),
+                    **({"ttft_ms": progress["ttft_ms"]} if progress["ttft_ms"] is not None else {}),
+                    "total_ms": (time.perf_counter() - request_start) * 1000
+                },
+                tokens=wsgi.token_counts(stats),
+                chunks=progress["chunks"],
+                error=error
+            )
+            with tracing.activate(trace), tracing.span("cleanup"):
+                wsgi.remove_files(compressed_paths)
+            finish_request(trace, memory_record)
+            if cancelled:
+                buffer.append(stream_replay.cancelled_payload(buffer.request_id))
+            buffer.finish()
+
+    # 生成任务与本连接解耦（保留引用，避免任务被回收）
+    task = asyncio.create_task(generate())
+    background_streams.add(task)
+    task.add_done_callback(background_streams.discard)
+    return StreamingResponse(traced_events(replay_events(buffer), trace), media_type='text/event-stream')
+
+
+async def resume_chat_stream(request):
+    """断线续传（与 Flask /api/chat_stream/<request_id> 相同，在事件循环上等待新事件）"""
+    buffer = stream_replay.registry.resume(request.path_params['request_id'], request.query_params.get('session_id'))
+    if buffer is None:
+        return JSONResponse({"success": False, "error": "流式回复不存在或已过期"}, status_code=404)
+    last_event_id = stream_replay.parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+    )
+    return StreamingResponse(traced_events(replay_events(buffer, last_event_id), None), media_type='text/event-stream')
+
+
+async def traced_events(events, trace):
+    """记录每个SSE事件的发送耗时（含等待慢客户端的时间）"""
+    index = 0
+    async for event in events:
+        start = time.perf_counter()
+        yield event
+        if trace is not None:
+            trace.add_span("send_event", start, time.perf_counter(), index=index, bytes=len(event))
+        index += 1
+
+
+async def asgi_status(request):
+    """异步服务的排队和生成线程状态（其余状态见 /api/status）"""
+    return JSONResponse({
+        "pending_requests": pending_requests,
+        "max_pending_requests": config.ASGI_MAX_PENDING_REQUESTS,
+        "active_generations": active_generations,
+        "max_generations": config.MAX_CONCURRENT_REQUESTS,
+        "background_streams": len(background_streams)
+    })
+
+
+app = Starlette(routes=[
+    Route('/api/chat', chat, methods=['POST']),
+    Route('/api/chat_stream', chat_stream, methods=['POST']),
+    Route('/api/chat_stream/{request_id}', resume_chat_stream, methods=['GET']),
+    Route('/api/asgi_status', asgi_status, methods=['GET']),
+    # 其余接口和静态文件由 Flask 应用提供
+    Mount('/', app=WSGIMiddleware(wsgi.app)),
+])
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    logger.info("=" * 60)
+    logger.info("Lingshu-7B Web 服务（异步模式）")
+    logger.info("=" * 60)
+    logger.info(f"推理后端: {config.INFERENCE_BACKEND}")
+    logger.info(f"生成线程数: {config.MAX_CONCURRENT_REQUESTS}, 最大排队请求数: {config.ASGI_MAX_PENDING_REQUESTS}")
+    logger.info(f"服务地址: http://{config.FLASK_HOST}:{config.FLASK_PORT}")
+    logger.info("=" * 60)
+
+    if wsgi.memory_accountant:
+        wsgi.memory_accountant.start()
+
+    uvicorn.run(app, host=config.FLASK_HOST, port=config.FLASK_PORT)
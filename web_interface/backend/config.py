@@ -12,15 +12,73 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(BASE_DIR))
 MODEL_PATH = os.path.join(PROJECT_ROOT, "models", "Lingshu-7B")
 DEFAULT_QUANTIZATION = "4bit"  # 默认使用4bit量化
 
+# 推理后端
+# model: 真实模型（ModelManager）
+# stub: 确定性假模型（stub_backend.StubModelManager），不加载模型，用于测试HTTP层和容量规划
+INFERENCE_BACKEND = "model"
+STUB_BACKEND_CONFIG = {
+    "prefill_ms_per_token": 0.2,  # 每个文本token的预填充耗时（毫秒）
+    "prefill_ms_per_image_token": 0.5,  # 每个图片token的预填充耗时（毫秒）
+    "tokens_per_second": 30.0,  # 单请求解码速率
+    "load_time_s": 0.0,  # 模拟慢启动
+    "oom_probability": 0.0,  # 随机OOM概率
+    "oom_prompt_tokens": None,  # prompt token数超过该值时必定OOM
+    "parallelism": 1,  # 同时执行计算的请求数（1 = 单卡串行交替）
+}
+
 # 显存优化配置 - 针对8GB显存优化
 MAX_PIXELS = 1003520  # 约100万像素 (原始1280万 -> 100万，减少约12倍显存占用)
 IMAGE_COMPRESSION_MAX_SIZE = 1024  # 图片预处理最大边长（像素）
 
+# 推理引擎配置
+# eager: 默认动态KV缓存，逐token即时执行
+# static: 按长度分桶预分配静态KV缓存，每个分桶编译一次解码步骤（仅GPU，适合短回答的低延迟场景）
+# chunked: 分块预填充，大型多图prompt按块预填充并与其他请求的解码交替执行
+ENGINE_MODE = "eager"
+STATIC_CACHE_BUCKETS = [1024, 2048, 4096]  # 分桶长度 = prompt token数 + max_new_tokens，超出最大分桶时回退eager
+COMPILE_CACHE_DIR = os.path.join(PROJECT_ROOT, "web_interface", "compile_cache")  # 编译产物磁盘缓存，重启后复用
+PREFILL_CHUNK_SIZE = 512  # chunked模式下每个预填充块的token数（越小峰值显存越低，解码间隔越短）
+VISION_BATCH_MAX_PATCHES = 16384  # chunked模式下视觉编码批次的最大patch数（跨请求合批，限制编码器显存峰值）
+VISION_BATCH_WAIT_MS = 10  # 视觉编码批次收集窗口（毫秒），等待同时上传的其他请求一起编码
+
+# 视觉token剪枝（仅chunked模式生效）- 去掉医学图像中大面积均匀背景/边框的token
+VISUAL_TOKEN_PRUNING = "off"  # 可选: off(直通), variance(丢弃低方差token), merge(合并到最相似的保留token)
+VISUAL_TOKEN_KEEP_RATIO = 0.5  # 每张图片保留的token比例
+
+# KV缓存量化配置 - 长对话/多图场景节省KV缓存显存
+KV_CACHE_QUANTIZATION = None  # 可选: None(不量化), "int8"(HQQ后端), "int4"(quanto后端)
+KV_CACHE_RESIDUAL_LENGTH = 128  # 最近N个token保持全精度
+
 # 上传文件配置
 UPLOAD_FOLDER = os.path.join(PROJECT_ROOT, "web_interface", "uploads")
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+UPLOAD_INSTANCE_ID = None  # 对象目录的实例ID（多实例共享 UPLOAD_FOLDER 时必须各不相同），None表示 <主机名>-<端口>
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'dcm', 'dicom', 'zip', 'npy',
+                      'tif', 'tiff', 'svs', 'ndpi', 'scn', 'bif'}
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
 
+# DICOM 配置（需要 pydicom）- 按窗宽窗位渲染为对齐到模型网格的内存图片，不生成压缩文件
+DICOM_HEADER_CACHE_SIZE = 1024  # 缓存的头信息条数
+DICOM_IMAGE_CACHE_SIZE = 32  # 缓存的渲染结果数（多轮对话中的历史图片不重复解码）
+
+# CT/MR序列配置 - 多帧DICOM、切片压缩包(.zip)、体数据(.npy)采样为视频帧输入
+SERIES_SAMPLING = "uniform"  # 切片采样策略: uniform(等间隔), content(按相邻切片的内容变化量)
+SERIES_TOKEN_BUDGET = 2048  # 每个序列的视觉token预算（每2帧合并为一个时间patch）
+SERIES_FRAME_MAX_SIZE = 448  # 帧的最大边长（像素）
+SERIES_MIN_FRAMES = 4  # 预算不足时降低帧分辨率，保证至少采样的帧数
+SERIES_MAX_FRAMES = 64  # 采样帧数上限
+SERIES_MAX_SLICES = 2048  # 压缩包/体数据的切片数上限
+SERIES_CACHE_SIZE = 16  # 缓存的采样序列数（同一会话的后续提问不重新采样）
+
+# 全切片/超大显微图像配置（厂商格式需要 openslide）- 按块读取接近目标分辨率的金字塔层，内存由块大小决定
+SLIDE_MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 切片文件（.svs/.ndpi/.scn/.bif/.tif/.tiff）的上传大小上限
+SLIDE_MIN_PIXELS = 32 * 1024 * 1024  # 普通图片超过该像素数时按切片处理（不整张解码）
+SLIDE_MAX_DECODE_PIXELS = 64 * 1024 * 1024  # 无法按块读取时允许整层解码的像素数上限
+SLIDE_READ_TILE = 2048  # 按块读取的块边长（像素）
+SLIDE_TILE_COUNT = 0  # 额外输入的高倍视野数（按组织占比挑选，0表示只输入全貌图）
+SLIDE_TILE_SIZE = 896  # 高倍视野的边长（像素）
+SLIDE_TILE_DOWNSAMPLE = 4.0  # 高倍视野相对原始分辨率的降采样倍数
+SLIDE_CACHE_SIZE = 8  # 缓存的渲染结果数
+
 # 生成配置
 GENERATION_CONFIG = {
     "max_new_tokens": 512,
@@ -30,6 +88,68 @@ GENERATION_CONFIG = {
     "repetition_penalty": 1.1
 }
 
+# 候选答案打分配置（/api/score）
+MAX_SCORE_OPTIONS = 64  # 单次打分请求的最大候选答案数
+
+# 流量录制配置（离线回放用，默认关闭）- 每个请求写一条JSONL记录，可用 benchmarks/loadgen.py --replay 回放
+TRAFFIC_RECORDING = False
+TRAFFIC_RECORD_DIR = os.path.join(PROJECT_ROOT, "web_interface", "traffic")
+TRAFFIC_RECORD_PROMPTS = False  # 是否记录问题原文（涉及隐私，关闭时只记录字符数）
+TRAFFIC_RECORD_IMAGES = False  # 是否将上传图片保存到内容寻址存储（TRAFFIC_RECORD_DIR/images）
+TRAFFIC_RECORD_MAX_BYTES = 64 * 1024 * 1024  # 单个录制文件大小上限，超出后轮转
+TRAFFIC_RECORD_MAX_FILES = 30  # 保留的录制文件数
+TRAFFIC_SESSION_SALT = ""  # 会话ID哈希的盐值
+
+# 请求追踪配置 - 按采样率记录单个请求的时间线（Chrome Trace格式，可在 chrome://tracing 或 Perfetto 中打开）
+TRACE_SAMPLE_RATE = 0.0  # 采样率 [0, 1]，0 表示只追踪带 X-Trace: 1 请求头的请求
+TRACE_DIR = os.path.join(PROJECT_ROOT, "web_interface", "traces")  # 追踪JSON文件目录（None表示只保存在内存中）
+TRACE_MAX_IN_MEMORY = 200  # 内存中保留的最近追踪数（/api/trace/<request_id>）
+
+# 按需性能剖析（管理员接口 /api/admin/profile）
+PROFILE_DIR = os.path.join(PROJECT_ROOT, "web_interface", "profiles")  # 抓取产物目录
+PROFILE_MAX_SECONDS = 600  # 单次抓取的最长时长（秒）
+ADMIN_TOKEN = None  # 管理员接口令牌（请求头 X-Admin-Token），None表示停用管理员接口（会话导出/导入、性能抓取）
+
+# 内存记账与泄漏检测
+MEMORY_ACCOUNTING = True  # 记录每个请求的RSS/显存增量和显存峰值，并在空闲时采集内存基线
+MEMORY_IDLE_SECONDS = 60  # 最后一个请求结束多久后视为空闲（秒）
+MEMORY_CHECK_INTERVAL = 30  # 泄漏检测线程的检查间隔（秒）
+MEMORY_BASELINE_WINDOW = 48  # 用于拟合增长趋势的最近空闲基线数
+MEMORY_LEAK_MIN_SAMPLES = 6  # 至少多少个基线后才判断是否泄漏
+MEMORY_LEAK_RSS_MB_PER_HOUR = 50  # RSS基线增长告警阈值（MB/小时）
+MEMORY_LEAK_DEVICE_MB_PER_HOUR = 50  # 显存基线增长告警阈值（MB/小时）
+MEMORY_LEAK_THREAD_TOLERANCE = 8  # 空闲线程数超过窗口内最小值多少个才算增长（调度、流式等线程会正常增减）
+MEMORY_LEAK_THREAD_SAMPLES = 3  # 连续多少个基线线程数增长才告警
+
+# 多实例会话亲和路由器（python router.py）
+ROUTER_REPLICAS = []  # 后端实例地址，如 ["http://10.0.0.1:5000", "http://10.0.0.2:5000"]
+ROUTER_PORT = 5080  # 路由器端口
+ROUTER_VIRTUAL_NODES = 64  # 一致性哈希环上每个实例的虚拟节点数
+ROUTER_HEALTH_INTERVAL = 5  # 健康检查间隔（秒）
+ROUTER_DRAIN_TIMEOUT = 120  # 移除实例时等待进行中请求结束的最长时间（秒）
+
+# 多LoRA适配器（需要 peft），请求通过 adapter 字段选择，不指定时使用基座模型
+LORA_ADAPTERS = {}  # {适配器名: 适配器目录}，如 {"dermatology": "/path/to/lora-derm"}
+LORA_MAX_MEMORY_MB = 512  # 已加载适配器的参数总量上限（MB），超出时按LRU淘汰
+
+# 增量聊天模板缓存 - 每个会话缓存已渲染历史消息的token id，新一轮只渲染和分词新增的消息
+PROMPT_CACHE_MAX_SESSIONS = 1024  # 缓存的会话数上限（LRU淘汰），0表示关闭（每轮整段渲染）
+
+# 相似病例检索（/api/similar）- 视觉编码器特征取平均作为图片向量，HNSW近邻图需要 hnswlib（没有时暴力检索）
+# 参考集用 datasets/build_similar_index.py 从 MedMNIST 等数据集写入同一索引目录
+SIMILAR_INDEX_ENABLED = False  # 默认关闭，开启后 /api/similar 可检索参考集
+SIMILAR_INDEX_DIR = os.path.join(PROJECT_ROOT, "web_interface", "similar_index")  # 向量、HNSW图和条目元数据
+SIMILAR_INDEX_UPLOADS = False  # 聊天上传的图片在后台写入索引（每张图片多一次GPU前向，与生成共用并发名额；
+                               # 上传结果只返回给上传它的会话，文件的最后一个引用释放时删除条目）
+SIMILAR_INDEX_BACKEND = "auto"  # auto(有 hnswlib 时用HNSW), hnsw, flat(暴力检索)
+SIMILAR_HNSW_M = 16  # HNSW每个节点的邻居数
+SIMILAR_HNSW_EF_CONSTRUCTION = 200  # 建图时的候选列表长度
+SIMILAR_HNSW_EF_SEARCH = 64  # 查询时的候选列表长度（越大召回越高、越慢）
+SIMILAR_SAVE_EVERY = 32  # 每插入多少条自动保存一次
+SIMILAR_TOP_K = 5  # 默认返回条数
+SIMILAR_MAX_K = 50  # 单次查询返回条数上限
+SIMILAR_DUPLICATE_THRESHOLD = 0.98  # 相似度不低于该值时标记为近似重复
+
 # Flask配置
 FLASK_HOST = "0.0.0.0"
 FLASK_PORT = 5000
@@ -39,5 +159,12 @@ FLASK_DEBUG = True
 MAX_CONCURRENT_REQUESTS = 3  # 最大并发请求数（防止服务器过载）
 REQUEST_TIMEOUT = 300  # 请求超时时间（秒）
 
+# 异步服务配置（python asgi_app.py，需要 starlette、uvicorn、python-multipart）
+ASGI_MAX_PENDING_REQUESTS = 256  # 等待生成名额的请求上限（超出后返回服务器繁忙）
+
+# 可续传的流式回复 - 事件写入重放缓冲区，断线后带 Last-Event-ID 请求 /api/chat_stream/<request_id> 继续接收
+STREAM_REPLAY_MAX_EVENTS = 4096  # 每个流保留的最近事件数（断点早于保留窗口时无法续传）
+STREAM_REPLAY_GRACE_SECONDS = 120  # 生成结束后缓冲区保留多久供重连（秒）
+
 # 确保上传文件夹存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
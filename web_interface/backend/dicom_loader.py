@@ -0,0 +1,328 @@
+"""
+DICOM 加载器 - 直接读取放射科的 DICOM 文件，渲染为模型输入网格尺寸的内存图片
+
+- 像素数据用 NumPy 解码：未压缩的像素数据直接按行列步长取样（大帧只拷贝需要的像素），
+  压缩传输语法回退到 pydicom 的 pixel_array
+- 按标签做灰度转换：BitsStored 掩码/符号扩展 → RescaleSlope/Intercept → WindowCenter/WindowWidth
+  线性窗宽窗位（无窗标签时按 0.5%~99.5% 分位数自动取窗），MONOCHROME1 反相
+- 输出尺寸直接对齐到视觉编码器的 28x28 合并网格（不超过最大边长和 max_pixels），
+  后续 process_vision_info 和处理器的缩放都是恒等变换
+- 头信息和渲染结果按 (路径, 修改时间, 目标尺寸) 缓存，多轮对话中的历史图片不会重复解码
+
+依赖 pydicom（可选，只有上传 DICOM 时需要）: pip install pydicom
+"""
+
+import os
+import math
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+import numpy as np
+from PIL import Image
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+logger = logging.getLogger(__name__)
+
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+
+# Qwen2.5-VL 视觉编码器：14像素patch，2x2合并 -> 每个视觉token覆盖28x28像素
+GRID_FACTOR = 28
+
+# 无窗标签时自动取窗的分位数
+AUTO_WINDOW_PERCENTILES = (0.5, 99.5)
+
+
+def is_dicom(path) -> bool:
+    """按扩展名或文件头（128字节前导 + "DICM"）判断是否为 DICOM 文件"""
+    if not isinstance(path, str):
+        return False
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            return f.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+def grid_size(width: int, height: int, max_size: int, max_pixels: int) -> Tuple[int, int]:
+    """
+    计算对齐到28x28合并网格的目标尺寸（与 qwen_vl_utils.smart_resize 的取整方式一致）
+
+    Args:
+        width, height: 原始尺寸
+        max_size: 最大边长
+        max_pixels: 最大像素数
+
+    Returns:
+        (目标宽, 目标高)
+    """
+    scale = min(1.0, max_size / max(width, height))
+    w = max(GRID_FACTOR, round(width * scale / GRID_FACTOR) * GRID_FACTOR)
+    h = max(GRID_FACTOR, round(height * scale / GRID_FACTOR) * GRID_FACTOR)
+    if w * h > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        w = max(GRID_FACTOR, math.floor(width / beta / GRID_FACTOR) * GRID_FACTOR)
+        h = max(GRID_FACTOR, math.floor(height / beta / GRID_FACTOR) * GRID_FACTOR)
+    return w, h
+
+
+def _first(value, default=None):
+    """多值标签（如多个窗宽窗位预设）取第一个值"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return value[0] if len(value) else default
+    return value
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """读取渲染需要的头信息（不读取像素数据）"""
+    ds = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+    transfer_syntax = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+    center = _first(ds.get('WindowCenter'))
+    width = _first(ds.get('WindowWidth'))
+    return {
+        "rows": int(ds.Rows),
+        "columns": int(ds.Columns),
+        "frames": int(ds.get('NumberOfFrames') or 1),
+        "samples_per_pixel": int(ds.get('SamplesPerPixel') or 1),
+        "planar_configuration": int(ds.get('PlanarConfiguration') or 0),
+        "photometric": str(ds.get('PhotometricInterpretation') or 'MONOCHROME2'),
+        "bits_allocated": int(ds.get('BitsAllocated') or 16),
+        "bits_stored": int(ds.get('BitsStored') or ds.get('BitsAllocated') or 16),
+        "signed": int(ds.get('PixelRepresentation') or 0) == 1,
+        "rescale_slope": float(ds.get('RescaleSlope') or 1.0),
+        "rescale_intercept": float(ds.get('RescaleIntercept') or 0.0),
+        "window_center": float(center) if center is not None else None,
+        "window_width": float(width) if width is not None else None,
+        "transfer_syntax": str(transfer_syntax) if transfer_syntax else None,
+        "compressed": bool(transfer_syntax is not None and transfer_syntax.is_compressed),
+        "big_endian": bool(transfer_syntax is not None and not transfer_syntax.is_little_endian),
+        "modality": str(ds.get('Modality') or ''),
+        "series_description": str(ds.get('SeriesDescription') or ''),
+        "instance_number": int(ds.get('InstanceNumber') or 0),
+        "slice_location": float(ds.get('SliceLocation')) if ds.get('SliceLocation') is not None else None,
+        "series_uid": str(ds.get('SeriesInstanceUID') or ''),
+    }
+
+
+def _native_frame(ds, header: Dict[str, Any], frame: int, stride: int) -> Optional[np.ndarray]:
+    """
+    直接从未压缩的像素数据取一帧并按步长降采样（np.frombuffer 零拷贝，切片后只拷贝取样的像素）
+
+    Returns:
+        降采样后的像素数组；不支持的格式返回 None（由调用方回退到 pixel_array）
+    """
+    bits = header["bits_allocated"]
+    if header["compressed"] or bits not in (8, 16, 32):
+        return None
+    kind = 'i' if header["signed"] else 'u'
+    dtype = np.dtype(f"{'>' if header['big_endian'] else '<'}{kind}{bits // 8}")
+    rows, cols, spp = header["rows"], header["columns"], header["samples_per_pixel"]
+    frame_len = rows * cols * spp
+    data = np.frombuffer(ds.PixelData, dtype=dtype, count=frame_len, offset=frame * frame_len * dtype.itemsize)
+    if spp == 1:
+        return data.reshape(rows, cols)[::stride, ::stride].astype(dtype.newbyteorder('='))
+    if header["planar_configuration"] == 1:
+        planes = data.reshape(spp, rows, cols)[:, ::stride, ::stride]
+        return np.ascontiguousarray(planes.transpose(1, 2, 0)).astype(dtype.newbyteorder('='))
+    return data.reshape(rows, cols, spp)[::stride, ::stride].astype(dtype.newbyteorder('='))
+
+
+def _decoded_frame(ds, header: Dict[str, Any], frame: int, stride: int) -> np.ndarray:
+    """压缩传输语法：由 pydicom 解码整帧后按步长降采样"""
+    pixels = ds.pixel_array
+    if header["frames"] > 1:
+        pixels = pixels[frame]
+    pixels = pixels[::stride, ::stride]
+    if header["samples_per_pixel"] == 3 and header["photometric"].startswith('YBR'):
+        try:
+            from pydicom.pixels import convert_color_space
+        except ImportError:
+            from pydicom.pixel_data_handlers.util import convert_color_space
+        pixels = convert_color_space(pixels, header["photometric"], 'RGB')
+    return pixels
+
+
+def _mask_bits(pixels: np.ndarray, header: Dict[str, Any]) -> np.ndarray:
+    """BitsStored < BitsAllocated 时去掉高位（可能存放叠加层），有符号数做符号扩展"""
+    bits_stored, bits_allocated = header["bits_stored"], header["bits_allocated"]
+    if bits_stored >= bits_allocated or pixels.dtype.kind not in 'iu':
+        return pixels
+    if header["signed"]:
+        shift = pixels.dtype.itemsize * 8 - bits_stored
+        return (pixels << shift) >> shift
+    return pixels & ((1 << bits_stored) - 1)
+
+
+def window_to_uint8(values: np.ndarray, center: float, width: float) -> np.ndarray:
+    """DICOM 线性窗宽窗位（PS3.3 C.11.2.1.2），输出 0~255"""
+    width = max(width, 1.0)
+    scaled = (values - (center - 0.5)) / max(width - 1.0, 1.0) + 0.5
+    return (np.clip(scaled, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def render(ds, header: Dict[str, Any], target: Tuple[int, int], frame: Optional[int] = None,
+           window: Optional[Tuple[float, float]] = None) -> Image.Image:
+    """
+    渲染一帧为目标尺寸的 PIL 图片（灰度为 L 模式，彩色为 RGB 模式）
+
+    Args:
+        ds: 含像素数据的 pydicom Dataset
+        header: read_header 的结果
+        target: 目标尺寸 (宽, 高)
+        frame: 帧序号（默认取多帧文件的中间帧）
+        window: 覆盖标签中的窗位/窗宽 (center, width)
+    """
+    rows, cols = header["rows"], header["columns"]
+    if frame is None:
+        frame = header["frames"] // 2
+    # 步长取样后至少保留目标尺寸的2倍，再用面积平均缩小到目标尺寸，避免混叠
+    stride = max(1, min(rows // (2 * target[1]), cols // (2 * target[0])))
+
+    pixels = _native_frame(ds, header, frame, stride)
+    if pixels is None:
+        pixels = _decoded_frame(ds, header, frame, stride)
+    pixels = _mask_bits(pixels, header)
+
+    if header["samples_per_pixel"] == 1:
+        values = pixels.astype(np.float32)
+        if header["rescale_slope"] != 1.0 or header["rescale_intercept"] != 0.0:
+            values = values * header["rescale_slope"] + header["rescale_intercept"]
+        center, width = window or (header["window_center"], header["window_width"])
+        if center is None or width is None:
+            low, high = np.percentile(values, AUTO_WINDOW_PERCENTILES)
+            center, width = (low + high) / 2, max(high - low, 1.0) + 1.0
+        gray = window_to_uint8(values, center, width)
+        if header["photometric"] == 'MONOCHROME1':
+            gray = 255 - gray
+        image = Image.fromarray(gray, mode='L')
+    else:
+        if pixels.dtype != np.uint8:
+            # 高位深彩色图按 BitsStored 缩放到8位
+            pixels = (pixels.astype(np.float32) * (255.0 / ((1 << header["bits_stored"]) - 1))).astype(np.uint8)
+        image = Image.fromarray(np.ascontiguousarray(pixels[..., :3]), mode='RGB')
+
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.BOX if stride > 1 else Image.Resampling.LANCZOS)
+    return image
+
+
+class DicomLoader:
+    """DICOM 加载器（线程安全），头信息和渲染结果按文件修改时间失效"""
+
+    def __init__(self, max_size: int = 1024, max_pixels: int = 1003520,
+                 header_cache_size: int = 1024, image_cache_size: int = 32):
+        """
+        Args:
+            max_size: 渲染结果的最大边长
+            max_pixels: 渲染结果的最大像素数（与模型的 max_pixels 一致）
+            header_cache_size: 缓存的头信息条数
+            image_cache_size: 缓存的渲染结果数（灰度 1024x1024 约 1MB/张）
+        """
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.header_cache_size = header_cache_size
+        self.image_cache_size = image_cache_size
+        self.stats = {"decodes": 0, "image_hits": 0, "header_reads": 0, "header_hits": 0}
+        self._headers: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._images: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_key(path: str) -> tuple:
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def header(self, path: str) -> Dict[str, Any]:
+        """
+        读取（或从缓存取）头信息
+
+        Raises:
+            RuntimeError: 未安装 pydicom
+        """
+        if pydicom is None:
+            raise RuntimeError("读取DICOM需要 pydicom: pip install pydicom")
+        key = self._file_key(path)
+        with self._lock:
+            cached = self._headers.get(key)
+            if cached is not None:
+                self._headers.move_to_end(key)
+                self.stats["header_hits"] += 1
+                return cached
+        header = read_header(path)
+        with self._lock:
+            self._headers[key] = header
+            self.stats["header_reads"] += 1
+            while len(self._headers) > self.header_cache_size:
+                self._headers.popitem(last=False)
+        return header
+
+    def target_size(self, path: str, max_size: Optional[int] = None) -> Tuple[int, int]:
+        """渲染结果的尺寸（只读头信息）"""
+        header = self.header(path)
+        return grid_size(header["columns"], header["rows"], max_size or self.max_size, self.max_pixels)
+
+    def load(self, path: str, max_size: Optional[int] = None, frame: Optional[int] = None,
+             window: Optional[Tuple[float, float]] = None) -> Image.Image:
+        """
+        渲染 DICOM 为对齐到模型网格的内存图片（调用方不要原地修改返回的图片）
+
+        Args:
+            path: DICOM 文件路径
+            max_size: 最大边长（默认使用构造参数）
+            frame: 帧序号（默认取多帧文件的中间帧）
+            window: 覆盖标签中的窗位/窗宽 (center, width)
+        """
+        header = self.header(path)
+        target = grid_size(header["columns"], header["rows"], max_size or self.max_size, self.max_pixels)
+        key = self._file_key(path) + (target, frame, window)
+        with self._lock:
+            cached = self._images.get(key)
+            if cached is not None:
+                self._images.move_to_end(key)
+                self.stats["image_hits"] += 1
+                return cached
+
+        ds = pydicom.dcmread(path, force=True)
+        image = render(ds, header, target, frame=frame, window=window)
+        del ds
+        logger.info(
+            f"🩻 DICOM已解码: {os.path.basename(path)} {header['modality']} "
+            f"{header['columns']}x{header['rows']} → {image.size[0]}x{image.size[1]}"
+        )
+
+        with self._lock:
+            self._images[key] = image
+            self.stats["decodes"] += 1
+            while len(self._images) > self.image_cache_size:
+                self._images.popitem(last=False)
+        return image
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "available": pydicom is not None,
+                "cached_headers": len(self._headers),
+                "cached_images": len(self._images),
+                **self.stats
+            }
+
+
+# 全局加载器（app.py 按配置初始化，模型管理器、假后端和流量录制共用）
+loader = DicomLoader()
+
+
+def image_size(path: str) -> Tuple[int, int]:
+    """图片尺寸：DICOM 返回渲染后的尺寸（只读头信息），其他格式用 PIL 读取"""
+    if is_dicom(path):
+        return loader.target_size(path)
+    with Image.open(path) as img:
+        return img.size
@@ -0,0 +1,176 @@
+"""
+多LoRA适配器池 - 一个基座模型 + 多个科室适配器（皮肤科、病理、胸片等）
+
+- 适配器按需加载，按LRU在显存上限内淘汰（正在被请求使用的适配器不会被淘汰）
+- 每次前向通过 peft 的 adapter_names 指定每一行使用的适配器（"__base__" 表示基座模型），
+  不切换全局激活适配器，因此切换适配器没有额外开销，一个批次中的不同请求可以使用不同的适配器
+- peft 通过在LoRA层上临时注册钩子传递 adapter_names，钩子是模型级别的状态，
+  所以带适配器的前向由一把锁串行执行
+- 适配器只作用于语言模型，视觉编码器始终使用基座权重（加载时过滤掉 visual 下的目标模块），
+  这样视觉特征可以跨适配器共享，视觉编码阶段的批处理也不受影响
+
+依赖 peft（可选，只有配置了 LORA_ADAPTERS 时需要）: pip install peft
+"""
+
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Union
+
+try:
+    from peft import LoraConfig, get_peft_model, load_peft_weights, set_peft_model_state_dict
+except ImportError:
+    LoraConfig = None
+
+logger = logging.getLogger(__name__)
+
+# peft 混合批次中表示"不使用适配器"的名称
+BASE_ADAPTER = "__base__"
+
+
+def language_model_targets(target_modules) -> str:
+    """把适配器的目标模块转换为排除视觉编码器的正则（peft 对字符串形式的 target_modules 做全匹配）"""
+    if isinstance(target_modules, str):
+        return rf"^(?!.*visual\.)(?:{target_modules})$"
+    names = "|".join(re.escape(name) for name in target_modules)
+    return rf"^(?!.*visual\.)(?:.*\.)?(?:{names})$"
+
+
+class LoraAdapterPool:
+    """LoRA适配器池（线程安全）"""
+
+    def __init__(self, model, adapter_paths: Dict[str, str], max_memory_bytes: int = 512 * 1024 * 1024):
+        """
+        Args:
+            model: 已加载的基座模型（加载第一个适配器时被 peft 原地注入LoRA层）
+            adapter_paths: {适配器名: 适配器目录}
+            max_memory_bytes: 已加载适配器的参数总量上限，超出时按LRU淘汰
+        """
+        if LoraConfig is None:
+            raise RuntimeError("多LoRA适配器需要 peft: pip install peft")
+        self.model = model
+        self.adapter_paths = dict(adapter_paths)
+        self.max_memory_bytes = max_memory_bytes
+        self.peft_model = None
+        self.stats = {"loads": 0, "evictions": 0, "hits": 0}
+        self._loaded: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        """是否已有适配器注入模型（此后所有语言模型前向都要指定 adapter_names）"""
+        return self.peft_model is not None
+
+    def validate(self, adapter: Optional[str]):
+        """
+        Raises:
+            ValueError: 未配置的适配器名
+        """
+        if adapter and adapter not in self.adapter_paths:
+            raise ValueError(f"未知的适配器: {adapter}（可用: {', '.join(self.adapter_paths) or '无'}）")
+
+    def _load(self, name: str):
+        """加载一个适配器（调用方持有锁）"""
+        path = self.adapter_paths[name]
+        lora_config = LoraConfig.from_pretrained(path)
+        lora_config.target_modules = language_model_targets(lora_config.target_modules)
+        lora_config.inference_mode = True
+
+        if self.peft_model is None:
+            self.peft_model = get_peft_model(self.model, lora_config, adapter_name=name)
+        else:
+            self.peft_model.add_adapter(name, lora_config)
+        weights = load_peft_weights(path, device=str(self.model.device))
+        result = set_peft_model_state_dict(self.peft_model, weights, adapter_name=name)
+        unexpected = [k for k in getattr(result, "unexpected_keys", []) if "visual" not in k]
+        if unexpected:
+            logger.warning(f"⚠️ 适配器 {name} 有 {len(unexpected)} 个权重未匹配到模块: {unexpected[:3]}")
+
+        size = sum(
+            param.numel() * param.element_size()
+            for param_name, param in self.peft_model.named_parameters()
+            if "lora_" in param_name and f".{name}." in param_name
+        )
+        self._loaded[name] = size
+        self.stats["loads"] += 1
+        logger.info(f"🧩 已加载适配器 {name}: {os.path.basename(os.path.normpath(path))} ({size / 1024**2:.1f} MB)")
+        self._evict(keep=name)
+
+    def _evict(self, keep: str):
+        """按LRU淘汰未被使用的适配器，直到总量不超过上限"""
+        for name in list(self._loaded):
+            if sum(self._loaded.values()) <= self.max_memory_bytes:
+                return
+            if name == keep or self._pins.get(name):
+                continue
+            self.peft_model.delete_adapter(name)
+            del self._loaded[name]
+            self.stats["evictions"] += 1
+            logger.info(f"♻️ 淘汰适配器 {name}")
+        if sum(self._loaded.values()) > self.max_memory_bytes:
+            logger.warning("⚠️ 使用中的适配器总量超过显存上限")
+
+    def _ensure(self, name: str):
+        """确保适配器已加载，并标记为最近使用（调用方持有锁）"""
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            self.stats["hits"] += 1
+        else:
+            self._load(name)
+
+    def pin(self, adapter: Optional[str]):
+        """请求开始使用适配器（加载并防止被淘汰），与 unpin 成对调用"""
+        if not adapter:
+            return
+        self.validate(adapter)
+        with self._lock:
+            self._ensure(adapter)
+            self._pins[adapter] = self._pins.get(adapter, 0) + 1
+
+    def unpin(self, adapter: Optional[str]):
+        if not adapter:
+            return
+        with self._lock:
+            count = self._pins.get(adapter, 0) - 1
+            if count > 0:
+                self._pins[adapter] = count
+            else:
+                self._pins.pop(adapter, None)
+
+    @contextmanager
+    def use(self, adapters: Union[None, str, List[Optional[str]]], batch_size: int = 1):
+        """
+        在 with 块内，语言模型前向的每一行使用指定的适配器
+
+        Args:
+            adapters: 适配器名（所有行相同），或每一行的适配器名列表；None 表示基座模型
+            batch_size: 批大小（adapters 为单个名称时使用）
+        """
+        if not isinstance(adapters, list):
+            adapters = [adapters] * batch_size
+        names = [name or BASE_ADAPTER for name in adapters]
+        if not self.enabled and all(name == BASE_ADAPTER for name in names):
+            # 尚未注入任何适配器，直接使用基座模型
+            yield
+            return
+        for name in set(names) - {BASE_ADAPTER}:
+            self.validate(name)
+        with self._lock:
+            for name in set(names) - {BASE_ADAPTER}:
+                self._ensure(name)
+            with self.peft_model._enable_peft_forward_hooks(adapter_names=names):
+                yield
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "available": sorted(self.adapter_paths),
+                "loaded": {name: size for name, size in self._loaded.items()},
+                "memory_bytes": sum(self._loaded.values()),
+                "max_memory_bytes": self.max_memory_bytes,
+                **self.stats
+            }
@@ -0,0 +1,356 @@
+"""
+内存记账与泄漏检测
+
+- 每个请求记录主机常驻内存（RSS）增量、显存增量和显存峰值
+- 按会话归因：历史消息文本、保留的原始图片文件，以及该会话请求累计的RSS增量
+- 后台线程在服务空闲时执行清理（gc + 清空CUDA缓存），采集一次"空闲基线"
+  （RSS、已分配显存、线程数、存活的PIL图片数、会话数），
+  用最小二乘拟合最近若干个基线的增长斜率，超过阈值时告警；线程数在连续若干个基线中
+  都超过窗口内最小值加容差时告警（调度、流式、排空等线程正常增减不告警）
+- 会话的图片文件大小由上传存储按引用增减维护，状态接口不逐个 stat 文件
+
+显存峰值使用 torch.cuda.max_memory_allocated()，只在没有其他请求进行时重置，
+并发请求的峰值是重叠时段的共同峰值（记录中 overlapped=True）。
+"""
+
+import os
+import gc
+import sys
+import time
+import logging
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, List, Callable
+
+import torch
+from PIL import Image
+
+try:
+    import resource  # 仅POSIX
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def current_rss() -> int:
+    """当前进程常驻内存（字节，无法获取时为0）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if resource is not None:
+        # 没有 psutil 的非Linux POSIX系统：退化为进程生命周期内的最大常驻内存
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+    return 0
+
+
+def device_allocated() -> int:
+    """当前已分配显存（字节，无GPU时为0）"""
+    return torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+
+
+def growth_per_hour(samples: List[Dict[str, Any]], key: str) -> float:
+    """最小二乘拟合基线随时间的增长斜率（单位/小时）"""
+    if len(samples) < 2:
+        return 0.0
+    xs = [s["ts"] for s in samples]
+    ys = [s[key] for s in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return slope * 3600
+
+
+class MemoryAccountant:
+    """请求内存记账 + 空闲基线泄漏检测（线程安全）"""
+
+    def __init__(
+        self,
+        sessions_provider: Callable[[], Dict[str, List[Dict[str, Any]]]],
+        cleanup: Optional[Callable[[], None]] = None,
+        upload_bytes: Optional[Callable[[str], int]] = None,
+        idle_seconds: float = 60,
+        check_interval_s: float = 30,
+        baseline_window: int = 48,
+        min_samples: int = 6,
+        rss_threshold_mb_per_hour: float = 50,
+        device_threshold_mb_per_hour: float = 50,
+        thread_tolerance: int = 8,
+        thread_alert_samples: int = 3,
+        recent_requests: int = 200
+    ):
+        """
+        Args:
+            sessions_provider: 返回会话存储 {session_id: [消息, ...]} 的函数
+            cleanup: 空闲时的清理函数（如清空CUDA缓存），gc.collect() 总会执行
+            upload_bytes: 返回会话持有的上传文件总字节数的函数（如 UploadStore.owner_bytes）
+            idle_seconds: 最后一个请求结束多久后视为空闲
+            check_interval_s: 检测线程的检查间隔
+            baseline_window: 用于拟合趋势的最近基线数
+            min_samples: 至少多少个基线后才判断是否泄漏
+            rss_threshold_mb_per_hour: RSS基线增长告警阈值（MB/小时）
+            device_threshold_mb_per_hour: 显存基线增长告警阈值（MB/小时）
+            thread_tolerance: 线程数超过窗口内最小基线多少个才算增长
+            thread_alert_samples: 连续多少个基线线程数增长才告警
+            recent_requests: 保留的最近请求记录数
+        """
+        self.sessions_provider = sessions_provider
+        self.cleanup = cleanup
+        self.upload_bytes = upload_bytes
+        self.idle_seconds = idle_seconds
+        self.check_interval_s = check_interval_s
+        self.min_samples = min_samples
+        self.rss_threshold_mb_per_hour = rss_threshold_mb_per_hour
+        self.device_threshold_mb_per_hour = device_threshold_mb_per_hour
+        self.thread_tolerance = thread_tolerance
+        self.thread_alert_samples = thread_alert_samples
+        self.recent: deque = deque(maxlen=recent_requests)
+        self.baselines: deque = deque(maxlen=baseline_window)
+        self.alert: Optional[Dict[str, Any]] = None
+        self.totals = {"requests": 0, "rss_delta_bytes": 0, "device_delta_bytes": 0}
+        self._in_flight: List[Dict[str, Any]] = []
+        self._session_rss: Dict[str, int] = {}
+        self._last_request_end = time.time()
+        self._baseline_taken = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动后台泄漏检测线程"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="memory-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def begin(self, endpoint: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        请求开始：记录RSS和显存起点
+
+        Returns:
+            请求记录（会话ID确定后可写入 record["session"]，结束时传给 end()）
+        """
+        record = {
+            "endpoint": endpoint,
+            "session": session_id,
+            "started_at": time.time(),
+            "overlapped": False,
+            "_rss": current_rss(),
+            "_device": device_allocated(),
+        }
+        with self._lock:
+            if self._in_flight:
+                record["overlapped"] = True
+                for other in self._in_flight:
+                    other["overlapped"] = True
+            elif torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            self._in_flight.append(record)
+            self._baseline_taken = False
+        return record
+
+    def end(self, record: Optional[Dict[str, Any]]):
+        """请求结束：计算RSS增量、显存增量和峰值，并归因到会话"""
+        if record is None:
+            return
+        rss_delta = current_rss() - record.pop("_rss")
+        device_start = record.pop("_device")
+        record["duration_ms"] = round((time.time() - record["started_at"]) * 1000, 1)
+        record["rss_delta_bytes"] = rss_delta
+        record["device_delta_bytes"] = device_allocated() - device_start
+        record["device_peak_bytes"] = (
+            torch.cuda.max_memory_allocated() - device_start if torch.cuda.is_available() else 0
+        )
+        with self._lock:
+            self._in_flight = [r for r in self._in_flight if r is not record]
+            self.recent.append(record)
+            self.totals["requests"] += 1
+            self.totals["rss_delta_bytes"] += rss_delta
+            self.totals["device_delta_bytes"] += record["device_delta_bytes"]
+            if record["session"]:
+                self._session_rss[record["session"]] = self._session_rss.get(record["session"], 0) + rss_delta
+            self._last_request_end = time.time()
+
+    def forget_session(self, session_id: Optional[str] = None):
+        """会话被清除后移除其归因（None表示全部）"""
+        with self._lock:
+            if session_id is None:
+                self._session_rss.clear()
+            else:
+                self._session_rss.pop(session_id, None)
+
+    def session_footprints(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """按占用排序的会话内存归因"""
+        sessions = dict(self.sessions_provider())
+        with self._lock:
+            session_rss = dict(self._session_rss)
+        footprints = []
+        for session_id, messages in sessions.items():
+            text_bytes = sum(len((m.get("content") or "").encode("utf-8")) for m in messages)
+            image_paths = [p for m in messages for p in m.get("image_paths", [])]
+            image_bytes = self.upload_bytes(session_id) if self.upload_bytes is not None else 0
+            footprints.append({
+                "session": session_id[:8],
+                "messages": len(messages),
+                "text_bytes": text_bytes,
+                "images": len(image_paths),
+                "image_file_bytes": image_bytes,
+                "rss_delta_bytes": session_rss.get(session_id, 0)
+            })
+        footprints.sort(key=lambda f: f["text_bytes"] + f["rss_delta_bytes"], reverse=True)
+        return footprints[:limit]
+
+    def take_baseline(self) -> Dict[str, Any]:
+        """清理后采集一次空闲基线"""
+        gc.collect()
+        if self.cleanup is not None:
+            try:
+                self.cleanup()
+            except Exception as e:
+                logger.warning(f"⚠️ 空闲清理失败: {e}")
+        baseline = {
+            "ts": time.time(),
+            "rss_bytes": current_rss(),
+            "device_bytes": device_allocated(),
+            "device_reserved_bytes": torch.cuda.memory_reserved() if torch.cuda.is_available() else 0,
+            "threads": threading.active_count(),
+            "pil_images": sum(1 for obj in gc.get_objects() if isinstance(obj, Image.Image)),
+            "sessions": len(self.sessions_provider())
+        }
+        with self._lock:
+            self.baselines.append(baseline)
+            self._baseline_taken = True
+        self._check_trend()
+        return baseline
+
+    def _check_trend(self):
+        """基线增长斜率超过阈值时告警"""
+        with self._lock:
+            samples = list(self.baselines)
+        if len(samples) < self.min_samples:
+            return
+        rss_rate = growth_per_hour(samples, "rss_bytes") / MB
+        device_rate = growth_per_hour(samples, "device_bytes") / MB
+        reasons = []
+        if rss_rate > self.rss_threshold_mb_per_hour:
+            reasons.append(f"RSS基线增长 {rss_rate:.1f} MB/小时")
+        if device_rate > self.device_threshold_mb_per_hour:
+            reasons.append(f"显存基线增长 {device_rate:.1f} MB/小时")
+        thread_floor = min(s["threads"] for s in samples)
+        recent_threads = [s["threads"] for s in samples[-self.thread_alert_samples:]]
+        if (len(recent_threads) >= self.thread_alert_samples
+                and min(recent_threads) > thread_floor + self.thread_tolerance):
+            reasons.append(f"空闲线程数 {thread_floor} -> {recent_threads[-1]}（连续 {len(recent_threads)} 个基线超过容差 {self.thread_tolerance}）")
+
+        alert = None
+        if reasons:
+            alert = {
+                "since": self.alert["since"] if self.alert else time.time(),
+                "reasons": reasons,
+                "rss_mb_per_hour": round(rss_rate, 2),
+                "device_mb_per_hour": round(device_rate, 2),
+                "samples": len(samples)
+            }
+            logger.warning(f"⚠️ 疑似内存泄漏: {'; '.join(reasons)} (基线数: {len(samples)})")
+        elif self.alert:
+            logger.info("✅ 内存基线已恢复平稳")
+        self.alert = alert
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval_s):
+            with self._lock:
+                idle = (
+                    not self._in_flight
+                    and not self._baseline_taken
+                    and time.time() - self._last_request_end >= self.idle_seconds
+                )
+            if idle:
+                try:
+                    baseline = self.take_baseline()
+                    logger.info(
+                        f"🧮 空闲内存基线: RSS {baseline['rss_bytes'] / MB:.0f}MB, "
+                        f"显存 {baseline['device_bytes'] / MB:.0f}MB, 线程 {baseline['threads']}"
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ 采集内存基线失败: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        """/api/status 中的内存信息"""
+        with self._lock:
+            recent = list(self.recent)
+            samples = list(self.baselines)
+            in_flight = len(self._in_flight)
+            totals = dict(self.totals)
+        peaks = sorted(r["device_peak_bytes"] for r in recent)
+        return {
+            "rss_bytes": current_rss(),
+            "device_allocated_bytes": device_allocated(),
+            "in_flight": in_flight,
+            "totals": totals,
+            "recent_requests": [
+                {k: r[k] for k in ("endpoint", "duration_ms", "rss_delta_bytes",
+                                   "device_delta_bytes", "device_peak_bytes", "overlapped")}
+                for r in recent[-10:]
+            ],
+            "device_peak_max_bytes": peaks[-1] if peaks else 0,
+            "baseline": samples[-1] if samples else None,
+            "baseline_samples": len(samples),
+            "rss_growth_mb_per_hour": round(growth_per_hour(samples, "rss_bytes") / MB, 2),
+            "device_growth_mb_per_hour": round(growth_per_hour(samples, "device_bytes") / MB, 2),
+            "leak_alert": self.alert,
+            "sessions": self.session_footprints()
+        }
+
+    def metrics(self) -> str:
+        """Prometheus 文本格式的内存指标"""
+        with self._lock:
+            samples = list(self.baselines)
+            totals = dict(self.totals)
+            recent = list(self.recent)
+        baseline = samples[-1] if samples else {}
+        lines = [
+            "# TYPE lingshu_process_rss_bytes gauge",
+            f"lingshu_process_rss_bytes {current_rss()}",
+            "# TYPE lingshu_device_allocated_bytes gauge",
+            f"lingshu_device_allocated_bytes {device_allocated()}",
+            "# TYPE lingshu_requests_accounted_total counter",
+            f"lingshu_requests_accounted_total {totals['requests']}",
+            "# TYPE lingshu_request_rss_delta_bytes_total counter",
+            f"lingshu_request_rss_delta_bytes_total {totals['rss_delta_bytes']}",
+            "# TYPE lingshu_request_device_peak_bytes gauge",
+            f"lingshu_request_device_peak_bytes {recent[-1]['device_peak_bytes'] if recent else 0}",
+            "# TYPE lingshu_idle_baseline_rss_bytes gauge",
+            f"lingshu_idle_baseline_rss_bytes {baseline.get('rss_bytes', 0)}",
+            "# TYPE lingshu_idle_baseline_device_bytes gauge",
+            f"lingshu_idle_baseline_device_bytes {baseline.get('device_bytes', 0)}",
+            "# TYPE lingshu_idle_baseline_threads gauge",
+            f"lingshu_idle_baseline_threads {baseline.get('threads', 0)}",
+            "# TYPE lingshu_idle_baseline_pil_images gauge",
+            f"lingshu_idle_baseline_pil_images {baseline.get('pil_images', 0)}",
+            "# TYPE lingshu_sessions gauge",
+            f"lingshu_sessions {len(self.sessions_provider())}",
+            "# TYPE lingshu_rss_growth_mb_per_hour gauge",
+            f"lingshu_rss_growth_mb_per_hour {growth_per_hour(samples, 'rss_bytes') / MB:.3f}",
+            "# TYPE lingshu_memory_leak_suspected gauge",
+            f"lingshu_memory_leak_suspected {1 if self.alert else 0}",
+        ]
+        return "\n".join(lines) + "\n"
@@ -3,24 +3,87 @@
 """
 
 import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer
+import numpy as np
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer, BatchFeature
+from transformers import StoppingCriteria, StoppingCriteriaList
 from qwen_vl_utils import process_vision_info
 import logging
-from typing import Optional, Dict, Any, List, Generator
+from typing import Optional, Dict, Any, List, Generator, Tuple
 import gc
-from threading import Thread
+import time
+from threading import Thread, Lock, Event
 from PIL import Image
 import os
+import inspect
+import uuid
+from contextlib import nullcontext
+
+from scheduler import ChunkedPrefillScheduler
+from token_pruning import VisualTokenPruner
+from lora_adapters import LoraAdapterPool
+from prompt_cache import PromptCache
+import dicom_loader
+import series_loader
+import slide_loader
+import upload_store
+import tracing
+
+# 静态KV缓存和编译配置（较老版本的transformers可能没有）
+try:
+    from transformers import StaticCache
+except ImportError:
+    StaticCache = None
+try:
+    from transformers import CompileConfig
+except ImportError:
+    CompileConfig = None
+try:
+    from transformers import DynamicCache
+except ImportError:
+    from transformers.cache_utils import DynamicCache
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class CancelCriteria(StoppingCriteria):
+    """任一事件被设置时让 model.generate 在下一个token处停止（用户停止生成、流被提前关闭）"""
+    
+    def __init__(self, *events: Event):
+        self.events = events
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = any(event.is_set() for event in self.events)
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+# KV缓存量化模式 -> 比特数
+KV_CACHE_QUANT_BITS = {"int8": 8, "int4": 4}
+KV_CACHE_QUANT_GROUP_SIZE = 64
+
 
 class ModelManager:
     """模型管理器类"""
     
-    def __init__(self, model_path: str, quantization: str = "4bit", max_pixels: int = 1003520):
+    def __init__(
+        self,
+        model_path: str,
+        quantization: str = "4bit",
+        max_pixels: int = 1003520,
+        engine_mode: str = "eager",
+        static_cache_buckets: Optional[List[int]] = None,
+        compile_cache_dir: Optional[str] = None,
+        kv_cache_quantization: Optional[str] = None,
+        kv_cache_residual_length: int = 128,
+        prefill_chunk_size: int = 512,
+        vision_batch_max_patches: int = 16384,
+        vision_batch_wait_ms: int = 10,
+        visual_token_pruning: str = "off",
+        visual_token_keep_ratio: float = 0.5,
+        lora_adapters: Optional[Dict[str, str]] = None,
+        lora_max_memory_mb: int = 512,
+        prompt_cache_sessions: int = 1024
+    ):
         """
         初始化模型管理器
         
@@ -28,14 +91,49 @@ class ModelManager:
             model_path: 模型路径
             quantization: 量化模式 (4bit, 8bit, standard, cpu)
             max_pixels: 最大像素数，默认1003520(约100万像素，适合8GB显存)
+            engine_mode: 推理引擎模式 (eager: 动态KV缓存; static: 静态KV缓存+编译解码; chunked: 分块预填充调度)
+            static_cache_buckets: 静态KV缓存的长度分桶（prompt长度+生成长度）
+            compile_cache_dir: 编译产物的磁盘缓存目录
+            kv_cache_quantization: KV缓存量化模式 (None, int8, int4)
+            kv_cache_residual_length: 量化KV缓存中保持全精度的最近token数
+            prefill_chunk_size: chunked模式下每个预填充块的token数
+            vision_batch_max_patches: chunked模式下视觉编码批次的最大patch数
+            vision_batch_wait_ms: chunked模式下视觉编码批次的收集等待窗口（毫秒）
+            visual_token_pruning: 视觉token剪枝模式 (off, variance, merge)，仅chunked模式生效
+            visual_token_keep_ratio: 剪枝时每张图片保留的token比例
+            lora_adapters: LoRA适配器 {适配器名: 适配器目录}，请求通过 adapter 字段选择
+            lora_max_memory_mb: 已加载适配器的参数总量上限（MB），超出时按LRU淘汰
+            prompt_cache_sessions: 增量聊天模板缓存的会话数上限（0表示关闭，每轮整段渲染）
         """
         self.model_path = model_path
         self.quantization = quantization
         self.max_pixels = max_pixels
+        self.engine_mode = engine_mode
+        self.static_cache_buckets = sorted(static_cache_buckets or [1024, 2048, 4096])
+        self.compile_cache_dir = compile_cache_dir
+        self.kv_cache_quantization = kv_cache_quantization
+        self.kv_cache_residual_length = kv_cache_residual_length
+        self.prefill_chunk_size = prefill_chunk_size
+        self.vision_batch_max_patches = vision_batch_max_patches
+        self.vision_batch_wait_ms = vision_batch_wait_ms
+        self.token_pruner = VisualTokenPruner(visual_token_pruning, visual_token_keep_ratio)
+        self.lora_adapters = dict(lora_adapters or {})
+        self.lora_max_memory_mb = lora_max_memory_mb
+        self.lora: Optional[LoraAdapterPool] = None
+        self.prompt_cache_sessions = prompt_cache_sessions
+        self.prompt_cache: Optional[PromptCache] = None
         self.model = None
         self.processor = None
         self.device = None
         
+        # 静态缓存引擎状态: {分桶长度: StaticCache}，每个分桶一把锁，同一时刻只服务一个请求
+        self._static_caches: Dict[int, Any] = {}
+        self._static_cache_locks: Dict[int, Lock] = {}
+        
+        # 分块预填充调度器（chunked模式）
+        self.scheduler: Optional[ChunkedPrefillScheduler] = None
+        self._forward_params: Optional[set] = None
+        
     def check_gpu(self) -> tuple[bool, float]:
         """检查GPU可用性"""
         if torch.cuda.is_available():
@@ -71,6 +169,12 @@ class ModelManager:
                 logger.info(f"✅ 已设置 max_pixels = {self.max_pixels} (约{self.max_pixels/1e6:.1f}M像素)")
                 logger.info(f"💡 这可以减少显存占用，适合处理复杂图片")
             
+            # 增量聊天模板缓存（模板不支持逐条拼接时自动停用）
+            if self.prompt_cache_sessions > 0:
+                self.prompt_cache = PromptCache(self.processor, self.prompt_cache_sessions)
+                if not self.prompt_cache.enabled:
+                    self.prompt_cache = None
+            
             # 根据量化模式加载模型
             if self.quantization == "4bit":
                 logger.info("使用4-bit量化模式")
@@ -122,6 +226,26 @@ class ModelManager:
             if hasattr(self.model, 'hf_device_map'):
                 logger.info(f"📊 设备映射: {self.model.hf_device_map}")
             
+            # 多LoRA适配器（按需加载，首次使用时注入）
+            if self.lora_adapters:
+                self.lora = LoraAdapterPool(self.model, self.lora_adapters, self.lora_max_memory_mb * 1024**2)
+                logger.info(f"🧩 可用LoRA适配器: {', '.join(self.lora_adapters)}")
+            
+            if self.token_pruner.enabled and self.engine_mode != "chunked":
+                logger.warning("⚠️ 视觉token剪枝需要 chunked 引擎模式，当前模式下不生效")
+            
+            # 静态缓存+编译解码 / 分块预填充模式（可选）
+            if self.engine_mode == "static":
+                self._setup_static_engine()
+            elif self.engine_mode == "chunked":
+                self.scheduler = ChunkedPrefillScheduler(
+                    self,
+                    self.prefill_chunk_size,
+                    self.vision_batch_max_patches,
+                    self.vision_batch_wait_ms
+                )
+                self.scheduler.start()
+            
             return True
             
         except Exception as e:
@@ -134,7 +258,8 @@ class ModelManager:
         self, 
         prompt: str, 
         image_paths: Optional[List[str]] = None,
-        generation_config: Optional[Dict[str, Any]] = None
+        generation_config: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         生成回复（不带历史记录）
@@ -143,6 +268,7 @@ class ModelManager:
             prompt: 用户输入的问题
             image_paths: 图片路径列表（可选）
             generation_config: 生成配置（可选）
+            adapter: LoRA适配器名（可选，None表示基座模型）
             
         Returns:
             包含生成结果的字典
@@ -151,7 +277,8 @@ class ModelManager:
             prompt=prompt,
             image_paths=image_paths,
             history=[],
-            generation_config=generation_config
+            generation_config=generation_config,
+            adapter=adapter
         )
     
     def generate_response_with_history(
@@ -159,7 +286,9 @@ class ModelManager:
         prompt: str,
         image_paths: Optional[List[str]] = None,
         history: Optional[List[Dict[str, Any]]] = None,
-        generation_config: Optional[Dict[str, Any]] = None
+        generation_config: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        session_id: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         生成回复（支持对话历史和多图片）
@@ -169,6 +298,8 @@ class ModelManager:
             image_paths: 图片路径列表（可选）
             history: 对话历史（可选）
             generation_config: 生成配置（可选）
+            adapter: LoRA适配器名（可选，None表示基座模型）
+            session_id: 会话ID（可选，用于增量聊天模板缓存；None时每轮整段渲染）
             
         Returns:
             包含生成结果的字典，包含压缩后的图片路径用于清理
@@ -189,187 +320,343 @@ class ModelManager:
             if image_paths is None:
                 image_paths = []
             
-            logger.info(f"🤔 生成回复: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
-            
-            # 统一预处理图片（压缩以节省显存）
-            if image_paths and len(image_paths) > 0:
-                logger.info("🖼️ 开始预处理图片...")
-                processed_paths = []
-                for img_path in image_paths:
-                    processed_path = self.preprocess_image(img_path, max_size=1024)
-                    processed_paths.append(processed_path)
-                    # 如果生成了压缩文件（路径不同），记录下来
-                    if processed_path != img_path:
-                        compressed_paths.append(processed_path)
-                image_paths = processed_paths
-                logger.info(f"✅ 图片预处理完成，生成了{len(compressed_paths)}个压缩文件")
-            
-            # 清理CUDA缓存
-            self.clear_cuda_cache()
-            
-            # 构建消息列表，包含历史对话
-            messages = []
-            
-            # 添加历史消息（包含图片）
-            # 用于给图片编号，便于后续引用
-            total_image_counter = 0
-            
-            for hist_idx, hist in enumerate(history):
-                role = hist.get('role')
-                content = hist.get('content')
+            self._validate_adapter(adapter)
+            logger.info(f"🤔 生成回复: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)}, 适配器: {adapter or '无'})")
+            
+            # 构建模型输入（图片预处理、历史恢复、聊天模板、视觉信息）
+            prepare_start = time.perf_counter()
+            inputs = self._prepare_inputs(prompt, image_paths, history, compressed_paths, session_id=session_id)
+            generate_start = time.perf_counter()
+            queue_wait_ms = 0.0
+            
+            # 合并生成配置
+            default_config = self._merge_generation_config(generation_config)
+            
+            if self.scheduler is not None:
+                # chunked模式：交给调度器分块预填充并逐token解码
+                gen_request = self.scheduler.submit(inputs, default_config, adapter)
+                response = "".join(gen_request.iter_text())
+                total_tokens = gen_request.total_tokens
+                prefill = gen_request.prefill_stats()
+                queue_wait_ms = gen_request.queue_wait_ms()
+                self._trace_generation(generate_start, None, gen_request)
+            else:
+                # 生成回答
+                generated_ids = self._generate({
+                    **inputs,
+                    **default_config
+                }, adapter)
+                self._trace_generation(generate_start, None)
+                total_tokens = generated_ids.shape[-1]
+                prefill = {"tokens": inputs.input_ids.shape[-1], "saved": 0}
                 
-                if role and content:
-                    hist_content = [{"type": "text", "text": content}]
-                    
-                    # 如果历史消息包含图片，也添加进去（保持多轮对话的上下文）
-                    if role == "user" and hist.get('has_images'):
-                        hist_image_paths = hist.get('image_paths', [])
-                        recovered_count = 0
-                        missing_count = 0
-                        
-                        for img_idx, img_path in enumerate(hist_image_paths):
-                            if os.path.exists(img_path):  # 确保文件仍存在
-                                total_image_counter += 1
-                                # 压缩历史图片以节省显存
-                                processed_hist_path = self.preprocess_image(img_path, max_size=1024)
-                                hist_content.insert(0, {"type": "image", "image": processed_hist_path})
-                                # 如果生成了压缩文件，记录下来用于后续清理
-                                if processed_hist_path != img_path:
-                                    compressed_paths.append(processed_hist_path)
-                                recovered_count += 1
-                                logger.info(f"✅ 历史消息[{hist_idx}] 恢复图片 #{total_image_counter}: {img_path}")
-                            else:
-                                missing_count += 1
-                                logger.warning(f"⚠️ 历史消息[{hist_idx}] 图片文件不存在: {img_path}")
-                        
-                        if recovered_count > 0:
-                            logger.info(f"📎 历史消息[{hist_idx}] 成功恢复 {recovered_count} 张图片")
-                        if missing_count > 0:
-                            logger.warning(f"⚠️ 历史消息[{hist_idx}] 有 {missing_count} 张图片丢失")
-                    
-                    messages.append({
-                        "role": role,
-                        "content": hist_content
-                    })
-            
-            # 添加当前用户消息
-            current_content = []
-            
-            # 添加多张图片
-            current_image_count = 0
-            if image_paths and len(image_paths) > 0:
-                for idx, image_path in enumerate(image_paths):
-                    total_image_counter += 1
-                    current_content.append({
-                        "type": "image",
-                        "image": image_path
-                    })
-                    current_image_count += 1
-                    logger.info(f"🖼️ 当前消息图片 #{total_image_counter}: {image_path}")
-                logger.info(f"📸 当前消息包含 {len(image_paths)} 张新图片")
-            
-            # 使用辅助方法构建增强的提示词
-            enhanced_prompt = self._build_enhanced_prompt(prompt, total_image_counter, current_image_count)
+                # 提取生成的文本
+                generated_ids_trimmed = [
+                    out_ids[len(in_ids):] 
+                    for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+                ]
+                
+                # 解码输出
+                response = self.processor.batch_decode(
+                    generated_ids_trimmed, 
+                    skip_special_tokens=True, 
+                    clean_up_tokenization_spaces=False
+                )[0]
             
-            current_content.append({"type": "text", "text": enhanced_prompt})
+            logger.info(f"✅ 生成完成，长度: {len(response)}")
             
-            messages.append({
-                "role": "user",
-                "content": current_content
-            })
+            return {
+                "success": True,
+                "response": response,
+                "has_images": len(image_paths) > 0,
+                "image_count": len(image_paths),
+                "kv_cache": self.estimate_kv_cache_memory(total_tokens),
+                "prefill": prefill,
+                "generation_config": default_config,
+                "adapter": adapter,
+                "timings": {
+                    "prepare_ms": (generate_start - prepare_start) * 1000,
+                    "queue_wait_ms": queue_wait_ms,
+                    "generate_ms": (time.perf_counter() - generate_start) * 1000
+                },
+                "compressed_paths": compressed_paths  # 返回压缩文件路径用于清理
+            }
             
-            logger.info(f"📝 消息总数: {len(messages)}, 图片总数: {total_image_counter} (历史: {total_image_counter - current_image_count}, 当前: {current_image_count})")
+        except Exception as e:
+            logger.error(f"❌ 生成失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    def generate_batch(
+        self,
+        requests: List[Dict[str, Any]],
+        generation_config: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        批量生成回复（不带历史记录），多个请求左填充后一次调用model.generate
+        
+        使用不同LoRA适配器的请求在同一批次中前向（每一行使用各自的适配器）。
+        
+        Args:
+            requests: 请求列表，每项为 {"prompt": 问题, "images": [图片路径或PIL图像, ...], "adapter": 适配器名（可选）}
+            generation_config: 生成配置（可选）
             
-            # 应用聊天模板
-            text = self.processor.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True
-            )
+        Returns:
+            包含与请求顺序一致的回复列表的字典
+        """
+        if self.model is None or self.processor is None:
+            return {
+                "success": False,
+                "error": "模型未加载"
+            }
+        
+        try:
+            adapters = [req.get("adapter") for req in requests]
+            for adapter in set(adapters):
+                self._validate_adapter(adapter)
+            
+            conversations = []
+            for req in requests:
+                content = [item for image in req.get("images", []) for item in self._image_contents(image, compress=False)]
+                content.append({"type": "text", "text": req["prompt"]})
+                conversations.append([{"role": "user", "content": content}])
+            
+            texts = [
+                self.processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+                for conversation in conversations
+            ]
             
-            # 处理视觉信息（处理所有消息，包括历史中的图片）
             image_inputs = None
             video_inputs = None
-            # 检查是否有任何消息包含图片
-            has_any_images = any(
-                any(item.get('type') == 'image' for item in msg.get('content', []))
-                for msg in messages
-            )
-            if has_any_images:
-                # 处理所有消息中的图片（包括历史消息）
-                image_inputs, video_inputs = process_vision_info(messages)
+            if any(req.get("images") for req in requests):
+                image_inputs, video_inputs = process_vision_info(conversations)
             
-            # 处理输入
+            # 批量生成需要左填充，使所有请求的生成起点对齐（按调用传入，不修改共享的 tokenizer，
+            # 避免影响同时进行的单条生成）
             inputs = self.processor(
-                text=[text],
+                text=texts,
                 images=image_inputs,
                 videos=video_inputs,
                 padding=True,
+                padding_side="left",
                 return_tensors="pt",
+            ).to(self.model.device)
+            
+            generated_ids = self._generate({
+                **inputs,
+                **self._merge_generation_config(generation_config)
+            }, adapters)
+            
+            responses = self.processor.batch_decode(
+                generated_ids[:, inputs.input_ids.shape[-1]:],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
             )
-            inputs = inputs.to(self.model.device)
-            
-            # 默认生成配置
-            default_config = {
-                "max_new_tokens": 512,
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "do_sample": True,
-                "repetition_penalty": 1.1
-            }
             
-            # 合并用户配置
-            if generation_config:
-                default_config.update(generation_config)
+            return {
+                "success": True,
+                "responses": responses,
+                "input_tokens": int(inputs.attention_mask.sum().item())
+            }
             
-            # 生成回答
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    **default_config
-                )
+        except Exception as e:
+            logger.error(f"❌ 批量生成失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    def score_options(
+        self,
+        prompt: str,
+        options: List[str],
+        image_paths: Optional[List[str]] = None,
+        adapter: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        计算每个候选答案的对数概率（用于分类类问题，代替自由文本生成）
+        
+        共享的图片+问题前缀只预填充一次，然后复制KV缓存，
+        所有候选答案（末尾加 <|im_end|>，即完整回答的概率）在一次批量前向中打分。
+        
+        Args:
+            prompt: 用户输入的问题
+            options: 候选答案列表
+            image_paths: 图片路径列表（可选）
+            adapter: LoRA适配器名（可选，None表示基座模型）
             
-            # 提取生成的文本
-            generated_ids_trimmed = [
-                out_ids[len(in_ids):] 
-                for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-            ]
+        Returns:
+            包含按对数概率降序排列的候选答案分布的字典，包含压缩后的图片路径用于清理
+        """
+        if self.model is None or self.processor is None:
+            return {
+                "success": False,
+                "error": "模型未加载"
+            }
+        
+        compressed_paths = []
+        
+        try:
+            if not options:
+                raise ValueError("候选答案列表为空")
+            self._validate_adapter(adapter)
+            image_paths = image_paths or []
+            logger.info(f"🎯 候选答案打分: {prompt[:50]}... (候选数: {len(options)}, 图片数: {len(image_paths)})")
             
-            # 解码输出
-            response = self.processor.batch_decode(
-                generated_ids_trimmed, 
-                skip_special_tokens=True, 
-                clean_up_tokenization_spaces=False
-            )[0]
+            inputs = self._prepare_inputs(prompt, image_paths, [], compressed_paths, log_tag="[打分] ")
             
-            logger.info(f"✅ 生成完成，长度: {len(response)}")
+            with torch.no_grad():
+                # 1. 分块预填充共享前缀，得到预测第一个候选token的logits
+                encoded = self._encode_multimodal(inputs)
+                prefix_len = encoded["inputs_embeds"].shape[1]
+                cache = DynamicCache()
+                for start in range(0, prefix_len, self.prefill_chunk_size):
+                    end = min(start + self.prefill_chunk_size, prefix_len)
+                    prefix_logits = self._forward_step(
+                        encoded["inputs_embeds"][:, start:end],
+                        encoded["position_ids"][:, :, start:end],
+                        cache,
+                        start,
+                        adapter=adapter
+                    )
+                
+                # 2. 候选答案token（右填充到相同长度）
+                tokenizer = self.processor.tokenizer
+                end_id = tokenizer.convert_tokens_to_ids("<|im_end|>")
+                option_ids = [tokenizer.encode(option, add_special_tokens=False) + [end_id] for option in options]
+                max_len = max(len(ids) for ids in option_ids)
+                device = self.model.device
+                candidate_ids = torch.full((len(options), max_len), end_id, dtype=torch.long, device=device)
+                for i, ids in enumerate(option_ids):
+                    candidate_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long, device=device)
+                
+                # 3. 复制前缀KV缓存，所有候选一次批量前向
+                token_logprobs = torch.zeros(candidate_ids.shape, dtype=torch.float32, device=device)
+                prefix_logprobs = torch.log_softmax(prefix_logits.float(), dim=-1)[0]
+                token_logprobs[:, 0] = prefix_logprobs[candidate_ids[:, 0]]
+                if max_len > 1:
+                    cache.batch_repeat_interleave(len(options))
+                    positions = torch.arange(prefix_len, prefix_len + max_len - 1, device=device) + encoded["rope_delta"]
+                    logits = self._forward_step(
+                        self.model.get_input_embeddings()(candidate_ids[:, :-1]),
+                        positions.view(1, 1, -1).expand(3, len(options), -1),
+                        cache,
+                        prefix_len,
+                        last_only=False,
+                        adapter=adapter
+                    )
+                    token_logprobs[:, 1:] = torch.log_softmax(logits.float(), dim=-1).gather(
+                        -1, candidate_ids[:, 1:].unsqueeze(-1)
+                    ).squeeze(-1)
+                
+                lengths = torch.tensor([len(ids) for ids in option_ids], device=device)
+                valid = torch.arange(max_len, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+                logprobs = (token_logprobs * valid).sum(dim=-1)
+                probabilities = torch.softmax(logprobs, dim=-1)
+            
+            ranked = sorted(
+                (
+                    {
+                        "option": option,
+                        "logprob": float(logprobs[i]),
+                        "avg_logprob": float(logprobs[i] / lengths[i]),
+                        "probability": float(probabilities[i])
+                    }
+                    for i, option in enumerate(options)
+                ),
+                key=lambda item: item["logprob"],
+                reverse=True
+            )
+            logger.info(f"✅ 打分完成，最佳答案: {ranked[0]['option']} ({ranked[0]['probability']:.2%})")
             
             return {
                 "success": True,
-                "response": response,
-                "has_images": len(image_paths) > 0,
-                "image_count": len(image_paths),
-                "compressed_paths": compressed_paths  # 返回压缩文件路径用于清理
+                "ranking": ranked,
+                "prefill_tokens": prefix_len,
+                "compressed_paths": compressed_paths
             }
             
         except Exception as e:
-            logger.error(f"❌ 生成失败: {e}")
+            logger.error(f"❌ 候选答案打分失败: {e}")
             import traceback
             traceback.print_exc()
             return {
                 "success": False,
-                "error": str(e)
+                "error": str(e),
+                "compressed_paths": compressed_paths
             }
     
+    def embed_images(self, images: List[Any]) -> List[np.ndarray]:
+        """
+        计算相似检索用的图片向量：视觉编码器输出的合并patch特征取平均后L2归一化
+        
+        与生成共用图片管线（_image_contents）：DICOM、CT/MR序列、全切片与模型看到的内容一致，
+        一个文件展开为多张图片（如全切片全貌+高倍视野）时对所有特征一起取平均。
+        
+        Args:
+            images: 图片路径或PIL图像列表
+        
+        Returns:
+            与输入顺序一致的float32向量列表
+        """
+        if self.model is None or self.processor is None:
+            raise RuntimeError("模型未加载")
+        
+        image_token = getattr(self.processor, "image_token", "<|image_pad|>")
+        video_token = getattr(self.processor, "video_token", "<|video_pad|>")
+        vectors = []
+        for image in images:
+            compressed_paths = []
+            try:
+                if isinstance(image, Image.Image):
+                    contents = [{"type": "image", "image": image}]
+                else:
+                    contents = self._image_contents(image, compressed_paths)
+                image_inputs, video_inputs = process_vision_info([{"role": "user", "content": contents}])
+                inputs = self.processor(
+                    text=[image_token * len(image_inputs or []) + video_token * len(video_inputs or [])],
+                    images=image_inputs,
+                    videos=video_inputs,
+                    return_tensors="pt",
+                ).to(self.model.device)
+                
+                features = []
+                with torch.no_grad():
+                    for pixel_key, grid_key in (("pixel_values", "image_grid_thw"), ("pixel_values_videos", "video_grid_thw")):
+                        if inputs.get(pixel_key) is not None:
+                            features.append(self._encode_visual(inputs[pixel_key], inputs[grid_key]).float())
+                    vector = torch.cat(features, dim=0).mean(dim=0)
+                    vector = torch.nn.functional.normalize(vector, dim=0)
+                vectors.append(vector.cpu().numpy().astype(np.float32))
+            finally:
+                for path in compressed_paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+        return vectors
+    
     def unload_model(self):
         """卸载模型，释放内存"""
         try:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+                self.scheduler = None
             if self.model is not None:
                 del self.model
                 self.model = None
             if self.processor is not None:
                 del self.processor
                 self.processor = None
+            self._static_caches = {}
+            self._static_cache_locks = {}
+            self._forward_params = None
+            self.lora = None
+            self.prompt_cache = None
             
             # 清理GPU缓存
             if torch.cuda.is_available():
@@ -405,6 +692,11 @@ class ModelManager:
                 logger.warning(f"⚠️ 图片文件不存在: {image_path}")
                 return image_path
             
+            # 上传清单中已记录尺寸，不需要压缩时不再打开文件
+            manifest = upload_store.manifest(image_path)
+            if manifest is not None and manifest.get("width") and max(manifest["width"], manifest["height"]) <= max_size:
+                return image_path
+            
             with Image.open(image_path) as img:
                 # 获取图片格式
                 img_format = img.format or 'JPEG'  # 默认使用JPEG格式
@@ -444,7 +736,8 @@ class ModelManager:
                     ext = format_ext_map.get(img_format, '.jpg')  # 默认使用.jpg
                     logger.info(f"🔍 检测到格式: {img_format}, 添加扩展名: {ext}")
                 
-                compressed_path = f"{base}_compressed{ext}"
+                # 上传文件可能被多个会话共用，压缩文件名加随机后缀，避免并发请求互相删除
+                compressed_path = f"{base}_compressed_{uuid.uuid4().hex[:8]}{ext}"
                 
                 # 根据格式保存，PNG不支持quality参数
                 if img_format == 'PNG':
@@ -464,6 +757,47 @@ class ModelManager:
             logger.error(f"详细错误: {traceback.format_exc()}")
             return image_path  # 失败时返回原路径
     
+    def _image_contents(
+        self,
+        image_path: str,
+        compressed_paths: Optional[List[str]] = None,
+        compress: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        为一个上传文件构建消息内容项：
+        - CT/MR序列（多帧DICOM、切片压缩包、npy体数据）采样为视频帧（带缓存，后续提问不重新采样）
+        - DICOM 渲染为对齐到模型网格的内存图片（带缓存，多轮对话不重复解码）
+        - 全切片/超大图片按块读取为全貌图（可附带高倍视野），不整张解码
+        - 其他格式压缩分辨率后使用文件路径
+        
+        Args:
+            image_path: 上传的文件路径
+            compressed_paths: 用于收集压缩文件路径的列表（可选）
+            compress: 普通图片是否压缩分辨率（False 时直接使用原路径）
+            
+        Returns:
+            内容项列表（{"type": "image", ...} 或 {"type": "video", ...}）
+        """
+        # 上传清单中已记录文件类型，不再读取文件头判断
+        manifest = upload_store.manifest(image_path)
+        kind = manifest["kind"] if manifest is not None else None
+        if kind == "series" or (kind is None and series_loader.loader.is_series(image_path)):
+            series = series_loader.loader.load(image_path)
+            width, height = series["size"]
+            return [{"type": "video", "video": series["frames"], "resized_width": width, "resized_height": height}]
+        if kind == "dicom" or (kind is None and dicom_loader.is_dicom(image_path)):
+            return [{"type": "image", "image": dicom_loader.loader.load(image_path, max_size=1024)}]
+        if kind == "slide" or (kind is None and slide_loader.loader.is_slide(image_path)):
+            slide = slide_loader.loader.load(image_path)
+            return [{"type": "image", "image": image} for image in [slide["overview"]] + [t["image"] for t in slide["tiles"]]]
+        if not compress:
+            return [{"type": "image", "image": image_path}]
+        processed_path = self.preprocess_image(image_path, max_size=1024)
+        # 如果生成了压缩文件（路径不同），记录下来用于后续清理
+        if processed_path != image_path and compressed_paths is not None:
+            compressed_paths.append(processed_path)
+        return [{"type": "image", "image": processed_path}]
+    
     def clear_cuda_cache(self):
         """清理CUDA缓存"""
         if torch.cuda.is_available():
@@ -510,67 +844,56 @@ class ModelManager:
         
         return enhanced_prompt
     
-    def generate_response_stream(
+    def _prepare_inputs(
         self,
         prompt: str,
-        image_paths: Optional[List[str]] = None,
-        history: Optional[List[Dict[str, Any]]] = None,
-        generation_config: Optional[Dict[str, Any]] = None,
-        compressed_paths_container: Optional[List[str]] = None
-    ) -> Generator[str, None, None]:
+        image_paths: List[str],
+        history: List[Dict[str, Any]],
+        compressed_paths: Optional[List[str]] = None,
+        log_tag: str = "",
+        session_id: Optional[str] = None
+    ):
         """
-        生成回复（流式输出，支持对话历史和多图片）
+        构建模型输入：预处理图片、恢复历史图片、应用聊天模板并处理视觉信息
         
         Args:
             prompt: 用户输入的问题
-            image_paths: 图片路径列表（可选）
-            history: 对话历史（可选）
-            generation_config: 生成配置（可选）
-            compressed_paths_container: 用于返回压缩文件路径的列表容器（可选）
+            image_paths: 当前消息的图片路径列表
+            history: 对话历史
+            compressed_paths: 用于收集压缩文件路径的列表（可选）
+            log_tag: 日志前缀，用于区分流式/非流式
+            session_id: 会话ID（有增量模板缓存时只渲染和分词新增的消息）
             
-        Yields:
-            生成的文本片段
+        Returns:
+            已移动到模型设备上的处理器输出
         """
-        if self.model is None or self.processor is None:
-            yield "[错误] 模型未加载"
-            return
+        # 统一预处理图片（压缩以节省显存）
+        if image_paths and len(image_paths) > 0:
+            logger.info("🖼️ 开始预处理图片...")
+            image_contents = []
+            for img_path in image_paths:
+                with tracing.span("preprocess_image", image=os.path.basename(img_path)):
+                    image_contents.append(self._image_contents(img_path, compressed_paths))
+            if compressed_paths is not None:
+                logger.info(f"✅ 图片预处理完成，生成了{len(compressed_paths)}个压缩文件")
         
-        try:
-            if history is None:
-                history = []
-            
-            if image_paths is None:
-                image_paths = []
-            
-            logger.info(f"🤔 流式生成回复: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)})")
-            
-            # 统一预处理图片（压缩以节省显存）
-            if image_paths and len(image_paths) > 0:
-                logger.info("🖼️ 开始预处理图片...")
-                processed_paths = []
-                for img_path in image_paths:
-                    processed_path = self.preprocess_image(img_path, max_size=1024)
-                    processed_paths.append(processed_path)
-                    # 如果生成了压缩文件（路径不同），记录下来
-                    if processed_path != img_path and compressed_paths_container is not None:
-                        compressed_paths_container.append(processed_path)
-                image_paths = processed_paths
-                if compressed_paths_container is not None:
-                    logger.info(f"✅ 图片预处理完成，生成了{len(compressed_paths_container)}个压缩文件")
-            
-            # 清理CUDA缓存
-            self.clear_cuda_cache()
-            
-            # 构建消息列表，包含历史对话
-            messages = []
-            
-            # 添加历史消息（包含图片）
-            # 用于给图片编号，便于后续引用
-            total_image_counter = 0
-            
+        # 清理CUDA缓存
+        self.clear_cuda_cache()
+        
+        # 构建消息列表，包含历史对话
+        messages = []
+        # 与 history 一一对应的模板消息（增量模板缓存按位置取新增消息，跳过的消息为 None）
+        history_messages = []
+        
+        # 添加历史消息（包含图片）
+        # 用于给图片编号，便于后续引用
+        total_image_counter = 0
+        
+        with tracing.span("history_replay", messages=len(history)):
             for hist_idx, hist in enumerate(history):
                 role = hist.get('role')
                 content = hist.get('content')
+                history_messages.append(None)
                 
                 if role and content:
                     hist_content = [{"type": "text", "text": content}]
@@ -585,75 +908,80 @@ class ModelManager:
                             if os.path.exists(img_path):  # 确保文件仍存在
                                 total_image_counter += 1
                                 # 压缩历史图片以节省显存
-                                processed_hist_path = self.preprocess_image(img_path, max_size=1024)
-                                hist_content.insert(0, {"type": "image", "image": processed_hist_path})
-                                # 如果生成了压缩文件，记录下来用于后续清理
-                                if processed_hist_path != img_path and compressed_paths_container is not None:
-                                    compressed_paths_container.append(processed_hist_path)
+                                with tracing.span("preprocess_image", image=os.path.basename(img_path), history=True):
+                                    hist_content[0:0] = self._image_contents(img_path, compressed_paths)
                                 recovered_count += 1
-                                logger.info(f"✅ [流式] 历史消息[{hist_idx}] 恢复图片 #{total_image_counter}: {img_path}")
+                                logger.info(f"✅ {log_tag}历史消息[{hist_idx}] 恢复图片 #{total_image_counter}: {img_path}")
                             else:
                                 missing_count += 1
-                                logger.warning(f"⚠️ [流式] 历史消息[{hist_idx}] 图片文件不存在: {img_path}")
+                                logger.warning(f"⚠️ {log_tag}历史消息[{hist_idx}] 图片文件不存在: {img_path}")
                         
                         if recovered_count > 0:
-                            logger.info(f"📎 [流式] 历史消息[{hist_idx}] 成功恢复 {recovered_count} 张图片")
+                            logger.info(f"📎 {log_tag}历史消息[{hist_idx}] 成功恢复 {recovered_count} 张图片")
                         if missing_count > 0:
-                            logger.warning(f"⚠️ [流式] 历史消息[{hist_idx}] 有 {missing_count} 张图片丢失")
+                            logger.warning(f"⚠️ {log_tag}历史消息[{hist_idx}] 有 {missing_count} 张图片丢失")
                     
                     messages.append({
                         "role": role,
                         "content": hist_content
                     })
-            
-            # 添加当前用户消息
-            current_content = []
-            
-            # 添加多张图片
-            current_image_count = 0
-            if image_paths and len(image_paths) > 0:
-                for idx, image_path in enumerate(image_paths):
-                    total_image_counter += 1
-                    current_content.append({
-                        "type": "image",
-                        "image": image_path
-                    })
-                    current_image_count += 1
-                    logger.info(f"🖼️ [流式] 当前消息图片 #{total_image_counter}: {image_path}")
-                logger.info(f"📸 [流式] 当前消息包含 {len(image_paths)} 张新图片")
-            
-            # 使用辅助方法构建增强的提示词
-            enhanced_prompt = self._build_enhanced_prompt(prompt, total_image_counter, current_image_count)
-            
-            current_content.append({"type": "text", "text": enhanced_prompt})
-            
-            messages.append({
-                "role": "user",
-                "content": current_content
-            })
-            
-            logger.info(f"📝 [流式] 消息总数: {len(messages)}, 图片总数: {total_image_counter} (历史: {total_image_counter - current_image_count}, 当前: {current_image_count})")
-            
-            # 应用聊天模板
+                    history_messages[-1] = messages[-1]
+        
+        # 添加当前用户消息
+        current_content = []
+        
+        # 添加多张图片
+        current_image_count = 0
+        if image_paths and len(image_paths) > 0:
+            for idx, (image_path, contents) in enumerate(zip(image_paths, image_contents)):
+                total_image_counter += 1
+                current_content.extend(contents)
+                current_image_count += 1
+                logger.info(f"🖼️ {log_tag}当前消息图片 #{total_image_counter}: {image_path}")
+            logger.info(f"📸 {log_tag}当前消息包含 {len(image_paths)} 张新图片")
+        
+        # 使用辅助方法构建增强的提示词
+        enhanced_prompt = self._build_enhanced_prompt(prompt, total_image_counter, current_image_count)
+        
+        current_content.append({"type": "text", "text": enhanced_prompt})
+        
+        messages.append({
+            "role": "user",
+            "content": current_content
+        })
+        
+        logger.info(f"📝 {log_tag}消息总数: {len(messages)}, 图片总数: {total_image_counter} (历史: {total_image_counter - current_image_count}, 当前: {current_image_count})")
+        
+        # 处理视觉信息（处理所有消息，包括历史中的图片）
+        image_inputs = None
+        video_inputs = None
+        # 检查是否有任何消息包含图片（序列以视频帧输入）
+        has_any_images = any(
+            any(item.get('type') in ('image', 'video') for item in msg.get('content', []))
+            for msg in messages
+        )
+        if has_any_images:
+            # 处理所有消息中的图片（包括历史消息）
+            with tracing.span("process_vision_info", images=total_image_counter):
+                image_inputs, video_inputs = process_vision_info(messages)
+        
+        # 增量模板缓存：历史消息的token id已缓存，只渲染和分词新增的消息
+        if self.prompt_cache is not None and session_id:
+            inputs = self._cached_inputs(session_id, history, history_messages, messages[-1], image_inputs, video_inputs)
+            if inputs is not None:
+                with tracing.span("host_to_device", tokens=inputs.input_ids.shape[-1]):
+                    return inputs.to(self.model.device)
+        
+        # 应用聊天模板
+        with tracing.span("apply_chat_template"):
             text = self.processor.apply_chat_template(
                 messages, 
                 tokenize=False, 
                 add_generation_prompt=True
             )
-            
-            # 处理视觉信息（处理所有消息，包括历史中的图片）
-            image_inputs = None
-            video_inputs = None
-            # 检查是否有任何消息包含图片
-            has_any_images = any(
-                any(item.get('type') == 'image' for item in msg.get('content', []))
-                for msg in messages
-            )
-            if has_any_images:
-                # 处理所有消息中的图片（包括历史消息）
-                image_inputs, video_inputs = process_vision_info(messages)
-            
-            # 处理输入
+        
+        # 处理输入
+        with tracing.span("processor_tensorize"):
             inputs = self.processor(
                 text=[text],
                 images=image_inputs,
@@ -661,20 +989,148 @@ class ModelManager:
                 padding=True,
                 return_tensors="pt",
             )
-            inputs = inputs.to(self.model.device)
-            
-            # 默认生成配置
-            default_config = {
-                "max_new_tokens": 512,
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "do_sample": True,
-                "repetition_penalty": 1.1
-            }
+        with tracing.span("host_to_device", tokens=inputs.input_ids.shape[-1]):
+            return inputs.to(self.model.device)
+    
+    def _cached_inputs(
+        self,
+        session_id: str,
+        history: List[Dict[str, Any]],
+        history_messages: List[Optional[Dict[str, Any]]],
+        current_message: Dict[str, Any],
+        image_inputs,
+        video_inputs
+    ):
+        """
+        用增量模板缓存构建模型输入：拼接缓存的历史token id和新增消息的token id，
+        视觉输入只交给处理器计算像素和网格，占位token按网格尺寸展开
+        
+        Returns:
+            处理器格式的输入（未移动设备）；占位数与视觉输入不一致时返回 None（回退为整段渲染）
+        """
+        with tracing.span("prompt_cache", history=len(history)):
+            ids = self.prompt_cache.input_ids(session_id, history, history_messages, current_message)
+        
+        with tracing.span("processor_tensorize"):
+            if image_inputs or video_inputs:
+                inputs = self.processor(
+                    text=[self.prompt_cache.vision_text(len(image_inputs or []), len(video_inputs or []))],
+                    images=image_inputs,
+                    videos=video_inputs,
+                    return_tensors="pt",
+                )
+            else:
+                inputs = BatchFeature()
+            input_ids = self.prompt_cache.expand(ids, inputs.get("image_grid_thw"), inputs.get("video_grid_thw"))
+        
+        if input_ids is None:
+            logger.warning(f"⚠️ 会话 {session_id[:8]} 的模板缓存与视觉输入不一致，整段重新渲染")
+            self.prompt_cache.fallback(session_id)
+            return None
+        inputs["input_ids"] = input_ids
+        inputs["attention_mask"] = torch.ones_like(input_ids)
+        return inputs
+    
+    def _merge_generation_config(self, generation_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """合并默认生成配置和用户配置"""
+        # 默认生成配置
+        default_config = {
+            "max_new_tokens": 512,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "do_sample": True,
+            "repetition_penalty": 1.1
+        }
+        
+        # 合并用户配置
+        if generation_config:
+            default_config.update(generation_config)
+        
+        return default_config
+    
+    def generate_response_stream(
+        self,
+        prompt: str,
+        image_paths: Optional[List[str]] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        compressed_paths_container: Optional[List[str]] = None,
+        stats_container: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        session_id: Optional[str] = None,
+        cancel_event: Optional[Event] = None
+    ) -> Generator[str, None, None]:
+        """
+        生成回复（流式输出，支持对话历史和多图片）
+        
+        提前关闭生成器或设置 cancel_event 都会停止生成：eager/static 模式通过 StoppingCriteria 在下一个token处
+        结束 model.generate，生成器关闭时等生成线程退出后才返回；chunked 模式取消调度请求。
+        
+        Args:
+            prompt: 用户输入的问题
+            image_paths: 图片路径列表（可选）
+            history: 对话历史（可选）
+            generation_config: 生成配置（可选）
+            compressed_paths_container: 用于返回压缩文件路径的列表容器（可选）
+            stats_container: 用于返回本次请求统计信息（如KV缓存显存）的字典容器（可选）
+            adapter: LoRA适配器名（可选，None表示基座模型）
+            session_id: 会话ID（可选，用于增量聊天模板缓存；None时每轮整段渲染）
+            cancel_event: 停止生成的事件（可选，如续传缓冲区的 cancelled）
             
-            # 合并用户配置
-            if generation_config:
-                default_config.update(generation_config)
+        Yields:
+            生成的文本片段
+        """
+        if self.model is None or self.processor is None:
+            yield "[错误] 模型未加载"
+            return
+        
+        try:
+            if history is None:
+                history = []
+            
+            if image_paths is None:
+                image_paths = []
+            
+            self._validate_adapter(adapter)
+            logger.info(f"🤔 流式生成回复: {prompt[:50]}... (图片数: {len(image_paths)}, 历史消息数: {len(history)}, 适配器: {adapter or '无'})")
+            
+            # 构建模型输入（图片预处理、历史恢复、聊天模板、视觉信息）
+            prepare_start = time.perf_counter()
+            inputs = self._prepare_inputs(
+                prompt, image_paths, history, compressed_paths_container, log_tag="[流式] ",
+                session_id=session_id
+            )
+            prepare_ms = (time.perf_counter() - prepare_start) * 1000
+            
+            # 合并生成配置
+            default_config = self._merge_generation_config(generation_config)
+            if stats_container is not None:
+                stats_container["generation_config"] = default_config
+                stats_container["adapter"] = adapter
+                stats_container["timings"] = {"prepare_ms": prepare_ms, "queue_wait_ms": 0.0}
+            
+            if self.scheduler is not None:
+                # chunked模式：交给调度器，与其他请求的解码交替执行
+                gen_request = self.scheduler.submit(inputs, default_config, adapter)
+                generate_start = time.perf_counter()
+                first_chunk_at = None
+                try:
+                    for text_chunk in gen_request.iter_text():
+                        if first_chunk_at is None:
+                            first_chunk_at = time.perf_counter()
+                        yield text_chunk
+                        if cancel_event is not None and cancel_event.is_set():
+                            break
+                finally:
+                    # 客户端提前断开时取消请求，释放KV缓存
+                    gen_request.cancel()
+                    self._trace_generation(generate_start, first_chunk_at, gen_request)
+                if stats_container is not None:
+                    stats_container["kv_cache"] = self.estimate_kv_cache_memory(gen_request.total_tokens)
+                    stats_container["prefill"] = gen_request.prefill_stats()
+                    stats_container["timings"]["queue_wait_ms"] = gen_request.queue_wait_ms()
+                logger.info("✅ 流式生成完成")
+                return
             
             # 创建流式输出器
             streamer = TextIteratorStreamer(
@@ -683,22 +1139,38 @@ class ModelManager:
                 skip_special_tokens=True
             )
             
-            # 添加streamer到生成配置
+            # 添加streamer到生成配置；生成器被关闭或 cancel_event 被设置时在下一个token处停止生成
+            stop_event = Event()
+            stop_events = (stop_event, cancel_event) if cancel_event is not None else (stop_event,)
             generation_kwargs = {
                 **inputs,
                 **default_config,
-                "streamer": streamer
+                "streamer": streamer,
+                "stopping_criteria": StoppingCriteriaList([CancelCriteria(*stop_events)])
             }
             
             # 在单独的线程中生成
-            thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
+            outputs = []
+            thread = Thread(target=lambda: outputs.append(self._generate(generation_kwargs, adapter)))
+            generate_start = time.perf_counter()
+            first_chunk_at = None
             thread.start()
             
             # 流式输出生成的文本
-            for text_chunk in streamer:
-                yield text_chunk
-            
-            thread.join()
+            try:
+                for text_chunk in streamer:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    yield text_chunk
+            finally:
+                # 提前关闭时通知生成线程停止，并等它退出：调用方释放并发名额时GPU已空闲
+                stop_event.set()
+                thread.join()
+                self._trace_generation(generate_start, first_chunk_at)
+            
+            if stats_container is not None and outputs:
+                stats_container["kv_cache"] = self.estimate_kv_cache_memory(outputs[0].shape[-1])
+                stats_container["prefill"] = {"tokens": inputs.input_ids.shape[-1], "saved": 0}
             
             logger.info("✅ 流式生成完成")
             
@@ -707,4 +1179,425 @@ class ModelManager:
             import traceback
             traceback.print_exc()
             yield f"[错误] {str(e)}"
+    
+    def _trace_generation(self, generate_start: float, first_chunk_at: Optional[float], gen_request=None):
+        """
+        在当前请求的追踪中记录生成阶段（未追踪时不做任何事）
+        
+        流式请求以首个文本块划分预填充和解码，阻塞请求只记录整体生成耗时；
+        chunked模式额外记录调度排队（含视觉编码）阶段。
+        """
+        trace = tracing.current()
+        if trace is None:
+            return
+        end = time.perf_counter()
+        start = generate_start
+        if gen_request is not None and gen_request.admitted_at is not None:
+            trace.add_span("scheduler_queue", gen_request.submitted_at, gen_request.admitted_at)
+            start = gen_request.admitted_at
+        if first_chunk_at is None:
+            trace.add_span("generate", start, end)
+        else:
+            trace.add_span("prefill", start, first_chunk_at)
+            trace.add_span("decode", first_chunk_at, end)
+    
+    def _encode_multimodal(self, inputs, visual_features: Optional[Dict[str, torch.Tensor]] = None) -> Dict[str, Any]:
+        """
+        计算整段输入的嵌入和多模态旋转位置编码（供分块预填充使用）
+        
+        视觉特征逐张图片计算并写入图片占位token的位置，避免一次性处理所有图片造成显存峰值。
+        
+        Args:
+            inputs: 处理器输出
+            visual_features: 视觉编码阶段已算好的特征 {pixel_values键: 特征}（可选）
+        
+        Returns:
+            包含 input_ids、inputs_embeds、position_ids(3, 1, L) 和 rope_delta 的字典（启用剪枝时L为剪枝后长度）
+        """
+        input_ids = inputs["input_ids"]
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        # 序列中保留的位置（视觉token剪枝时去掉被剪掉的图片token）
+        seq_keep = None
+        
+        for pixel_key, grid_key, token_id in (
+            ("pixel_values", "image_grid_thw", self.model.config.image_token_id),
+            ("pixel_values_videos", "video_grid_thw", self.model.config.video_token_id),
+        ):
+            pixel_values = inputs.get(pixel_key)
+            if pixel_values is None:
+                continue
+            if visual_features and pixel_key in visual_features:
+                visual_embeds = visual_features[pixel_key]
+            else:
+                visual_embeds = self._encode_visual(pixel_values, inputs[grid_key])
+            visual_embeds = visual_embeds.to(inputs_embeds.device, inputs_embeds.dtype)
+            
+            if pixel_key == "pixel_values" and self.token_pruner.enabled:
+                token_keep, visual_embeds = self._prune_visual_tokens(pixel_values, inputs[grid_key], visual_embeds)
+                positions = (input_ids[0] == token_id).nonzero(as_tuple=True)[0]
+                inputs_embeds[0, positions[token_keep]] = visual_embeds
+                seq_keep = torch.ones(input_ids.shape[-1], dtype=torch.bool, device=input_ids.device)
+                seq_keep[positions[~token_keep.to(positions.device)]] = False
+            else:
+                mask = (input_ids == token_id).unsqueeze(-1).expand_as(inputs_embeds)
+                inputs_embeds = inputs_embeds.masked_scatter(mask, visual_embeds)
+        
+        # 位置编码按完整网格计算，剪枝后保留token仍使用原始的空间位置
+        position_ids, rope_deltas = self._get_rope_index(
+            input_ids,
+            inputs.get("image_grid_thw"),
+            inputs.get("video_grid_thw"),
+            inputs.get("second_per_grid_ts"),
+            inputs.get("attention_mask")
+        )
+        rope_delta = int(rope_deltas.reshape(-1)[0].item())
+        
+        if seq_keep is not None:
+            original_len = input_ids.shape[-1]
+            input_ids = input_ids[:, seq_keep]
+            inputs_embeds = inputs_embeds[:, seq_keep]
+            position_ids = position_ids[:, :, seq_keep.to(position_ids.device)]
+            # 解码位置 = 缓存长度 + rope_delta，序列变短后需要重新计算
+            rope_delta = int(position_ids.max().item()) + 1 - input_ids.shape[-1]
+            logger.info(f"✂️ 视觉token剪枝: prompt {original_len} → {input_ids.shape[-1]} tokens")
+        
+        return {
+            "input_ids": input_ids,
+            "inputs_embeds": inputs_embeds,
+            "position_ids": position_ids,
+            "rope_delta": rope_delta
+        }
+    
+    def _prune_visual_tokens(self, pixel_values: torch.Tensor, grid_thw: torch.Tensor, features: torch.Tensor):
+        """
+        逐张图片剪枝视觉token
+        
+        Returns:
+            (所有图片token的保留掩码, 保留token的特征)
+        """
+        merge_unit = getattr(self.model.visual, "spatial_merge_size", 2) ** 2
+        keep_masks = []
+        kept_features = []
+        patch_offset = 0
+        token_offset = 0
+        for thw in grid_thw:
+            num_patches = int(thw.prod().item())
+            num_tokens = num_patches // merge_unit
+            keep, kept = self.token_pruner.prune(
+                pixel_values[patch_offset:patch_offset + num_patches],
+                features[token_offset:token_offset + num_tokens],
+                merge_unit
+            )
+            keep_masks.append(keep)
+            kept_features.append(kept)
+            patch_offset += num_patches
+            token_offset += num_tokens
+        return torch.cat(keep_masks), torch.cat(kept_features)
+    
+    def _encode_visual(self, pixel_values: torch.Tensor, grid_thw: torch.Tensor) -> torch.Tensor:
+        """逐个图片/视频运行视觉编码器，返回拼接后的合并patch特征"""
+        visual = self.model.visual
+        features = []
+        offset = 0
+        for thw in grid_thw:
+            num_patches = int(thw.prod().item())
+            patches = pixel_values[offset:offset + num_patches].type(visual.dtype)
+            offset += num_patches
+            output = visual(patches, grid_thw=thw.unsqueeze(0))
+            features.append(output[0] if isinstance(output, (tuple, list)) else output)
+        return torch.cat(features, dim=0)
+    
+    def _get_rope_index(self, input_ids, image_grid_thw, video_grid_thw, second_per_grid_ts, attention_mask):
+        """计算Qwen2.5-VL的三维旋转位置编码（兼容不同版本transformers的模块结构）"""
+        get_rope_index = getattr(self.model, "get_rope_index", None) or self.model.model.get_rope_index
+        return get_rope_index(input_ids, image_grid_thw, video_grid_thw, second_per_grid_ts, attention_mask)
+    
+    def _forward_step(
+        self,
+        inputs_embeds: torch.Tensor,
+        position_ids: torch.Tensor,
+        cache,
+        start: int,
+        last_only: bool = True,
+        adapter: Optional[str] = None
+    ) -> torch.Tensor:
+        """
+        在KV缓存上前向一段输入嵌入
+        
+        Args:
+            inputs_embeds: (batch, n, hidden) 输入嵌入
+            position_ids: (3, batch, n) 位置编码
+            cache: KV缓存（原地更新）
+            start: 本段第一个token在序列中的位置
+            last_only: 是否只返回最后一个位置的logits
+            adapter: LoRA适配器名（批次中所有行相同，None表示基座模型）
+            
+        Returns:
+            最后一个位置的logits (batch, vocab)，或全部位置的logits (batch, n, vocab)
+        """
+        batch_size, length = inputs_embeds.shape[:2]
+        device = inputs_embeds.device
+        kwargs = {}
+        # 只计算最后一个位置的logits，避免分块时生成 (n, vocab) 的大张量
+        if last_only and self._forward_accepts("logits_to_keep"):
+            kwargs["logits_to_keep"] = 1
+        elif last_only and self._forward_accepts("num_logits_to_keep"):
+            kwargs["num_logits_to_keep"] = 1
+        with self._adapter_context(adapter, batch_size):
+            outputs = self.model(
+                inputs_embeds=inputs_embeds,
+                position_ids=position_ids,
+                attention_mask=torch.ones((batch_size, start + length), dtype=torch.long, device=device),
+                past_key_values=cache,
+                cache_position=torch.arange(start, start + length, device=device),
+                use_cache=True,
+                **kwargs
+            )
+        return outputs.logits[:, -1, :] if last_only else outputs.logits
+    
+    def _validate_adapter(self, adapter: Optional[str]):
+        """
+        检查请求的适配器是否可用
+        
+        Raises:
+            ValueError: 未配置适配器或适配器名未知
+        """
+        if not adapter:
+            return
+        if self.lora is None:
+            raise ValueError("未配置LoRA适配器（config.LORA_ADAPTERS）")
+        self.lora.validate(adapter)
+    
+    def _adapter_context(self, adapters, batch_size: int = 1):
+        """语言模型前向使用的适配器（未配置适配器时为空上下文）"""
+        if self.lora is None:
+            return nullcontext()
+        return self.lora.use(adapters, batch_size)
+    
+    def _forward_accepts(self, name: str) -> bool:
+        """检查模型forward是否支持某个参数"""
+        if self._forward_params is None:
+            self._forward_params = set(inspect.signature(self.model.forward).parameters)
+        return name in self._forward_params
+    
+    def _eos_token_ids(self) -> set:
+        """生成结束token集合"""
+        eos = self.model.generation_config.eos_token_id
+        if eos is None:
+            eos = self.processor.tokenizer.eos_token_id
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+    
+    def _generate(self, generation_kwargs: Dict[str, Any], adapters=None):
+        """
+        调用model.generate，按引擎模式选择KV缓存
+        
+        static模式下按 prompt长度+max_new_tokens 路由到最近的空闲分桶，
+        使用预分配的静态KV缓存（解码步骤由transformers自动编译）；
+        超出最大分桶或分桶均被占用时回退到eager（动态KV缓存）。
+        
+        Args:
+            generation_kwargs: model.generate 参数
+            adapters: LoRA适配器名（所有行相同）或每一行的适配器名列表，None表示基座模型
+        """
+        bucket = None
+        # 静态缓存按单请求预分配，批量生成直接走eager；
+        # 注入LoRA后每次前向临时注册钩子，编译的解码图无法复用，也走eager
+        if (
+            self._static_caches
+            and not (self.lora is not None and self.lora.enabled)
+            and "past_key_values" not in generation_kwargs
+            and generation_kwargs["input_ids"].shape[0] == 1
+        ):
+            input_len = generation_kwargs["input_ids"].shape[-1]
+            max_new_tokens = generation_kwargs.get("max_new_tokens", 512)
+            bucket, cache = self._acquire_static_cache(input_len + max_new_tokens)
+            if bucket is not None:
+                generation_kwargs = {**generation_kwargs, "past_key_values": cache}
+                if CompileConfig is not None:
+                    generation_kwargs["compile_config"] = CompileConfig(fullgraph=False, mode="reduce-overhead")
+        
+        # 未使用静态缓存时，按配置启用量化KV缓存（长对话场景）
+        if bucket is None and self.kv_cache_quantization and "past_key_values" not in generation_kwargs:
+            generation_kwargs = {
+                **generation_kwargs,
+                "cache_implementation": "quantized",
+                "cache_config": self._quantized_cache_config()
+            }
+        
+        try:
+            with torch.no_grad(), self._adapter_context(adapters, generation_kwargs["input_ids"].shape[0]):
+                return self.model.generate(**generation_kwargs)
+        finally:
+            if bucket is not None:
+                self._static_cache_locks[bucket].release()
+    
+    def _quantized_cache_config(self) -> Dict[str, Any]:
+        """
+        量化KV缓存配置
+        
+        int4 使用 quanto 后端，int8 使用 HQQ 后端（quanto 仅支持2/4bit）。
+        最近 residual_length 个token保持全精度，超出部分分组量化。
+        """
+        if self.kv_cache_quantization not in KV_CACHE_QUANT_BITS:
+            raise ValueError(f"不支持的KV缓存量化模式: {self.kv_cache_quantization}")
+        nbits = KV_CACHE_QUANT_BITS[self.kv_cache_quantization]
+        return {
+            "backend": "quanto" if nbits == 4 else "HQQ",
+            "nbits": nbits,
+            "residual_length": self.kv_cache_residual_length,
+            "q_group_size": KV_CACHE_QUANT_GROUP_SIZE
+        }
+    
+    def estimate_kv_cache_memory(self, num_tokens: int) -> Dict[str, Any]:
+        """
+        估算一次请求的KV缓存显存占用及量化节省量
+        
+        Args:
+            num_tokens: KV缓存中的token数（prompt + 生成）
+            
+        Returns:
+            包含全精度/实际占用/节省字节数的字典
+        """
+        text_config = self.model.config.get_text_config() if hasattr(self.model.config, "get_text_config") else self.model.config
+        head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // text_config.num_attention_heads
+        kv_heads = getattr(text_config, "num_key_value_heads", None) or text_config.num_attention_heads
+        # 每个token的K和V元素总数（所有层）
+        elements_per_token = 2 * text_config.num_hidden_layers * kv_heads * head_dim
+        full_bytes = elements_per_token * num_tokens * 2  # fp16/bf16
+        
+        mode = self.kv_cache_quantization
+        if mode in KV_CACHE_QUANT_BITS:
+            nbits = KV_CACHE_QUANT_BITS[mode]
+            residual_tokens = min(num_tokens, self.kv_cache_residual_length)
+            quantized_tokens = num_tokens - residual_tokens
+            # 量化部分：nbits数据 + 每组一个fp16 scale和zero point
+            quantized_bytes = elements_per_token * quantized_tokens * (nbits / 8 + 4 / KV_CACHE_QUANT_GROUP_SIZE)
+            used_bytes = int(elements_per_token * residual_tokens * 2 + quantized_bytes)
+        else:
+            mode = "none"
+            used_bytes = full_bytes
+        
+        saved_bytes = full_bytes - used_bytes
+        logger.info(f"🧮 KV缓存({mode}): {num_tokens} tokens, 占用约 {used_bytes / 1024**2:.1f} MB, 节省约 {saved_bytes / 1024**2:.1f} MB")
+        return {
+            "mode": mode,
+            "tokens": num_tokens,
+            "full_precision_bytes": full_bytes,
+            "used_bytes": used_bytes,
+            "saved_bytes": saved_bytes
+        }
+    
+    def _acquire_static_cache(self, needed_len: int) -> Tuple[Optional[int], Any]:
+        """
+        选择能容纳 needed_len 的最小空闲分桶
+        
+        Returns:
+            (分桶长度, 已重置的StaticCache)；没有可用分桶时返回 (None, None)
+        """
+        for bucket in self.static_cache_buckets:
+            if bucket < needed_len or bucket not in self._static_caches:
+                continue
+            if self._static_cache_locks[bucket].acquire(blocking=False):
+                cache = self._static_caches[bucket]
+                cache.reset()
+                logger.info(f"⚡ 使用静态KV缓存分桶: {bucket} (需要 {needed_len})")
+                return bucket, cache
+        
+        logger.info(f"🐢 无可用静态缓存分桶 (需要 {needed_len})，回退到eager模式")
+        return None, None
+    
+    def _setup_static_engine(self):
+        """
+        初始化静态KV缓存引擎：为每个分桶预分配缓存并预热编译解码步骤
+        
+        编译产物写入 compile_cache_dir，重启后直接复用，无需重新编译。
+        任何一步失败都会回退到eager模式，不影响模型正常使用。
+        """
+        if StaticCache is None:
+            logger.warning("⚠️ 当前transformers版本不支持StaticCache，使用eager模式")
+            return
+        if self.device is None or self.device.type != "cuda":
+            logger.warning("⚠️ 静态缓存编译解码仅支持GPU，使用eager模式")
+            return
+        
+        try:
+            self._load_compile_cache()
+            
+            dtype = self.model.dtype if self.model.dtype in (torch.float16, torch.bfloat16) else torch.float16
+            for bucket in self.static_cache_buckets:
+                self._static_caches[bucket] = StaticCache(
+                    config=self.model.config,
+                    max_batch_size=1,
+                    max_cache_len=bucket,
+                    device=self.model.device,
+                    dtype=dtype
+                )
+                self._static_cache_locks[bucket] = Lock()
+                logger.info(f"📦 预分配静态KV缓存分桶: {bucket}")
+            
+            # 预热：每个分桶编译一次解码步骤
+            warmup_inputs = self.processor(
+                text=[self.processor.apply_chat_template(
+                    [{"role": "user", "content": [{"type": "text", "text": "你好"}]}],
+                    tokenize=False,
+                    add_generation_prompt=True
+                )],
+                return_tensors="pt",
+            ).to(self.model.device)
+            for bucket in self.static_cache_buckets:
+                cache = self._static_caches[bucket]
+                cache.reset()
+                generation_kwargs = {**warmup_inputs, "max_new_tokens": 4, "do_sample": False, "past_key_values": cache}
+                if CompileConfig is not None:
+                    generation_kwargs["compile_config"] = CompileConfig(fullgraph=False, mode="reduce-overhead")
+                with torch.no_grad():
+                    self.model.generate(**generation_kwargs)
+                logger.info(f"🔥 分桶 {bucket} 预热编译完成")
+            
+            self._save_compile_cache()
+            logger.info(f"✅ 静态缓存引擎就绪，分桶: {self.static_cache_buckets}")
+            
+        except Exception as e:
+            logger.error(f"❌ 静态缓存引擎初始化失败，回退到eager模式: {e}")
+            self._static_caches = {}
+            self._static_cache_locks = {}
+            self.clear_cuda_cache()
+    
+    def _load_compile_cache(self):
+        """将编译缓存目录指向磁盘，并加载上次保存的编译产物"""
+        if not self.compile_cache_dir:
+            return
+        os.makedirs(self.compile_cache_dir, exist_ok=True)
+        # inductor的FX图缓存/Triton内核缓存写入该目录
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.compile_cache_dir
+        try:
+            import torch._inductor.config as inductor_config
+            inductor_config.fx_graph_cache = True
+        except Exception:
+            pass
+        
+        # PyTorch 2.6+ 支持整体保存/加载编译产物
+        artifact_path = os.path.join(self.compile_cache_dir, "compile_artifacts.bin")
+        if os.path.exists(artifact_path) and hasattr(torch.compiler, "load_cache_artifacts"):
+            try:
+                with open(artifact_path, "rb") as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+                logger.info(f"📂 已加载编译缓存: {artifact_path}")
+            except Exception as e:
+                logger.warning(f"⚠️ 加载编译缓存失败，将重新编译: {e}")
+    
+    def _save_compile_cache(self):
+        """保存编译产物到磁盘，供下次启动复用"""
+        if not self.compile_cache_dir or not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+        try:
+            artifacts = torch.compiler.save_cache_artifacts()
+            if artifacts is not None:
+                artifact_bytes, _ = artifacts
+                artifact_path = os.path.join(self.compile_cache_dir, "compile_artifacts.bin")
+                with open(artifact_path, "wb") as f:
+                    f.write(artifact_bytes)
+                logger.info(f"💾 编译缓存已保存: {artifact_path}")
+        except Exception as e:
+            logger.warning(f"⚠️ 保存编译缓存失败: {e}")
 
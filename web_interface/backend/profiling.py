@@ -0,0 +1,324 @@
+"""
+按需性能剖析 - 管理员接口触发，抓取接下来 N 个请求或 T 秒内的性能数据
+
+一次抓取同时运行：
+- torch.profiler：所有线程的 CPU 算子（有GPU时加上CUDA kernel），视觉编码器、注意力层、lm_head
+  通过模块前后钩子标注为 record_function 区间，chunked模式的采样步骤标注为 sampling，
+  eager模式下 generate() 内部的采样以 aten::softmax / aten::multinomial 等算子出现在算子表中
+- Python 采样剖析器：后台线程按固定间隔采集所有线程的调用栈，输出 collapsed 格式（可直接生成火焰图）
+
+抓取结束后产物写入 <PROFILE_DIR>/<capture_id>/：
+    torch_trace.json        Chrome Trace（chrome://tracing、Perfetto）
+    operators.txt           按耗时排序的算子表
+    python_stacks.collapsed 采样调用栈（flamegraph.pl / speedscope）
+    summary.json            抓取参数和统计
+
+未抓取时不安装任何钩子，请求路径上只有一次布尔判断。
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+from typing import Optional, Dict, Any, List
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class _NullLabel:
+    """未抓取时使用的空上下文管理器"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_LABEL = _NullLabel()
+
+
+class StackSampler:
+    """Python 采样剖析器：定时采集所有线程的调用栈"""
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+            self._stop.wait(self.interval_s)
+
+    def write_collapsed(self, path: str):
+        """写出 collapsed 格式（每行: 栈;帧;帧 次数）"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top_functions(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """按自身采样数排序的热点函数（栈顶帧）"""
+        self_counts: Counter = Counter()
+        for stack, count in self.samples.items():
+            self_counts[stack.rsplit(";", 1)[-1]] += count
+        return [{"frame": frame, "samples": count} for frame, count in self_counts.most_common(limit)]
+
+
+class ProfilerCapture:
+    """一次抓取只允许一个，由控制线程启动和停止 torch.profiler"""
+
+    def __init__(self, profile_dir: str, max_seconds: float = 600):
+        """
+        Args:
+            profile_dir: 抓取产物目录
+            max_seconds: 单次抓取的最长时长（只指定请求数时的兜底，防止一直不结束）
+        """
+        self.profile_dir = profile_dir
+        self.max_seconds = max_seconds
+        self.armed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._remaining_requests: Optional[int] = None
+        self._capture: Optional[Dict[str, Any]] = None
+        self._hooks = []
+        self.history: List[Dict[str, Any]] = []
+
+    def arm(
+        self,
+        model=None,
+        requests: Optional[int] = None,
+        seconds: Optional[float] = None,
+        sampling_interval_ms: float = 5.0,
+        record_shapes: bool = True
+    ) -> Dict[str, Any]:
+        """
+        开始抓取，满足请求数或时长任一条件后结束
+
+        Args:
+            model: 已加载的模型（用于标注视觉编码器/注意力层，None时只抓取算子）
+            requests: 抓取的请求数
+            seconds: 最长抓取时长（秒）
+            sampling_interval_ms: Python 采样间隔（毫秒）
+            record_shapes: 是否记录算子输入形状
+
+        Returns:
+            抓取信息
+
+        Raises:
+            RuntimeError: 已有抓取在进行中
+        """
+        if not requests and not seconds:
+            raise ValueError("请指定 requests 或 seconds")
+        with self._lock:
+            if self.armed:
+                raise RuntimeError("已有性能抓取在进行中")
+            capture_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+            self._capture = {
+                "capture_id": capture_id,
+                "requests": requests,
+                "seconds": seconds,
+                "sampling_interval_ms": sampling_interval_ms,
+                "record_shapes": record_shapes,
+                "started_at": time.time(),
+                "status": "running",
+                "completed_requests": 0,
+            }
+            self._remaining_requests = requests
+            self._done.clear()
+            self.armed = True
+            info = dict(self._capture)
+
+        ready = threading.Event()
+        thread = threading.Thread(
+            target=self._run, args=(model, seconds, sampling_interval_ms, record_shapes, ready),
+            name="profiler-capture", daemon=True
+        )
+        thread.start()
+        ready.wait()
+        logger.info(f"🔬 性能抓取已开始: {capture_id} (请求数: {requests}, 时长: {seconds}s)")
+        return info
+
+    def request_finished(self):
+        """一个请求结束（未抓取时只有一次布尔判断）"""
+        if not self.armed:
+            return
+        with self._lock:
+            if self._capture is None:
+                return
+            self._capture["completed_requests"] += 1
+            if self._remaining_requests is not None:
+                self._remaining_requests -= 1
+                if self._remaining_requests <= 0:
+                    self._done.set()
+
+    def status(self) -> Dict[str, Any]:
+        """当前抓取状态和最近的抓取记录"""
+        with self._lock:
+            return {
+                "armed": self.armed,
+                "current": dict(self._capture) if self.armed and self._capture else None,
+                "captures": list(self.history[-20:])
+            }
+
+    def artifact_dir(self, capture_id: str) -> str:
+        return os.path.join(self.profile_dir, os.path.basename(capture_id))
+
+    def _run(self, model, seconds, sampling_interval_ms, record_shapes, ready):
+        """控制线程：启动 torch.profiler 和采样器，等待结束条件，写出产物"""
+        capture = self._capture
+        out_dir = self.artifact_dir(capture["capture_id"])
+        os.makedirs(out_dir, exist_ok=True)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # 抓取由控制线程启动，CPU算子回调默认只记录启动线程，需要开启全部线程
+        # （Flask请求线程、生成线程、调度线程上的算子和 record_function 标注）
+        experimental_config = _all_threads_config()
+        if experimental_config is None:
+            logger.warning("⚠️ 当前 torch 版本不支持记录所有线程的CPU算子，算子表只包含CUDA kernel")
+        profiler = torch.profiler.profile(
+            activities=activities,
+            record_shapes=record_shapes,
+            **({"experimental_config": experimental_config} if experimental_config is not None else {})
+        )
+        with self._lock:
+            capture["all_threads"] = experimental_config is not None
+        sampler = StackSampler(sampling_interval_ms / 1000)
+        error = None
+        try:
+            self._install_hooks(model)
+            profiler.start()
+            sampler.start()
+        except Exception as e:
+            error = str(e)
+        ready.set()
+
+        if error is None:
+            self._done.wait(timeout=min(seconds or self.max_seconds, self.max_seconds))
+            sampler.stop()
+            try:
+                profiler.stop()
+                profiler.export_chrome_trace(os.path.join(out_dir, "torch_trace.json"))
+                sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+                with open(os.path.join(out_dir, "operators.txt"), "w", encoding="utf-8") as f:
+                    f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=100))
+            except Exception as e:
+                error = str(e)
+            sampler.write_collapsed(os.path.join(out_dir, "python_stacks.collapsed"))
+        self._remove_hooks()
+
+        with self._lock:
+            capture["status"] = "failed" if error else "completed"
+            capture["finished_at"] = time.time()
+            capture["error"] = error
+            capture["python_samples"] = sampler.sample_count
+            capture["top_python_frames"] = sampler.top_functions()
+            capture["artifacts"] = sorted(os.listdir(out_dir)) + ["summary.json"]
+            with open(os.path.join(out_dir, "summary.json"), "w", encoding="utf-8") as f:
+                json.dump(capture, f, ensure_ascii=False, indent=2)
+            self.history.append(dict(capture))
+            self.armed = False
+            self._capture = None
+        if error:
+            logger.error(f"❌ 性能抓取失败 {capture['capture_id']}: {error}")
+        else:
+            logger.info(f"✅ 性能抓取完成: {out_dir}")
+
+    def _install_hooks(self, model):
+        """为视觉编码器、语言模型注意力层和lm_head安装 record_function 标注钩子"""
+        if model is None:
+            return
+        targets = []
+        visual = getattr(model, "visual", None)
+        if visual is not None:
+            targets.append(("vision_tower", visual))
+        for name, module in model.named_modules():
+            if name.startswith("visual"):
+                continue
+            if type(module).__name__.endswith("Attention"):
+                targets.append(("attention", module))
+        lm_head = getattr(model, "lm_head", None)
+        if lm_head is not None:
+            targets.append(("lm_head", lm_head))
+
+        for label, module in targets:
+            self._hooks.append(module.register_forward_pre_hook(_make_pre_hook(label)))
+            self._hooks.append(module.register_forward_hook(_post_hook))
+
+    def _remove_hooks(self):
+        for handle in self._hooks:
+            handle.remove()
+        self._hooks = []
+
+
+def _all_threads_config():
+    """记录所有线程CPU算子的 profiler 实验配置；torch 版本不支持时返回 None"""
+    experimental_config = getattr(getattr(torch._C, "_profiler", None), "_ExperimentalConfig", None)
+    if experimental_config is None:
+        return None
+    try:
+        return experimental_config(profile_all_threads=True)
+    except TypeError:
+        return None
+
+
+def _make_pre_hook(label: str):
+    def pre_hook(module, args):
+        record = torch.profiler.record_function(label)
+        record.__enter__()
+        stack = getattr(_local, "records", None)
+        if stack is None:
+            stack = _local.records = []
+        stack.append(record)
+    return pre_hook
+
+
+def _post_hook(module, args, output):
+    stack = getattr(_local, "records", None)
+    if stack:
+        stack.pop().__exit__(None, None, None)
+
+
+# 全局抓取器（app.py 按配置初始化）
+capture: Optional[ProfilerCapture] = None
+
+
+def label(name: str):
+    """抓取期间用 record_function 标注一段代码（未抓取时为空操作）"""
+    if capture is None or not capture.armed:
+        return _NULL_LABEL
+    return torch.profiler.record_function(name)
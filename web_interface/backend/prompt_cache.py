@@ -0,0 +1,189 @@
+"""
+增量聊天模板缓存 - 每个会话缓存已渲染历史消息的token id，新一轮只渲染和分词新增的消息
+
+- 聊天模板逐条拼接消息（Qwen2.5-VL: <|im_start|>角色\\n内容<|im_end|>\\n），整段文本可以拆成
+  "开头 + 每条消息的片段 + 生成提示"。加载时用探测对话校验拆分后的文本和token id都与整段渲染一致，
+  模板不满足时停用缓存（回退为整段渲染）
+- 片段中每张图片/每段视频只保留一个占位token，展开个数由本轮视觉处理得到的网格尺寸计算
+  （t*h*w / merge_size²），与处理器先展开文本再分词的结果相同
+- 会话历史只追加不修改；缓存记录最后一条已渲染的历史消息对象，会话被导入替换或清除后整体重建
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# 用于切分模板的探测消息
+_SYSTEM_PROBE = {"role": "system", "content": [{"type": "text", "text": "§"}]}
+_CONVERSATION_PROBE = [
+    {"role": "user", "content": [{"type": "image", "image": "probe"}, {"type": "text", "text": "这是什么？"}]},
+    {"role": "assistant", "content": [{"type": "text", "text": "一张图片。"}]},
+    {"role": "user", "content": [{"type": "text", "text": "谢谢"}]},
+]
+
+
+class PromptCache:
+    """按会话缓存历史消息token id的增量提示词构建器（线程安全）"""
+
+    def __init__(self, processor, max_sessions: int = 1024):
+        """
+        Args:
+            processor: 模型处理器（提供聊天模板、分词器和视觉网格参数）
+            max_sessions: 缓存的会话数上限（LRU淘汰）
+        """
+        self.processor = processor
+        self.tokenizer = processor.tokenizer
+        self.max_sessions = max_sessions
+        self.image_token = getattr(processor, "image_token", "<|image_pad|>")
+        self.video_token = getattr(processor, "video_token", "<|video_pad|>")
+        self.image_pad_id = self.tokenizer.convert_tokens_to_ids(self.image_token)
+        self.video_pad_id = self.tokenizer.convert_tokens_to_ids(self.video_token)
+        self.merge_length = processor.image_processor.merge_size ** 2
+        self.stats = {"hits": 0, "rebuilds": 0, "rendered_messages": 0, "fallbacks": 0}
+        # 会话ID -> {"count": 已缓存的历史消息数, "last": 最后一条历史消息, "ids": 开头+历史片段的token id}
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.enabled = self._calibrate()
+
+    def _render(self, messages: List[Dict[str, Any]], add_generation_prompt: bool = False) -> str:
+        return self.processor.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt
+        )
+
+    def _encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+
+    def turn_text(self, message: Dict[str, Any]) -> str:
+        """单条消息在模板中的片段（渲染在探测系统消息之后，再去掉系统消息部分）"""
+        text = self._render([_SYSTEM_PROBE, message])
+        if not text.startswith(self._system_text):
+            raise ValueError("聊天模板的消息片段依赖前文，无法增量渲染")
+        return text[len(self._system_text):]
+
+    def _calibrate(self) -> bool:
+        """切分模板并校验：开头 + 各消息片段 + 生成提示 必须与整段渲染的文本和token id完全一致"""
+        try:
+            self._system_text = self._render([_SYSTEM_PROBE])
+            prompt_text = self._render([_SYSTEM_PROBE], add_generation_prompt=True)
+            if not prompt_text.startswith(self._system_text):
+                raise ValueError("生成提示不是追加在末尾")
+            self.generation_text = prompt_text[len(self._system_text):]
+
+            whole = self._render(_CONVERSATION_PROBE, add_generation_prompt=True)
+            parts = [self.turn_text(message) for message in _CONVERSATION_PROBE]
+            header_len = len(whole) - len(self.generation_text) - sum(len(part) for part in parts)
+            self.header_text = whole[:max(header_len, 0)]
+            if header_len < 0 or self.header_text + "".join(parts) + self.generation_text != whole:
+                raise ValueError("整段渲染不等于逐条片段的拼接")
+
+            self.header_ids = self._encode(self.header_text, add_special_tokens=True)
+            self.generation_ids = self._encode(self.generation_text)
+            ids = list(self.header_ids)
+            for part in parts:
+                ids += self._encode(part)
+            ids += self.generation_ids
+            if ids != self._encode(whole, add_special_tokens=True):
+                raise ValueError("逐段分词结果与整段分词不一致")
+        except Exception as e:
+            logger.warning(f"⚠️ 聊天模板不支持增量渲染，每轮整段渲染: {e}")
+            return False
+        logger.info("✅ 增量聊天模板缓存已启用")
+        return True
+
+    def input_ids(
+        self,
+        session_id: str,
+        history: List[Dict[str, Any]],
+        history_messages: List[Optional[Dict[str, Any]]],
+        current_message: Dict[str, Any]
+    ) -> List[int]:
+        """
+        构建本轮提示词的token id（视觉占位未展开）：只渲染和分词缓存之后新增的历史消息和当前消息
+
+        Args:
+            session_id: 会话ID
+            history: 会话历史原始消息（用于判断缓存是否仍然有效）
+            history_messages: 与 history 一一对应的模板消息（被跳过的消息为 None）
+            current_message: 当前轮的模板消息
+
+        Returns:
+            token id 列表
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        count = 0
+        ids = self.header_ids
+        if entry is not None:
+            cached = entry["count"]
+            if cached <= len(history) and (cached == 0 or history[cached - 1] is entry["last"]):
+                count, ids = cached, entry["ids"]
+                self.stats["hits"] += 1
+            else:
+                self.stats["rebuilds"] += 1
+
+        if count < len(history):
+            ids = list(ids)
+            for message in history_messages[count:]:
+                if message is not None:
+                    ids += self._encode(self.turn_text(message))
+            self.stats["rendered_messages"] += len(history) - count
+            with self._lock:
+                self._sessions[session_id] = {"count": len(history), "last": history[-1], "ids": ids}
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+        return ids + self._encode(self.turn_text(current_message)) + self.generation_ids
+
+    def vision_text(self, num_images: int, num_videos: int) -> str:
+        """只含视觉占位的文本（交给处理器计算像素和网格，不再对整段对话分词）"""
+        return self.image_token * num_images + self.video_token * num_videos
+
+    def expand(
+        self,
+        ids: List[int],
+        image_grid_thw: Optional[torch.Tensor] = None,
+        video_grid_thw: Optional[torch.Tensor] = None
+    ) -> Optional[torch.Tensor]:
+        """
+        按网格尺寸展开视觉占位token
+
+        Returns:
+            [1, 序列长度] 的 input_ids；占位数与视觉输入数不一致时返回 None（调用方回退为整段渲染）
+        """
+        ids = torch.tensor(ids, dtype=torch.long)
+        repeats = torch.ones_like(ids)
+        for pad_id, grid_thw in ((self.image_pad_id, image_grid_thw), (self.video_pad_id, video_grid_thw)):
+            positions = (ids == pad_id).nonzero(as_tuple=True)[0]
+            counts = grid_thw.prod(-1) // self.merge_length if grid_thw is not None else torch.zeros(0, dtype=torch.long)
+            if len(positions) != len(counts):
+                return None
+            repeats[positions] = counts.to(torch.long)
+        return torch.repeat_interleave(ids, repeats).unsqueeze(0)
+
+    def forget(self, session_id: Optional[str] = None):
+        """丢弃会话的缓存（None 表示全部）"""
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
+
+    def fallback(self, session_id: str):
+        """增量结果不可用（如历史图片文件已被删除）时丢弃会话缓存，本轮整段渲染"""
+        self.stats["fallbacks"] += 1
+        self.forget(session_id)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sessions": len(self._sessions),
+                "cached_tokens": sum(len(entry["ids"]) for entry in self._sessions.values()),
+                **self.stats
+            }
@@ -0,0 +1,693 @@
+"""
+会话亲和路由器 - 把请求分发到多个 Lingshu 服务实例
+
+会话是有状态的（conversation_sessions、会话图片），同一会话的请求必须落到同一个实例：
+- 已知会话按路由表转发；未知会话（如路由器重启后）按一致性哈希环查找实例
+- 新会话（请求不带 session_id）选择上报排队深度最小的健康实例，并生成一个在哈希环上
+  恰好落到该实例的会话ID，这样即使路由表丢失，一致性哈希仍能找回会话所在实例
+- 后台线程定期通过 /api/status 检查实例健康和排队深度
+- 移除实例时先停止分配新会话，等待进行中的请求结束，再通过
+  /api/session/<id>/export 和 /api/session/import 把会话逐个迁移到哈希环上的下一个实例
+
+本地测试（启动3个使用假模型后端的实例，端口5101-5103）：
+    python router.py --stub-replicas 3
+    python router.py --replicas http://10.0.0.1:5000 http://10.0.0.2:5000
+
+实例之间需要配置相同的 ADMIN_TOKEN（会话迁移接口需要管理员权限，未配置时实例拒绝迁移请求）。
+--stub-replicas 未配置 ADMIN_TOKEN 时为本次启动生成随机令牌，通过环境变量传给子进程。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import random
+import hashlib
+import secrets
+import logging
+import argparse
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse
+from typing import Optional, Dict, Any, List
+
+from flask import Flask, request, jsonify, Response, stream_with_context
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 传给本机假模型实例的管理员令牌环境变量
+STUB_ADMIN_TOKEN_ENV = "LINGSHU_STUB_ADMIN_TOKEN"
+
+# 转发请求体时每次读取的字节数
+FORWARD_CHUNK_SIZE = 64 * 1024
+
+# 不转发给客户端的逐跳响应头
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "te", "trailer",
+    "upgrade", "proxy-authenticate", "proxy-authorization", "content-length"
+}
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """带虚拟节点的一致性哈希环"""
+
+    def __init__(self, nodes: Optional[List[str]] = None, vnodes: int = 64):
+        self.vnodes = vnodes
+        self._keys: List[int] = []
+        self._nodes: List[str] = []
+        for node in nodes or []:
+            self.add(node)
+
+    def add(self, node: str):
+        for i in range(self.vnodes):
+            key = hash_key(f"{node}#{i}")
+            index = bisect.bisect(self._keys, key)
+            self._keys.insert(index, key)
+            self._nodes.insert(index, node)
+
+    def remove(self, node: str):
+        pairs = [(k, n) for k, n in zip(self._keys, self._nodes) if n != node]
+        self._keys = [k for k, _ in pairs]
+        self._nodes = [n for _, n in pairs]
+
+    def lookup(self, key: str, exclude=()) -> Optional[str]:
+        """顺时针查找第一个不在 exclude 中的节点"""
+        if not self._keys:
+            return None
+        start = bisect.bisect(self._keys, hash_key(key))
+        for offset in range(len(self._keys)):
+            node = self._nodes[(start + offset) % len(self._keys)]
+            if node not in exclude:
+                return node
+        return None
+
+
+class Replica:
+    """一个后端实例的健康状态"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        parsed = urlparse(self.url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.healthy = False
+        self.draining = False
+        self.failures = 0
+        self.active_requests = 0
+        self.scheduler_pending = 0
+        self.model_loaded = False
+        self.last_status: Dict[str, Any] = {}
+        self.last_check = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.active_requests + self.scheduler_pending
+
+    def connect(self, timeout: float = config.REQUEST_TIMEOUT) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def call(self, method: str, path: str, payload=None, timeout: float = 30) -> Dict[str, Any]:
+        """发送JSON请求并解析JSON响应（健康检查和会话迁移使用）"""
+        headers = {"Content-Type": "application/json"}
+        if config.ADMIN_TOKEN:
+            headers["X-Admin-Token"] = config.ADMIN_TOKEN
+        conn = self.connect(timeout)
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = json.loads(resp.read() or b"{}")
+            if resp.status >= 400:
+                raise RuntimeError(data.get("error") or f"HTTP {resp.status}")
+            return data
+        finally:
+            conn.close()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "model_loaded": self.model_loaded,
+            "active_requests": self.active_requests,
+            "scheduler_pending": self.scheduler_pending,
+            "queue_depth": self.queue_depth,
+            "failures": self.failures,
+            "last_check": self.last_check
+        }
+
+
+class SessionRouter:
+    """会话到实例的映射、健康检查和会话迁移（线程安全）"""
+
+    def __init__(
+        self,
+        replica_urls: List[str],
+        vnodes: int = 64,
+        health_interval: float = 5.0,
+        failure_threshold: int = 2,
+        drain_timeout: float = 120.0
+    ):
+        """
+        Args:
+            replica_urls: 实例地址列表
+            vnodes: 每个实例的虚拟节点数
+            health_interval: 健康检查间隔（秒）
+            failure_threshold: 连续失败多少次后视为不健康
+            drain_timeout: 移除实例时等待进行中请求结束的最长时间（秒）
+        """
+        self.vnodes = vnodes
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.drain_timeout = drain_timeout
+        self.replicas: Dict[str, Replica] = {}
+        self.ring = HashRing(vnodes=vnodes)
+        self.pins: Dict[str, str] = {}
+        self.migrated = 0
+        self._in_flight: Dict[str, int] = {}
+        self._migrating = set()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        for url in replica_urls:
+            self.add_replica(url)
+
+    # ---------- 实例管理 ----------
+
+    def add_replica(self, url: str) -> Replica:
+        """添加实例（立即做一次健康检查）；已有会话保持原有映射，只有新会话会分配到新实例"""
+        replica = Replica(url)
+        with self._cond:
+            if replica.url in self.replicas:
+                return self.replicas[replica.url]
+            self.replicas[replica.url] = replica
+            self.ring.add(replica.url)
+        self.check(replica)
+        logger.info(f"➕ 添加实例: {replica.url} ({'健康' if replica.healthy else '不可用'})")
+        return replica
+
+    def remove_replica(self, url: str, migrate: bool = True) -> Dict[str, Any]:
+        """
+        移除实例：停止分配新会话 → 等待进行中请求结束 → 迁移会话 → 从哈希环删除
+
+        Returns:
+            {"migrated": 迁移成功的会话数, "failed": 迁移失败的会话ID}
+        """
+        url = url.rstrip("/")
+        with self._cond:
+            replica = self.replicas.get(url)
+            if replica is None:
+                raise KeyError(url)
+            replica.draining = True
+        logger.info(f"🚰 开始排空实例: {url}")
+
+        # 等待路由器转发到该实例的请求结束
+        deadline = time.time() + self.drain_timeout
+        with self._cond:
+            while time.time() < deadline and any(
+                count and self.pins.get(sid) == url for sid, count in self._in_flight.items()
+            ):
+                self._cond.wait(timeout=1.0)
+
+        result = {"migrated": 0, "failed": []}
+        if migrate and replica.healthy:
+            try:
+                sessions = [s["session_id"] for s in replica.call("GET", "/api/sessions")["sessions"]]
+            except Exception as e:
+                logger.error(f"❌ 获取实例会话列表失败 {url}: {e}")
+                sessions = [sid for sid, pinned in list(self.pins.items()) if pinned == url]
+            for session_id in sessions:
+                if self.migrate_session(session_id, url):
+                    result["migrated"] += 1
+                else:
+                    result["failed"].append(session_id)
+
+        with self._cond:
+            self.ring.remove(url)
+            del self.replicas[url]
+            for sid in [sid for sid, pinned in self.pins.items() if pinned == url]:
+                del self.pins[sid]
+            self._cond.notify_all()
+        logger.info(f"➖ 已移除实例: {url} (迁移 {result['migrated']} 个会话，失败 {len(result['failed'])} 个)")
+        return result
+
+    def migrate_session(self, session_id: str, source_url: str) -> bool:
+        """把一个会话从源实例迁移到哈希环上的下一个可用实例（迁移期间该会话的新请求等待）"""
+        with self._cond:
+            self._migrating.add(session_id)
+            # 等待该会话进行中的请求结束
+            deadline = time.time() + self.drain_timeout
+            while self._in_flight.get(session_id) and time.time() < deadline:
+                self._cond.wait(timeout=1.0)
+            target_url = self.ring.lookup(session_id, exclude=self._unavailable() | {source_url})
+        try:
+            if target_url is None:
+                raise RuntimeError("没有可用的目标实例")
+            source, target = self.replicas[source_url], self.replicas[target_url]
+            exported = source.call("GET", f"/api/session/{session_id}/export")
+            target.call("POST", "/api/session/import", {
+                "session_id": session_id,
+                "messages": exported["messages"],
+                "images": exported["images"]
+            })
+            source.call("POST", "/api/clear_history", {"session_id": session_id})
+            with self._cond:
+                self.pins[session_id] = target_url
+                self.migrated += 1
+            logger.info(f"🚚 会话 {session_id[:8]} 已迁移: {source_url} -> {target_url}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ 会话 {session_id[:8]} 迁移失败: {e}")
+            return False
+        finally:
+            with self._cond:
+                self._migrating.discard(session_id)
+                self._cond.notify_all()
+
+    def _unavailable(self):
+        return {url for url, r in self.replicas.items() if not r.healthy or r.draining}
+
+    # ---------- 健康检查 ----------
+
+    def check(self, replica: Replica):
+        """通过 /api/status 检查一个实例"""
+        try:
+            status = replica.call("GET", "/api/status", timeout=5)
+            replica.active_requests = int(status.get("active_requests", 0))
+            replica.scheduler_pending = int(status.get("scheduler_pending", 0))
+            replica.model_loaded = bool(status.get("model_loaded"))
+            replica.last_status = status
+            replica.failures = 0
+            if not replica.healthy:
+                logger.info(f"✅ 实例恢复: {replica.url}")
+            replica.healthy = True
+        except Exception as e:
+            replica.failures += 1
+            if replica.healthy and replica.failures >= self.failure_threshold:
+                logger.warning(f"⚠️ 实例不可用: {replica.url} ({e})")
+                replica.healthy = False
+        replica.last_check = time.time()
+
+    def start(self):
+        """启动后台健康检查线程"""
+        threading.Thread(target=self._health_loop, name="router-health", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval):
+            for replica in list(self.replicas.values()):
+                self.check(replica)
+
+    # ---------- 路由 ----------
+
+    def least_loaded(self) -> Optional[Replica]:
+        """排队深度最小的健康实例（深度相同时随机选择）"""
+        candidates = [r for r in self.replicas.values() if r.healthy and not r.draining]
+        if not candidates:
+            return None
+        depth = min(r.queue_depth for r in candidates)
+        return random.choice([r for r in candidates if r.queue_depth == depth])
+
+    def new_session(self) -> Optional[str]:
+        """为新会话选择实例，并生成在哈希环上落到该实例的会话ID"""
+        replica = self.least_loaded()
+        if replica is None:
+            return None
+        with self._cond:
+            exclude = self._unavailable()
+            session_id = str(uuid.uuid4())
+            for _ in range(64 * max(1, len(self.replicas))):
+                if self.ring.lookup(session_id, exclude=exclude) == replica.url:
+                    break
+                session_id = str(uuid.uuid4())
+            self.pins[session_id] = replica.url
+        return session_id
+
+    def acquire(self, session_id: str) -> Optional[Replica]:
+        """
+        查找会话所在实例并登记一个进行中的请求（会话迁移中时等待迁移完成）
+
+        Returns:
+            Replica，没有可用实例时返回None
+        """
+        with self._cond:
+            while session_id in self._migrating:
+                self._cond.wait(timeout=1.0)
+            url = self.pins.get(session_id)
+            replica = self.replicas.get(url) if url else None
+            if replica is None or not replica.healthy:
+                if replica is not None:
+                    logger.warning(f"⚠️ 会话 {session_id[:8]} 所在实例不可用，改派到其他实例（历史记录丢失）")
+                url = self.ring.lookup(session_id, exclude=self._unavailable())
+                if url is None:
+                    return None
+                self.pins[session_id] = url
+                replica = self.replicas[url]
+            self._in_flight[session_id] = self._in_flight.get(session_id, 0) + 1
+            return replica
+
+    def release(self, session_id: str):
+        with self._cond:
+            count = self._in_flight.get(session_id, 0) - 1
+            if count > 0:
+                self._in_flight[session_id] = count
+            else:
+                self._in_flight.pop(session_id, None)
+            self._cond.notify_all()
+
+    def forget(self, session_id: Optional[str] = None):
+        """会话被清除后删除路由表项（None表示全部）"""
+        with self._cond:
+            if session_id is None:
+                self.pins.clear()
+            else:
+                self.pins.pop(session_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "replicas": [r.to_dict() for r in self.replicas.values()],
+                "sessions": len(self.pins),
+                "in_flight": sum(self._in_flight.values()),
+                "migrating": len(self._migrating),
+                "migrated": self.migrated
+            }
+
+
+def encode_multipart(fields, files):
+    """
+    编码 multipart/form-data 请求体（文件按块读取，不整体读入内存）
+
+    Args:
+        fields: [(name, value)]
+        files: [(name, filename, content_type, 可 seek 的文件对象)]
+
+    Returns:
+        (body 迭代器, 长度, content_type)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []  # bytes 或 (文件对象, 大小)
+    for name, value in fields:
+        parts.append(
+            f"--{boundary}\r\n".encode()
+            + f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+            + str(value).encode("utf-8") + b"\r\n"
+        )
+    for name, filename, content_type, stream in files:
+        parts.append(
+            f"--{boundary}\r\n".encode()
+            + f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'.encode()
+            + f"Content-Type: {content_type or 'application/octet-stream'}\r\n\r\n".encode()
+        )
+        stream.seek(0, io.SEEK_END)
+        parts.append((stream, stream.tell()))
+        stream.seek(0)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+    def body():
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            stream, _ = part
+            while True:
+                chunk = stream.read(FORWARD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    return body(), length, f"multipart/form-data; boundary={boundary}"
+
+
+def create_app(router: SessionRouter) -> Flask:
+    """创建路由器的Flask应用"""
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = max(config.MAX_FILE_SIZE, config.SLIDE_MAX_FILE_SIZE)  # 单个文件的上限由实例检查
+
+    def forward(replica: Replica, method: str, path: str, body=None, headers=None, on_close=None):
+        """转发请求并流式返回响应（客户端断开时关闭到实例的连接；流式生成在实例上继续，可续传）"""
+        try:
+            conn = replica.connect()
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+        except Exception as e:
+            if on_close:
+                on_close()
+            logger.error(f"❌ 转发到 {replica.url} 失败: {e}")
+            return jsonify({"success": False, "error": f"后端实例不可用: {e}"}), 502
+
+        def stream():
+            try:
+                while True:
+                    data = resp.read1(8192)
+                    if not data:
+                        break
+                    yield data
+            finally:
+                conn.close()
+                if on_close:
+                    on_close()
+
+        headers = [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP_HEADERS]
+        return Response(stream_with_context(stream()), status=resp.status, headers=headers)
+
+    def no_replica():
+        return jsonify({"success": False, "error": "没有可用的后端实例"}), 503
+
+    def forward_headers():
+        return {k: v for k, v in request.headers.items() if k.lower() in ("x-trace", "x-admin-token", "last-event-id")}
+
+    def forward_form(replica: Replica, path: str, session_id: Optional[str] = None, on_close=None):
+        """重新编码并转发 multipart 表单（session_id 替换为给定值）"""
+        # 上传文件已由 werkzeug 解析到临时文件（大文件在磁盘上），转发时按块读取
+        fields = [(k, v) for k, v in request.form.items(multi=True) if k != 'session_id']
+        if session_id:
+            fields.append(('session_id', session_id))
+        files = [
+            (name, f.filename, f.mimetype, f.stream)
+            for name, f in request.files.items(multi=True)
+        ]
+        body, length, content_type = encode_multipart(fields, files)
+        headers = {"Content-Type": content_type, "Content-Length": str(length), **forward_headers()}
+        return forward(replica, "POST", path, body, headers, on_close=on_close)
+
+    def forward_chat(path):
+        """带会话亲和的聊天请求转发（新会话由路由器分配会话ID）"""
+        session_id = request.form.get('session_id') or router.new_session()
+        if session_id is None:
+            return no_replica()
+        replica = router.acquire(session_id)
+        if replica is None:
+            return no_replica()
+        return forward_form(replica, path, session_id, on_close=lambda: router.release(session_id))
+
+    @app.route('/api/chat', methods=['POST'])
+    def chat():
+        return forward_chat('/api/chat')
+
+    @app.route('/api/chat_stream', methods=['POST'])
+    def chat_stream():
+        return forward_chat('/api/chat_stream')
+
+    @app.route('/api/similar', methods=['POST'])
+    def similar():
+        """相似检索：带 session_id 时转发到会话所在实例（上传来源的结果和 sha256 查询只对本会话的上传有效）"""
+        session_id = request.form.get('session_id')
+        if not session_id:
+            replica = router.least_loaded()
+            if replica is None:
+                return no_replica()
+            return forward_form(replica, '/api/similar')
+        replica = router.acquire(session_id)
+        if replica is None:
+            return no_replica()
+        return forward_form(replica, '/api/similar', session_id, on_close=lambda: router.release(session_id))
+
+    def forward_stream_control(method):
+        """断线续传/停止生成：按 session_id 参数转发到生成该流的实例"""
+        session_id = request.args.get('session_id')
+        if not session_id:
+            return jsonify({"success": False, "error": "缺少 session_id"}), 400
+        replica = router.acquire(session_id)
+        if replica is None:
+            return no_replica()
+        return forward(replica, method, request.full_path, None, forward_headers(), on_close=lambda: router.release(session_id))
+
+    @app.route('/api/chat_stream/<request_id>', methods=['GET'])
+    def resume_chat_stream(request_id):
+        return forward_stream_control("GET")
+
+    @app.route('/api/chat_stream/<request_id>/cancel', methods=['POST'])
+    def cancel_chat_stream(request_id):
+        return forward_stream_control("POST")
+
+    @app.route('/api/clear_history', methods=['POST'])
+    def clear_history():
+        data = request.get_json(silent=True) or {}
+        session_id = data.get('session_id')
+        if session_id:
+            replica = router.acquire(session_id)
+            if replica is None:
+                return no_replica()
+            try:
+                result = replica.call("POST", "/api/clear_history", {"session_id": session_id})
+            finally:
+                router.release(session_id)
+            router.forget(session_id)
+            return jsonify(result)
+        # 清除所有会话：广播到所有实例
+        results = broadcast("POST", "/api/clear_history", {})
+        router.forget()
+        return jsonify({"success": all(r.get("success") for r in results.values()), "replicas": results})
+
+    def broadcast(method, path, payload):
+        results = {}
+        for replica in list(router.replicas.values()):
+            try:
+                results[replica.url] = replica.call(method, path, payload, timeout=config.REQUEST_TIMEOUT)
+            except Exception as e:
+                results[replica.url] = {"success": False, "error": str(e)}
+        return results
+
+    @app.route('/api/load_model', methods=['POST'])
+    def load_model():
+        """加载/卸载模型广播到所有实例"""
+        results = broadcast("POST", "/api/load_model", request.get_json(silent=True) or {})
+        ok = all(r.get("success") for r in results.values())
+        return jsonify({"success": ok, "message": "所有实例已加载模型" if ok else "部分实例加载失败", "replicas": results})
+
+    @app.route('/api/unload_model', methods=['POST'])
+    def unload_model():
+        results = broadcast("POST", "/api/unload_model", {})
+        return jsonify({"success": all(r.get("success") for r in results.values()), "replicas": results})
+
+    @app.route('/api/status', methods=['GET'])
+    def status():
+        """排队最少的实例的状态 + 路由器状态"""
+        replica = router.least_loaded()
+        result = dict(replica.last_status) if replica else {"service": "running", "model_loaded": False}
+        result["router"] = router.status()
+        return jsonify(result)
+
+    @app.route('/router/replicas', methods=['GET'])
+    def list_replicas():
+        return jsonify({"success": True, **router.status()})
+
+    @app.route('/router/replicas', methods=['POST'])
+    def add_replica():
+        url = (request.get_json(silent=True) or {}).get('url')
+        if not url:
+            return jsonify({"success": False, "error": "缺少 url"}), 400
+        replica = router.add_replica(url)
+        return jsonify({"success": True, "replica": replica.to_dict()})
+
+    @app.route('/router/replicas', methods=['DELETE'])
+    def remove_replica():
+        """排空并移除实例（后台执行，进度见 GET /router/replicas）"""
+        data = request.get_json(silent=True) or {}
+        url = (data.get('url') or '').rstrip('/')
+        if url not in router.replicas:
+            return jsonify({"success": False, "error": "实例不存在"}), 404
+        threading.Thread(
+            target=router.remove_replica, args=(url, data.get('migrate', True)),
+            name="router-drain", daemon=True
+        ).start()
+        return jsonify({"success": True, "message": f"开始排空实例 {url}"}), 202
+
+    @app.route('/', defaults={'path': ''}, methods=['GET'])
+    @app.route('/<path:path>', methods=['GET', 'POST'])
+    def passthrough(path):
+        """其余请求（页面、静态文件、打分、追踪等无会话状态的接口）转发到排队最少的实例"""
+        replica = router.least_loaded()
+        if replica is None:
+            return no_replica()
+        full_path = request.full_path if request.query_string else request.path
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS | {"host"}}
+        # 请求体按块从客户端连接读出直接写给实例（有长度时原样转发，否则分块传输）
+        body = None
+        if request.content_length or request.headers.get('Transfer-Encoding'):
+            body = request.stream
+            if request.content_length:
+                headers["Content-Length"] = str(request.content_length)
+        return forward(replica, request.method, full_path, body, headers)
+
+    return app
+
+
+def serve_stub_replica(port: int):
+    """启动一个使用假模型后端的实例（本地测试路由器，每个实例一个进程，会话互相隔离）"""
+    config.INFERENCE_BACKEND = "stub"
+    config.ADMIN_TOKEN = os.environ.get(STUB_ADMIN_TOKEN_ENV) or config.ADMIN_TOKEN
+    config.UPLOAD_INSTANCE_ID = f"stub-{port}"  # 实例共享 UPLOAD_FOLDER，各自使用独立的对象目录
+    import app as app_module
+    from stub_backend import StubModelManager
+    manager = StubModelManager(max_pixels=config.MAX_PIXELS, **config.STUB_BACKEND_CONFIG)
+    manager.load_model()
+    app_module.model_manager = manager
+    app_module.app.run(host="127.0.0.1", port=port, threaded=True, use_reloader=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lingshu 会话亲和路由器")
+    parser.add_argument("--replicas", nargs="*", default=list(config.ROUTER_REPLICAS), help="后端实例地址")
+    parser.add_argument("--stub-replicas", type=int, default=0, help="在本机启动N个假模型后端实例（端口从 --stub-base-port 开始）")
+    parser.add_argument("--stub-base-port", type=int, default=5101, help="假模型实例的起始端口")
+    parser.add_argument("--serve-stub", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--host", type=str, default=config.FLASK_HOST, help="路由器监听地址")
+    parser.add_argument("--port", type=int, default=config.ROUTER_PORT, help="路由器端口")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.serve_stub is not None:
+        serve_stub_replica(args.serve_stub)
+        return
+
+    children = []
+    replicas = list(args.replicas)
+    if args.stub_replicas and not config.ADMIN_TOKEN:
+        # 假模型实例也需要管理员令牌才能迁移会话，本地测试时为本次启动生成一个
+        config.ADMIN_TOKEN = secrets.token_urlsafe(32)
+    for i in range(args.stub_replicas):
+        port = args.stub_base_port + i
+        env = {**os.environ, STUB_ADMIN_TOKEN_ENV: config.ADMIN_TOKEN}
+        children.append(subprocess.Popen([sys.executable, __file__, "--serve-stub", str(port)], env=env))
+        replicas.append(f"http://127.0.0.1:{port}")
+    if children:
+        logger.info(f"🧪 已启动 {len(children)} 个假模型实例，等待就绪...")
+        time.sleep(3)
+
+    if not replicas:
+        parser.error("请通过 --replicas 或 --stub-replicas 指定后端实例")
+
+    router = SessionRouter(
+        replicas,
+        vnodes=config.ROUTER_VIRTUAL_NODES,
+        health_interval=config.ROUTER_HEALTH_INTERVAL,
+        drain_timeout=config.ROUTER_DRAIN_TIMEOUT
+    )
+    router.start()
+    logger.info(f"🔀 路由器: http://{args.host}:{args.port} -> {', '.join(router.replicas)}")
+    try:
+        create_app(router).run(host=args.host, port=args.port, threaded=True, use_reloader=False)
+    finally:
+        router.stop()
+        for child in children:
+            child.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+"""
+分块预填充调度器 - 将长prompt的预填充切分为固定大小的token块，与其他请求的解码步骤交替执行
+
+带图片的请求先进入独立的视觉编码阶段：编码线程收集所有排队请求的图片，
+按patch网格尺寸分组后批量运行视觉编码器，再把特征交给各自请求的LLM预填充。
+
+LLM工作线程每轮调度：
+1. 接纳视觉特征已就绪的请求（计算输入嵌入和位置编码）
+2. 所有处于解码阶段的请求各生成一个token
+3. 最早的一个预填充请求前进一个块
+
+这样大型多图prompt的预填充不会一次性占用大量激活显存，
+也不会长时间阻塞其他流式请求的解码。
+"""
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional, Dict, Any, List, Generator
+
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+# 兼容不同版本transformers的DynamicCache位置
+try:
+    from transformers import DynamicCache
+except ImportError:
+    from transformers.cache_utils import DynamicCache
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# 输出队列结束标记
+_END = object()
+
+# 视觉输入键 -> 网格尺寸键
+VISUAL_INPUT_KEYS = (("pixel_values", "image_grid_thw"), ("pixel_values_videos", "video_grid_thw"))
+
+
+class GenerationRequest:
+    """调度器中的单个生成请求"""
+
+    def __init__(self, inputs, generation_config: Dict[str, Any], adapter: Optional[str] = None):
+        """
+        Args:
+            inputs: 处理器输出（已在模型设备上）
+            generation_config: 合并后的生成配置
+            adapter: LoRA适配器名（None表示基座模型）
+        """
+        self.request_id = uuid.uuid4().hex
+        self.inputs = inputs
+        self.config = generation_config
+        self.adapter = adapter
+        self.state = "waiting"  # (vision ->) waiting -> prefill -> decode -> finished
+        self.prompt_len = inputs["input_ids"].shape[-1]
+        self.prefill_tokens_saved = 0
+        self.all_ids = inputs["input_ids"]
+        self.generated_ids: List[int] = []
+        self.visual_features: Optional[Dict[str, Any]] = None
+        self.encoded: Optional[Dict[str, Any]] = None
+        self.cache = None
+        self.prefill_pos = 0
+        self.next_logits = None
+        self.logits_processor = None
+        # 增量解码的偏移（与 TextIteratorStreamer 相同的思路）：每步只解码
+        # generated_ids[prefix_offset:]，减去 [prefix_offset:read_offset] 的文本得到新增部分
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.output_queue: "queue.Queue" = queue.Queue()
+        self.cancelled = False
+        self.error: Optional[str] = None
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.adapter_pinned = False
+
+    @property
+    def has_visual_inputs(self) -> bool:
+        """是否包含需要视觉编码的图片/视频"""
+        return any(self.inputs.get(key) is not None for key, _ in VISUAL_INPUT_KEYS)
+
+    @property
+    def total_tokens(self) -> int:
+        """KV缓存中的token数（prompt + 已生成）"""
+        return self.prompt_len + len(self.generated_ids)
+
+    def prefill_stats(self) -> Dict[str, int]:
+        """预填充token数及视觉token剪枝节省的token数"""
+        return {"tokens": self.prompt_len, "saved": self.prefill_tokens_saved}
+
+    def queue_wait_ms(self) -> float:
+        """从提交到被LLM工作线程接纳的等待时间（毫秒，含视觉编码阶段）"""
+        admitted_at = self.admitted_at if self.admitted_at is not None else time.perf_counter()
+        return (admitted_at - self.submitted_at) * 1000
+
+    def cancel(self):
+        """取消请求（客户端断开等），调度器会在下一轮丢弃它"""
+        self.cancelled = True
+
+    def iter_text(self) -> Generator[str, None, None]:
+        """
+        逐块读取生成的文本，直到请求完成
+
+        Raises:
+            RuntimeError: 请求在调度器中执行失败
+        """
+        while True:
+            item = self.output_queue.get()
+            if item is _END:
+                break
+            yield item
+        if self.error:
+            raise RuntimeError(self.error)
+
+
+class VisionEncoderStage:
+    """
+    视觉编码阶段 - 跨请求批量运行视觉编码器
+
+    独立线程收集所有排队请求的图片/视频，按 (t, h, w) patch网格分组，
+    相同网格的图片拼接成一个批次运行视觉编码器，再把特征按原顺序拆回各个请求。
+    """
+
+    def __init__(self, manager, on_ready, max_batch_patches: int = 16384, batch_wait_ms: int = 10):
+        """
+        Args:
+            manager: 已加载模型的ModelManager
+            on_ready: 请求视觉特征就绪后的回调
+            max_batch_patches: 单个批次的最大patch数（限制视觉编码器显存峰值）
+            batch_wait_ms: 收到第一张图片后等待更多请求的时间窗口（毫秒）
+        """
+        self.manager = manager
+        self.on_ready = on_ready
+        self.max_batch_patches = max_batch_patches
+        self.batch_wait_ms = batch_wait_ms
+        self._pending: List[GenerationRequest] = []
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"batches": 0, "images": 0, "requests": 0}
+
+    def start(self):
+        """启动视觉编码线程"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="vision-encoder-stage", daemon=True)
+        self._thread.start()
+        logger.info(f"👁️ 视觉编码阶段已启动 (批次上限: {self.max_batch_patches} patches, 等待窗口: {self.batch_wait_ms}ms)")
+
+    def stop(self) -> List[GenerationRequest]:
+        """停止线程，返回尚未编码的请求"""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        pending, self._pending = self._pending, []
+        return pending
+
+    def submit(self, req: GenerationRequest):
+        """提交需要视觉编码的请求"""
+        req.state = "vision"
+        with self._condition:
+            self._pending.append(req)
+            self._condition.notify()
+
+    def pending_count(self) -> int:
+        """等待视觉编码的请求数"""
+        with self._condition:
+            return len(self._pending)
+
+    def _run(self):
+        """编码主循环"""
+        with torch.inference_mode():
+            while True:
+                with self._condition:
+                    while self._running and not self._pending:
+                        self._condition.wait()
+                    if not self._running:
+                        return
+                # 短暂等待，让同时上传的其他请求进入同一批次
+                if self.batch_wait_ms > 0:
+                    time.sleep(self.batch_wait_ms / 1000)
+                with self._condition:
+                    batch, self._pending = self._pending, []
+
+                # 已取消的请求不参与编码，直接交给调度器丢弃
+                active = [req for req in batch if not req.cancelled]
+                try:
+                    if active:
+                        self._encode_batch(active)
+                except Exception as e:
+                    logger.error(f"❌ 视觉编码批次失败: {e}")
+                    self.manager.clear_cuda_cache()
+                    for req in active:
+                        req.error = f"视觉编码失败: {e}"
+                for req in batch:
+                    self.on_ready(req)
+
+    def _encode_batch(self, batch: List[GenerationRequest]):
+        """按网格尺寸分组批量编码，并把特征拆回各请求"""
+        visual = self.manager.model.visual
+        merge_unit = getattr(visual, "spatial_merge_size", 2) ** 2
+
+        # 收集所有图片/视频条目: 网格 -> [(请求, 输入键, 序号, patches)]
+        groups = defaultdict(list)
+        item_counts = {}
+        for req in batch:
+            for pixel_key, grid_key in VISUAL_INPUT_KEYS:
+                pixel_values = req.inputs.get(pixel_key)
+                if pixel_values is None:
+                    continue
+                offset = 0
+                grids = req.inputs[grid_key]
+                item_counts[(id(req), pixel_key)] = len(grids)
+                for idx, thw in enumerate(grids):
+                    num_patches = int(thw.prod().item())
+                    groups[tuple(thw.tolist())].append((req, pixel_key, idx, pixel_values[offset:offset + num_patches]))
+                    offset += num_patches
+
+        features = {}
+        for thw, items in groups.items():
+            patches_per_item = items[0][3].shape[0]
+            per_batch = max(1, self.max_batch_patches // patches_per_item)
+            for start in range(0, len(items), per_batch):
+                chunk = items[start:start + per_batch]
+                pixel_values = torch.cat([item[3] for item in chunk], dim=0).type(visual.dtype)
+                grid_thw = torch.tensor([thw] * len(chunk), dtype=torch.long, device=pixel_values.device)
+                output = visual(pixel_values, grid_thw=grid_thw)
+                output = output[0] if isinstance(output, (tuple, list)) else output
+                for (req, pixel_key, idx, _), feature in zip(chunk, output.split(patches_per_item // merge_unit, dim=0)):
+                    features[(id(req), pixel_key, idx)] = feature
+                self.stats["batches"] += 1
+                logger.info(f"👁️ 视觉编码批次: 网格{thw} × {len(chunk)} 张")
+
+        # 按原顺序拼接每个请求的特征
+        for req in batch:
+            req.visual_features = {}
+            for pixel_key, _ in VISUAL_INPUT_KEYS:
+                count = item_counts.get((id(req), pixel_key), 0)
+                if count:
+                    req.visual_features[pixel_key] = torch.cat(
+                        [features[(id(req), pixel_key, idx)] for idx in range(count)], dim=0
+                    )
+                    self.stats["images"] += count
+            self.stats["requests"] += 1
+
+
+class ChunkedPrefillScheduler:
+    """分块预填充调度器"""
+
+    def __init__(
+        self,
+        manager,
+        prefill_chunk_size: int = 512,
+        vision_batch_max_patches: int = 16384,
+        vision_batch_wait_ms: int = 10
+    ):
+        """
+        Args:
+            manager: 已加载模型的ModelManager
+            prefill_chunk_size: 每个预填充块的token数
+            vision_batch_max_patches: 视觉编码批次的最大patch数
+            vision_batch_wait_ms: 视觉编码批次的收集等待窗口（毫秒）
+        """
+        self.manager = manager
+        self.prefill_chunk_size = prefill_chunk_size
+        self.vision_stage = VisionEncoderStage(
+            manager, self._enqueue, vision_batch_max_patches, vision_batch_wait_ms
+        )
+        self._waiting: List[GenerationRequest] = []
+        self._active: List[GenerationRequest] = []
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动调度线程"""
+        if self._running:
+            return
+        self._running = True
+        self.vision_stage.start()
+        self._thread = threading.Thread(target=self._run, name="chunked-prefill-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"🚦 分块预填充调度器已启动 (块大小: {self.prefill_chunk_size})")
+
+    def stop(self):
+        """停止调度线程，未完成的请求以错误结束"""
+        for req in self.vision_stage.stop():
+            self._finish(req, error="调度器已停止")
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        for req in self._waiting + self._active:
+            self._finish(req, error="调度器已停止")
+        self._waiting = []
+        self._active = []
+        logger.info("🛑 分块预填充调度器已停止")
+
+    def submit(self, inputs, generation_config: Dict[str, Any], adapter: Optional[str] = None) -> GenerationRequest:
+        """
+        提交一个生成请求
+
+        Args:
+            inputs: 处理器输出
+            generation_config: 合并后的生成配置
+            adapter: LoRA适配器名（None表示基座模型）
+
+        Returns:
+            GenerationRequest，调用方通过 iter_text() 读取输出
+        """
+        req = GenerationRequest(inputs, generation_config, adapter)
+        logger.info(f"📥 请求 {req.request_id[:8]} 进入调度队列 (prompt: {req.prompt_len} tokens)")
+        if req.has_visual_inputs:
+            self.vision_stage.submit(req)
+        else:
+            self._enqueue(req)
+        return req
+
+    def _enqueue(self, req: GenerationRequest):
+        """请求进入LLM等待队列（视觉特征已就绪或无需视觉编码）"""
+        if req.error:
+            self._finish(req, error=req.error)
+            return
+        req.state = "waiting"
+        with self._condition:
+            self._waiting.append(req)
+            self._condition.notify()
+
+    def pending_count(self) -> int:
+        """排队中和执行中的请求数（含等待视觉编码的请求）"""
+        with self._condition:
+            return len(self._waiting) + len(self._active) + self.vision_stage.pending_count()
+
+    def _run(self):
+        """调度主循环"""
+        with torch.inference_mode():
+            while True:
+                with self._condition:
+                    while self._running and not self._waiting and not self._active:
+                        self._condition.wait()
+                    if not self._running:
+                        return
+                    admitted = self._waiting
+                    self._waiting = []
+
+                for req in admitted:
+                    self._run_step(req, self._admit)
+
+                # 所有解码中的请求各前进一个token
+                for req in list(self._active):
+                    if req.state == "decode":
+                        self._run_step(req, self._decode_step)
+
+                # 最早的预填充请求前进一个块
+                for req in self._active:
+                    if req.state == "prefill":
+                        self._run_step(req, self._prefill_step)
+                        break
+
+                self._active = [r for r in self._active if r.state != "finished"]
+
+    def _run_step(self, req: GenerationRequest, step):
+        """执行一个调度步骤，单个请求失败不影响其他请求"""
+        if req.cancelled:
+            logger.info(f"⏹️ 请求 {req.request_id[:8]} 已取消")
+            self._finish(req)
+            return
+        try:
+            step(req)
+        except Exception as e:
+            logger.error(f"❌ 请求 {req.request_id[:8]} 执行失败: {e}")
+            self._finish(req, error=str(e))
+            self.manager.clear_cuda_cache()
+
+    def _admit(self, req: GenerationRequest):
+        """接纳请求：计算输入嵌入、位置编码并初始化KV缓存"""
+        req.admitted_at = time.perf_counter()
+        # 请求执行期间固定其适配器，防止被LRU淘汰
+        if req.adapter and self.manager.lora is not None:
+            self.manager.lora.pin(req.adapter)
+            req.adapter_pinned = True
+        req.encoded = self.manager._encode_multimodal(req.inputs, req.visual_features)
+        req.visual_features = None
+        # 视觉token剪枝后prompt变短
+        pruned_len = req.encoded["input_ids"].shape[-1]
+        req.prefill_tokens_saved = req.prompt_len - pruned_len
+        req.prompt_len = pruned_len
+        req.all_ids = req.encoded["input_ids"]
+        req.cache = DynamicCache()
+        req.logits_processor = self._build_logits_processor(req.config)
+        req.state = "prefill"
+        self._active.append(req)
+
+    def _prefill_step(self, req: GenerationRequest):
+        """预填充一个块"""
+        start = req.prefill_pos
+        end = min(start + self.prefill_chunk_size, req.prompt_len)
+        logits = self.manager._forward_step(
+            req.encoded["inputs_embeds"][:, start:end],
+            req.encoded["position_ids"][:, :, start:end],
+            req.cache,
+            start,
+            adapter=req.adapter
+        )
+        req.prefill_pos = end
+        if end >= req.prompt_len:
+            logger.info(f"✅ 请求 {req.request_id[:8]} 预填充完成 ({req.prompt_len} tokens, "
+                        f"{(req.prompt_len + self.prefill_chunk_size - 1) // self.prefill_chunk_size} 块)")
+            req.next_logits = logits
+            req.encoded["inputs_embeds"] = None  # 释放整段输入嵌入
+            req.state = "decode"
+
+    def _decode_step(self, req: GenerationRequest):
+        """采样一个token，输出增量文本，并为下一步计算logits"""
+        with profiling.label("sampling"):
+            scores = req.logits_processor(req.all_ids, req.next_logits.float())
+            if req.config.get("do_sample", True):
+                probs = torch.softmax(scores, dim=-1)
+                next_token = torch.multinomial(probs, num_samples=1)
+            else:
+                next_token = torch.argmax(scores, dim=-1, keepdim=True)
+
+        token_id = int(next_token.item())
+        req.all_ids = torch.cat([req.all_ids, next_token.to(req.all_ids.device)], dim=-1)
+
+        if token_id in self.manager._eos_token_ids():
+            self._finish(req)
+            return
+
+        req.generated_ids.append(token_id)
+        self._emit_text(req)
+
+        if len(req.generated_ids) >= req.config.get("max_new_tokens", 512):
+            self._finish(req)
+            return
+
+        position = req.total_tokens - 1
+        req.next_logits = self.manager._forward_step(
+            self.manager.model.get_input_embeddings()(next_token.to(self.manager.model.device)),
+            req.encoded["position_ids"].new_full((3, 1, 1), position + req.encoded["rope_delta"]),
+            req.cache,
+            position,
+            adapter=req.adapter
+        )
+
+    def _emit_text(self, req: GenerationRequest):
+        """增量解码最近的token，输出新增的完整字符（每步的解码量与已生成长度无关）"""
+        tokenizer = self.manager.processor.tokenizer
+        # 带上前一段已输出的token一起解码，保证词间空格和合并规则与整段解码一致
+        prefix_text = tokenizer.decode(req.generated_ids[req.prefix_offset:req.read_offset], skip_special_tokens=True)
+        text = tokenizer.decode(req.generated_ids[req.prefix_offset:], skip_special_tokens=True)
+        # 末尾是不完整的多字节字符时先不输出，等待后续token
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return
+        req.output_queue.put(text[len(prefix_text):])
+        req.prefix_offset = req.read_offset
+        req.read_offset = len(req.generated_ids)
+
+    def _finish(self, req: GenerationRequest, error: Optional[str] = None):
+        """结束请求并释放其KV缓存"""
+        if req.state == "finished":
+            return
+        req.state = "finished"
+        req.error = error
+        if req.adapter_pinned:
+            self.manager.lora.unpin(req.adapter)
+            req.adapter_pinned = False
+        req.cache = None
+        req.encoded = None
+        req.next_logits = None
+        req.output_queue.put(_END)
+
+    def _build_logits_processor(self, config: Dict[str, Any]) -> LogitsProcessorList:
+        """按生成配置构建与model.generate一致的logits处理链"""
+        defaults = self.manager.model.generation_config
+        processors = LogitsProcessorList()
+        repetition_penalty = config.get("repetition_penalty", defaults.repetition_penalty)
+        if repetition_penalty and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if config.get("do_sample", True):
+            temperature = config.get("temperature", defaults.temperature)
+            if temperature and temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(temperature))
+            top_k = config.get("top_k", defaults.top_k)
+            if top_k:
+                processors.append(TopKLogitsWarper(top_k=top_k))
+            top_p = config.get("top_p", defaults.top_p)
+            if top_p is not None and top_p < 1.0:
+                processors.append(TopPLogitsWarper(top_p=top_p))
+        return processors
@@ -0,0 +1,392 @@
+"""
+多层CT/MR序列加载器 - 把一个切片堆栈映射为 Qwen2.5-VL 的视频输入
+
+支持的上传格式：
+- 多帧 DICOM（NumberOfFrames > 1）
+- 切片压缩包（.zip，内含 DICOM 或 PNG/JPG 切片；DICOM 按 InstanceNumber/SliceLocation 排序，其他按文件名排序）
+- NumPy 体数据（.npy，形状 (层数, 高, 宽) 或 (层数, 高, 宽, 3)，按内存映射读取）
+
+几百层的序列逐张作为图片上传会让prompt爆炸，这里按采样策略选出少量切片作为视频帧：
+- uniform: 等间隔采样
+- content: 按相邻切片的内容变化量采样（解剖结构变化快的区间采得更密）
+每个序列的视觉token数不超过预算（视频每2帧合并为一个时间patch，token数 = ceil(帧数/2) x 每帧网格数），
+预算不足以容纳最少帧数时降低帧分辨率。
+
+采样结果按上传文件缓存，同一会话的后续提问直接复用，不重新读取体数据；清除会话时释放。
+"""
+
+import io
+import os
+import re
+import math
+import zipfile
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+import dicom_loader
+import slide_loader
+from dicom_loader import GRID_FACTOR, grid_size, window_to_uint8, AUTO_WINDOW_PERCENTILES
+
+logger = logging.getLogger(__name__)
+
+SERIES_EXTENSIONS = ('.zip', '.npy')
+RASTER_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+SAMPLING_MODES = ('uniform', 'content')
+
+# 视频输入每2帧合并为一个时间patch（qwen_vl_utils 的 FRAME_FACTOR）
+FRAME_FACTOR = 2
+
+# 内容变化采样时计算差异的缩略图边长
+THUMBNAIL_SIZE = 32
+
+
+def _natural_key(name: str):
+    """按文件名中的数字排序（slice_2 在 slice_10 之前）"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+class DicomFramesVolume:
+    """多帧 DICOM"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = dicom_loader.loader.header(path)
+        self.num_slices = self.header["frames"]
+        self.size = (self.header["columns"], self.header["rows"])
+        self._ds = None
+
+    def render(self, index: int, target: Tuple[int, int]) -> Image.Image:
+        if self._ds is None:
+            self._ds = dicom_loader.pydicom.dcmread(self.path, force=True)
+        return dicom_loader.render(self._ds, self.header, target, frame=index)
+
+    def close(self):
+        self._ds = None
+
+
+class ZipVolume:
+    """切片压缩包（只在内存中读取条目，不解压到磁盘）"""
+
+    def __init__(self, path: str, max_slices: int):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        names = [
+            info.filename for info in self._zip.infolist()
+            if not info.is_dir() and not os.path.basename(info.filename).startswith('.')
+            and '__MACOSX' not in info.filename
+        ]
+        raster = sorted((n for n in names if n.lower().endswith(RASTER_EXTENSIONS)), key=_natural_key)
+        dicoms = [n for n in names if not n.lower().endswith(RASTER_EXTENSIONS)]
+        if dicoms and dicom_loader.pydicom is None:
+            raise RuntimeError("读取DICOM需要 pydicom: pip install pydicom")
+
+        self.headers: Dict[str, Dict[str, Any]] = {}
+        for name in dicoms:
+            try:
+                self.headers[name] = dicom_loader.read_header(io.BytesIO(self._zip.read(name)))
+            except Exception:
+                logger.warning(f"⚠️ 跳过无法识别的序列条目: {name}")
+        if self.headers:
+            # 同一压缩包中有多个序列时取切片最多的一个
+            series: Dict[str, List[str]] = {}
+            for name, header in self.headers.items():
+                series.setdefault(header["series_uid"], []).append(name)
+            chosen = max(series.values(), key=len)
+            self.names = sorted(chosen, key=lambda n: (
+                self.headers[n]["instance_number"],
+                self.headers[n]["slice_location"] or 0.0,
+                _natural_key(n)
+            ))
+        else:
+            self.names = raster
+        if not self.names:
+            raise ValueError("压缩包中没有可识别的切片（DICOM 或 PNG/JPG）")
+        if len(self.names) > max_slices:
+            raise ValueError(f"切片数 {len(self.names)} 超过上限 {max_slices}")
+
+        self.num_slices = len(self.names)
+        first = self.names[0]
+        if first in self.headers:
+            self.size = (self.headers[first]["columns"], self.headers[first]["rows"])
+        else:
+            with Image.open(io.BytesIO(self._zip.read(first))) as img:
+                self.size = img.size
+
+    def render(self, index: int, target: Tuple[int, int]) -> Image.Image:
+        name = self.names[index]
+        data = io.BytesIO(self._zip.read(name))
+        if name in self.headers:
+            ds = dicom_loader.pydicom.dcmread(data, force=True)
+            return dicom_loader.render(ds, self.headers[name], target)
+        with Image.open(data) as img:
+            img = img.convert('L' if img.mode in ('L', 'I', 'I;16', 'F') else 'RGB')
+            return img.resize(target, Image.Resampling.LANCZOS)
+
+    def close(self):
+        self._zip.close()
+
+
+class NumpyVolume:
+    """NumPy 体数据（内存映射，只读取采样到的切片）"""
+
+    def __init__(self, path: str, max_slices: int):
+        self.path = path
+        self.volume = np.load(path, mmap_mode='r', allow_pickle=False)
+        if self.volume.ndim == 4 and self.volume.shape[-1] in (3, 4):
+            self.color = True
+        elif self.volume.ndim == 3:
+            self.color = False
+        else:
+            raise ValueError(f"体数据形状应为 (层数, 高, 宽) 或 (层数, 高, 宽, 3)，实际为 {self.volume.shape}")
+        if self.volume.shape[0] > max_slices:
+            raise ValueError(f"切片数 {self.volume.shape[0]} 超过上限 {max_slices}")
+        self.num_slices = self.volume.shape[0]
+        self.size = (self.volume.shape[2], self.volume.shape[1])
+        self._window = None
+
+    def _volume_window(self) -> Tuple[float, float]:
+        """整个体数据共用一个窗（在稀疏取样的体素上取分位数），保证切片之间亮度一致"""
+        if self._window is None:
+            depth, height, width = self.volume.shape[:3]
+            step = max(1, int(round((depth * height * width / 2_000_000) ** (1 / 3))))
+            sample = np.asarray(self.volume[::step, ::step, ::step], dtype=np.float32)
+            low, high = np.percentile(sample, AUTO_WINDOW_PERCENTILES)
+            self._window = ((low + high) / 2, max(high - low, 1.0) + 1.0)
+        return self._window
+
+    def render(self, index: int, target: Tuple[int, int]) -> Image.Image:
+        height, width = self.volume.shape[1:3]
+        stride = max(1, min(height // (2 * target[1]), width // (2 * target[0])))
+        pixels = np.asarray(self.volume[index, ::stride, ::stride])
+        if self.color:
+            if pixels.dtype != np.uint8:
+                pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+            image = Image.fromarray(np.ascontiguousarray(pixels[..., :3]), mode='RGB')
+        else:
+            center, window_width = self._volume_window()
+            image = Image.fromarray(window_to_uint8(pixels.astype(np.float32), center, window_width), mode='L')
+        return image.resize(target, Image.Resampling.BOX if stride > 1 else Image.Resampling.LANCZOS)
+
+    def close(self):
+        self.volume = None
+
+
+def uniform_indices(num_slices: int, count: int) -> List[int]:
+    """等间隔采样（取每个区间的中点）"""
+    return sorted({min(num_slices - 1, int((i + 0.5) * num_slices / count)) for i in range(count)})
+
+
+def content_indices(volume, count: int, max_candidates: int) -> List[int]:
+    """
+    按内容变化采样：在候选切片上计算相邻缩略图的平均绝对差，按累计变化量等分选帧
+
+    Args:
+        volume: 体数据
+        count: 采样帧数
+        max_candidates: 参与比较的候选切片数上限（超出时先等间隔取候选）
+    """
+    candidates = uniform_indices(volume.num_slices, min(volume.num_slices, max_candidates))
+    if len(candidates) <= count:
+        return candidates
+    thumbs = [
+        np.asarray(volume.render(index, (THUMBNAIL_SIZE, THUMBNAIL_SIZE)).convert('L'), dtype=np.float32)
+        for index in candidates
+    ]
+    changes = np.array([0.0] + [float(np.mean(np.abs(b - a))) for a, b in zip(thumbs, thumbs[1:])])
+    cumulative = np.cumsum(changes)
+    if cumulative[-1] <= 0:
+        return uniform_indices(volume.num_slices, count)
+
+    targets = (np.arange(count) + 0.5) / count * cumulative[-1]
+    picked = {candidates[min(len(candidates) - 1, int(i))] for i in np.searchsorted(cumulative, targets)}
+    # 变化集中在少数切片时会重复命中同一切片，用等间隔采样补足
+    for index in uniform_indices(len(candidates), count):
+        if len(picked) >= count:
+            break
+        picked.add(candidates[index])
+    return sorted(picked)
+
+
+class SeriesLoader:
+    """序列加载器（线程安全），采样结果按上传文件缓存"""
+
+    def __init__(
+        self,
+        sampling: str = "uniform",
+        token_budget: int = 2048,
+        frame_max_size: int = 448,
+        max_pixels: int = 1003520,
+        min_frames: int = 4,
+        max_frames: int = 64,
+        max_slices: int = 2048,
+        content_candidates: int = 256,
+        cache_size: int = 16
+    ):
+        """
+        Args:
+            sampling: 切片采样策略 (uniform, content)
+            token_budget: 每个序列的视觉token预算
+            frame_max_size: 帧的最大边长
+            max_pixels: 帧的最大像素数
+            min_frames: 预算不足时优先降低分辨率，保证至少采样的帧数
+            max_frames: 采样帧数上限
+            max_slices: 压缩包/体数据的切片数上限
+            content_candidates: content 采样时参与比较的候选切片数上限
+            cache_size: 缓存的采样序列数
+        """
+        if sampling not in SAMPLING_MODES:
+            raise ValueError(f"未知的切片采样策略: {sampling}（可选: {', '.join(SAMPLING_MODES)}）")
+        self.sampling = sampling
+        self.token_budget = token_budget
+        self.frame_max_size = frame_max_size
+        self.max_pixels = max_pixels
+        self.min_frames = max(FRAME_FACTOR, min_frames)
+        self.max_frames = max_frames
+        self.max_slices = max_slices
+        self.content_candidates = content_candidates
+        self.cache_size = cache_size
+        self.stats = {"samples": 0, "hits": 0}
+        self._cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_series(self, path) -> bool:
+        """压缩包、体数据和多帧 DICOM 作为序列处理"""
+        if not isinstance(path, str):
+            return False
+        if path.lower().endswith(SERIES_EXTENSIONS):
+            return True
+        if dicom_loader.is_dicom(path):
+            try:
+                return dicom_loader.loader.header(path)["frames"] > 1
+            except Exception:
+                return False
+        return False
+
+    def open(self, path: str):
+        lower = path.lower()
+        if lower.endswith('.zip'):
+            return ZipVolume(path, self.max_slices)
+        if lower.endswith('.npy'):
+            return NumpyVolume(path, self.max_slices)
+        return DicomFramesVolume(path)
+
+    def plan(self, num_slices: int, width: int, height: int) -> Dict[str, Any]:
+        """
+        按token预算确定帧尺寸和帧数
+
+        Returns:
+            {"frames", "size": (宽, 高), "tokens"}
+        """
+        size = grid_size(width, height, self.frame_max_size, self.max_pixels)
+        grid_tokens = (size[0] // GRID_FACTOR) * (size[1] // GRID_FACTOR)
+        wanted = min(num_slices, self.min_frames)
+        if math.ceil(wanted / FRAME_FACTOR) * grid_tokens > self.token_budget:
+            # 预算放不下最少帧数，降低帧分辨率
+            frame_pixels = self.token_budget // math.ceil(wanted / FRAME_FACTOR) * GRID_FACTOR * GRID_FACTOR
+            size = grid_size(width, height, self.frame_max_size, max(frame_pixels, GRID_FACTOR * GRID_FACTOR))
+            grid_tokens = (size[0] // GRID_FACTOR) * (size[1] // GRID_FACTOR)
+        frames = min(num_slices, self.max_frames, FRAME_FACTOR * max(1, self.token_budget // grid_tokens))
+        return {"frames": frames, "size": size, "tokens": math.ceil(frames / FRAME_FACTOR) * grid_tokens}
+
+    def token_count(self, path: str) -> int:
+        """序列占用的视觉token数（只读取头信息，不渲染切片）"""
+        volume = self.open(path)
+        try:
+            return self.plan(volume.num_slices, *volume.size)["tokens"]
+        finally:
+            volume.close()
+
+    def load(self, path: str) -> Dict[str, Any]:
+        """
+        采样序列（带缓存）
+
+        Returns:
+            {"frames": [PIL图片], "indices", "num_slices", "size": (宽, 高), "tokens", "sampling"}
+
+        Raises:
+            ValueError: 无法识别的序列
+            RuntimeError: 缺少 pydicom
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached
+
+        volume = self.open(path)
+        try:
+            plan = self.plan(volume.num_slices, *volume.size)
+            if self.sampling == "content":
+                indices = content_indices(volume, plan["frames"], self.content_candidates)
+            else:
+                indices = uniform_indices(volume.num_slices, plan["frames"])
+            frames = [volume.render(index, plan["size"]) for index in indices]
+        finally:
+            volume.close()
+
+        series = {
+            "frames": frames,
+            "indices": indices,
+            "num_slices": volume.num_slices,
+            "size": plan["size"],
+            "tokens": math.ceil(len(frames) / FRAME_FACTOR) * (plan["size"][0] // GRID_FACTOR) * (plan["size"][1] // GRID_FACTOR),
+            "sampling": self.sampling,
+        }
+        logger.info(
+            f"🎞️ 序列已采样: {os.path.basename(path)} {volume.num_slices}层 → {len(frames)}帧 "
+            f"{plan['size'][0]}x{plan['size'][1]} ({self.sampling}, {series['tokens']} tokens)"
+        )
+        with self._lock:
+            self._cache[key] = series
+            self.stats["samples"] += 1
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return series
+
+    def forget(self, paths: Optional[List[str]] = None):
+        """释放会话上传文件的采样缓存（清除会话时调用，None 表示全部释放）"""
+        with self._lock:
+            if paths is None:
+                self._cache.clear()
+                return
+            targets = {os.path.abspath(p) for p in paths}
+            for key in [k for k in self._cache if k[0] in targets]:
+                del self._cache[key]
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sampling": self.sampling,
+                "token_budget": self.token_budget,
+                "cached_series": len(self._cache),
+                **self.stats
+            }
+
+
+# 全局加载器（app.py 按配置初始化）
+loader = SeriesLoader()
+
+
+def image_size(path: str) -> Tuple[int, int]:
+    """图片、序列帧或切片原始尺寸（只读取头信息）"""
+    if loader.is_series(path):
+        volume = loader.open(path)
+        try:
+            return loader.plan(volume.num_slices, *volume.size)["size"]
+        finally:
+            volume.close()
+    if slide_loader.loader.is_slide(path):
+        source = slide_loader.loader.open(path)
+        try:
+            return source.size
+        finally:
+            source.close()
+    return dicom_loader.image_size(path)
@@ -0,0 +1,406 @@
+"""
+相似病例检索索引 - 上传图片和参考集图片的视觉向量近邻检索
+
+- 向量：Lingshu 视觉编码器输出的合并patch特征取平均后L2归一化（ModelManager.embed_images，
+  与生成共用图片管线：DICOM窗宽窗位、序列采样帧、切片全貌图都与模型看到的一致）
+- 近邻结构：安装了 hnswlib 时使用 HNSW 图（增量插入，毫秒级 top-k），否则回退为 numpy 暴力内积检索
+- 条目以内容为键（上传文件的 SHA-256、参考集的 "数据集/划分/索引"），同一内容只计算一次向量；
+  相似度接近1的结果标记为近似重复
+- 删除条目（上传文件的最后一个引用释放时）：元数据和向量清空，HNSW中标记删除，标签位置保留
+- 持久化：索引目录下 vectors.npy（全部向量，HNSW文件缺失或与向量数不一致时据此重建）、
+  hnsw.bin 和 items.json；每插入 save_every 条保存一次，退出前调用 save()
+- 上传图片由后台线程（SimilarIndexer）计算向量，不阻塞聊天请求；上传条目只在会话存续期间保留
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Optional, Dict, Any, List, Callable, Iterable
+
+import numpy as np
+
+# HNSW近邻图（可选，没有时暴力检索）
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_BACKENDS = ("auto", "hnsw", "flat")
+
+# 已删除条目的占位（不保留键和元数据）
+REMOVED_ITEM = {"key": None, "removed": True}
+
+
+class SimilarIndex:
+    """视觉向量近邻索引（线程安全）"""
+
+    def __init__(
+        self,
+        index_dir: str,
+        backend: str = "auto",
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+        save_every: int = 32,
+        duplicate_threshold: float = 0.98
+    ):
+        """
+        Args:
+            index_dir: 索引目录
+            backend: auto(有 hnswlib 时用HNSW), hnsw, flat(暴力检索)
+            m: HNSW每个节点的邻居数
+            ef_construction: HNSW建图时的候选列表长度
+            ef_search: HNSW查询时的候选列表长度（越大召回越高、越慢）
+            save_every: 每插入多少条自动保存一次
+            duplicate_threshold: 相似度不低于该值时标记为近似重复
+        """
+        if backend not in INDEX_BACKENDS:
+            raise ValueError(f"未知的索引类型: {backend}（可选: {', '.join(INDEX_BACKENDS)}）")
+        if backend == "hnsw" and hnswlib is None:
+            raise RuntimeError("HNSW索引需要 hnswlib: pip install hnswlib")
+        self.backend = "hnsw" if backend != "flat" and hnswlib is not None else "flat"
+        self.index_dir = index_dir
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.save_every = save_every
+        self.duplicate_threshold = duplicate_threshold
+        self.dim: Optional[int] = None
+        self.stats = {"queries": 0, "inserts": 0, "removed": 0, "reused": 0, "saves": 0}
+        self._items: List[Dict[str, Any]] = []  # 标签（插入顺序） -> 元数据（已删除的条目为 REMOVED_ITEM）
+        self._labels: Dict[str, int] = {}  # 键 -> 标签
+        self._vectors: Optional[np.ndarray] = None  # 按容量预分配，前 len(self._items) 行有效
+        self._hnsw = None
+        self._unsaved = 0
+        self._lock = threading.RLock()
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _load(self):
+        """加载已保存的索引（HNSW文件缺失或条目数不一致时从向量重建）"""
+        items_path, vectors_path = self._path("items.json"), self._path("vectors.npy")
+        if not os.path.exists(items_path) or not os.path.exists(vectors_path):
+            return
+        try:
+            with open(items_path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+            vectors = np.load(vectors_path)
+            if len(items) != len(vectors):
+                raise ValueError(f"条目数 {len(items)} 与向量数 {len(vectors)} 不一致")
+        except Exception as e:
+            logger.warning(f"⚠️ 相似检索索引损坏，重新开始: {e}")
+            return
+        if not items:
+            return
+        self._init_storage(vectors.shape[1], capacity=len(vectors))
+        self._vectors[:len(vectors)] = vectors
+        self._items = items
+        self._labels = {item["key"]: label for label, item in enumerate(items) if not item.get("removed")}
+
+        if self.backend == "hnsw":
+            hnsw_path = self._path("hnsw.bin")
+            if os.path.exists(hnsw_path):
+                index = hnswlib.Index(space="ip", dim=self.dim)
+                index.load_index(hnsw_path, max_elements=len(self._vectors))
+                if index.get_current_count() == len(items):
+                    index.set_ef(self.ef_search)
+                    self._hnsw = index
+            if self._hnsw is None:
+                logger.info("🔧 HNSW索引文件缺失或过期，按已保存的向量重建")
+                self._hnsw = self._new_hnsw(len(self._vectors))
+                self._hnsw.add_items(vectors, np.arange(len(vectors)))
+                for label, item in enumerate(items):
+                    if item.get("removed"):
+                        self._hnsw.mark_deleted(label)
+        logger.info(f"🔎 已加载相似检索索引: {len(self._labels)} 条 ({self.backend}, {self.dim}维)")
+
+    def _new_hnsw(self, capacity: int):
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.m)
+        index.set_ef(self.ef_search)
+        return index
+
+    def _init_storage(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self._vectors = np.zeros((max(capacity, 1024), dim), dtype=np.float32)
+        if self.backend == "hnsw":
+            self._hnsw = None
+
+    def _grow(self):
+        """容量翻倍（向量数组和HNSW图）"""
+        capacity = len(self._vectors) * 2
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:len(self._items)] = self._vectors[:len(self._items)]
+        self._vectors = vectors
+        if self._hnsw is not None:
+            self._hnsw.resize_index(capacity)
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._labels
+
+    def vector(self, key: str) -> Optional[np.ndarray]:
+        """已索引内容的向量（重复上传时复用，不再运行视觉编码器）"""
+        with self._lock:
+            label = self._labels.get(key)
+            if label is None:
+                return None
+            self.stats["reused"] += 1
+            return self._vectors[label].copy()
+
+    def add(self, key: str, vector: np.ndarray, meta: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        插入一条向量（键已存在时不插入）
+
+        Args:
+            key: 内容键（上传文件的SHA-256或参考集条目ID）
+            vector: 视觉向量（会再次L2归一化）
+            meta: 元数据（source、filename、dataset、label 等，随检索结果返回）
+
+        Returns:
+            是否插入
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        with self._lock:
+            if key in self._labels:
+                return False
+            if self.dim is None:
+                self._init_storage(len(vector))
+            elif len(vector) != self.dim:
+                raise ValueError(f"向量维度 {len(vector)} 与索引维度 {self.dim} 不一致")
+            label = len(self._items)
+            if label >= len(self._vectors):
+                self._grow()
+            self._vectors[label] = vector
+            if self.backend == "hnsw":
+                if self._hnsw is None:
+                    self._hnsw = self._new_hnsw(len(self._vectors))
+                self._hnsw.add_items(vector[None, :], np.array([label]))
+            self._items.append({"key": key, "added_at": time.time(), **(meta or {})})
+            self._labels[key] = label
+            self.stats["inserts"] += 1
+            self._unsaved += 1
+            if self.save_every and self._unsaved >= self.save_every:
+                self.save()
+        return True
+
+    def remove(self, key: str) -> bool:
+        """
+        删除一条（清空元数据和向量，HNSW中标记删除）
+
+        Returns:
+            是否存在并已删除
+        """
+        with self._lock:
+            label = self._labels.pop(key, None)
+            if label is None:
+                return False
+            self._items[label] = dict(REMOVED_ITEM)
+            self._vectors[label] = 0
+            if self._hnsw is not None:
+                self._hnsw.mark_deleted(label)
+            self.stats["removed"] += 1
+            self._unsaved += 1
+        return True
+
+    def purge(self, source: str) -> int:
+        """删除某个来源的全部条目（如启动时清除上次运行留下的上传条目），返回删除数"""
+        with self._lock:
+            keys = [item["key"] for item in self._items if not item.get("removed") and item.get("source") == source]
+            for key in keys:
+                self.remove(key)
+            if keys:
+                self.save()
+        if keys:
+            logger.info(f"🧹 已清除相似检索索引中的 {len(keys)} 条 {source} 条目")
+        return len(keys)
+
+    def query(
+        self,
+        vector: np.ndarray,
+        k: int = 5,
+        source: Optional[str] = None,
+        exclude: Iterable[str] = (),
+        allow: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        查询最相似的 k 条
+
+        Args:
+            vector: 查询向量
+            k: 返回条数
+            source: 只返回该来源的条目（upload 或 reference）
+            exclude: 排除的键（如查询图片自身）
+            allow: 条目过滤函数（如只返回调用方会话自己的上传），返回 False 的条目不出现在结果中
+
+        Returns:
+            [{"score": 余弦相似度, "duplicate": 是否近似重复, **元数据}]，按相似度降序
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        exclude = set(exclude)
+
+        def wanted(label: int) -> bool:
+            item = self._items[label]
+            if item.get("removed") or item["key"] in exclude:
+                return False
+            return (source is None or item.get("source") == source) and (allow is None or allow(item))
+
+        with self._lock:
+            count = len(self._items)
+            if not self._labels or k <= 0:
+                return []
+            self.stats["queries"] += 1
+            if self.backend == "hnsw":
+                # 带过滤条件时多取候选，不够时逐步扩大（最多取全部未删除的条目）
+                count = len(self._labels)
+                fetch = min(count, k + len(exclude))
+                while True:
+                    self._hnsw.set_ef(max(self.ef_search, fetch))  # hnswlib 要求 ef >= k
+                    labels, distances = self._hnsw.knn_query(vector[None, :], k=fetch)
+                    hits = [(int(l), 1.0 - float(d)) for l, d in zip(labels[0], distances[0]) if wanted(int(l))]
+                    if len(hits) >= k or fetch >= count:
+                        break
+                    fetch = min(count, fetch * 4)
+            else:
+                scores = self._vectors[:count] @ vector
+                order = np.argsort(-scores)
+                hits = []
+                for label in order:
+                    if wanted(int(label)):
+                        hits.append((int(label), float(scores[label])))
+                        if len(hits) >= k:
+                            break
+            return [
+                {"score": round(score, 4), "duplicate": score >= self.duplicate_threshold, **self._items[label]}
+                for label, score in hits[:k]
+            ]
+
+    def save(self):
+        """保存索引（先写临时文件再替换，中途崩溃不会留下半个索引）"""
+        with self._lock:
+            if self.dim is None:
+                return
+            count = len(self._items)
+            tmp_vectors = self._path("vectors.tmp.npy")
+            np.save(tmp_vectors, self._vectors[:count])
+            tmp_items = self._path("items.json.tmp")
+            with open(tmp_items, "w", encoding="utf-8") as f:
+                json.dump(self._items, f, ensure_ascii=False)
+            if self._hnsw is not None:
+                tmp_hnsw = self._path("hnsw.bin.tmp")
+                self._hnsw.save_index(tmp_hnsw)
+                os.replace(tmp_hnsw, self._path("hnsw.bin"))
+            os.replace(tmp_vectors, self._path("vectors.npy"))
+            os.replace(tmp_items, self._path("items.json"))
+            self._unsaved = 0
+            self.stats["saves"] += 1
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            sources: Dict[str, int] = {}
+            for item in self._items:
+                if not item.get("removed"):
+                    sources[item.get("source", "unknown")] = sources.get(item.get("source", "unknown"), 0) + 1
+            return {
+                "backend": self.backend,
+                "items": len(self._labels),
+                "tombstones": len(self._items) - len(self._labels),
+                "dim": self.dim,
+                "sources": sources,
+                "unsaved": self._unsaved,
+                **self.stats
+            }
+
+
+class SimilarIndexer:
+    """
+    后台索引线程：上传文件计算向量并插入索引（同一内容只计算一次）；
+    上传文件的最后一个引用释放时调用 forget() 删除条目（正在计算的条目算完后丢弃）
+    """
+
+    def __init__(self, index: SimilarIndex, embed: Callable[[List[str]], List[np.ndarray]], max_pending: int = 256):
+        """
+        Args:
+            index: 相似检索索引
+            embed: 计算向量的函数（文件路径列表 -> 向量列表），需要与生成请求共用GPU名额，模型未加载时抛出异常
+            max_pending: 待索引文件数上限（超出时丢弃新提交的文件）
+        """
+        self.index = index
+        self.embed = embed
+        self.stats = {"indexed": 0, "skipped": 0, "dropped": 0, "failed": 0, "forgotten": 0}
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._current: Optional[str] = None  # 正在计算向量的键
+        self._current_forgotten = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="similar-indexer", daemon=True)
+        self._thread.start()
+
+    def submit(self, items: List[Dict[str, Any]]):
+        """
+        提交待索引的上传文件
+
+        Args:
+            items: [{"key": 内容哈希, "path": 文件路径, **元数据}]
+        """
+        for item in items:
+            if self.index.contains(item["key"]):
+                self.stats["skipped"] += 1
+                continue
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.stats["dropped"] += 1
+
+    def forget(self, key: str):
+        """删除条目（上传文件不再被任何会话引用时调用）；正在计算该条目时算完后不插入"""
+        with self._lock:
+            if key == self._current:
+                self._current_forgotten = True
+            if self.index.remove(key):
+                self.stats["forgotten"] += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            with self._lock:
+                self._current = item["key"]
+                self._current_forgotten = False
+            try:
+                # 文件已删除（引用已全部释放）时跳过
+                if self.index.contains(item["key"]) or not os.path.exists(item["path"]):
+                    self.stats["skipped"] += 1
+                    continue
+                vector = self.embed([item["path"]])[0]
+                meta = {k: v for k, v in item.items() if k not in ("key", "path")}
+                with self._lock:
+                    if self._current_forgotten:
+                        self.stats["skipped"] += 1
+                    elif self.index.add(item["key"], vector, meta):
+                        self.stats["indexed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.warning(f"⚠️ 相似检索索引失败 {item.get('filename')}: {e}")
+            finally:
+                with self._lock:
+                    self._current = None
+
+    def status(self) -> Dict[str, Any]:
+        return {"pending": self._queue.qsize(), **self.stats}
+
+
+# 全局索引和后台索引线程（app.py 按配置初始化，未开启时为 None）
+index: Optional[SimilarIndex] = None
+indexer: Optional[SimilarIndexer] = None
@@ -0,0 +1,459 @@
+"""
+全切片/超大显微图像加载器 - 只读取接近目标分辨率的金字塔层或感兴趣区域
+
+几万像素边长的病理切片如果用 Image.open(...).resize(...) 整张解码，需要数秒和数GB内存。这里按块读取：
+- 有 openslide 时直接读取金字塔层（.svs/.ndpi/.scn 等厂商格式和分块TIFF）
+- 没有 openslide 时：
+  - 金字塔TIFF按页选层；未压缩的分块/分条TIFF只解码与区域相交的块
+  - JPEG 用 draft 模式在解码时按 1/2、1/4、1/8 缩小
+  - 无法按块读取且超过解码上限的文件直接报错（提示安装 openslide），不会整张解码
+- 全貌图从不小于目标尺寸的最粗层按块读取并逐块缩小拼接，内存占用由块大小决定，与切片大小无关
+- 可选按组织占比挑选若干个高倍视野，作为额外的图片一起输入模型
+
+依赖 openslide-python（可选）: pip install openslide-python（另需系统库 libopenslide）
+"""
+
+import os
+import math
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from dicom_loader import GRID_FACTOR, grid_size
+
+try:
+    import openslide
+except ImportError:
+    openslide = None
+
+logger = logging.getLogger(__name__)
+
+# 只有 openslide 能读取的厂商格式
+OPENSLIDE_EXTENSIONS = ('.svs', '.ndpi', '.scn', '.bif', '.vms', '.vmu', '.svslide')
+# 由其他加载器处理的格式
+NON_SLIDE_EXTENSIONS = ('.dcm', '.dicom', '.zip', '.npy')
+
+# 灰度低于该值的像素视为组织（切片背景接近白色）
+TISSUE_GRAY_THRESHOLD = 220
+# 高倍视野的最低组织占比
+MIN_TISSUE_FRACTION = 0.2
+
+_bomb_check_lock = threading.Lock()
+
+
+@contextmanager
+def _unchecked_open(path: str):
+    """打开图片时跳过 PIL 的解压炸弹检查（这里只读取头信息或按块解码，不会整张解码）"""
+    with _bomb_check_lock:
+        saved = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            image = Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = saved
+    try:
+        yield image
+    finally:
+        image.close()
+
+
+def _flatten(region: Image.Image) -> Image.Image:
+    """RGBA 区域合成到白色背景（切片外的透明区域显示为白色）"""
+    if region.mode != 'RGBA':
+        return region.convert('RGB')
+    background = Image.new('RGB', region.size, (255, 255, 255))
+    background.paste(region, mask=region.getchannel('A'))
+    return background
+
+
+class OpenSlideSource:
+    """openslide 读取的金字塔切片"""
+
+    backend = "openslide"
+
+    def __init__(self, path: str):
+        self.slide = openslide.OpenSlide(path)
+        self.size = self.slide.dimensions
+        self.levels = [
+            (width, height, float(downsample))
+            for (width, height), downsample in zip(self.slide.level_dimensions, self.slide.level_downsamples)
+        ]
+
+    def readable(self, level: int) -> bool:
+        return True
+
+    def read(self, level: int, box: Tuple[int, int, int, int]) -> Image.Image:
+        """读取某一层上的区域（box 为该层像素坐标）"""
+        x0, y0, x1, y1 = box
+        downsample = self.levels[level][2]
+        region = self.slide.read_region((int(x0 * downsample), int(y0 * downsample)), level, (x1 - x0, y1 - y0))
+        return _flatten(region)
+
+    def close(self):
+        self.slide.close()
+
+
+class _DecodedLevelSource:
+    """整层解码后裁剪（只缓存一层，层的像素数不超过解码上限时才可读）"""
+
+    backend = "pil"
+
+    def __init__(self, path: str, max_decode_pixels: int):
+        self.path = path
+        self.max_decode_pixels = max_decode_pixels
+        self._decoded: Optional[Tuple[int, Image.Image]] = None
+
+    def readable(self, level: int) -> bool:
+        width, height, _ = self.levels[level]
+        return width * height <= self.max_decode_pixels
+
+    def _decode(self, level: int) -> Image.Image:
+        raise NotImplementedError
+
+    def read(self, level: int, box: Tuple[int, int, int, int]) -> Image.Image:
+        if self._decoded is None or self._decoded[0] != level:
+            self._decoded = None
+            self._decoded = (level, self._decode(level))
+        return self._decoded[1].crop(box)
+
+    def close(self):
+        self._decoded = None
+
+
+class JpegSource(_DecodedLevelSource):
+    """JPEG：draft 模式在 DCT 阶段按 1/2、1/4、1/8 缩小解码"""
+
+    def __init__(self, path: str, size: Tuple[int, int], max_decode_pixels: int):
+        super().__init__(path, max_decode_pixels)
+        self.size = size
+        self.levels = [
+            (math.ceil(size[0] / scale), math.ceil(size[1] / scale), float(scale))
+            for scale in (1, 2, 4, 8)
+        ]
+
+    def _decode(self, level: int) -> Image.Image:
+        width, height, _ = self.levels[level]
+        with _unchecked_open(self.path) as img:
+            img.draft('RGB', (width, height))
+            decoded = img.convert('RGB')
+        if decoded.size != (width, height):
+            decoded = decoded.resize((width, height), Image.Resampling.BOX)
+        return decoded
+
+
+class TiffSource(_DecodedLevelSource):
+    """
+    TIFF：金字塔TIFF的每一页作为一层；未压缩的分块/分条页只解码与区域相交的块，
+    压缩页（由 libtiff 整页解码）只有在不超过解码上限时可读
+    """
+
+    def __init__(self, path: str, max_decode_pixels: int):
+        super().__init__(path, max_decode_pixels)
+        self.pages: List[int] = []
+        self.levels = []
+        self._tiled: Dict[int, bool] = {}
+        with _unchecked_open(path) as img:
+            self.size = img.size
+            aspect = img.size[0] / img.size[1]
+            for page in range(getattr(img, 'n_frames', 1)):
+                img.seek(page)
+                width, height = img.size
+                # 金字塔层与原图宽高比一致且逐层变小；标签图、缩略图等其他页跳过
+                if self.levels and (width >= self.levels[-1][0] or abs(width / height - aspect) > 0.02 * aspect):
+                    continue
+                self.pages.append(page)
+                self.levels.append((width, height, self.size[0] / width))
+                self._tiled[len(self.levels) - 1] = (
+                    not getattr(img, 'use_load_libtiff', False)
+                    and len(img.tile) > 1
+                    and all(entry[0] == 'raw' for entry in img.tile)
+                )
+
+    def readable(self, level: int) -> bool:
+        return self._tiled[level] or super().readable(level)
+
+    def _decode(self, level: int) -> Image.Image:
+        with _unchecked_open(self.path) as img:
+            img.seek(self.pages[level])
+            return img.convert('RGB')
+
+    def read(self, level: int, box: Tuple[int, int, int, int]) -> Image.Image:
+        if not self._tiled[level]:
+            return super().read(level, box)
+        x0, y0, x1, y1 = box
+        with _unchecked_open(self.path) as img:
+            img.seek(self.pages[level])
+            entries = [
+                entry for entry in img.tile
+                if entry[1][0] < x1 and entry[1][2] > x0 and entry[1][1] < y1 and entry[1][3] > y0
+            ]
+            bx0 = min(entry[1][0] for entry in entries)
+            by0 = min(entry[1][1] for entry in entries)
+            bx1 = max(entry[1][2] for entry in entries)
+            by1 = max(entry[1][3] for entry in entries)
+            # 只解码相交的块：把图片尺寸缩小为这些块的外接矩形，块坐标平移到矩形内
+            img._size = (bx1 - bx0, by1 - by0)
+            img.tile = [_shift_tile(entry, bx0, by0) for entry in entries]
+            img.load()
+            return img.convert('RGB').crop((x0 - bx0, y0 - by0, x1 - bx0, y1 - by0))
+
+
+def _shift_tile(entry, dx: int, dy: int):
+    left, top, right, bottom = entry[1]
+    extents = (left - dx, top - dy, right - dx, bottom - dy)
+    if hasattr(entry, '_replace'):
+        return entry._replace(extents=extents)
+    return (entry[0], extents, entry[2], entry[3])
+
+
+class RasterSource(_DecodedLevelSource):
+    """其他格式（PNG等）：单层，只有不超过解码上限时可读"""
+
+    def __init__(self, path: str, size: Tuple[int, int], max_decode_pixels: int):
+        super().__init__(path, max_decode_pixels)
+        self.size = size
+        self.levels = [(size[0], size[1], 1.0)]
+
+    def _decode(self, level: int) -> Image.Image:
+        with _unchecked_open(self.path) as img:
+            return img.convert('RGB')
+
+
+def render_region(source, level: int, box: Tuple[int, int, int, int], out_size: Tuple[int, int],
+                  read_tile: int) -> Image.Image:
+    """
+    按块读取某一层上的区域，逐块缩小后拼接为 out_size（内存占用由 read_tile 决定）
+
+    Args:
+        source: 切片数据源
+        level: 层序号
+        box: 区域（该层像素坐标）
+        out_size: 输出尺寸 (宽, 高)
+        read_tile: 每次读取的块边长（该层像素）
+    """
+    x0, y0, x1, y1 = box
+    scale_x = out_size[0] / (x1 - x0)
+    scale_y = out_size[1] / (y1 - y0)
+    canvas = Image.new('RGB', out_size, (255, 255, 255))
+    for top in range(y0, y1, read_tile):
+        bottom = min(top + read_tile, y1)
+        out_top, out_bottom = round((top - y0) * scale_y), round((bottom - y0) * scale_y)
+        if out_bottom <= out_top:
+            continue
+        for left in range(x0, x1, read_tile):
+            right = min(left + read_tile, x1)
+            out_left, out_right = round((left - x0) * scale_x), round((right - x0) * scale_x)
+            if out_right <= out_left:
+                continue
+            piece = source.read(level, (left, top, right, bottom))
+            canvas.paste(piece.resize((out_right - out_left, out_bottom - out_top), Image.Resampling.BOX),
+                         (out_left, out_top))
+    return canvas
+
+
+def pick_level(source, downsample: float) -> int:
+    """选择可读层中降采样倍数不超过 downsample 的最粗层（分辨率不低于目标），都不满足时取最细的可读层"""
+    readable = [i for i in range(len(source.levels)) if source.readable(i)]
+    if not readable:
+        raise RuntimeError("切片没有可按块读取的层，请安装 openslide 或导出为金字塔TIFF")
+    finer = [i for i in readable if source.levels[i][2] <= downsample + 1e-6]
+    if finer:
+        return max(finer, key=lambda i: source.levels[i][2])
+    return min(readable, key=lambda i: source.levels[i][2])
+
+
+class SlideLoader:
+    """切片加载器（线程安全），渲染结果按文件修改时间缓存"""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        max_pixels: int = 1003520,
+        min_pixels: int = 32 * 1024 * 1024,
+        max_decode_pixels: int = 64 * 1024 * 1024,
+        read_tile: int = 2048,
+        tile_count: int = 0,
+        tile_size: int = 896,
+        tile_downsample: float = 4.0,
+        cache_size: int = 8
+    ):
+        """
+        Args:
+            max_size: 全貌图的最大边长
+            max_pixels: 全貌图和高倍视野的最大像素数
+            min_pixels: 普通图片（TIFF/JPEG/PNG等）超过该像素数时按切片处理
+            max_decode_pixels: 无法按块读取时允许整层解码的像素数上限
+            read_tile: 按块读取的块边长（像素）
+            tile_count: 额外输入的高倍视野数（0 表示只输入全貌图）
+            tile_size: 高倍视野的边长（像素，对齐到28）
+            tile_downsample: 高倍视野相对原始分辨率的降采样倍数
+            cache_size: 缓存的渲染结果数
+        """
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.min_pixels = min_pixels
+        self.max_decode_pixels = max_decode_pixels
+        self.read_tile = read_tile
+        self.tile_count = tile_count
+        self.tile_size = grid_size(tile_size, tile_size, tile_size, max_pixels)[0]
+        self.tile_downsample = tile_downsample
+        self.cache_size = cache_size
+        self.stats = {"renders": 0, "hits": 0}
+        self._cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_slide_name(filename: str) -> bool:
+        """按扩展名判断可能是切片的上传文件（用于放宽上传大小限制）"""
+        return filename.lower().endswith(OPENSLIDE_EXTENSIONS + ('.tif', '.tiff'))
+
+    def is_slide(self, path) -> bool:
+        """厂商切片格式，或像素数超过 min_pixels 的普通图片（只读取头信息）"""
+        if not isinstance(path, str):
+            return False
+        lower = path.lower()
+        if lower.endswith(OPENSLIDE_EXTENSIONS):
+            return True
+        if lower.endswith(NON_SLIDE_EXTENSIONS):
+            return False
+        try:
+            with _unchecked_open(path) as img:
+                width, height = img.size
+        except Exception:
+            return False
+        return width * height > self.min_pixels
+
+    def open(self, path: str):
+        if openslide is not None:
+            try:
+                return OpenSlideSource(path)
+            except Exception:
+                pass
+        if path.lower().endswith(OPENSLIDE_EXTENSIONS):
+            raise RuntimeError(f"读取 {os.path.splitext(path)[1]} 切片需要 openslide: pip install openslide-python")
+        with _unchecked_open(path) as img:
+            image_format, size = img.format, img.size
+        if image_format == 'JPEG':
+            return JpegSource(path, size, self.max_decode_pixels)
+        if image_format == 'TIFF':
+            return TiffSource(path, self.max_decode_pixels)
+        return RasterSource(path, size, self.max_decode_pixels)
+
+    def _overview_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        return grid_size(size[0], size[1], self.max_size, self.max_pixels)
+
+    def _fan_out(self, source, overview: Image.Image) -> List[Dict[str, Any]]:
+        """按全貌图上的组织占比挑选高倍视野并读取"""
+        width, height = source.size
+        region = self.tile_size * self.tile_downsample  # 每个视野覆盖的原始像素边长
+        cols, rows = max(1, int(width // region)), max(1, int(height // region))
+        tissue = np.asarray(overview.convert('L')) < TISSUE_GRAY_THRESHOLD
+        cell_w, cell_h = tissue.shape[1] / cols, tissue.shape[0] / rows
+        cells = []
+        for row in range(rows):
+            for col in range(cols):
+                cell = tissue[int(row * cell_h):int((row + 1) * cell_h), int(col * cell_w):int((col + 1) * cell_w)]
+                if cell.size:
+                    cells.append((float(cell.mean()), row, col))
+        cells = [c for c in sorted(cells, reverse=True) if c[0] >= MIN_TISSUE_FRACTION][:self.tile_count]
+
+        level = pick_level(source, self.tile_downsample)
+        level_w, level_h, downsample = source.levels[level]
+        tiles = []
+        for fraction, row, col in cells:
+            box = (
+                int(col * region / downsample), int(row * region / downsample),
+                min(level_w, int((col + 1) * region / downsample)), min(level_h, int((row + 1) * region / downsample))
+            )
+            out_size = grid_size(box[2] - box[0], box[3] - box[1], self.tile_size, self.max_pixels)
+            tiles.append({
+                "image": render_region(source, level, box, out_size, self.read_tile),
+                "box": [int(v * downsample) for v in box],
+                "tissue": round(fraction, 3),
+            })
+        return tiles
+
+    def token_count(self, path: str) -> int:
+        """全貌图和高倍视野占用的视觉token数上限（只读取头信息）"""
+        source = self.open(path)
+        try:
+            width, height = self._overview_size(source.size)
+        finally:
+            source.close()
+        tile_tokens = (self.tile_size // GRID_FACTOR) ** 2
+        return (width // GRID_FACTOR) * (height // GRID_FACTOR) + self.tile_count * tile_tokens
+
+    def load(self, path: str) -> Dict[str, Any]:
+        """
+        渲染切片（带缓存）
+
+        Returns:
+            {"overview": PIL图片, "tiles": [{"image", "box", "tissue"}], "size", "level", "backend"}
+
+        Raises:
+            RuntimeError: 缺少 openslide，或切片无法在内存上限内读取
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached
+
+        source = self.open(path)
+        try:
+            out_size = self._overview_size(source.size)
+            level = pick_level(source, source.size[0] / out_size[0])
+            level_w, level_h, _ = source.levels[level]
+            overview = render_region(source, level, (0, 0, level_w, level_h), out_size, self.read_tile)
+            tiles = self._fan_out(source, overview) if self.tile_count > 0 else []
+        finally:
+            source.close()
+
+        slide = {
+            "overview": overview,
+            "tiles": tiles,
+            "size": source.size,
+            "level": level,
+            "backend": source.backend,
+        }
+        logger.info(
+            f"🔬 切片已读取: {os.path.basename(path)} {source.size[0]}x{source.size[1]} "
+            f"(层 {level}/{len(source.levels)}, {source.backend}) → 全貌 {out_size[0]}x{out_size[1]} + {len(tiles)}个高倍视野"
+        )
+        with self._lock:
+            self._cache[key] = slide
+            self.stats["renders"] += 1
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return slide
+
+    def forget(self, paths: Optional[List[str]] = None):
+        """释放会话上传文件的渲染缓存（None 表示全部释放）"""
+        with self._lock:
+            if paths is None:
+                self._cache.clear()
+                return
+            targets = {os.path.abspath(p) for p in paths}
+            for key in [k for k in self._cache if k[0] in targets]:
+                del self._cache[key]
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "openslide": openslide is not None,
+                "tile_count": self.tile_count,
+                "cached_slides": len(self._cache),
+                **self.stats
+            }
+
+
+# 全局加载器（app.py 按配置初始化）
+loader = SlideLoader()
@@ -0,0 +1,208 @@
+"""
+可续传的流式回复 - 每个流式请求的SSE事件写入有界的重放缓冲区，生成与客户端连接解耦
+
+- 每个事件带递增的事件ID（SSE id 字段）。连接断开后客户端带 Last-Event-ID 请求
+  GET /api/chat_stream/<request_id>，从断点之后的事件继续接收；断开期间生成在后台继续
+- 缓冲区只保留最近 max_events 个事件，断点早于保留窗口时返回 replay_expired 错误
+- 生成结束后缓冲区再保留 grace_seconds 秒供重连，过期后删除（创建和查询时顺带清理）
+- 用户主动停止生成时调用 cancel()：cancelled 事件同时传给模型的流式生成（StoppingCriteria），
+  model.generate 在下一个token处停止；生成线程等模型线程退出后才释放并发名额，
+  最后写入 cancelled 结束事件（续传的客户端据此区分主动停止和连接中断）
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, List, Tuple, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event_id: Optional[int], payload: Dict[str, Any]) -> str:
+    """格式化一条SSE事件（event_id 为 None 时不带 id 字段，不影响客户端的断点）"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+
+def parse_last_event_id(value) -> int:
+    """解析 Last-Event-ID（缺失或无效时从头开始）"""
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def expired_payload(request_id: str) -> Dict[str, Any]:
+    """断点早于保留窗口时发送的错误事件"""
+    return {'error': '断点已超出续传窗口，请重新提问', 'replay_expired': True, 'request_id': request_id}
+
+
+def cancelled_payload(request_id: str) -> Dict[str, Any]:
+    """用户停止生成后的结束事件"""
+    return {'done': True, 'cancelled': True, 'request_id': request_id}
+
+
+class ReplayBuffer:
+    """单个流的事件重放缓冲区（线程安全：生成线程写入，任意个连接读取）"""
+
+    def __init__(self, request_id: str, session_id: Optional[str], max_events: int):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.cancelled = threading.Event()
+        self._events: deque = deque(maxlen=max_events)  # (事件ID, 内容)
+        self._next_id = 1
+        self._cond = threading.Condition()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def append(self, payload: Dict[str, Any]) -> int:
+        """写入一个事件，返回事件ID"""
+        with self._cond:
+            event_id = self._next_id
+            self._next_id += 1
+            self._events.append((event_id, payload))
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for notify in listeners:
+            notify()
+        return event_id
+
+    def finish(self):
+        """生成结束（含出错、取消），等待中的读取方读完剩余事件后结束"""
+        with self._cond:
+            self.finished_at = time.time()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for notify in listeners:
+            notify()
+
+    def cancel(self):
+        """请求停止生成"""
+        self.cancelled.set()
+
+    def since(self, last_event_id: int) -> Tuple[List[Tuple[int, Dict[str, Any]]], bool, bool]:
+        """
+        取断点之后的事件
+
+        Returns:
+            (事件列表, 是否已结束, 断点是否早于保留窗口)
+        """
+        with self._cond:
+            return self._since(last_event_id)
+
+    def _since(self, last_event_id: int):
+        first_id = self._events[0][0] if self._events else self._next_id
+        lost = last_event_id + 1 < first_id
+        events = [event for event in self._events if event[0] > last_event_id]
+        return events, self.finished, lost
+
+    def follow(self, last_event_id: int = 0) -> Iterator[Tuple[Optional[int], Dict[str, Any]]]:
+        """
+        阻塞读取：依次产出断点之后的事件，新事件到达时继续，生成结束且读完后返回
+        （Flask 流式响应使用；异步服务用 add_listener 在事件循环上等待）
+        """
+        while True:
+            with self._cond:
+                while not self.finished and (not self._events or self._events[-1][0] <= last_event_id):
+                    self._cond.wait()
+                events, finished, lost = self._since(last_event_id)
+            if lost:
+                yield None, expired_payload(self.request_id)
+                return
+            for event_id, payload in events:
+                yield event_id, payload
+                last_event_id = event_id
+            if finished:
+                return
+
+    def add_listener(self, notify: Callable[[], None]):
+        """注册新事件/结束时的回调（在写入线程中调用，需线程安全）"""
+        with self._cond:
+            self._listeners.append(notify)
+
+    def remove_listener(self, notify: Callable[[], None]):
+        with self._cond:
+            if notify in self._listeners:
+                self._listeners.remove(notify)
+
+
+class StreamRegistry:
+    """按请求ID管理重放缓冲区（线程安全）"""
+
+    def __init__(self, max_events: int = 4096, grace_seconds: float = 120):
+        """
+        Args:
+            max_events: 每个流保留的最近事件数
+            grace_seconds: 生成结束后缓冲区保留多久供重连（秒）
+        """
+        self.max_events = max_events
+        self.grace_seconds = grace_seconds
+        self.stats = {"streams": 0, "resumes": 0, "cancelled": 0, "expired": 0}
+        self._buffers: "OrderedDict[str, ReplayBuffer]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sweep(self):
+        """删除结束超过宽限期的缓冲区（调用方持有锁）"""
+        deadline = time.time() - self.grace_seconds
+        for request_id in [rid for rid, buf in self._buffers.items() if buf.finished and buf.finished_at < deadline]:
+            del self._buffers[request_id]
+            self.stats["expired"] += 1
+
+    def create(self, request_id: str, session_id: Optional[str] = None) -> ReplayBuffer:
+        buffer = ReplayBuffer(request_id, session_id, self.max_events)
+        with self._lock:
+            self._sweep()
+            self._buffers[request_id] = buffer
+            self.stats["streams"] += 1
+        return buffer
+
+    def get(self, request_id: str, session_id: Optional[str] = None) -> Optional[ReplayBuffer]:
+        """按请求ID查找缓冲区（指定会话ID时必须一致）；不存在或已过期时返回 None"""
+        with self._lock:
+            self._sweep()
+            buffer = self._buffers.get(request_id)
+        if buffer is None or (session_id and buffer.session_id != session_id):
+            return None
+        return buffer
+
+    def resume(self, request_id: str, session_id: Optional[str] = None) -> Optional[ReplayBuffer]:
+        """断线重连时查找缓冲区（计入续传统计）"""
+        buffer = self.get(request_id, session_id)
+        if buffer is not None:
+            self.stats["resumes"] += 1
+            logger.info(f"🔁 流式回复续传: {request_id[:8]}")
+        return buffer
+
+    def cancel(self, request_id: str, session_id: Optional[str] = None) -> bool:
+        """停止生成（用户点击停止）；流不存在时返回 False"""
+        buffer = self.get(request_id, session_id)
+        if buffer is None:
+            return False
+        if not buffer.finished and not buffer.cancelled.is_set():
+            buffer.cancel()
+            self.stats["cancelled"] += 1
+            logger.info(f"⏹️ 停止生成: {request_id[:8]}")
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            self._sweep()
+            active = sum(1 for buf in self._buffers.values() if not buf.finished)
+            return {
+                "buffered": len(self._buffers),
+                "active": active,
+                "max_events": self.max_events,
+                "grace_seconds": self.grace_seconds,
+                **self.stats
+            }
+
+
+# 全局注册表（app.py 按配置初始化）
+registry = StreamRegistry()
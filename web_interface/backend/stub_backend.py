@@ -0,0 +1,281 @@
+"""
+确定性假推理后端 - 与 ModelManager 接口相同，不加载模型
+
+用于在没有GPU的机器上测试/压测HTTP层、会话管理和并发控制，以及做容量规划：
+- 预填充耗时与prompt token数、图片token数成正比（图片token数按 Qwen2.5-VL 的28x28合并网格估算）
+- 按配置的速率逐token输出，同一问题总是生成相同的文本
+- 可模拟显存不足（OOM）和慢启动（加载耗时）
+- parallelism 限制同时执行计算的请求数（1 表示像单卡一样串行交替执行）
+
+通过 config.py 中的 INFERENCE_BACKEND = "stub" 启用，参数见 STUB_BACKEND_CONFIG。
+"""
+
+import os
+import math
+import time
+import random
+import hashlib
+import logging
+import threading
+from typing import Optional, Dict, Any, List, Generator
+
+import dicom_loader
+import series_loader
+import slide_loader
+import upload_store
+
+logger = logging.getLogger(__name__)
+
+# 与 Qwen2.5-VL 一致：每个视觉token对应 28x28 像素
+IMAGE_TOKEN_PIXELS = 28 * 28
+
+# 生成文本使用的词表
+STUB_VOCABULARY = [
+    "图像", "显示", "可见", "未见", "明显", "异常", "病灶", "区域", "边界", "清晰",
+    "密度", "增高", "建议", "结合", "临床", "进一步", "检查", "随访", "，", "。",
+]
+
+OOM_MESSAGE = "CUDA out of memory. Tried to allocate 2.00 GiB (模拟)"
+
+
+class StubModelManager:
+    """假模型管理器"""
+
+    def __init__(
+        self,
+        prefill_ms_per_token: float = 0.2,
+        prefill_ms_per_image_token: float = 0.5,
+        tokens_per_second: float = 30.0,
+        load_time_s: float = 0.0,
+        oom_probability: float = 0.0,
+        oom_prompt_tokens: Optional[int] = None,
+        parallelism: int = 1,
+        max_pixels: int = 1003520,
+        seed: int = 0
+    ):
+        """
+        Args:
+            prefill_ms_per_token: 每个文本token的预填充耗时（毫秒）
+            prefill_ms_per_image_token: 每个图片token的预填充耗时（毫秒，含视觉编码）
+            tokens_per_second: 单请求解码速率
+            load_time_s: 模拟的模型加载耗时（慢启动）
+            oom_probability: 每个请求随机触发OOM的概率
+            oom_prompt_tokens: prompt token数（含图片）超过该值时必定OOM（None表示不限制）
+            parallelism: 同时执行计算的请求数
+            max_pixels: 单张图片的最大像素数（与 ModelManager 的 max_pixels 一致）
+            seed: 随机种子（OOM抽样和生成文本）
+        """
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.prefill_ms_per_image_token = prefill_ms_per_image_token
+        self.tokens_per_second = tokens_per_second
+        self.load_time_s = load_time_s
+        self.oom_probability = oom_probability
+        self.oom_prompt_tokens = oom_prompt_tokens
+        self.max_pixels = max_pixels
+        self.seed = seed
+        self.quantization = "stub"
+        self.engine_mode = "stub"
+        self.kv_cache_quantization = None
+        self.scheduler = None
+        self._loaded = False
+        self._compute = threading.Semaphore(max(1, parallelism))
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def load_model(self) -> bool:
+        """模拟加载（可配置耗时）"""
+        logger.info(f"🧪 加载假模型 (耗时 {self.load_time_s:.1f}s)...")
+        time.sleep(self.load_time_s)
+        self._loaded = True
+        logger.info("✅ 假模型加载完成")
+        return True
+
+    def unload_model(self) -> bool:
+        """卸载假模型"""
+        self._loaded = False
+        return True
+
+    def is_loaded(self) -> bool:
+        """检查模型是否已加载"""
+        return self._loaded
+
+    def clear_cuda_cache(self):
+        """与 ModelManager 接口一致（无操作）"""
+
+    def generate_response(
+        self,
+        prompt: str,
+        image_paths: Optional[List[str]] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """生成回复（不带历史记录）"""
+        return self.generate_response_with_history(prompt, image_paths, [], generation_config, adapter)
+
+    def generate_response_with_history(
+        self,
+        prompt: str,
+        image_paths: Optional[List[str]] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """生成回复（阻塞），返回格式与 ModelManager 一致（session_id 仅为接口兼容）"""
+        stats = {}
+        chunks = []
+        try:
+            for chunk in self._generate(prompt, image_paths or [], history or [], generation_config, stats, adapter):
+                chunks.append(chunk)
+        except RuntimeError as e:
+            logger.error(f"❌ 生成失败: {e}")
+            return {"success": False, "error": str(e)}
+        return {
+            "success": True,
+            "response": "".join(chunks),
+            "has_images": bool(image_paths),
+            "image_count": len(image_paths or []),
+            "compressed_paths": [],
+            **stats
+        }
+
+    def generate_response_stream(
+        self,
+        prompt: str,
+        image_paths: Optional[List[str]] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        compressed_paths_container: Optional[List[str]] = None,
+        stats_container: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        session_id: Optional[str] = None,
+        cancel_event: Optional[threading.Event] = None
+    ) -> Generator[str, None, None]:
+        """生成回复（流式），出错时与 ModelManager 一样输出 "[错误] ..." 文本；cancel_event 被设置时在下一个token处停止"""
+        try:
+            for chunk in self._generate(
+                prompt, image_paths or [], history or [], generation_config,
+                stats_container if stats_container is not None else {}, adapter
+            ):
+                yield chunk
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+        except RuntimeError as e:
+            logger.error(f"❌ 流式生成失败: {e}")
+            yield f"[错误] {str(e)}"
+
+    def score_options(
+        self,
+        prompt: str,
+        options: List[str],
+        image_paths: Optional[List[str]] = None,
+        adapter: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """候选答案打分：按问题、适配器和候选答案的哈希给出确定性的对数概率"""
+        text_tokens, image_tokens = self.count_prompt_tokens(prompt, image_paths or [], [])
+        self._prefill(text_tokens, image_tokens)
+        scored = []
+        for option in options:
+            key = f"{adapter}:{prompt}" if adapter else prompt
+            digest = hashlib.sha256(f"{key}\n{option}".encode("utf-8")).digest()
+            logprob = -1.0 - digest[0] / 32.0
+            scored.append({"option": option, "logprob": logprob, "avg_logprob": logprob / max(1, len(option))})
+        total = sum(math.exp(s["logprob"]) for s in scored)
+        for s in scored:
+            s["probability"] = math.exp(s["logprob"]) / total
+        scored.sort(key=lambda s: s["logprob"], reverse=True)
+        return {
+            "success": True,
+            "ranking": scored,
+            "prefill_tokens": text_tokens + image_tokens,
+            "compressed_paths": []
+        }
+
+    def image_tokens(self, image_path: str) -> int:
+        """按28x28合并网格估算单张图片的视觉token数（超出max_pixels时等比缩小；序列和切片按读取计划计算）"""
+        manifest = upload_store.manifest(image_path)
+        if manifest is not None and manifest.get("width"):
+            # 上传时已记录尺寸和开销，不再打开文件
+            if manifest["kind"] != "image":
+                return manifest["tokens"]
+            pixels = min(manifest["width"] * manifest["height"], self.max_pixels)
+            return max(4, pixels // IMAGE_TOKEN_PIXELS)
+        try:
+            if series_loader.loader.is_series(image_path):
+                return series_loader.loader.token_count(image_path)
+            if slide_loader.loader.is_slide(image_path):
+                return slide_loader.loader.token_count(image_path)
+            width, height = dicom_loader.image_size(image_path)
+        except Exception:
+            return 0
+        pixels = min(width * height, self.max_pixels)
+        return max(4, pixels // IMAGE_TOKEN_PIXELS)
+
+    def count_prompt_tokens(self, prompt: str, image_paths: List[str], history: List[Dict[str, Any]]):
+        """
+        估算prompt token数（文本按字符计，含历史消息和历史图片）
+
+        Returns:
+            (文本token数, 图片token数)
+        """
+        text_tokens = len(prompt) + 20  # 聊天模板开销
+        text_tokens += sum(len(h.get('content') or "") + 5 for h in history)
+        image_tokens = 0
+        for paths in [image_paths] + [h.get('image_paths', []) for h in history if h.get('has_images')]:
+            image_tokens += sum(self.image_tokens(p) for p in paths if os.path.exists(p))
+        return text_tokens, image_tokens
+
+    def _prefill(self, text_tokens: int, image_tokens: int) -> float:
+        """
+        模拟预填充耗时（占用计算资源）
+
+        Returns:
+            等待计算资源的时间（毫秒）
+        """
+        queued = time.perf_counter()
+        with self._compute:
+            queue_wait_ms = (time.perf_counter() - queued) * 1000
+            time.sleep((text_tokens * self.prefill_ms_per_token + image_tokens * self.prefill_ms_per_image_token) / 1000)
+        return queue_wait_ms
+
+    def _generate(self, prompt, image_paths, history, generation_config, stats, adapter=None) -> Generator[str, None, None]:
+        """按配置的速率逐token输出确定性文本（不同适配器生成不同的文本）"""
+        if not self._loaded:
+            raise RuntimeError("模型未加载")
+        config = {"max_new_tokens": 512, "temperature": 0.7, "top_p": 0.9, "do_sample": True, "repetition_penalty": 1.1}
+        config.update(generation_config or {})
+        max_new_tokens = int(config["max_new_tokens"])
+
+        text_tokens, image_tokens = self.count_prompt_tokens(prompt, image_paths, history)
+        prompt_tokens = text_tokens + image_tokens
+        stats["generation_config"] = config
+        stats["adapter"] = adapter
+        stats["timings"] = {"prepare_ms": 0.0, "queue_wait_ms": 0.0}
+
+        with self._rng_lock:
+            oom = self._rng.random() < self.oom_probability
+        if oom or (self.oom_prompt_tokens is not None and prompt_tokens > self.oom_prompt_tokens):
+            raise RuntimeError(OOM_MESSAGE)
+
+        stats["timings"]["queue_wait_ms"] = self._prefill(text_tokens, image_tokens)
+
+        # 同一问题（含历史长度）总是生成相同的文本
+        key = f"{self.seed}:{len(history)}:{prompt}" + (f":{adapter}" if adapter else "")
+        seed = int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        interval = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        generated = 0
+        for _ in range(max_new_tokens):
+            with self._compute:
+                time.sleep(interval)
+            generated += 1
+            yield rng.choice(STUB_VOCABULARY)
+
+        stats["prefill"] = {"tokens": prompt_tokens, "saved": 0}
+        stats["kv_cache"] = {
+            "mode": "none",
+            "tokens": prompt_tokens + generated,
+            "full_precision_bytes": 0,
+            "used_bytes": 0,
+            "saved_bytes": 0
+        }
@@ -0,0 +1,81 @@
+"""
+视觉token剪枝 - 在视觉编码器之后丢弃或合并低信息量的图片token
+
+胸片、MedMNIST等医学图像有大面积均匀背景和边框，Qwen2.5-VL仍会为每个28x28区域输出一个token。
+剪枝按每个合并token对应像素区域的方差打分，只保留信息量最高的一部分：
+- off: 直通，不做任何剪枝
+- variance: 直接丢弃低方差token
+- merge: 低方差token按特征余弦相似度合并到最相似的保留token（取平均）
+"""
+
+import logging
+from typing import Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PRUNING_MODES = ("off", "variance", "merge")
+
+
+class VisualTokenPruner:
+    """视觉token剪枝器"""
+
+    def __init__(self, mode: str = "off", keep_ratio: float = 0.5, min_keep: int = 16):
+        """
+        Args:
+            mode: 剪枝模式 (off, variance, merge)
+            keep_ratio: 每张图片保留的token比例 (0, 1]
+            min_keep: 每张图片至少保留的token数
+        """
+        if mode not in PRUNING_MODES:
+            raise ValueError(f"不支持的剪枝模式: {mode}，可选: {PRUNING_MODES}")
+        if not 0 < keep_ratio <= 1:
+            raise ValueError(f"keep_ratio 必须在 (0, 1] 范围内: {keep_ratio}")
+        self.mode = mode
+        self.keep_ratio = keep_ratio
+        self.min_keep = min_keep
+
+    @property
+    def enabled(self) -> bool:
+        """是否启用剪枝"""
+        return self.mode != "off" and self.keep_ratio < 1
+
+    def prune(self, patches: torch.Tensor, features: torch.Tensor, merge_unit: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        对单张图片的视觉token剪枝
+
+        Args:
+            patches: 该图片的pixel_values行 (num_tokens * merge_unit, patch_dim)，
+                     Qwen2.5-VL处理器按合并组连续排列，每 merge_unit 行对应一个合并token
+            features: 视觉编码器输出 (num_tokens, hidden)
+            merge_unit: 每个合并token包含的patch数 (spatial_merge_size ** 2)
+
+        Returns:
+            (保留token的布尔掩码 (num_tokens,), 保留token的特征 (num_kept, hidden))
+        """
+        num_tokens = features.shape[0]
+        keep_mask = torch.ones(num_tokens, dtype=torch.bool, device=features.device)
+        num_keep = max(min(self.min_keep, num_tokens), int(round(num_tokens * self.keep_ratio)))
+        if not self.enabled or num_keep >= num_tokens:
+            return keep_mask, features
+
+        # 每个合并token对应像素区域的方差，均匀背景/边框接近0
+        scores = patches.float().reshape(num_tokens, -1).var(dim=1).to(features.device)
+        keep_idx = torch.topk(scores, num_keep).indices.sort().values
+        keep_mask[:] = False
+        keep_mask[keep_idx] = True
+
+        if self.mode == "variance":
+            return keep_mask, features[keep_idx]
+
+        # merge: 被剪掉的token合并到特征最相似的保留token
+        kept = features[keep_idx].float()
+        dropped = features[~keep_mask].float()
+        similarity = torch.nn.functional.normalize(dropped, dim=-1) @ torch.nn.functional.normalize(kept, dim=-1).T
+        target = similarity.argmax(dim=-1)
+        merged = kept.clone()
+        merged.index_add_(0, target, dropped)
+        counts = torch.ones(num_keep, device=features.device)
+        counts.index_add_(0, target, torch.ones_like(target, dtype=counts.dtype))
+        return keep_mask, (merged / counts.unsqueeze(-1)).to(features.dtype)
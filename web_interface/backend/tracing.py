@@ -0,0 +1,196 @@
+"""
+单请求时间线追踪 - 导出为 Chrome Trace Event 格式（chrome://tracing、Perfetto 可直接打开）
+
+按采样率对请求开启追踪，记录上传保存、图片预处理、历史恢复、聊天模板、视觉信息处理、
+张量化、主机到设备拷贝、预填充、每个流式文本块和清理等阶段的耗时。
+
+ModelManager 等内部代码通过模块级 span() 记录阶段，当前线程没有激活的追踪时
+span() 直接返回一个共享的空上下文管理器，未被采样的请求几乎没有额外开销。
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class _NullSpan:
+    """未追踪时使用的空上下文管理器"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class RequestTrace:
+    """一个请求的追踪事件集合（线程安全，生成线程和请求线程可同时写入）"""
+
+    def __init__(self, request_id: str, endpoint: str):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.created_at = time.time()
+        self._origin = time.perf_counter()
+        self._events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._thread_names: Dict[int, str] = {}
+
+    def _ts(self, t: float) -> float:
+        """perf_counter 时间 -> 相对请求开始的微秒数"""
+        return (t - self._origin) * 1e6
+
+    def _add(self, event: Dict[str, Any]):
+        tid = threading.get_ident()
+        event.setdefault("tid", tid)
+        event["pid"] = os.getpid()
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+
+    def add_span(self, name: str, start: float, end: float, **args):
+        """
+        记录一个已完成的阶段
+
+        Args:
+            name: 阶段名
+            start: 开始时间（time.perf_counter()）
+            end: 结束时间（time.perf_counter()）
+            **args: 附加信息（在追踪查看器中显示）
+        """
+        self._add({"name": name, "ph": "X", "ts": self._ts(start), "dur": (end - start) * 1e6, "args": args})
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """记录 with 块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_span(name, start, time.perf_counter(), **args)
+
+    def instant(self, name: str, **args):
+        """记录一个瞬时事件"""
+        self._add({"name": name, "ph": "i", "s": "t", "ts": self._ts(time.perf_counter()), "args": args})
+
+    def to_chrome(self) -> Dict[str, Any]:
+        """导出为 Chrome Trace Event JSON"""
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in thread_names.items()
+        ]
+        return {
+            "traceEvents": metadata + sorted(events, key=lambda e: e["ts"]),
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "request_id": self.request_id,
+                "endpoint": self.endpoint,
+                "created_at": self.created_at
+            }
+        }
+
+
+class Tracer:
+    """按采样率创建请求追踪，保存最近的追踪并写出JSON文件"""
+
+    def __init__(self, sample_rate: float = 0.0, trace_dir: Optional[str] = None, max_in_memory: int = 200):
+        """
+        Args:
+            sample_rate: 采样率 [0, 1]，0 表示只追踪显式要求追踪的请求
+            trace_dir: 追踪JSON文件目录（None表示只保存在内存中）
+            max_in_memory: 内存中保留的最近追踪数
+        """
+        self.sample_rate = sample_rate
+        self.trace_dir = trace_dir
+        self.max_in_memory = max_in_memory
+        self._traces: "OrderedDict[str, RequestTrace]" = OrderedDict()
+        self._lock = threading.Lock()
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    def start(self, endpoint: str, request_id: Optional[str] = None, force: bool = False) -> Optional[RequestTrace]:
+        """
+        按采样率决定是否追踪该请求
+
+        Args:
+            endpoint: 接口名
+            request_id: 请求ID（默认自动生成）
+            force: 强制追踪（忽略采样率）
+
+        Returns:
+            RequestTrace，未被采样时返回None
+        """
+        if not force and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        return RequestTrace(request_id or uuid.uuid4().hex, endpoint)
+
+    def finish(self, trace: Optional[RequestTrace]):
+        """请求结束：保存追踪（内存 + 可选的JSON文件）"""
+        if trace is None:
+            return
+        with self._lock:
+            self._traces[trace.request_id] = trace
+            self._traces.move_to_end(trace.request_id)
+            while len(self._traces) > self.max_in_memory:
+                self._traces.popitem(last=False)
+        if self.trace_dir:
+            path = os.path.join(self.trace_dir, f"{trace.request_id}.json")
+            try:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(trace.to_chrome(), f, ensure_ascii=False)
+            except Exception as e:
+                logger.warning(f"⚠️ 写入追踪文件失败 {path}: {e}")
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """按请求ID获取 Chrome Trace JSON（内存中没有时从文件读取）"""
+        with self._lock:
+            trace = self._traces.get(request_id)
+        if trace is not None:
+            return trace.to_chrome()
+        if self.trace_dir:
+            path = os.path.join(self.trace_dir, f"{os.path.basename(request_id)}.json")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+        return None
+
+
+def current() -> Optional[RequestTrace]:
+    """当前线程激活的追踪"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def activate(trace: Optional[RequestTrace]):
+    """在当前线程激活追踪，with 块内的 span() 记录到该追踪"""
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def span(name: str, **args):
+    """在当前线程激活的追踪中记录一个阶段（未追踪时为空操作）"""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name, **args)
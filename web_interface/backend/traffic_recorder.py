@@ -0,0 +1,204 @@
+"""
+流量录制 - 每个请求写一条紧凑的JSONL记录，供离线回放（benchmarks/loadgen.py --replay）
+
+记录内容：会话ID哈希、问题长度（可选原文）、图片内容哈希和尺寸、历史消息数、合并后的生成配置、
+排队等待、各阶段耗时、token数和结果（ok / aborted / error / busy）。
+图片原始字节可选保存到内容寻址存储 <录制目录>/images/<sha256前2位>/<sha256><扩展名>，
+同一张图片无论上传多少次只保存一份。
+
+录制文件按大小轮转，只保留最近的若干个文件（图片存储不自动清理）。
+"""
+
+import os
+import json
+import glob
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+import series_loader
+import upload_store
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficRecorder:
+    """请求流量录制器（线程安全）"""
+
+    def __init__(
+        self,
+        record_dir: str,
+        record_prompts: bool = False,
+        store_images: bool = False,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_files: int = 30,
+        session_salt: str = ""
+    ):
+        """
+        Args:
+            record_dir: 录制目录
+            record_prompts: 是否记录问题原文（关闭时只记录字符数）
+            store_images: 是否将图片保存到内容寻址存储
+            max_bytes: 单个录制文件的大小上限，超出后轮转
+            max_files: 保留的录制文件数
+            session_salt: 会话ID哈希的盐值
+        """
+        self.record_dir = record_dir
+        self.image_store = os.path.join(record_dir, "images")
+        self.record_prompts = record_prompts
+        self.store_images = store_images
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.session_salt = session_salt
+        self._lock = threading.Lock()
+        self._file = None
+        self._path: Optional[str] = None
+        os.makedirs(record_dir, exist_ok=True)
+        if store_images:
+            os.makedirs(self.image_store, exist_ok=True)
+
+    def hash_session(self, session_id: Optional[str]) -> Optional[str]:
+        """会话ID的不可逆短哈希（同一会话的请求仍可关联）"""
+        if not session_id:
+            return None
+        return hashlib.sha256((self.session_salt + session_id).encode("utf-8")).hexdigest()[:16]
+
+    def describe_images(self, image_paths: List[str]) -> List[Dict[str, Any]]:
+        """
+        计算图片内容哈希和尺寸，按需保存到内容寻址存储
+
+        Returns:
+            [{"sha256", "width", "height", "bytes"}]
+        """
+        described = []
+        for path in image_paths:
+            manifest = upload_store.manifest(path)
+            if manifest is not None:
+                # 上传存储中的文件：哈希和尺寸在上传时已记录
+                described.append({
+                    "sha256": manifest["sha256"],
+                    "width": manifest.get("width"),
+                    "height": manifest.get("height"),
+                    "bytes": manifest["bytes"]
+                })
+                if self.store_images:
+                    self._store_image(path, manifest["sha256"])
+                continue
+            try:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+                sha256 = digest.hexdigest()
+                width, height = series_loader.image_size(path)
+                described.append({
+                    "sha256": sha256,
+                    "width": width,
+                    "height": height,
+                    "bytes": os.path.getsize(path)
+                })
+                if self.store_images:
+                    self._store_image(path, sha256)
+            except Exception as e:
+                logger.warning(f"⚠️ 录制图片信息失败 {path}: {e}")
+        return described
+
+    def _store_image(self, path: str, sha256: str):
+        """保存图片到内容寻址存储（已存在则跳过）"""
+        ext = os.path.splitext(path)[1].lower()
+        target_dir = os.path.join(self.image_store, sha256[:2])
+        target = os.path.join(target_dir, sha256 + ext)
+        if os.path.exists(target):
+            return
+        os.makedirs(target_dir, exist_ok=True)
+        # 先写临时文件再改名，避免并发请求读到写了一半的图片
+        temp = f"{target}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, temp)
+        os.replace(temp, target)
+
+    def record(
+        self,
+        endpoint: str,
+        session_id: Optional[str],
+        prompt: str,
+        outcome: str,
+        images: Optional[List[Dict[str, Any]]] = None,
+        history_len: int = 0,
+        generation_config: Optional[Dict[str, Any]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        tokens: Optional[Dict[str, int]] = None,
+        chunks: Optional[int] = None,
+        error: Optional[str] = None
+    ):
+        """
+        写入一条请求记录
+
+        Args:
+            endpoint: 接口名 (chat, chat_stream)
+            session_id: 会话ID（只保存哈希）
+            prompt: 用户问题
+            outcome: ok, aborted, error, busy
+            images: describe_images() 的结果
+            history_len: 请求时的历史消息数
+            generation_config: 合并后的生成配置
+            timings: 各阶段耗时（毫秒）
+            tokens: {"prompt": 预填充token数, "generated": 生成token数}
+            chunks: 流式请求已发送的文本块数（回放时按此复现中途断开）
+            error: 错误信息
+        """
+        entry = {
+            "ts": time.time(),
+            "endpoint": endpoint,
+            "session": self.hash_session(session_id),
+            "prompt_chars": len(prompt),
+            "images": images or [],
+            "history_len": history_len,
+            "generation_config": generation_config,
+            "timings": {k: round(v, 2) for k, v in (timings or {}).items()},
+            "tokens": tokens,
+            "outcome": outcome
+        }
+        if self.record_prompts:
+            entry["prompt"] = prompt
+        if chunks is not None:
+            entry["chunks"] = chunks
+        if error:
+            entry["error"] = error[:200]
+
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                self._rotate_if_needed(len(line.encode("utf-8")))
+                self._file.write(line)
+                self._file.flush()
+        except Exception as e:
+            logger.warning(f"⚠️ 写入流量记录失败: {e}")
+
+    def _rotate_if_needed(self, incoming: int):
+        """当前文件超过大小上限时切换到新文件，并删除最旧的文件"""
+        if self._file is not None and self._file.tell() + incoming <= self.max_bytes:
+            return
+        if self._file is not None:
+            self._file.close()
+        name = datetime.now().strftime("traffic-%Y%m%d-%H%M%S-%f.jsonl")
+        self._path = os.path.join(self.record_dir, name)
+        self._file = open(self._path, "a", encoding="utf-8")
+        logger.info(f"📼 流量录制文件: {self._path}")
+
+        files = sorted(glob.glob(os.path.join(self.record_dir, "traffic-*.jsonl")))
+        for old in files[:-self.max_files] if self.max_files > 0 else []:
+            try:
+                os.remove(old)
+            except OSError as e:
+                logger.warning(f"⚠️ 删除旧录制文件失败 {old}: {e}")
+
+    def close(self):
+        """关闭当前录制文件"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
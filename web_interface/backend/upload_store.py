@@ -0,0 +1,368 @@
+"""
+内容寻址上传存储 - 上传文件按内容哈希去重保存，按会话引用计数
+
+- 边写入磁盘边计算 SHA-256，同一文件重复上传（同一会话多次、不同会话、会话迁移导入）只保存一份
+- 每个引用方（会话ID，或打分等一次性请求的ID）对文件持有引用计数，最后一个引用释放时删除文件；
+  引用计数的减少和删除文件在同一把锁内完成，并发上传相同内容不会写入后又被删除
+- 引用计数只在进程内，多个实例共享 UPLOAD_FOLDER 时每个实例使用自己的对象目录（objects/<实例ID>/），
+  一个实例释放引用不会删除另一个实例（如会话迁移的目标实例）仍在使用的文件
+- 每个引用方持有的文件总字节数在引用增减时更新（owner_bytes()），状态接口不需要逐个 stat 文件
+- on_delete 回调在文件的最后一个引用释放时（持有锁）调用，用于同步删除派生数据（如相似检索条目）
+- 每个文件在首次保存时记录一次清单（manifest）：尺寸、格式、模式、当前 MAX_PIXELS 下的目标网格
+  和视觉token数。后续轮次的开销估算、录制和缓存查找只读清单，不再打开文件
+- 清单以 <哈希>.json 保存在文件旁边，重启后重新加载（会话在内存中，重启后文件不再被引用，
+  但再次上传相同内容时直接复用文件和清单）
+
+文件路径: <根目录>/objects/<实例ID>/<哈希><扩展名>
+"""
+
+import io
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+from PIL import Image
+
+import dicom_loader
+import series_loader
+import slide_loader
+from dicom_loader import GRID_FACTOR, grid_size
+
+logger = logging.getLogger(__name__)
+
+# 流式写入的块大小
+CHUNK_SIZE = 1024 * 1024
+
+
+class FileTooLargeError(ValueError):
+    """上传文件超过大小上限"""
+
+
+def describe_media(path: str, max_size: int, max_pixels: int) -> Dict[str, Any]:
+    """
+    读取文件头信息，计算目标网格和视觉token数（不解码像素；序列和切片按各自加载器的读取计划计算）
+
+    Returns:
+        {"kind", "format", "mode", "width", "height", "grid": [宽, 高], "tokens"}
+    """
+    if series_loader.loader.is_series(path):
+        volume = series_loader.loader.open(path)
+        try:
+            plan = series_loader.loader.plan(volume.num_slices, *volume.size)
+            width, height = volume.size
+            slices = volume.num_slices
+        finally:
+            volume.close()
+        frame_w, frame_h = plan["size"]
+        return {
+            "kind": "series", "format": os.path.splitext(path)[1].lstrip('.').upper() or "DICOM", "mode": None,
+            "width": width, "height": height, "slices": slices, "frames": plan["frames"],
+            "grid": [frame_w // GRID_FACTOR, frame_h // GRID_FACTOR], "tokens": plan["tokens"],
+        }
+    if dicom_loader.is_dicom(path):
+        header = dicom_loader.loader.header(path)
+        out_w, out_h = grid_size(header["columns"], header["rows"], max_size, max_pixels)
+        return {
+            "kind": "dicom", "format": "DICOM", "mode": header["photometric"],
+            "width": header["columns"], "height": header["rows"], "modality": header["modality"],
+            "grid": [out_w // GRID_FACTOR, out_h // GRID_FACTOR],
+            "tokens": (out_w // GRID_FACTOR) * (out_h // GRID_FACTOR),
+        }
+    if slide_loader.loader.is_slide(path):
+        source = slide_loader.loader.open(path)
+        try:
+            width, height = source.size
+            levels = len(source.levels)
+        finally:
+            source.close()
+        out_w, out_h = grid_size(width, height, max_size, max_pixels)
+        return {
+            "kind": "slide", "format": os.path.splitext(path)[1].lstrip('.').upper(), "mode": "RGB",
+            "width": width, "height": height, "levels": levels,
+            "grid": [out_w // GRID_FACTOR, out_h // GRID_FACTOR],
+            "tokens": slide_loader.loader.token_count(path),
+        }
+    with Image.open(path) as img:
+        width, height = img.size
+        image_format, mode = img.format, img.mode
+    out_w, out_h = grid_size(width, height, max_size, max_pixels)
+    return {
+        "kind": "image", "format": image_format, "mode": mode,
+        "width": width, "height": height,
+        "grid": [out_w // GRID_FACTOR, out_h // GRID_FACTOR],
+        "tokens": (out_w // GRID_FACTOR) * (out_h // GRID_FACTOR),
+    }
+
+
+class UploadStore:
+    """内容寻址上传存储（线程安全）"""
+
+    def __init__(self, root: str, instance_id: str = "default", max_size: int = 1024, max_pixels: int = 1003520):
+        """
+        Args:
+            root: 存储根目录（通常是 UPLOAD_FOLDER）
+            instance_id: 实例ID（共享存储根目录的实例之间必须不同）
+            max_size: 图片预处理的最大边长（用于计算目标网格）
+            max_pixels: 模型的最大像素数（用于计算目标网格，变化后清单在首次查询时重算）
+        """
+        self.instance_id = instance_id
+        self.object_dir = os.path.join(root, "objects", os.path.basename(instance_id))
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.stats = {"uploads": 0, "dedup_hits": 0, "deleted": 0, "bytes_saved": 0}
+        self._manifests: Dict[str, Dict[str, Any]] = {}  # 哈希 -> 清单
+        self._refs: Dict[str, Dict[str, int]] = {}  # 哈希 -> {引用方: 次数}
+        self._sizes: Dict[str, int] = {}  # 哈希 -> 文件字节数
+        self._owner_bytes: Dict[str, int] = {}  # 引用方 -> 持有的文件总字节数（同一文件只计一次）
+        self._lock = threading.Lock()
+        self.on_delete: Optional[Callable[[str], None]] = None  # 文件不再被引用时调用（参数为哈希）
+        os.makedirs(self.object_dir, exist_ok=True)
+        self._load_manifests()
+
+    def _load_manifests(self):
+        """加载已有文件的清单（文件已不存在的清单删除）"""
+        for name in os.listdir(self.object_dir):
+            if not name.endswith(".json"):
+                continue
+            manifest_path = os.path.join(self.object_dir, name)
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if os.path.exists(manifest["path"]):
+                    self._manifests[manifest["sha256"]] = manifest
+                    self._sizes[manifest["sha256"]] = manifest["bytes"]
+                else:
+                    os.remove(manifest_path)
+            except Exception as e:
+                logger.warning(f"⚠️ 跳过损坏的上传清单 {name}: {e}")
+        if self._manifests:
+            logger.info(f"📦 上传存储已加载 {len(self._manifests)} 个文件清单")
+
+    @staticmethod
+    def sha_of(path: str) -> str:
+        """从存储路径取出内容哈希"""
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def _manifest_path(self, sha256: str) -> str:
+        return os.path.join(self.object_dir, f"{sha256}.json")
+
+    def _describe(self, sha256: str, path: str, filename: str, size: int) -> Dict[str, Any]:
+        """首次保存时记录清单（头信息读取失败时只记录大小，开销估算回退为0）"""
+        manifest = {
+            "sha256": sha256,
+            "path": path,
+            "filename": filename,
+            "bytes": size,
+            "created_at": time.time(),
+            "max_size": self.max_size,
+            "max_pixels": self.max_pixels,
+        }
+        try:
+            manifest.update(describe_media(path, self.max_size, self.max_pixels))
+        except Exception as e:
+            logger.warning(f"⚠️ 无法读取上传文件信息 {filename}: {e}")
+            manifest.update({"kind": "unknown", "grid": None, "tokens": 0})
+        with open(self._manifest_path(sha256), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        return manifest
+
+    def put(self, stream, filename: str, owner: str, max_bytes: Optional[int] = None) -> str:
+        """
+        保存上传文件（边写入边计算哈希），并为引用方增加一次引用
+
+        Args:
+            stream: 可读的二进制文件对象
+            filename: 原始文件名（用于扩展名和清单）
+            owner: 引用方（会话ID或请求ID）
+            max_bytes: 大小上限
+
+        Returns:
+            存储路径
+
+        Raises:
+            FileTooLargeError: 超过大小上限（已写入的临时文件会被删除）
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        tmp_path = os.path.join(self.object_dir, f".upload-{uuid.uuid4().hex}{ext}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                for block in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    size += len(block)
+                    if max_bytes is not None and size > max_bytes:
+                        raise FileTooLargeError(f"文件过大: {filename}")
+                    digest.update(block)
+                    out.write(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        sha256 = digest.hexdigest()
+
+        with self._lock:
+            manifest = self._manifests.get(sha256)
+            if manifest is not None and os.path.exists(manifest["path"]):
+                path = manifest["path"]
+                os.remove(tmp_path)
+                self.stats["dedup_hits"] += 1
+                self.stats["bytes_saved"] += size
+                logger.info(f"♻️ 重复上传，复用已有文件: {filename} -> {sha256[:12]}")
+            else:
+                path = os.path.join(self.object_dir, f"{sha256}{ext}")
+                os.replace(tmp_path, path)
+                manifest = None
+            self._sizes[sha256] = size
+            self._acquire(sha256, owner)
+            self.stats["uploads"] += 1
+        if manifest is None:
+            # 清单在锁外计算（可能读取序列/切片头信息），并发上传同一文件时结果相同
+            manifest = self._describe(sha256, path, filename, size)
+            with self._lock:
+                if sha256 in self._refs:
+                    self._manifests.setdefault(sha256, manifest)
+                else:
+                    # 计算清单期间引用已全部释放（释放时还没有清单，文件未被删除）
+                    self._sizes.pop(sha256, None)
+                    self._delete_files([(path, self._manifest_path(sha256))])
+            logger.info(f"📥 保存上传文件: {filename} -> {sha256[:12]} ({manifest.get('kind')}, {manifest.get('tokens')} tokens)")
+        return path
+
+    def put_bytes(self, data: bytes, filename: str, owner: str) -> str:
+        """保存内存中的文件内容（会话导入时使用）"""
+        return self.put(io.BytesIO(data), filename, owner)
+
+    def _acquire(self, sha256: str, owner: str):
+        refs = self._refs.setdefault(sha256, {})
+        if owner not in refs:
+            self._owner_bytes[owner] = self._owner_bytes.get(owner, 0) + self._sizes.get(sha256, 0)
+        refs[owner] = refs.get(owner, 0) + 1
+
+    def _forget_owner(self, sha256: str, owner: str):
+        """引用方不再持有该文件（调用方持有锁）"""
+        del self._refs[sha256][owner]
+        remaining = self._owner_bytes.get(owner, 0) - self._sizes.get(sha256, 0)
+        if remaining > 0:
+            self._owner_bytes[owner] = remaining
+        else:
+            self._owner_bytes.pop(owner, None)
+
+    def acquire(self, path: str, owner: str):
+        """为已有文件增加一次引用"""
+        sha256 = self.sha_of(path)
+        with self._lock:
+            if sha256 not in self._sizes and os.path.exists(path):
+                self._sizes[sha256] = os.path.getsize(path)
+            self._acquire(sha256, owner)
+
+    def owner_bytes(self, owner: Optional[str]) -> int:
+        """引用方持有的文件总字节数（同一文件只计一次）"""
+        with self._lock:
+            return self._owner_bytes.get(owner, 0)
+
+    def owned(self, owner: Optional[str]) -> set:
+        """引用方持有引用的文件哈希"""
+        if not owner:
+            return set()
+        with self._lock:
+            return {sha256 for sha256, refs in self._refs.items() if owner in refs}
+
+    def release(self, paths: List[str], owner: str) -> int:
+        """
+        释放引用方对这些文件的各一次引用，没有引用的文件被删除
+
+        Returns:
+            删除的文件数
+        """
+        deleted = []
+        with self._lock:
+            for path in paths:
+                sha256 = self.sha_of(path)
+                refs = self._refs.get(sha256)
+                if not refs or owner not in refs:
+                    continue
+                refs[owner] -= 1
+                if refs[owner] <= 0:
+                    self._forget_owner(sha256, owner)
+                if not refs:
+                    deleted.append(self._drop(sha256))
+            return self._delete_files(deleted)
+
+    def release_owner(self, owner: str) -> int:
+        """释放引用方持有的全部引用（清除会话时调用）"""
+        deleted = []
+        with self._lock:
+            for sha256 in [s for s, refs in self._refs.items() if owner in refs]:
+                self._forget_owner(sha256, owner)
+                if not self._refs[sha256]:
+                    deleted.append(self._drop(sha256))
+            return self._delete_files(deleted)
+
+    def _drop(self, sha256: str) -> Tuple[Optional[str], str]:
+        """从索引中移除（调用方持有锁），返回待删除的文件"""
+        self._refs.pop(sha256, None)
+        self._sizes.pop(sha256, None)
+        manifest = self._manifests.pop(sha256, None)
+        if self.on_delete is not None:
+            try:
+                self.on_delete(sha256)
+            except Exception as e:
+                logger.warning(f"⚠️ 上传文件删除回调失败: {e}")
+        return (manifest["path"] if manifest else None, self._manifest_path(sha256))
+
+    def _delete_files(self, deleted: List[Tuple[Optional[str], str]]) -> int:
+        """删除文件和清单（调用方持有锁，避免同一内容的并发上传在写入后被删除）"""
+        count = 0
+        for path, manifest_path in deleted:
+            for target in (path, manifest_path):
+                if target and os.path.exists(target):
+                    try:
+                        os.remove(target)
+                    except OSError as e:
+                        logger.warning(f"删除上传文件失败: {e}")
+            if path:
+                count += 1
+                logger.info(f"🗑️ 删除不再引用的上传文件: {os.path.basename(path)}")
+        self.stats["deleted"] += count
+        return count
+
+    def manifest(self, path) -> Optional[Dict[str, Any]]:
+        """
+        文件清单（不属于本存储的路径返回 None）；MAX_PIXELS 等配置变化后首次查询时重算
+        """
+        if not isinstance(path, str) or os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.object_dir):
+            return None
+        sha256 = self.sha_of(path)
+        with self._lock:
+            manifest = self._manifests.get(sha256)
+        if manifest is None:
+            return None
+        if manifest.get("max_pixels") != self.max_pixels or manifest.get("max_size") != self.max_size:
+            manifest = self._describe(sha256, manifest["path"], manifest["filename"], manifest["bytes"])
+            with self._lock:
+                if sha256 in self._manifests:
+                    self._manifests[sha256] = manifest
+        return manifest
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "instance_id": self.instance_id,
+                "files": len(self._manifests),
+                "referenced_files": len(self._refs),
+                "bytes": sum(self._sizes.values()),
+                **self.stats
+            }
+
+
+# 全局存储（app.py 按配置初始化）
+store: Optional[UploadStore] = None
+
+
+def manifest(path) -> Optional[Dict[str, Any]]:
+    """上传文件的清单（未初始化存储或不是存储中的文件时返回 None）"""
+    return store.manifest(path) if store is not None else None
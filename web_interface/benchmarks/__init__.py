@@ -0,0 +1,3 @@
+"""
+Lingshu-7B 服务基准测试工具
+"""
@@ -0,0 +1,131 @@
+"""
+KV缓存量化 质量-显存 对比基准
+
+对同一组问题（可带图片）分别使用全精度、int8、int4 KV缓存进行贪心解码，
+记录KV缓存显存估算、峰值显存、耗时，并以全精度输出为参考计算回答一致率。
+
+用法:
+    python -m benchmarks.kv_cache_quality --model ../models/Lingshu-7B --images a.png b.png
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import difflib
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+import torch
+from model_manager import ModelManager
+
+DEFAULT_PROMPTS = [
+    "这张图像显示了什么病症？请详细描述。",
+    "请分析这张医学图像并给出诊断建议。",
+]
+
+KV_MODES = [None, "int8", "int4"]
+
+
+def run_mode(manager, mode, cases, max_new_tokens):
+    """使用指定KV缓存量化模式运行所有用例"""
+    manager.kv_cache_quantization = mode
+    results = []
+    for case in cases:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        result = manager.generate_response_with_history(
+            prompt=case["prompt"],
+            image_paths=list(case["images"]),
+            history=[],
+            generation_config={"max_new_tokens": max_new_tokens, "do_sample": False, "repetition_penalty": 1.0}
+        )
+        elapsed = time.perf_counter() - start
+        for path in result.get("compressed_paths", []):
+            if os.path.exists(path):
+                os.remove(path)
+        results.append({
+            "prompt": case["prompt"],
+            "images": case["images"],
+            "success": result.get("success", False),
+            "response": result.get("response", ""),
+            "latency_s": elapsed,
+            "kv_cache": result.get("kv_cache"),
+            "peak_memory_bytes": torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+        })
+    return results
+
+
+def agreement(reference, candidate):
+    """回答一致率：完全一致比例和平均字符相似度"""
+    exact = sum(1 for r, c in zip(reference, candidate) if r["response"] == c["response"])
+    similarity = [
+        difflib.SequenceMatcher(None, r["response"], c["response"]).ratio()
+        for r, c in zip(reference, candidate)
+    ]
+    return {
+        "exact_match": exact / len(reference) if reference else 0.0,
+        "mean_similarity": sum(similarity) / len(similarity) if similarity else 0.0
+    }
+
+
+def summarize(results):
+    """汇总一个模式下的显存与耗时"""
+    kv = [r["kv_cache"] for r in results if r["kv_cache"]]
+    peaks = [r["peak_memory_bytes"] for r in results if r["peak_memory_bytes"] is not None]
+    return {
+        "kv_cache_used_bytes": sum(k["used_bytes"] for k in kv),
+        "kv_cache_saved_bytes": sum(k["saved_bytes"] for k in kv),
+        "peak_memory_bytes": max(peaks) if peaks else None,
+        "mean_latency_s": sum(r["latency_s"] for r in results) / len(results) if results else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KV缓存量化 质量-显存 对比基准")
+    parser.add_argument("--model", type=str, required=True, help="模型路径")
+    parser.add_argument("--quantization", type=str, default="4bit", help="权重量化模式 (4bit, 8bit, standard, cpu)")
+    parser.add_argument("--images", nargs="*", default=[], help="测试图片（每个问题都会带上全部图片）")
+    parser.add_argument("--prompts", nargs="*", default=DEFAULT_PROMPTS, help="测试问题")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="每个问题的最大生成token数")
+    parser.add_argument("--residual-length", type=int, default=128, help="全精度残差token数")
+    parser.add_argument("--output", type=str, default="kv_cache_quality.json", help="结果输出JSON文件")
+    args = parser.parse_args()
+
+    manager = ModelManager(
+        model_path=args.model,
+        quantization=args.quantization,
+        kv_cache_residual_length=args.residual_length
+    )
+    if not manager.load_model():
+        print("❌ 模型加载失败")
+        return
+
+    cases = [{"prompt": p, "images": args.images} for p in args.prompts]
+    report = {"residual_length": args.residual_length, "modes": {}}
+    reference = None
+    for mode in KV_MODES:
+        name = mode or "none"
+        print(f"\n▶️ KV缓存模式: {name}")
+        results = run_mode(manager, mode, cases, args.max_new_tokens)
+        if reference is None:
+            reference = results
+        entry = {"summary": summarize(results), "agreement": agreement(reference, results), "results": results}
+        report["modes"][name] = entry
+        print(f"  KV缓存占用: {entry['summary']['kv_cache_used_bytes'] / 1024**2:.1f} MB, "
+              f"节省: {entry['summary']['kv_cache_saved_bytes'] / 1024**2:.1f} MB, "
+              f"一致率: {entry['agreement']['exact_match']:.2%}, "
+              f"相似度: {entry['agreement']['mean_similarity']:.3f}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已保存: {args.output}")
+    manager.unload_model()
+
+
+if __name__ == "__main__":
+    main()
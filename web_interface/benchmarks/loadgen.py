@@ -0,0 +1,428 @@
+"""
+HTTP 负载生成与流量回放工具
+
+模拟 N 个并发会话持续访问运行中的服务（/api/chat_stream）：
+- 遵循 session_id 协议：首轮不带 session_id，从第一条SSE事件中取得，后续轮次沿用，结束时清除历史
+- 按概率从本地目录随机挑选图片上传，模拟纯文本/单图/多图混合请求
+- 按概率在收到若干文本块后主动断开，模拟中途关闭页面的客户端
+- 可回放录制的流量（JSONL，每行一个请求记录），按原始时间间隔（可加速）重放
+
+报告 TTFT、端到端延迟的 p50/p95/p99，繁忙拒绝(429)率、错误率和生成吞吐量(tokens/s)。
+只依赖标准库；--stub 会在本进程内启动使用假模型后端（backend/stub_backend.py）的服务，
+无需真实模型即可压测HTTP层，也可以直接指向以 INFERENCE_BACKEND = "stub" 启动的服务。
+
+用法:
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --sessions 8 --turns 3 --image-dir ../test_images
+    python -m benchmarks.loadgen --stub --sessions 16 --duration 60 --abort-prob 0.2
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --replay traffic/2025-01-01.jsonl --speed 4
+"""
+
+import os
+import io
+import sys
+import glob
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
+
+DEFAULT_PROMPTS = [
+    "这张图像显示了什么病症？请详细描述。",
+    "根据图像，患者可能出现哪些异常症状？",
+    "请分析这张医学图像并给出诊断建议。",
+    "感冒和流感有什么区别？",
+    "糖尿病患者应该注意哪些饮食问题？",
+    "刚才提到的异常需要做哪些进一步检查？",
+]
+
+# 服务端并发已满时 /api/chat_stream 以SSE错误事件返回该提示（HTTP状态码仍为200）
+BUSY_MESSAGE = "服务器繁忙"
+
+
+def percentile(values, q):
+    """线性插值百分位数，空列表返回None"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def encode_multipart(fields, files):
+    """
+    编码 multipart/form-data 请求体
+
+    Args:
+        fields: {name: value}
+        files: [(name, filename, bytes)]
+
+    Returns:
+        (body, content_type)
+    """
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        body.write(str(value).encode("utf-8"))
+        body.write(b"\r\n")
+    for name, filename, data in files:
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'.encode())
+        body.write(b"Content-Type: application/octet-stream\r\n\r\n")
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    """单个HTTP连接的最小客户端"""
+
+    def __init__(self, base_url, timeout=300):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.timeout = timeout
+
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def post_json(self, path, payload):
+        conn = self.connect()
+        try:
+            conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        finally:
+            conn.close()
+
+    def chat_stream(self, fields, files, abort_after=None):
+        """
+        发起流式请求并解析SSE事件
+
+        Args:
+            fields: 表单字段（prompt, session_id, config）
+            files: 上传图片 [(filename, bytes)]
+            abort_after: 收到该数量的文本块后主动断开（None表示读到结束）
+
+        Returns:
+            请求结果字典
+        """
+        body, content_type = encode_multipart(fields, [("images", name, data) for name, data in files])
+        result = {
+            "status": None,
+            "outcome": "error",
+            "session_id": None,
+            "ttft_s": None,
+            "e2e_s": None,
+            "chunks": 0,
+            "tokens": None,
+            "error": None,
+        }
+        start = time.perf_counter()
+        conn = self.connect()
+        try:
+            conn.request("POST", "/api/chat_stream", body=body, headers={"Content-Type": content_type})
+            resp = conn.getresponse()
+            result["status"] = resp.status
+            if resp.status != 200:
+                result["outcome"] = "busy" if resp.status == 429 else "error"
+                result["error"] = resp.read().decode("utf-8", "replace")[:200]
+                return result
+
+            while True:
+                line = resp.readline()
+                if not line:
+                    result["error"] = result["error"] or "连接提前关闭"
+                    break
+                line = line.decode("utf-8").rstrip("\r\n")
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if "session_id" in event:
+                    result["session_id"] = event["session_id"]
+                elif "chunk" in event:
+                    if result["ttft_s"] is None:
+                        result["ttft_s"] = time.perf_counter() - start
+                    result["chunks"] += 1
+                    if abort_after is not None and result["chunks"] >= abort_after:
+                        result["outcome"] = "aborted"
+                        break
+                elif event.get("done"):
+                    result["outcome"] = "ok"
+                    kv_cache, prefill = event.get("kv_cache"), event.get("prefill")
+                    if kv_cache and prefill:
+                        result["tokens"] = kv_cache["tokens"] - prefill["tokens"]
+                    break
+                elif "error" in event:
+                    result["error"] = event["error"]
+                    result["outcome"] = "busy" if BUSY_MESSAGE in event["error"] else "error"
+                    break
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            result["error"] = str(e)
+        finally:
+            result["e2e_s"] = time.perf_counter() - start
+            # 主动断开：直接关闭连接，服务端在下一次写入时感知客户端离开
+            conn.close()
+        if result["tokens"] is None:
+            result["tokens"] = result["chunks"]
+        return result
+
+
+def list_images(image_dir):
+    """列出目录下所有图片"""
+    if not image_dir:
+        return []
+    return sorted(
+        path for path in glob.glob(os.path.join(image_dir, "**", "*"), recursive=True)
+        if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class LoadGenerator:
+    """合成负载：N 个并发会话，每个会话多轮对话"""
+
+    def __init__(self, client, args, images):
+        self.client = client
+        self.args = args
+        self.images = images
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _record(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    def run_session(self, worker_id, deadline):
+        """一个客户端：循环开启会话直到达到总时长（或只跑一个会话）"""
+        rng = random.Random(self.args.seed * 1000 + worker_id)
+        while True:
+            session_id = None
+            for turn in range(self.args.turns):
+                fields = {
+                    "prompt": rng.choice(DEFAULT_PROMPTS),
+                    "config": json.dumps({"max_new_tokens": self.args.max_new_tokens}),
+                }
+                if session_id:
+                    fields["session_id"] = session_id
+                files = []
+                if self.images and rng.random() < self.args.image_prob:
+                    for path in rng.sample(self.images, min(len(self.images), rng.randint(1, self.args.max_images))):
+                        files.append((os.path.basename(path), read_file(path)))
+                abort_after = rng.randint(1, 8) if rng.random() < self.args.abort_prob else None
+
+                result = self.client.chat_stream(fields, files, abort_after)
+                result.update({"worker": worker_id, "turn": turn, "images": len(files)})
+                self._record(result)
+                session_id = session_id or result["session_id"]
+
+                if self.args.think_time:
+                    time.sleep(rng.uniform(0, 2 * self.args.think_time))
+                if deadline and time.time() >= deadline:
+                    break
+            if session_id:
+                self.client.post_json("/api/clear_history", {"session_id": session_id})
+            if not deadline or time.time() >= deadline:
+                return
+
+    def run(self):
+        deadline = time.time() + self.args.duration if self.args.duration else None
+        with ThreadPoolExecutor(max_workers=self.args.sessions) as pool:
+            list(pool.map(lambda i: self.run_session(i, deadline), range(self.args.sessions)))
+        return self.results
+
+
+def load_replay(paths):
+    """读取录制流量（JSONL），按时间排序"""
+    records = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def replay_image(image_store, info, rng):
+    """
+    获取回放用的图片：优先从内容寻址存储中按哈希取原图，否则按记录的尺寸合成一张
+
+    Returns:
+        (filename, bytes)
+    """
+    if image_store:
+        matches = glob.glob(os.path.join(image_store, info["sha256"][:2], info["sha256"] + "*"))
+        if matches:
+            return os.path.basename(matches[0]), read_file(matches[0])
+    from PIL import Image
+    size = (max(1, int(info.get("width") or 224)), max(1, int(info.get("height") or 224)))
+    img = Image.effect_noise(size, 64).convert("RGB") if rng.random() < 0.5 else Image.new("RGB", size, (128, 128, 128))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return f"{info['sha256'][:16]}.png", buffer.getvalue()
+
+
+def run_replay(client, args):
+    """按录制时间间隔（除以 --speed）回放流量，同一录制会话映射到同一个服务端会话"""
+    records = [r for r in load_replay(args.replay) if r.get("endpoint", "chat_stream") == "chat_stream"]
+    if not records:
+        return []
+    rng = random.Random(args.seed)
+    t0 = records[0]["ts"]
+    start = time.time()
+    session_map, session_locks = {}, {}
+    results, lock = [], threading.Lock()
+
+    def send(record):
+        delay = (record["ts"] - t0) / args.speed - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+        key = record.get("session")
+        with lock:
+            session_lock = session_locks.setdefault(key, threading.Lock())
+        # 同一会话的请求按顺序发送，保证历史一致
+        with session_lock:
+            prompt = record.get("prompt") or "请描述。" * max(1, record.get("prompt_chars", 8) // 4)
+            fields = {"prompt": prompt, "config": json.dumps(record.get("generation_config") or {})}
+            if key in session_map:
+                fields["session_id"] = session_map[key]
+            files = [replay_image(args.image_store, info, rng) for info in record.get("images", [])]
+            abort_after = None
+            if record.get("outcome") == "aborted":
+                abort_after = max(1, record.get("chunks") or 1)
+            result = client.chat_stream(fields, files, abort_after)
+            result.update({"images": len(files), "recorded_outcome": record.get("outcome")})
+            if result["session_id"]:
+                session_map.setdefault(key, result["session_id"])
+        with lock:
+            results.append(result)
+
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        list(pool.map(send, records))
+    for session_id in session_map.values():
+        client.post_json("/api/clear_history", {"session_id": session_id})
+    return results
+
+
+def summarize(results, wall_s):
+    """汇总延迟分位数、拒绝率、错误率和吞吐量"""
+    total = len(results)
+    completed = [r for r in results if r["outcome"] in ("ok", "aborted")]
+    ttft = [r["ttft_s"] for r in completed if r["ttft_s"] is not None]
+    e2e = [r["e2e_s"] for r in results if r["outcome"] == "ok"]
+    tokens = sum(r["tokens"] for r in completed)
+    count = lambda outcome: sum(1 for r in results if r["outcome"] == outcome)
+    return {
+        "requests": total,
+        "ok": count("ok"),
+        "aborted": count("aborted"),
+        "busy": count("busy"),
+        "errors": count("error"),
+        "busy_rate": count("busy") / total if total else 0.0,
+        "error_rate": count("error") / total if total else 0.0,
+        "wall_s": wall_s,
+        "tokens": tokens,
+        "tokens_per_s": tokens / wall_s if wall_s > 0 else 0.0,
+        "ttft_s": {f"p{q}": percentile(ttft, q) for q in (50, 95, 99)},
+        "e2e_s": {f"p{q}": percentile(e2e, q) for q in (50, 95, 99)},
+    }
+
+
+def format_seconds(value):
+    return f"{value:.3f}s" if value is not None else "-"
+
+
+def start_stub_server(port=0):
+    """在本进程内启动使用假模型后端（stub_backend）的服务（后台线程），返回 (服务地址, server)"""
+    from werkzeug.serving import make_server
+    import app as app_module
+    import config
+    from stub_backend import StubModelManager
+    manager = StubModelManager(max_pixels=config.MAX_PIXELS, **config.STUB_BACKEND_CONFIG)
+    manager.load_model()
+    app_module.model_manager = manager
+    server = make_server("127.0.0.1", port, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP 负载生成与流量回放工具")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:5000", help="服务地址")
+    parser.add_argument("--stub", action="store_true", help="在本进程内启动使用假模型后端的服务并压测它（参数取自 config.STUB_BACKEND_CONFIG）")
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数（回放时为最大并发）")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--duration", type=float, default=0, help="持续时长（秒），0表示每个客户端只跑一个会话")
+    parser.add_argument("--image-dir", type=str, default=None, help="上传图片目录")
+    parser.add_argument("--image-prob", type=float, default=0.5, help="每轮带图片的概率")
+    parser.add_argument("--max-images", type=int, default=2, help="每轮最多上传的图片数")
+    parser.add_argument("--abort-prob", type=float, default=0.1, help="客户端中途断开的概率")
+    parser.add_argument("--think-time", type=float, default=0.0, help="轮次之间的平均思考时间（秒）")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="每个请求的最大生成token数")
+    parser.add_argument("--replay", nargs="+", default=None, help="回放录制的流量文件（JSONL）")
+    parser.add_argument("--image-store", type=str, default=None, help="回放用的内容寻址图片存储目录")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放加速倍数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", type=str, default=None, help="结果输出JSON文件（含每个请求的明细）")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if args.stub:
+        url, server = start_stub_server()
+        print(f"🧪 假模型服务已启动: {url}")
+
+    client = Client(url)
+    start = time.perf_counter()
+    if args.replay:
+        print(f"▶️ 回放流量: {', '.join(args.replay)} (加速 {args.speed}x)")
+        results = run_replay(client, args)
+    else:
+        images = list_images(args.image_dir)
+        print(f"▶️ 合成负载: {args.sessions} 个并发会话, 每会话 {args.turns} 轮, 可用图片 {len(images)} 张")
+        results = LoadGenerator(client, args, images).run()
+    summary = summarize(results, time.perf_counter() - start)
+
+    print("\n" + "=" * 60)
+    print(f"📊 请求: {summary['requests']}  成功: {summary['ok']}  中途断开: {summary['aborted']}  "
+          f"繁忙拒绝: {summary['busy']} ({summary['busy_rate']:.1%})  错误: {summary['errors']} ({summary['error_rate']:.1%})")
+    for name in ("ttft_s", "e2e_s"):
+        p = summary[name]
+        print(f"   {name[:-2].upper():5s} p50 {format_seconds(p['p50'])}  p95 {format_seconds(p['p95'])}  p99 {format_seconds(p['p99'])}")
+    print(f"   吞吐量: {summary['tokens_per_s']:.1f} tokens/s ({summary['tokens']} tokens / {summary['wall_s']:.1f}s)")
+    print("=" * 60)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "requests": results}, f, ensure_ascii=False, indent=2)
+        print(f"✅ 结果已保存: {args.output}")
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
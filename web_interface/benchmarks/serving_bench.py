@@ -0,0 +1,558 @@
+"""
+端到端服务基准测试
+
+分别直接调用 ModelManager 和通过 Flask 应用（test_client）发起请求，覆盖阻塞和流式两种模式，
+围绕一个基准配置逐项扫描：权重量化模式、图片数量和尺寸、历史消息数、max_new_tokens、并发数，
+记录首token延迟(TTFT)、token间延迟(ITL)、端到端延迟、吞吐量和峰值内存，结果保存为JSON，
+并可与保存的基线对比，超出回归阈值时以非零状态码退出。
+
+默认使用随机权重的微型 Qwen2.5-VL 模型（benchmarks/tiny_model.py），完全离线、CPU即可运行；
+每次请求固定生成 max_new_tokens 个token（min_new_tokens = max_new_tokens），结果不受随机回答长度影响。
+
+用法:
+    python -m benchmarks.serving_bench --quick
+    python -m benchmarks.serving_bench --output bench.json --baseline benchmarks/baselines/cpu_tiny.json
+    python -m benchmarks.serving_bench --quick --save-baseline benchmarks/baselines/cpu_tiny.json
+    python -m benchmarks.serving_bench --model ../models/Lingshu-7B --quantization 4bit 8bit
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource  # 仅POSIX
+except ImportError:
+    resource = None
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+import torch
+from PIL import Image
+
+from model_manager import ModelManager
+
+# 基准配置：扫描某一项时其余各项固定为此值
+BASE_CASE = {
+    "images": 1,
+    "image_size": 224,
+    "history": 0,
+    "max_new_tokens": 32,
+    "concurrency": 1,
+}
+
+# 逐项扫描的取值
+SWEEP_AXES = {
+    "images": [0, 1, 2, 4],
+    "image_size": [112, 224, 448],
+    "history": [0, 4, 8],
+    "max_new_tokens": [16, 32, 64],
+    "concurrency": [1, 2, 4],
+}
+
+QUICK_SWEEP_AXES = {
+    "images": [0, 1],
+    "max_new_tokens": [16, 32],
+    "concurrency": [1, 2],
+}
+
+TARGETS = ["direct", "http"]
+MODES = ["blocking", "streaming"]
+
+# 回归阈值：相对基线的允许变化比例（延迟/内存越大越差，吞吐量越小越差）
+DEFAULT_THRESHOLDS = {
+    "ttft_p50_s": 0.25,
+    "itl_p50_s": 0.25,
+    "e2e_p50_s": 0.25,
+    "throughput_tok_s": 0.20,
+    "peak_memory_bytes": 0.10,
+}
+HIGHER_IS_BETTER = {"throughput_tok_s"}
+
+
+class MemorySampler:
+    """在后台线程中采样进程内存，记录一段时间内的峰值（CUDA可用时同时记录显存峰值）"""
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current_rss() -> Optional[int]:
+        """当前进程常驻内存（字节，无法获取时为 None）"""
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            if resource is None:
+                return None
+            # 非Linux的POSIX系统：退化为进程生命周期内的最大常驻内存
+            usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return usage if sys.platform == "darwin" else usage * 1024
+
+    def _sample(self):
+        rss = self.current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval_s)
+
+    def __enter__(self):
+        self.peak_rss = self.current_rss()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def peak(self) -> Optional[int]:
+        """峰值内存：GPU上为显存峰值，CPU上为常驻内存峰值（无法获取时为 None）"""
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated()
+        return self.peak_rss
+
+
+def percentile(values, q):
+    """线性插值百分位数，空列表返回None"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def make_images(directory, count, size, seed=0):
+    """生成确定性的合成测试图片（渐变背景 + 随机斑块，模拟医学图像的均匀背景和局部结构）"""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        img = Image.new("RGB", (size, size))
+        pixels = img.load()
+        for y in range(size):
+            for x in range(size):
+                v = (x + y) * 255 // (2 * size)
+                pixels[x, y] = (v, v, v)
+        for _ in range(8):
+            cx, cy, r = rng.randrange(size), rng.randrange(size), rng.randrange(4, max(5, size // 6))
+            color = tuple(rng.randrange(256) for _ in range(3))
+            for y in range(max(0, cy - r), min(size, cy + r)):
+                for x in range(max(0, cx - r), min(size, cx + r)):
+                    pixels[x, y] = color
+        path = os.path.join(directory, f"bench_{size}_{i}.png")
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def make_history(turns):
+    """生成纯文本对话历史（每轮一问一答）"""
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"第{i + 1}个问题：请描述图像中的主要发现。", "has_images": False})
+        history.append({"role": "assistant", "content": f"第{i + 1}个回答：图像中未见明显异常，建议结合临床。"})
+    return history
+
+
+def generation_config(max_new_tokens):
+    """固定长度的贪心解码配置"""
+    return {
+        "max_new_tokens": max_new_tokens,
+        "min_new_tokens": max_new_tokens,
+        "do_sample": False,
+        "repetition_penalty": 1.0,
+    }
+
+
+def count_tokens(manager, text):
+    """回答文本的token数"""
+    return len(manager.processor.tokenizer(text, add_special_tokens=False).input_ids)
+
+
+class DirectTarget:
+    """直接调用 ModelManager"""
+
+    name = "direct"
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def request(self, mode, prompt, image_paths, history, gen_config):
+        start = time.perf_counter()
+        if mode == "blocking":
+            result = self.manager.generate_response_with_history(
+                prompt=prompt, image_paths=list(image_paths), history=history, generation_config=gen_config
+            )
+            end = time.perf_counter()
+            for path in result.get("compressed_paths", []):
+                if os.path.exists(path):
+                    os.remove(path)
+            return {
+                "ok": result.get("success", False),
+                "status": 200 if result.get("success") else 500,
+                "text": result.get("response", ""),
+                "chunk_times": [],
+                "e2e_s": end - start,
+            }
+
+        compressed_paths = []
+        chunks, chunk_times = [], []
+        for chunk in self.manager.generate_response_stream(
+            prompt=prompt, image_paths=list(image_paths), history=history,
+            generation_config=gen_config, compressed_paths_container=compressed_paths
+        ):
+            chunk_times.append(time.perf_counter() - start)
+            chunks.append(chunk)
+        end = time.perf_counter()
+        for path in compressed_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        text = "".join(chunks)
+        return {
+            "ok": not text.startswith("[错误]"),
+            "status": 200,
+            "text": text,
+            "chunk_times": [t for t, c in zip(chunk_times, chunks) if c],
+            "e2e_s": end - start,
+        }
+
+    def close(self):
+        pass
+
+
+class HttpTarget:
+    """通过 Flask test_client 调用 /api/chat 和 /api/chat_stream（包含上传、会话和并发限制开销）"""
+
+    name = "http"
+
+    def __init__(self, manager):
+        import app as app_module
+        self.app_module = app_module
+        self._previous_manager = app_module.model_manager
+        app_module.model_manager = manager
+
+    def _seed_history(self, history):
+        """写入会话历史并返回会话ID"""
+        session_id = f"bench-{time.perf_counter_ns()}-{threading.get_ident()}"
+        self.app_module.conversation_sessions[session_id] = [dict(m) for m in history]
+        return session_id
+
+    def _form(self, prompt, image_paths, session_id, handles):
+        data = {"prompt": prompt, "session_id": session_id}
+        if image_paths:
+            data["images"] = []
+            for path in image_paths:
+                handle = open(path, "rb")
+                handles.append(handle)
+                data["images"].append((handle, os.path.basename(path)))
+        return data
+
+    @contextlib.contextmanager
+    def _generation_config(self, gen_config):
+        """/api/chat 使用 config.GENERATION_CONFIG，基准测试期间临时替换"""
+        config_module = self.app_module.config
+        previous = config_module.GENERATION_CONFIG
+        config_module.GENERATION_CONFIG = gen_config
+        try:
+            yield
+        finally:
+            config_module.GENERATION_CONFIG = previous
+
+    def request(self, mode, prompt, image_paths, history, gen_config):
+        session_id = self._seed_history(history)
+        # 每个请求使用独立的客户端，并发线程之间不共享状态
+        client = self.app_module.app.test_client()
+        handles = []
+        try:
+            data = self._form(prompt, image_paths, session_id, handles)
+            start = time.perf_counter()
+            if mode == "blocking":
+                with self._generation_config(gen_config):
+                    resp = client.post("/api/chat", data=data, content_type="multipart/form-data")
+                end = time.perf_counter()
+                body = resp.get_json(silent=True) or {}
+                return {
+                    "ok": resp.status_code == 200 and body.get("success", False),
+                    "status": resp.status_code,
+                    "text": body.get("response", ""),
+                    "chunk_times": [],
+                    "e2e_s": end - start,
+                }
+
+            data["config"] = json.dumps(gen_config)
+            resp = client.post(
+                "/api/chat_stream", data=data, content_type="multipart/form-data", buffered=False
+            )
+            chunks, chunk_times = [], []
+            status, ok = resp.status_code, False
+            buffer = ""
+            try:
+                for raw in resp.iter_encoded():
+                    buffer += raw.decode("utf-8")
+                    while "\n\n" in buffer:
+                        event, buffer = buffer.split("\n\n", 1)
+                        if not event.startswith("data: "):
+                            continue
+                        payload = json.loads(event[len("data: "):])
+                        if payload.get("chunk"):
+                            chunk_times.append(time.perf_counter() - start)
+                            chunks.append(payload["chunk"])
+                        elif payload.get("done"):
+                            ok = True
+                        elif "error" in payload:
+                            status = 429 if "繁忙" in payload["error"] else 500
+            finally:
+                resp.close()
+            return {
+                "ok": ok,
+                "status": status,
+                "text": "".join(chunks),
+                "chunk_times": chunk_times,
+                "e2e_s": time.perf_counter() - start,
+            }
+        finally:
+            for handle in handles:
+                handle.close()
+            client.post("/api/clear_history", json={"session_id": session_id})
+
+    def close(self):
+        self.app_module.model_manager = self._previous_manager
+
+
+def run_case(manager, target, mode, case, image_paths, repeats):
+    """运行一个扫描点：concurrency 个并发客户端，每个连续发 repeats 个请求"""
+    history = make_history(case["history"])
+    gen_config = generation_config(case["max_new_tokens"])
+    prompt = "请分析这张医学图像并给出诊断建议。" if case["images"] else "请介绍一下高血压的症状和治疗方法。"
+
+    def client(_):
+        return [target.request(mode, prompt, image_paths, history, gen_config) for _ in range(repeats)]
+
+    with MemorySampler() as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=case["concurrency"]) as pool:
+            results = [r for batch in pool.map(client, range(case["concurrency"])) for r in batch]
+        wall = time.perf_counter() - start
+
+    ok = [r for r in results if r["ok"]]
+    ttft = [r["chunk_times"][0] for r in ok if r["chunk_times"]]
+    itl = [b - a for r in ok for a, b in zip(r["chunk_times"], r["chunk_times"][1:])]
+    e2e = [r["e2e_s"] for r in ok]
+    output_tokens = sum(count_tokens(manager, r["text"]) for r in ok)
+
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "rejected": sum(1 for r in results if r["status"] == 429),
+        "errors": sum(1 for r in results if not r["ok"] and r["status"] != 429),
+        "wall_s": wall,
+        "output_tokens": output_tokens,
+        "throughput_tok_s": output_tokens / wall if wall > 0 else 0.0,
+        "ttft_p50_s": percentile(ttft, 50),
+        "ttft_p95_s": percentile(ttft, 95),
+        "itl_p50_s": percentile(itl, 50),
+        "itl_p95_s": percentile(itl, 95),
+        "e2e_p50_s": percentile(e2e, 50),
+        "e2e_p95_s": percentile(e2e, 95),
+        "peak_memory_bytes": sampler.peak(),
+    }
+
+
+def sweep_cases(axes):
+    """基准配置 + 逐项扫描的全部扫描点（去重）"""
+    cases, seen = [], set()
+    for axis, values in [(None, [None])] + list(axes.items()):
+        for value in values:
+            case = dict(BASE_CASE)
+            if axis is not None:
+                case[axis] = value
+            key = tuple(sorted(case.items()))
+            if key not in seen:
+                seen.add(key)
+                cases.append(case)
+    return cases
+
+
+def case_key(target, mode, quantization, case):
+    """扫描点唯一标识（用于与基线对比）"""
+    return (
+        f"{target}/{mode}/q={quantization}/img={case['images']}x{case['image_size']}"
+        f"/hist={case['history']}/tok={case['max_new_tokens']}/conc={case['concurrency']}"
+    )
+
+
+def compare_with_baseline(report, baseline, thresholds):
+    """
+    与基线对比
+
+    Returns:
+        回归列表 [{"case", "metric", "baseline", "current", "change"}]
+    """
+    regressions = []
+    for key, current in report["results"].items():
+        reference = baseline.get("results", {}).get(key)
+        if not reference:
+            continue
+        for metric, threshold in thresholds.items():
+            base_value, value = reference.get(metric), current.get(metric)
+            if not base_value or value is None:
+                continue
+            change = (value - base_value) / base_value
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions.append({
+                    "case": key,
+                    "metric": metric,
+                    "baseline": base_value,
+                    "current": value,
+                    "change": change,
+                })
+    return regressions
+
+
+def parse_thresholds(items):
+    """解析 --threshold metric=ratio"""
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for item in items or []:
+        metric, _, value = item.partition("=")
+        if metric not in DEFAULT_THRESHOLDS:
+            raise ValueError(f"未知指标: {metric}，可选: {list(DEFAULT_THRESHOLDS)}")
+        thresholds[metric] = float(value)
+    return thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端服务基准测试")
+    parser.add_argument("--model", type=str, default=None, help="模型路径（默认构建随机权重的微型模型）")
+    parser.add_argument("--quantization", nargs="+", default=None,
+                        help="扫描的权重量化模式（默认CPU上为cpu，GPU上为 standard 8bit 4bit）")
+    parser.add_argument("--engine-mode", type=str, default="eager", help="推理引擎模式 (eager, static, chunked)")
+    parser.add_argument("--targets", nargs="+", default=TARGETS, choices=TARGETS, help="直接调用 / HTTP")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES, help="阻塞 / 流式")
+    parser.add_argument("--repeats", type=int, default=3, help="每个并发客户端连续发送的请求数")
+    parser.add_argument("--quick", action="store_true", help="缩小扫描范围（CI冒烟测试）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", type=str, default="serving_bench.json", help="结果输出JSON文件")
+    parser.add_argument("--baseline", type=str, default=None, help="基线JSON文件，超出阈值时以状态码1退出")
+    parser.add_argument("--save-baseline", type=str, default=None, help="将本次结果保存为基线")
+    parser.add_argument("--threshold", action="append", default=[], help="回归阈值，如 ttft_p50_s=0.3（可多次指定）")
+    args = parser.parse_args()
+
+    thresholds = parse_thresholds(args.threshold)
+    torch.manual_seed(args.seed)
+
+    model_path = args.model
+    if model_path is None:
+        from benchmarks.tiny_model import build_tiny_model
+        model_path = build_tiny_model(seed=args.seed)
+        print(f"🧪 使用微型随机模型: {model_path}")
+
+    quantizations = args.quantization or (["standard", "8bit", "4bit"] if torch.cuda.is_available() else ["cpu"])
+    axes = QUICK_SWEEP_AXES if args.quick else SWEEP_AXES
+    cases = sweep_cases(axes)
+    max_image_size = max(axes.get("image_size", [BASE_CASE["image_size"]]))
+
+    report = {
+        "environment": {
+            "model": os.path.abspath(model_path),
+            "device": torch.cuda.get_device_name(0) if torch.cuda.is_available() else platform.processor() or "cpu",
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "engine_mode": args.engine_mode,
+            "repeats": args.repeats,
+        },
+        "results": {},
+    }
+
+    image_dir = tempfile.mkdtemp(prefix="lingshu_bench_")
+    try:
+        for quantization in quantizations:
+            print(f"\n▶️ 权重量化模式: {quantization}")
+            manager = ModelManager(
+                model_path=model_path,
+                quantization=quantization,
+                max_pixels=max_image_size * max_image_size,
+                engine_mode=args.engine_mode,
+            )
+            if not manager.load_model():
+                print(f"❌ 模型加载失败，跳过: {quantization}")
+                continue
+
+            try:
+                # 预热（首次调用的内核选择/编译不计入结果）
+                warmup_images = make_images(image_dir, 1, BASE_CASE["image_size"], args.seed)
+                DirectTarget(manager).request("blocking", "预热", warmup_images, [], generation_config(4))
+
+                for target_name in args.targets:
+                    target = DirectTarget(manager) if target_name == "direct" else HttpTarget(manager)
+                    try:
+                        for mode in args.modes:
+                            for case in cases:
+                                image_paths = make_images(image_dir, case["images"], case["image_size"], args.seed)
+                                key = case_key(target_name, mode, quantization, case)
+                                result = run_case(manager, target, mode, case, image_paths, args.repeats)
+                                report["results"][key] = {**case, "quantization": quantization, **result}
+                                ttft = result["ttft_p50_s"]
+                                peak = result["peak_memory_bytes"]
+                                print(f"  {key}: e2e p50 {result['e2e_p50_s'] or 0:.3f}s, "
+                                      f"TTFT p50 {f'{ttft:.3f}s' if ttft is not None else '-'}, "
+                                      f"{result['throughput_tok_s']:.1f} tok/s, "
+                                      f"峰值内存 {f'{peak / 1024**2:.0f} MB' if peak is not None else '不可用'}, "
+                                      f"拒绝 {result['rejected']}, 错误 {result['errors']}")
+                    finally:
+                        target.close()
+            finally:
+                manager.unload_model()
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已保存: {args.output}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 基线已保存: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("environment", {}).get("device") != report["environment"]["device"]:
+            print("⚠️  基线与本次运行的设备不同，对比结果仅供参考")
+        regressions = compare_with_baseline(report, baseline, thresholds)
+        if regressions:
+            print(f"\n❌ 发现 {len(regressions)} 项性能回归:")
+            for r in regressions:
+                print(f"  {r['case']} {r['metric']}: {r['baseline']:.4g} → {r['current']:.4g} ({r['change']:+.1%})")
+            sys.exit(1)
+        print("\n✅ 未发现超出阈值的性能回归")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+构建随机权重的微型 Qwen2.5-VL 模型（完全离线，CPU可运行）
+
+结构与 Lingshu-7B 相同（视觉编码器 + M-RoPE 语言模型 + 同样的聊天模板和特殊token），
+只是层数和隐藏维度极小，权重随机初始化，分词器为字节级BPE（不含合并规则）。
+用于在没有GPU、没有网络的环境下测试服务端代码路径和做性能回归基准。
+
+用法:
+    python -m benchmarks.tiny_model --output benchmarks/.tiny_model
+    # 同时生成随机权重的LoRA适配器（测试多适配器服务，需要 peft）
+    python -m benchmarks.tiny_model --adapters dermatology pathology chest
+"""
+
+import os
+import json
+import inspect
+import argparse
+from typing import Dict, List
+
+import torch
+from transformers import (
+    Qwen2_5_VLConfig,
+    Qwen2_5_VLForConditionalGeneration,
+    Qwen2_5_VLProcessor,
+    Qwen2VLImageProcessor,
+    Qwen2TokenizerFast,
+    GenerationConfig,
+)
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+
+DEFAULT_TINY_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tiny_model")
+
+# 微型模型版本号，结构参数变化时递增以触发重建
+TINY_MODEL_VERSION = 1
+
+SPECIAL_TOKENS = [
+    "<|endoftext|>",
+    "<|im_start|>",
+    "<|im_end|>",
+    "<|vision_start|>",
+    "<|vision_end|>",
+    "<|image_pad|>",
+    "<|video_pad|>",
+]
+
+# 与 Qwen2.5-VL 相同的聊天模板
+CHAT_TEMPLATE = (
+    "{% set image_count = namespace(value=0) %}{% set video_count = namespace(value=0) %}"
+    "{% for message in messages %}{% if loop.first and message['role'] != 'system' %}"
+    "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n{% endif %}"
+    "<|im_start|>{{ message['role'] }}\n"
+    "{% if message['content'] is string %}{{ message['content'] }}<|im_end|>\n"
+    "{% else %}{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' or 'image' in content or 'image_url' in content %}"
+    "{% set image_count.value = image_count.value + 1 %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% elif content['type'] == 'video' or 'video' in content %}"
+    "{% set video_count.value = video_count.value + 1 %}<|vision_start|><|video_pad|><|vision_end|>"
+    "{% elif 'text' in content %}{{ content['text'] }}{% endif %}{% endfor %}<|im_end|>\n{% endif %}"
+    "{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+# 语言模型结构（head_dim = 64 / 4 = 16，mrope_section 之和为 head_dim / 2）
+TEXT_CONFIG = {
+    "hidden_size": 64,
+    "intermediate_size": 128,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "max_position_embeddings": 8192,
+    "rope_theta": 1000000.0,
+    "rope_scaling": {"type": "mrope", "mrope_section": [2, 3, 3]},
+    "tie_word_embeddings": True,
+}
+
+# 视觉编码器结构（patch、合并、窗口参数与原模型一致）
+VISION_CONFIG = {
+    "depth": 2,
+    "hidden_size": 32,
+    "intermediate_size": 64,
+    "num_heads": 2,
+    "out_hidden_size": 64,
+    "patch_size": 14,
+    "spatial_merge_size": 2,
+    "temporal_patch_size": 2,
+    "window_size": 112,
+    "fullatt_block_indexes": [1],
+    "in_chans": 3,
+}
+
+
+def build_tokenizer() -> Qwen2TokenizerFast:
+    """构建字节级BPE分词器（256个字节token + Qwen特殊token）"""
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {ch: i for i, ch in enumerate(alphabet)}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=True)
+    backend.decoder = decoders.ByteLevel()
+
+    return Qwen2TokenizerFast(
+        tokenizer_object=backend,
+        unk_token=None,
+        bos_token=None,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=SPECIAL_TOKENS,
+    )
+
+
+def build_processor(tokenizer: Qwen2TokenizerFast) -> Qwen2_5_VLProcessor:
+    """构建处理器（图像处理参数与原模型一致）"""
+    kwargs = {
+        "image_processor": Qwen2VLImageProcessor(),
+        "tokenizer": tokenizer,
+        "chat_template": CHAT_TEMPLATE,
+    }
+    # transformers 4.52+ 的处理器需要单独的视频处理器
+    if "video_processor" in inspect.signature(Qwen2_5_VLProcessor.__init__).parameters:
+        from transformers import Qwen2VLVideoProcessor
+        kwargs["video_processor"] = Qwen2VLVideoProcessor()
+    return Qwen2_5_VLProcessor(**kwargs)
+
+
+def build_tiny_model(output_dir: str = DEFAULT_TINY_MODEL_DIR, seed: int = 0, force: bool = False) -> str:
+    """
+    构建并保存微型模型（已存在且版本一致时直接复用）
+
+    Args:
+        output_dir: 保存目录
+        seed: 随机权重种子（同一种子生成完全相同的权重）
+        force: 强制重建
+
+    Returns:
+        模型目录
+    """
+    marker = os.path.join(output_dir, "tiny_model.json")
+    if not force and os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("version") == TINY_MODEL_VERSION and info.get("seed") == seed:
+            return output_dir
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = build_tokenizer()
+    processor = build_processor(tokenizer)
+
+    token_id = tokenizer.convert_tokens_to_ids
+    config = Qwen2_5_VLConfig(
+        vocab_size=len(tokenizer),
+        vision_config=VISION_CONFIG,
+        image_token_id=token_id("<|image_pad|>"),
+        video_token_id=token_id("<|video_pad|>"),
+        vision_start_token_id=token_id("<|vision_start|>"),
+        vision_end_token_id=token_id("<|vision_end|>"),
+        bos_token_id=token_id("<|endoftext|>"),
+        eos_token_id=token_id("<|im_end|>"),
+        pad_token_id=token_id("<|endoftext|>"),
+        torch_dtype="float32",
+        **TEXT_CONFIG,
+    )
+
+    torch.manual_seed(seed)
+    model = Qwen2_5_VLForConditionalGeneration(config)
+    model.generation_config = GenerationConfig(
+        eos_token_id=[token_id("<|im_end|>"), token_id("<|endoftext|>")],
+        pad_token_id=token_id("<|endoftext|>"),
+    )
+    model.save_pretrained(output_dir)
+    processor.save_pretrained(output_dir)
+
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump({"version": TINY_MODEL_VERSION, "seed": seed}, f)
+    return output_dir
+
+
+def build_tiny_adapters(model_dir: str, names: List[str], seed: int = 0, rank: int = 4) -> Dict[str, str]:
+    """
+    为微型模型生成随机权重的LoRA适配器（权重非零，不同适配器的输出不同）
+
+    目标模块同时包含语言模型和视觉编码器中的 down_proj，用于验证服务端只加载语言模型部分。
+
+    Args:
+        model_dir: build_tiny_model() 生成的模型目录
+        names: 适配器名列表
+        seed: 随机种子
+        rank: LoRA秩
+
+    Returns:
+        {适配器名: 适配器目录}，可直接用作 config.LORA_ADAPTERS
+    """
+    from peft import LoraConfig, get_peft_model
+
+    adapters = {}
+    for index, name in enumerate(names):
+        path = os.path.join(model_dir, "adapters", name)
+        adapters[name] = path
+        if os.path.exists(os.path.join(path, "adapter_config.json")):
+            continue
+        torch.manual_seed(seed + index + 1)
+        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_dir, torch_dtype=torch.float32)
+        lora_config = LoraConfig(
+            r=rank,
+            lora_alpha=rank * 2,
+            target_modules=["q_proj", "v_proj", "down_proj"],
+            init_lora_weights=False,
+        )
+        get_peft_model(model, lora_config).save_pretrained(path)
+    return adapters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="构建随机权重的微型 Qwen2.5-VL 模型")
+    parser.add_argument("--output", type=str, default=DEFAULT_TINY_MODEL_DIR, help="保存目录")
+    parser.add_argument("--seed", type=int, default=0, help="随机权重种子")
+    parser.add_argument("--force", action="store_true", help="强制重建")
+    parser.add_argument("--adapters", nargs="*", default=[], help="同时生成的LoRA适配器名")
+    args = parser.parse_args()
+
+    path = build_tiny_model(args.output, args.seed, args.force)
+    print(f"✅ 微型模型已保存: {path}")
+    if args.adapters:
+        adapters = build_tiny_adapters(path, args.adapters, args.seed)
+        print(f"✅ LoRA适配器已保存（可用作 LORA_ADAPTERS）: {json.dumps(adapters, ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+视觉token剪枝评估
+
+在 datasets/extract_sample_images.py 提取的MedMNIST示例图片上，
+分别以直通模式和不同保留比例的剪枝模式进行贪心解码，
+报告预填充token节省量，以及与直通模式回答的一致率。
+
+用法:
+    python datasets/extract_sample_images.py --npz datasets/medmnist_data/chestmnist.npz --output test_images
+    cd web_interface
+    python -m benchmarks.token_pruning_eval --model ../models/Lingshu-7B --images ../test_images
+"""
+
+import os
+import sys
+import json
+import argparse
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from model_manager import ModelManager
+from token_pruning import VisualTokenPruner, PRUNING_MODES
+from benchmarks.kv_cache_quality import agreement
+
+DEFAULT_PROMPT = "请描述这张医学图像的主要发现。"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def run_samples(manager, image_paths, prompt, max_new_tokens):
+    """对每张示例图片生成一次回答，记录预填充token数"""
+    results = []
+    for image_path in image_paths:
+        result = manager.generate_response_with_history(
+            prompt=prompt,
+            image_paths=[image_path],
+            history=[],
+            generation_config={"max_new_tokens": max_new_tokens, "do_sample": False, "repetition_penalty": 1.0}
+        )
+        for path in result.get("compressed_paths", []):
+            if os.path.exists(path):
+                os.remove(path)
+        prefill = result.get("prefill") or {"tokens": 0, "saved": 0}
+        results.append({
+            "image": os.path.basename(image_path),
+            "response": result.get("response", ""),
+            "prefill_tokens": prefill["tokens"],
+            "prefill_tokens_saved": prefill["saved"]
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="视觉token剪枝评估")
+    parser.add_argument("--model", type=str, required=True, help="模型路径")
+    parser.add_argument("--quantization", type=str, default="4bit", help="权重量化模式 (4bit, 8bit, standard, cpu)")
+    parser.add_argument("--images", type=str, default="test_images", help="示例图片目录（extract_sample_images.py的输出）")
+    parser.add_argument("--num", type=int, default=10, help="最多评估的图片数")
+    parser.add_argument("--prompt", type=str, default=DEFAULT_PROMPT, help="评估问题")
+    parser.add_argument("--modes", nargs="+", default=["variance", "merge"], choices=PRUNING_MODES[1:], help="剪枝模式")
+    parser.add_argument("--keep-ratios", nargs="+", type=float, default=[0.75, 0.5, 0.25], help="保留比例")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="最大生成token数")
+    parser.add_argument("--output", type=str, default="token_pruning_eval.json", help="结果输出JSON文件")
+    args = parser.parse_args()
+
+    image_paths = sorted(
+        os.path.join(args.images, name) for name in os.listdir(args.images)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:args.num]
+    if not image_paths:
+        print(f"❌ 目录中没有图片: {args.images}")
+        return
+
+    manager = ModelManager(model_path=args.model, quantization=args.quantization, engine_mode="chunked")
+    if not manager.load_model():
+        print("❌ 模型加载失败")
+        return
+
+    print(f"▶️ 直通模式 ({len(image_paths)} 张图片)")
+    manager.token_pruner = VisualTokenPruner("off")
+    reference = run_samples(manager, image_paths, args.prompt, args.max_new_tokens)
+    report = {"prompt": args.prompt, "images": len(image_paths), "passthrough": reference, "pruned": []}
+
+    for mode in args.modes:
+        for ratio in args.keep_ratios:
+            print(f"▶️ 剪枝模式: {mode}, 保留比例: {ratio}")
+            manager.token_pruner = VisualTokenPruner(mode, ratio)
+            results = run_samples(manager, image_paths, args.prompt, args.max_new_tokens)
+            total = sum(r["prefill_tokens"] + r["prefill_tokens_saved"] for r in results)
+            saved = sum(r["prefill_tokens_saved"] for r in results)
+            entry = {
+                "mode": mode,
+                "keep_ratio": ratio,
+                "prefill_tokens_saved": saved,
+                "prefill_saved_fraction": saved / total if total else 0.0,
+                "agreement": agreement(reference, results),
+                "results": results
+            }
+            report["pruned"].append(entry)
+            print(f"  节省预填充token: {saved} ({entry['prefill_saved_fraction']:.1%}), "
+                  f"一致率: {entry['agreement']['exact_match']:.2%}, "
+                  f"相似度: {entry['agreement']['mean_similarity']:.3f}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已保存: {args.output}")
+    manager.unload_model()
+
+
+if __name__ == "__main__":
+    main()
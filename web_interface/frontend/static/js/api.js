@@ -3,6 +3,8 @@
  */
 
 const API_BASE_URL = '';  // 使用相对路径
+const STREAM_RESUME_MAX_RETRIES = 5;  // 流式连接中断后的续传重试次数
+const STREAM_RESUME_DELAY_MS = 1000;  // 续传重试的基础等待时间（第n次等待 n 倍）
 
 /**
  * API客户端类
@@ -183,27 +185,22 @@ class APIClient {
             formData.append('session_id', sessionId);
         }
         
-        try {
-            const response = await fetch(`${this.baseURL}/api/chat_stream`, {
-                method: 'POST',
-                body: formData,
-                signal: signal  // 添加中止信号支持
-            });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            
+        let requestId = null;
+        let returnSessionId = null;
+        let lastEventId = 0;  // 最后处理的事件ID，断线重连时作为 Last-Event-ID
+        
+        // 读取一个SSE响应，收到完成或错误事件时返回 true，连接提前结束时返回 false
+        const readEvents = async (response) => {
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
             let buffer = '';
-            let returnSessionId = null;
+            let eventId = null;
             
             while (true) {
                 const { value, done } = await reader.read();
                 
                 if (done) {
-                    break;
+                    return false;
                 }
                 
                 // 解码数据
@@ -214,21 +211,29 @@ class APIClient {
                 buffer = lines.pop() || '';  // 保留最后一行（可能不完整）
                 
                 for (const line of lines) {
-                    if (line.startsWith('data: ')) {
+                    if (line.startsWith('id: ')) {
+                        eventId = parseInt(line.substring(4), 10);
+                    } else if (line.startsWith('data: ')) {
                         const dataStr = line.substring(6);
+                        // 先记录断点，回调出错也不会在续传时重复处理该事件
+                        if (eventId !== null) {
+                            lastEventId = eventId;
+                            eventId = null;
+                        }
                         try {
                             const data = JSON.parse(dataStr);
                             
                             if (data.session_id) {
                                 returnSessionId = data.session_id;
+                                requestId = data.request_id || requestId;
                             } else if (data.chunk) {
                                 onChunk(data.chunk);
                             } else if (data.done) {
                                 onComplete(returnSessionId);
-                                return;
+                                return true;
                             } else if (data.error) {
                                 onError(data.error);
-                                return;
+                                return true;
                             }
                         } catch (e) {
                             console.error('解析SSE数据失败:', e, dataStr);
@@ -236,11 +241,45 @@ class APIClient {
                     }
                 }
             }
+        };
+        
+        try {
+            let response = await fetch(`${this.baseURL}/api/chat_stream`, {
+                method: 'POST',
+                body: formData,
+                signal: signal  // 添加中止信号支持
+            });
+            
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            
+            while (true) {
+                try {
+                    if (await readEvents(response)) {
+                        return;
+                    }
+                } catch (error) {
+                    if (error.name === 'AbortError') {
+                        throw error;
+                    }
+                    console.warn('流式连接中断:', error);
+                }
+                
+                // 连接中断但回复未完成：生成在服务器端继续，从断点续传
+                if (!requestId) {
+                    throw new Error('连接中断，未收到回复');
+                }
+                response = await this.resumeStream(requestId, returnSessionId || sessionId, lastEventId, signal);
+            }
             
         } catch (error) {
-            // 检查是否是用户主动中止
+            // 检查是否是用户主动中止（断开连接不会停止服务器端的生成，需要显式停止）
             if (error.name === 'AbortError') {
                 console.log('请求已被用户中止');
+                if (requestId) {
+                    this.cancelStream(requestId, returnSessionId || sessionId);
+                }
                 onError('已中止生成');
                 return;
             }
@@ -248,6 +287,65 @@ class APIClient {
             onError(error.message);
         }
     }
+
+    /**
+     * 断线续传：带 Last-Event-ID 重新连接流式回复（逐次延长等待，最多重试 STREAM_RESUME_MAX_RETRIES 次）
+     * @param {string} requestId - 流式请求ID（首个事件中返回）
+     * @param {string|null} sessionId - 会话ID（多实例路由时用于找到生成该流的实例）
+     * @param {number} lastEventId - 最后处理的事件ID
+     * @param {AbortSignal} signal - 中止信号（可选）
+     * @returns {Promise<Response>} 续传的SSE响应
+     */
+    async resumeStream(requestId, sessionId, lastEventId, signal = null) {
+        const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : '';
+        
+        for (let attempt = 1; attempt <= STREAM_RESUME_MAX_RETRIES; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, STREAM_RESUME_DELAY_MS * attempt));
+            if (signal && signal.aborted) {
+                throw new DOMException('已中止生成', 'AbortError');
+            }
+            
+            let response;
+            try {
+                response = await fetch(`${this.baseURL}/api/chat_stream/${requestId}${query}`, {
+                    method: 'GET',
+                    headers: { 'Last-Event-ID': String(lastEventId) },
+                    signal: signal
+                });
+            } catch (error) {
+                if (error.name === 'AbortError') {
+                    throw error;
+                }
+                console.warn(`续传失败（第${attempt}次）:`, error);
+                continue;
+            }
+            
+            if (response.ok) {
+                console.log(`流式回复已续传（断点事件ID: ${lastEventId}）`);
+                return response;
+            }
+            if (response.status === 404) {
+                throw new Error('连接中断，回复已过期，请重新提问');
+            }
+            console.warn(`续传失败（第${attempt}次）: HTTP ${response.status}`);
+        }
+        
+        throw new Error('连接中断，续传失败');
+    }
+
+    /**
+     * 停止生成（断开连接不会中止服务器端的生成）
+     * @param {string} requestId - 流式请求ID
+     * @param {string|null} sessionId - 会话ID（可选）
+     */
+    async cancelStream(requestId, sessionId = null) {
+        const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : '';
+        try {
+            await fetch(`${this.baseURL}/api/chat_stream/${requestId}/cancel${query}`, { method: 'POST' });
+        } catch (error) {
+            console.warn('停止生成请求失败:', error);
+        }
+    }
 }
 
 // 创建全局API客户端实例
@@ -770,6 +770,27 @@ async function handleClearChat() {
     }
 }
 
+/**
+ * 是否为DICOM文件（浏览器通常不识别其MIME类型，按扩展名判断）
+ */
+function isDicomFile(file) {
+    return /\.(dcm|dicom)$/i.test(file.name) || file.type === 'application/dicom';
+}
+
+/**
+ * 是否为CT/MR序列（切片压缩包或NumPy体数据，作为视频帧输入模型）
+ */
+function isSeriesFile(file) {
+    return /\.(zip|npy)$/i.test(file.name);
+}
+
+/**
+ * 是否为全切片/超大显微图像（上传大小上限放宽，后端按块读取）
+ */
+function isSlideFile(file) {
+    return /\.(svs|ndpi|scn|bif|tif|tiff)$/i.test(file.name);
+}
+
 /**
  * 处理多图片选择
  */
@@ -790,14 +811,14 @@ function handleImageSelect(e) {
     // 验证每个文件
     for (const file of files) {
         // 检查文件类型
-        if (!file.type.startsWith('image/')) {
+        if (!file.type.startsWith('image/') && !isDicomFile(file) && !isSeriesFile(file) && !isSlideFile(file)) {
             showNotification('只能选择图片文件', 'error');
             return;
         }
         
-        // 检查文件大小（16MB）
-        if (file.size > 16 * 1024 * 1024) {
-            showNotification('图片文件过大，请选择小于16MB的图片', 'error');
+        // 检查文件大小（16MB，切片文件4GB）
+        if (isSlideFile(file) ? file.size > 4 * 1024 * 1024 * 1024 : file.size > 16 * 1024 * 1024) {
+            showNotification(isSlideFile(file) ? '切片文件过大，请选择小于4GB的文件' : '图片文件过大，请选择小于16MB的图片', 'error');
             return;
         }
     }
@@ -833,29 +854,35 @@ function updateImagePreview() {
     
     // 显示每张图片的预览
     appState.currentImages.forEach((file, index) => {
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            const itemDiv = document.createElement('div');
-            itemDiv.className = 'image-preview-item';
-            
-            const img = document.createElement('img');
-            img.src = e.target.result;
+        const itemDiv = document.createElement('div');
+        itemDiv.className = 'image-preview-item';
+        
+        // 浏览器无法直接显示DICOM、序列和切片，用文件名占位（不读取文件内容，切片可能有数GB）
+        let img;
+        if (isDicomFile(file) || isSeriesFile(file) || isSlideFile(file)) {
+            img = document.createElement('div');
+            img.className = 'dicom-preview';
+            img.textContent = `${isSeriesFile(file) ? '序列' : isDicomFile(file) ? 'DICOM' : '切片'}\n${file.name}`;
+            img.title = file.name;
+        } else {
+            img = document.createElement('img');
+            img.src = URL.createObjectURL(file);
+            img.onload = () => URL.revokeObjectURL(img.src);
             img.alt = `预览图片 ${index + 1}`;
-            
-            const removeBtn = document.createElement('button');
-            removeBtn.className = 'remove-image-btn';
-            removeBtn.textContent = '✕';
-            removeBtn.title = '移除此图片';
-            removeBtn.onclick = (e) => {
-                e.stopPropagation();
-                handleRemoveSingleImage(index);
-            };
-            
-            itemDiv.appendChild(img);
-            itemDiv.appendChild(removeBtn);
-            elements.imagePreviewList.appendChild(itemDiv);
+        }
+        
+        const removeBtn = document.createElement('button');
+        removeBtn.className = 'remove-image-btn';
+        removeBtn.textContent = '✕';
+        removeBtn.title = '移除此图片';
+        removeBtn.onclick = (e) => {
+            e.stopPropagation();
+            handleRemoveSingleImage(index);
         };
-        reader.readAsDataURL(file);
+        
+        itemDiv.appendChild(img);
+        itemDiv.appendChild(removeBtn);
+        elements.imagePreviewList.appendChild(itemDiv);
     });
     
     elements.imagePreviewContainer.classList.remove('hidden');
@@ -1,12 +1,28 @@
 """
 Lingshu-7B 模型测试脚本
 支持多种加载方式：标准加载、量化加载、CPU加载
+
+交互模式:
+    python 2_测试模型.py
+
+非交互批量模式（所有问题左填充后一次批量生成）:
+    python 2_测试模型.py --batch --prompts "问题1" "问题2"
+    python 2_测试模型.py --batch --prompts-file prompts.txt --mode 4bit
 """
 
 import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList
 import os
 import sys
+import time
+import argparse
+
+# 预设测试问题
+DEFAULT_PROMPTS = [
+    "请介绍一下高血压的症状和治疗方法。",
+    "感冒和流感有什么区别？",
+    "糖尿病患者应该注意哪些饮食问题？"
+]
 
 def check_gpu():
     """检查GPU可用性"""
@@ -88,11 +104,7 @@ def test_inference(model, processor):
     print("=" * 60)
     
     # 测试问题列表
-    test_prompts = [
-        "请介绍一下高血压的症状和治疗方法。",
-        "感冒和流感有什么区别？",
-        "糖尿病患者应该注意哪些饮食问题？"
-    ]
+    test_prompts = list(DEFAULT_PROMPTS)
     
     print("\n请选择测试方式：")
     print("1. 使用预设问题测试")
@@ -173,6 +185,154 @@ def test_inference(model, processor):
             import traceback
             traceback.print_exc()
 
+class RowFinishTimer(StoppingCriteria):
+    """记录批量生成中每一行首次生成结束token的时间（不提前停止生成）"""
+    
+    def __init__(self, eos_token_ids, batch_size, start_time):
+        self.eos_token_ids = set(eos_token_ids)
+        self.finish_times = [None] * batch_size
+        self.start_time = start_time
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        for row, token_id in enumerate(input_ids[:, -1].tolist()):
+            if self.finish_times[row] is None and token_id in self.eos_token_ids:
+                self.finish_times[row] = now - self.start_time
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def batch_inference(model, processor, prompts, max_new_tokens=512):
+    """
+    所有问题一次批量生成
+    
+    Returns:
+        (回答列表, 每个问题的延迟列表, 生成token总数, 总耗时)
+    """
+    texts = [
+        processor.apply_chat_template(
+            [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+            tokenize=False, add_generation_prompt=True
+        )
+        for prompt in prompts
+    ]
+    
+    # 左填充，使所有问题的生成起点对齐
+    processor.tokenizer.padding_side = "left"
+    inputs = processor.tokenizer(texts, padding=True, return_tensors="pt")
+    inputs = inputs.to(model.device)
+    
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, (list, tuple)):
+        eos_token_ids = [eos_token_ids]
+    
+    start_time = time.perf_counter()
+    timer = RowFinishTimer(eos_token_ids, len(prompts), start_time)
+    with torch.no_grad():
+        generated_ids = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            temperature=0.7,
+            top_p=0.9,
+            do_sample=True,
+            repetition_penalty=1.1,
+            stopping_criteria=StoppingCriteriaList([timer])
+        )
+    total_time = time.perf_counter() - start_time
+    
+    # 提取生成的文本（左填充后所有行的输入长度相同）
+    generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[-1]:]
+    responses = processor.batch_decode(
+        generated_ids_trimmed,
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+    
+    # 统计每行到结束token为止的生成token数
+    generated_tokens = 0
+    for row in generated_ids_trimmed.tolist():
+        length = len(row)
+        for i, token_id in enumerate(row):
+            if token_id in eos_token_ids:
+                length = i + 1
+                break
+        generated_tokens += length
+    
+    latencies = [t if t is not None else total_time for t in timer.finish_times]
+    return responses, latencies, generated_tokens, total_time
+
+
+def read_prompts(args):
+    """从命令行或文件读取问题列表（文件每行一个问题）"""
+    prompts = list(args.prompts or [])
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts.extend(line.strip() for line in f if line.strip())
+    return prompts or list(DEFAULT_PROMPTS)
+
+
+def default_mode():
+    """非交互模式下的默认加载模式（与交互模式的推荐一致）"""
+    has_gpu, gpu_memory = check_gpu()
+    if not has_gpu:
+        return "cpu"
+    return "8bit" if gpu_memory < 14 else "standard"
+
+
+def run_batch_mode(args):
+    """非交互批量模式"""
+    print("=" * 60)
+    print("Lingshu-7B 模型批量测试")
+    print("=" * 60)
+    
+    if not os.path.exists(args.model):
+        print(f"\n❌ 错误: 未找到模型文件")
+        print(f"路径: {os.path.abspath(args.model)}")
+        print("\n请先运行 '1_下载模型.py' 下载模型")
+        return
+    
+    prompts = read_prompts(args)
+    mode = args.mode or default_mode()
+    model, processor = load_model(args.model, mode)
+    
+    print(f"\n💭 {len(prompts)} 个问题批量生成中...")
+    try:
+        responses, latencies, tokens, elapsed = batch_inference(
+            model, processor, prompts, args.max_new_tokens
+        )
+    except Exception as e:
+        print(f"\n❌ 推理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return
+    
+    for i, (prompt, response, latency) in enumerate(zip(prompts, responses, latencies), 1):
+        print(f"\n{'=' * 60}")
+        print(f"测试 {i}/{len(prompts)}")
+        print(f"{'=' * 60}")
+        print(f"❓ 问题: {prompt}")
+        print(f"⏱️  延迟: {latency:.2f} 秒")
+        print("-" * 60)
+        print(response)
+        print("-" * 60)
+    
+    print("\n" + "=" * 60)
+    print(f"📊 总计: {len(prompts)} 个问题, {elapsed:.2f} 秒")
+    print(f"   吞吐量: {tokens / elapsed:.1f} tokens/秒, {len(prompts) / elapsed:.2f} 问题/秒")
+    print("=" * 60)
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="Lingshu-7B 模型测试工具")
+    parser.add_argument("--batch", action="store_true", help="非交互批量模式")
+    parser.add_argument("--prompts", nargs="+", help="问题列表（默认使用预设问题）")
+    parser.add_argument("--prompts-file", type=str, help="问题文件，每行一个问题")
+    parser.add_argument("--mode", type=str, choices=["standard", "8bit", "4bit", "cpu"], help="加载模式（默认按显存自动选择）")
+    parser.add_argument("--model", type=str, default="../models/Lingshu-7B", help="模型路径")
+    parser.add_argument("--max-new-tokens", type=int, default=512, help="最大生成token数")
+    return parser.parse_args()
+
+
 def main():
     """主函数"""
     print("=" * 60)
@@ -254,5 +414,9 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.batch:
+        run_batch_mode(args)
+    else:
+        main()
 
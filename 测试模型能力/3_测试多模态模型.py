@@ -1,13 +1,31 @@
 """
 Lingshu-7B 多模态模型测试脚本
 支持图像输入和病症询问
+
+交互模式:
+    python 3_测试多模态模型.py
+
+非交互批量模式（每张图片只预处理一次、视觉编码器只运行一次，同一图片的所有问题左填充后一次批量生成）:
+    python 3_测试多模态模型.py --batch --images a.png b.png --prompts "问题1" "问题2"
+    python 3_测试多模态模型.py --batch --images a.png --prompts-file prompts.txt --mode 4bit
 """
 
 import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList
 from qwen_vl_utils import process_vision_info
 import os
 import sys
+import time
+import argparse
+import contextlib
+
+# 预设测试问题
+DEFAULT_PROMPTS = [
+    "这张图像显示了什么病症？请详细描述。",
+    "根据图像，患者可能出现哪些异常症状？",
+    "请分析这张医学图像并给出诊断建议。",
+    "这张图像中的主要发现是什么？"
+]
 
 def check_gpu():
     """检查GPU可用性"""
@@ -97,12 +115,7 @@ def test_multimodal_inference(model, processor, image_path):
     print(f"\n🖼️  图像路径: {os.path.abspath(image_path)}")
     
     # 测试问题列表
-    test_prompts = [
-        "这张图像显示了什么病症？请详细描述。",
-        "根据图像，患者可能出现哪些异常症状？",
-        "请分析这张医学图像并给出诊断建议。",
-        "这张图像中的主要发现是什么？"
-    ]
+    test_prompts = list(DEFAULT_PROMPTS)
     
     print("\n请选择测试方式：")
     print("1. 使用预设问题测试（自动使用所有问题）")
@@ -193,6 +206,223 @@ def test_multimodal_inference(model, processor, image_path):
             import traceback
             traceback.print_exc()
 
+class RowFinishTimer(StoppingCriteria):
+    """记录批量生成中每一行首次生成结束token的时间（不提前停止生成）"""
+    
+    def __init__(self, eos_token_ids, batch_size, start_time):
+        self.eos_token_ids = set(eos_token_ids)
+        self.finish_times = [None] * batch_size
+        self.start_time = start_time
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        for row, token_id in enumerate(input_ids[:, -1].tolist()):
+            if self.finish_times[row] is None and token_id in self.eos_token_ids:
+                self.finish_times[row] = now - self.start_time
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def encode_image_once(processor, image_path):
+    """
+    读取、缩放并切分图片（每张图片只处理一次）
+    
+    Returns:
+        (pixel_values, image_grid_thw, 图片占位token数)
+    """
+    image_inputs, _ = process_vision_info([
+        {"role": "user", "content": [{"type": "image", "image": image_path}]}
+    ])
+    image_features = processor.image_processor(images=image_inputs, return_tensors="pt")
+    merge_length = processor.image_processor.merge_size ** 2
+    num_image_tokens = int(image_features["image_grid_thw"][0].prod().item()) // merge_length
+    return image_features["pixel_values"], image_features["image_grid_thw"], num_image_tokens
+
+
+@contextlib.contextmanager
+def shared_image_embeds(model, pixel_values, image_grid_thw, batch_size):
+    """
+    视觉编码器只运行一次：预填充时 model.visual 直接返回缓存的图片特征（按批大小重复），
+    退出时恢复原来的 forward
+    
+    Returns:
+        传给 generate 的 pixel_values（单张图片，只用于触发图片分支）
+    """
+    visual = model.visual
+    pixel_values = pixel_values.to(visual.device, dtype=visual.dtype)
+    with torch.no_grad():
+        image_embeds = visual(pixel_values, grid_thw=image_grid_thw.to(visual.device))
+    batch_embeds = image_embeds.repeat(batch_size, 1)
+    # accelerate 的设备映射可能已经在实例上包装了 forward，退出时原样放回
+    original_forward = visual.__dict__.get("forward")
+    visual.forward = lambda *args, **kwargs: batch_embeds
+    try:
+        yield pixel_values
+    finally:
+        if original_forward is None:
+            del visual.forward
+        else:
+            visual.forward = original_forward
+
+
+def batch_multimodal_inference(model, processor, image_path, prompts, max_new_tokens=512):
+    """
+    同一张图片的所有问题一次批量生成
+    
+    Returns:
+        (回答列表, 每个问题的延迟列表, 生成token总数, 总耗时)
+    """
+    pixel_values, image_grid_thw, num_image_tokens = encode_image_once(processor, image_path)
+    
+    # 构建每个问题的文本，并按图片网格展开图片占位token
+    texts = []
+    for prompt in prompts:
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image_path},
+                    {"type": "text", "text": prompt}
+                ]
+            }
+        ]
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        texts.append(text.replace(processor.image_token, processor.image_token * num_image_tokens))
+    
+    # 左填充，使所有问题的生成起点对齐；每行的图片网格相同（用于计算多模态位置编码）
+    processor.tokenizer.padding_side = "left"
+    inputs = processor.tokenizer(texts, padding=True, return_tensors="pt")
+    inputs["image_grid_thw"] = image_grid_thw.repeat(len(prompts), 1)
+    inputs = inputs.to(model.device)
+    
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, (list, tuple)):
+        eos_token_ids = [eos_token_ids]
+    
+    start_time = time.perf_counter()
+    timer = RowFinishTimer(eos_token_ids, len(prompts), start_time)
+    with torch.no_grad(), shared_image_embeds(model, pixel_values, image_grid_thw, len(prompts)) as shared_pixels:
+        generated_ids = model.generate(
+            **inputs,
+            pixel_values=shared_pixels,
+            max_new_tokens=max_new_tokens,
+            temperature=0.7,
+            top_p=0.9,
+            do_sample=True,
+            repetition_penalty=1.1,
+            stopping_criteria=StoppingCriteriaList([timer])
+        )
+    total_time = time.perf_counter() - start_time
+    
+    # 提取生成的文本（左填充后所有行的输入长度相同）
+    generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[-1]:]
+    responses = processor.batch_decode(
+        generated_ids_trimmed,
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+    
+    # 统计每行到结束token为止的生成token数
+    generated_tokens = 0
+    for row in generated_ids_trimmed.tolist():
+        length = len(row)
+        for i, token_id in enumerate(row):
+            if token_id in eos_token_ids:
+                length = i + 1
+                break
+        generated_tokens += length
+    
+    latencies = [t if t is not None else total_time for t in timer.finish_times]
+    return responses, latencies, generated_tokens, total_time
+
+
+def read_prompts(args):
+    """从命令行或文件读取问题列表（文件每行一个问题）"""
+    prompts = list(args.prompts or [])
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts.extend(line.strip() for line in f if line.strip())
+    return prompts or list(DEFAULT_PROMPTS)
+
+
+def default_mode():
+    """非交互模式下的默认加载模式（与交互模式的推荐一致）"""
+    has_gpu, gpu_memory = check_gpu()
+    if not has_gpu:
+        return "cpu"
+    return "8bit" if gpu_memory < 14 else "standard"
+
+
+def run_batch_mode(args):
+    """非交互批量模式"""
+    print("=" * 60)
+    print("Lingshu-7B 多模态模型批量测试")
+    print("=" * 60)
+    
+    if not os.path.exists(args.model):
+        print(f"\n❌ 错误: 未找到模型文件")
+        print(f"路径: {os.path.abspath(args.model)}")
+        return
+    
+    image_paths = [path for path in args.images if os.path.exists(path)]
+    for path in set(args.images) - set(image_paths):
+        print(f"⚠️  跳过不存在的图像: {path}")
+    if not image_paths:
+        print("\n❌ 错误: 没有可用的图像，请通过 --images 指定")
+        return
+    
+    prompts = read_prompts(args)
+    mode = args.mode or default_mode()
+    model, processor = load_model(args.model, mode)
+    
+    total_tokens = 0
+    total_time = 0.0
+    for image_index, image_path in enumerate(image_paths, 1):
+        print(f"\n{'=' * 60}")
+        print(f"🖼️  图像 {image_index}/{len(image_paths)}: {os.path.abspath(image_path)} ({len(prompts)} 个问题批量生成)")
+        print(f"{'=' * 60}")
+        
+        try:
+            responses, latencies, tokens, elapsed = batch_multimodal_inference(
+                model, processor, image_path, prompts, args.max_new_tokens
+            )
+        except Exception as e:
+            print(f"\n❌ 推理失败: {e}")
+            import traceback
+            traceback.print_exc()
+            continue
+        
+        for prompt, response, latency in zip(prompts, responses, latencies):
+            print(f"\n❓ 问题: {prompt}")
+            print(f"⏱️  延迟: {latency:.2f} 秒")
+            print("-" * 60)
+            print(response)
+            print("-" * 60)
+        
+        total_tokens += tokens
+        total_time += elapsed
+        print(f"\n📊 本图像: {elapsed:.2f} 秒, {tokens} tokens, {tokens / elapsed:.1f} tokens/秒")
+    
+    if total_time > 0:
+        num_requests = len(prompts) * len(image_paths)
+        print("\n" + "=" * 60)
+        print(f"📊 总计: {num_requests} 个问题, {total_time:.2f} 秒")
+        print(f"   吞吐量: {total_tokens / total_time:.1f} tokens/秒, {num_requests / total_time:.2f} 问题/秒")
+        print("=" * 60)
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="Lingshu-7B 多模态模型测试工具")
+    parser.add_argument("--batch", action="store_true", help="非交互批量模式")
+    parser.add_argument("--images", nargs="+", default=["../test_images/示例.jpg"], help="图像路径（可多张）")
+    parser.add_argument("--prompts", nargs="+", help="问题列表（默认使用预设问题）")
+    parser.add_argument("--prompts-file", type=str, help="问题文件，每行一个问题")
+    parser.add_argument("--mode", type=str, choices=["standard", "8bit", "4bit", "cpu"], help="加载模式（默认按显存自动选择）")
+    parser.add_argument("--model", type=str, default="../models/Lingshu-7B", help="模型路径")
+    parser.add_argument("--max-new-tokens", type=int, default=512, help="最大生成token数")
+    return parser.parse_args()
+
+
 def main():
     """主函数"""
     print("=" * 60)
@@ -297,5 +527,9 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.batch:
+        run_batch_mode(args)
+    else:
+        main()
 